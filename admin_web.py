@@ -16,7 +16,17 @@ from config import (
     PUBLIC_SITE_URL,
     TARIFFS,
 )
+from services.remnawave import (
+    remnawave_coalescing_stats,
+    remnawave_resilience_stats,
+    remnawave_user_info_cache_stats,
+)
+from services.admin_counters import last_reconciliation, reconcile_admin_counters_now
+from services.admin_jobs import JOB_HANDLERS, enqueue_admin_job
+from services.batch_executor import background_batch_stats
+from services.remnawave_sync import get_mirror_status
 from services.subscription_adjustment import SubscriptionAdjustmentError, adjust_subscription_days
+from services.telegram_sender import telegram_sender_stats
 from services.subscription_deletion import (
     RemnawaveDeletionError,
     SubscriptionBusyError,
@@ -52,6 +62,11 @@ class ToggleBody(BaseModel):
     active: bool
 
 
+class AdminJobBody(BaseModel):
+    kind: str
+    scope: str = "all"
+
+
 class DiscountBody(BaseModel):
     name: str = Field(min_length=2, max_length=120)
     discount_type: str
@@ -104,12 +119,58 @@ async def admin_session(_: int = Depends(require_admin)):
 
 @router.get("/admin/api/dashboard")
 async def admin_dashboard(_: int = Depends(require_admin)):
-    return _plain(await db.admin_dashboard_stats())
+    stats = _plain(await db.admin_dashboard_stats())
+    stats["reconciliation"] = last_reconciliation()
+    return stats
+
+
+@router.post("/admin/api/dashboard/reconcile")
+async def admin_dashboard_reconcile(_: int = Depends(require_admin)):
+    return await reconcile_admin_counters_now()
+
+
+@router.get("/admin/api/remnawave")
+async def admin_remnawave_client(_: int = Depends(require_admin)):
+    return {
+        "user_info_cache": remnawave_user_info_cache_stats(),
+        "coalescing": remnawave_coalescing_stats(),
+        "resilience": remnawave_resilience_stats(),
+        "mirror": await get_mirror_status(),
+        "background_batches": background_batch_stats(),
+    }
+
+
+@router.get("/admin/api/telegram")
+async def admin_telegram_sender(_: int = Depends(require_admin)):
+    return telegram_sender_stats()
+
+
+@router.get("/admin/api/database")
+async def admin_database(_: int = Depends(require_admin)):
+    return {"pool": db.pool_wait_stats(), "memo": db.memo_stats(), "user_locks": db.user_lock_stats()}
+
+
+@router.get("/admin/api/database/queries")
+async def admin_database_queries(limit: int = 20, order: str = "total", _: int = Depends(require_admin)):
+    if order not in ("total", "avg", "max"):
+        raise HTTPException(status_code=400, detail="order: total, avg или max")
+    return db.query_stats(min(max(limit, 1), 200), order)
+
+
+@router.post("/admin/api/database/queries/reset")
+async def admin_database_queries_reset(_: int = Depends(require_admin)):
+    db.reset_query_stats()
+    return {"ok": True}
 
 
 @router.get("/admin/api/users")
-async def admin_users(q: str = "", limit: int = 50, offset: int = 0, _: int = Depends(require_admin)):
-    return _plain(await db.admin_list_users(q, min(max(limit, 1), 100), max(offset, 0)))
+async def admin_users(q: str = "", limit: int = 50, cursor: str | None = None, _: int = Depends(require_admin)):
+    if cursor:
+        try:
+            db.decode_admin_users_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Некорректный курсор")
+    return _plain(await db.admin_list_users(q, min(max(limit, 1), 100), cursor))
 
 
 @router.get("/admin/api/users/{tg_id}")
@@ -186,6 +247,14 @@ async def admin_links(_: int = Depends(require_admin)):
     return {"items": items, "bot_username": BOT_USERNAME, "site_url": PUBLIC_SITE_URL}
 
 
+@router.get("/admin/api/links/{code}/daily")
+async def admin_link_daily(code: str, days: int = 30, _: int = Depends(require_admin)):
+    if not await db.get_tracking_link(code):
+        raise HTTPException(status_code=404, detail="Tracking-ссылка не найдена")
+    days = max(1, min(days, 366))
+    return {"code": code.strip().lower(), "days": days, "items": _plain(await db.get_tracking_link_daily_stats(code, days))}
+
+
 @router.post("/admin/api/links")
 async def admin_create_link(body: LinkBody, _: int = Depends(require_admin)):
     code = body.code.strip().lower()
@@ -257,3 +326,33 @@ async def admin_delete_discount(discount_id: int, _: int = Depends(require_admin
     if not await db.delete_discount(discount_id):
         raise HTTPException(status_code=404, detail="Скидка не найдена")
     return {"ok": True}
+
+
+@router.get("/admin/api/jobs")
+async def admin_jobs(limit: int = 20, _: int = Depends(require_admin)):
+    return {"items": _plain(await db.list_admin_jobs(min(max(limit, 1), 100)))}
+
+
+@router.post("/admin/api/jobs")
+async def admin_create_job(body: AdminJobBody, admin_id: int = Depends(require_admin)):
+    if body.kind not in JOB_HANDLERS or body.scope not in {"all", "active"}:
+        raise HTTPException(status_code=400, detail="Неизвестный тип задачи")
+    job, created = await enqueue_admin_job(body.kind, body.scope, created_by=admin_id)
+    if created:
+        logger.info("Web admin enqueued %s job %s", body.kind, job["id"])
+    return {"ok": True, "created": created, "job": _plain(job)}
+
+
+@router.get("/admin/api/jobs/{job_id}")
+async def admin_job(job_id: int, _: int = Depends(require_admin)):
+    job = await db.get_admin_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return {"job": _plain(job), "failed_items": _plain(await db.get_failed_admin_job_items(job_id))}
+
+
+@router.post("/admin/api/jobs/{job_id}/cancel")
+async def admin_cancel_job(job_id: int, _: int = Depends(require_admin)):
+    if not await db.cancel_admin_job(job_id):
+        raise HTTPException(status_code=404, detail="Задача не найдена или уже завершена")
+    return {"ok": True}
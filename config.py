@@ -60,6 +60,28 @@ SUBSCRIPTION_PUBLIC_BASE_URL = os.getenv("SUBSCRIPTION_PUBLIC_BASE_URL", "https:
 DEFAULT_SQUAD_UUID = os.getenv("DEFAULT_SQUAD_UUID", "")
 REGULAR_SQUAD_UUID = os.getenv("REGULAR_SQUAD_UUID", "89902b23-6765-425c-ae27-9bb43c121a70")
 BYPASS_SQUAD_UUID = os.getenv("BYPASS_SQUAD_UUID", "3766e220-ebe1-4a0c-b53f-a4731f805d7e")
+REMNAWAVE_POOL_LIMIT = int(os.getenv("REMNAWAVE_POOL_LIMIT", "50"))  # всего соединений в keep-alive пуле
+REMNAWAVE_POOL_LIMIT_PER_HOST = int(os.getenv("REMNAWAVE_POOL_LIMIT_PER_HOST", "25"))  # на панель / sub-домен
+REMNAWAVE_KEEPALIVE_TIMEOUT = int(os.getenv("REMNAWAVE_KEEPALIVE_TIMEOUT", "60"))  # секунд простоя соединения
+REMNAWAVE_DNS_CACHE_TTL = int(os.getenv("REMNAWAVE_DNS_CACHE_TTL", "300"))  # секунд
+REMNAWAVE_USER_INFO_CACHE_TTL = int(os.getenv("REMNAWAVE_USER_INFO_CACHE_TTL", "30"))  # секунд свежести GET /users/{uuid}
+REMNAWAVE_USER_INFO_STALE_TTL = int(os.getenv("REMNAWAVE_USER_INFO_STALE_TTL", "300"))  # до скольких секунд отдаём устаревшее с фоновым обновлением
+REMNAWAVE_USER_INFO_CACHE_SIZE = int(os.getenv("REMNAWAVE_USER_INFO_CACHE_SIZE", "10000"))  # записей
+REMNAWAVE_USER_INFO_FALLBACK_TTL = int(os.getenv("REMNAWAVE_USER_INFO_FALLBACK_TTL", "3600"))  # сколько отдаём кеш, пока панель недоступна
+REMNAWAVE_BREAKER_FAILURES = int(os.getenv("REMNAWAVE_BREAKER_FAILURES", "5"))  # ошибок подряд до размыкания
+REMNAWAVE_BREAKER_OPEN_SECONDS = int(os.getenv("REMNAWAVE_BREAKER_OPEN_SECONDS", "30"))  # пауза до пробного запроса
+REMNAWAVE_CONCURRENCY_MIN = int(os.getenv("REMNAWAVE_CONCURRENCY_MIN", "2"))
+REMNAWAVE_CONCURRENCY_MAX = int(os.getenv("REMNAWAVE_CONCURRENCY_MAX", "25"))
+REMNAWAVE_LATENCY_TARGET = float(os.getenv("REMNAWAVE_LATENCY_TARGET", "2.0"))  # секунд; медленнее — уменьшаем параллелизм
+REMNAWAVE_QUEUE_TIMEOUT = float(os.getenv("REMNAWAVE_QUEUE_TIMEOUT", "5"))  # секунд ожидания слота до отказа
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))  # исходящих сообщений в секунду на весь бот (лимит Telegram ~30)
+TELEGRAM_GLOBAL_BURST = int(os.getenv("TELEGRAM_GLOBAL_BURST", "25"))  # сколько сообщений можно отправить подряд после простоя
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1.0"))  # секунд между сообщениями в один чат
+TELEGRAM_SEND_MAX_RETRIES = int(os.getenv("TELEGRAM_SEND_MAX_RETRIES", "3"))  # повторов после 429 retry_after
+SUBSCRIPTION_URL_REFRESH_TTL = int(os.getenv("SUBSCRIPTION_URL_REFRESH_TTL", "86400"))  # секунд; сохранённые ссылки старше сверяем с зеркалом, 0 — не сверять
+BACKGROUND_BATCH_WORKERS = int(os.getenv("BACKGROUND_BATCH_WORKERS", "8"))  # параллельных подписок в фоновых циклах трафика и устройств
+BACKGROUND_BATCH_SIZE = int(os.getenv("BACKGROUND_BATCH_SIZE", "200"))  # подписок в пачке (один запрос за докупленными устройствами)
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))  # параллельных отправок в одной рассылке (темп держит общий отправитель)
 
 # ────────────────────────────────────────────────
 #            CRYPTOBOT PAYMENT CONFIG
@@ -81,6 +103,16 @@ YOOKASSA_API_URL = "https://api.yookassa.ru/v3"
 # ────────────────────────────────────────────────
 
 DATABASE_URL = os.getenv("DATABASE_URL", "")
+DB_BIND_CONNECTION = os.getenv("DB_BIND_CONNECTION", "True").lower() == "true"  # одно соединение пула на апдейт Telegram / HTTP-запрос (на время запросов к Remnawave/оплатам/Telegram отдаётся в пул)
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "True").lower() == "true"  # false — только проверка, применять через scripts/migrate.py
+USER_LOCK_BACKEND = os.getenv("USER_LOCK_BACKEND", "local").strip().lower()  # local — в процессе; postgres — pg_try_advisory_lock для нескольких процессов
+USER_LOCK_CONNECTIONS = max(1, int(os.getenv("USER_LOCK_CONNECTIONS", "4")))  # отдельные соединения бэкенда postgres; tg_id закреплён за одним из них
+DB_REPLICA_URL = os.getenv("DB_REPLICA_URL", "")  # read-only реплика для аналитики веб-панели; пусто — всё в основную БД
+DB_INTERACTIVE_POOL_SIZE = int(os.getenv("DB_INTERACTIVE_POOL_SIZE", "20"))  # апдейты бота, мини-приложение
+DB_PAYMENTS_POOL_SIZE = int(os.getenv("DB_PAYMENTS_POOL_SIZE", "5"))  # вебхуки оплат и выдача оплаченных подписок
+DB_BACKGROUND_POOL_SIZE = int(os.getenv("DB_BACKGROUND_POOL_SIZE", "5"))  # фоновые циклы и задачи админа
+DB_ANALYTICS_POOL_SIZE = int(os.getenv("DB_ANALYTICS_POOL_SIZE", "3"))  # тяжёлые отчёты веб-панели (и реплика, если задана)
+DB_SLOW_QUERY_MS = int(os.getenv("DB_SLOW_QUERY_MS", "500"))  # запросы дольше — в лог медленных запросов (параметры скрыты); 0 — выключить
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
 
@@ -31,14 +31,14 @@ from services.discounts import calculate_discounted_price
 from services.device_addons import available_device_addon_packages, current_device_limit, effective_device_limit
 from services.payment_summary import build_payment_success_summary
 from services.payment_processing import process_paid_payment
-from services.remnawave import remnawave_get_subscription_url, remnawave_get_user_info
+from services.remnawave import remnawave_get_user_info
 from services.subscription_deletion import (
     RemnawaveDeletionError,
     SubscriptionBusyError,
     SubscriptionNotFoundError,
     delete_subscription_everywhere,
 )
-from services.subscription_sync import reconcile_subscription_expiry
+from services.subscription_sync import reconcile_subscription_expiry, stored_subscription_url
 from services.web_auth import (
     create_session_token,
     hash_password,
@@ -173,7 +173,7 @@ async def _serialize_subscription(subscription) -> dict:
     used_bytes = subscription.get("last_known_used_traffic_bytes") or 0
     if subscription.get("remnawave_uuid"):
         try:
-            subscription_url = await remnawave_get_subscription_url(None, subscription["remnawave_uuid"])
+            subscription_url = await stored_subscription_url(subscription)
             user_info = await remnawave_get_user_info(None, subscription["remnawave_uuid"])
             effective_until = await reconcile_subscription_expiry(subscription, user_info)
             if plan_kind == "bypass" and user_info:
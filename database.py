@@ -1,9 +1,31 @@
 import asyncio
 import asyncpg
+import bisect
+import functools
+import hashlib
+import json
 import logging
-from datetime import datetime
+import sys
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
 from config import (
+    BACKGROUND_BATCH_SIZE,
     DATABASE_URL,
+    DB_ANALYTICS_POOL_SIZE,
+    DB_BACKGROUND_POOL_SIZE,
+    DB_BIND_CONNECTION,
+    DB_INTERACTIVE_POOL_SIZE,
+    DB_MIGRATE_ON_STARTUP,
+    DB_PAYMENTS_POOL_SIZE,
+    DB_REPLICA_URL,
+    DB_SLOW_QUERY_MS,
+    USER_LOCK_BACKEND,
+    USER_LOCK_CONNECTIONS,
     PAYMENT_EXPIRY_TIME,
     TRACKING_ATTRIBUTION_DAYS,
     GIFT_REQUEST_COOLDOWN,
@@ -19,14 +41,28 @@ from config import (
 MAX_SUBSCRIPTIONS_PER_USER = 5
 
 
-# Глобальный пул подключений
-_pool = None
+# Пулы подключений по типу нагрузки: медленный отчёт в веб-панели или
+# фоновый цикл не занимает соединения, которые ждут апдейты бота, а поток
+# апдейтов — соединения вебхуков оплат.
+# replica создаётся только при DB_REPLICA_URL и обслуживает чтения аналитики.
+_pools: dict[str, asyncpg.Pool] = {}
 
-# Блокировки пользователя на уровне процесса.
-# Бот, webhook-сервер и фоновые задачи работают в одном процессе,
-# поэтому asyncio.Lock надёжнее, чем advisory lock через разные соединения пула.
-_user_locks: dict[int, asyncio.Lock] = {}
-_user_locks_guard = asyncio.Lock()
+
+@dataclass(frozen=True)
+class PoolSettings:
+    min_size: int
+    max_size: int
+    command_timeout: float
+    acquire_timeout: float
+
+
+POOL_SETTINGS = {
+    "interactive": PoolSettings(3, DB_INTERACTIVE_POOL_SIZE, command_timeout=30, acquire_timeout=10),
+    "payments": PoolSettings(1, DB_PAYMENTS_POOL_SIZE, command_timeout=30, acquire_timeout=10),
+    "background": PoolSettings(1, DB_BACKGROUND_POOL_SIZE, command_timeout=120, acquire_timeout=60),
+    "analytics": PoolSettings(1, DB_ANALYTICS_POOL_SIZE, command_timeout=120, acquire_timeout=30),
+}
+REPLICA_POOL = "replica"
 
 
 async def get_table_columns(conn, table_name: str) -> dict:
@@ -115,1050 +151,2201 @@ async def sync_table_schema(conn, table_name: str, expected_columns: dict):
                 logging.warning(f"⚠️ Ошибка при удалении столбца {table_name}.{col_name}: {e}")
 
 
-async def run_migrations():
-    """Запустить автоматические миграции при старте бота"""
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+async def _migrate_baseline_schema(conn):
+    """Базовая схема: таблицы, столбцы, индексы и исправления данных.
+
+    Шаг идемпотентный и повторяемый: после правки он один раз выполняется
+    заново (изменилась контрольная сумма), на тёплом старте не запускается.
+    """
+    try:
+        logging.info("Running migrations...")
+
+        # ═══════════════════════════════════════════════════════════
+        # ОПРЕДЕЛЯЕМ ОЖИДАЕМУЮ СТРУКТУРУ ТАБЛИЦ
+        # ═══════════════════════════════════════════════════════════
+
+        expected_users_columns = {
+            'tg_id': {'type': 'BIGINT', 'nullable': False},
+            'username': {'type': 'TEXT', 'nullable': True},
+            'accepted_terms': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'remnawave_uuid': {'type': 'UUID', 'nullable': True},
+            'remnawave_username': {'type': 'TEXT', 'nullable': True},
+            'subscription_until': {'type': 'TIMESTAMP', 'nullable': True},
+            'squad_uuid': {'type': 'UUID', 'nullable': True},
+            'referrer_id': {'type': 'BIGINT', 'nullable': True},
+            'tracking_code': {'type': 'TEXT', 'nullable': True},
+            'first_payment': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'referral_count': {'type': 'INT', 'nullable': False, 'default': '0'},
+            'active_referrals': {'type': 'INT', 'nullable': False, 'default': '0'},
+            'gift_received': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'next_notification_time': {'type': 'TIMESTAMP', 'nullable': True},
+            'notification_type': {'type': 'TEXT', 'nullable': True},
+            'last_gift_attempt': {'type': 'TIMESTAMP', 'nullable': True},
+            'last_promo_attempt': {'type': 'TIMESTAMP', 'nullable': True},
+            'last_payment_check': {'type': 'TIMESTAMP', 'nullable': True},
+        }
+
+        expected_payments_columns = {
+            'tg_id': {'type': 'BIGINT', 'nullable': False},
+            'tariff_code': {'type': 'TEXT', 'nullable': False},
+            'amount': {'type': 'NUMERIC', 'nullable': False},
+            'provider': {'type': 'TEXT', 'nullable': False},
+            'invoice_id': {'type': 'TEXT', 'nullable': False},
+            'subscription_id': {'type': 'BIGINT', 'nullable': True},
+            'payment_target': {'type': 'TEXT', 'nullable': False, 'default': "'new'"},
+            'target_slot_number': {'type': 'INT', 'nullable': True},
+            'payment_kind': {'type': 'TEXT', 'nullable': False, 'default': "'subscription'"},
+            'traffic_package_code': {'type': 'TEXT', 'nullable': True},
+            'tracking_code': {'type': 'TEXT', 'nullable': True},
+            'refund_requested_at': {'type': 'TIMESTAMP', 'nullable': True},
+            'refund_status': {'type': 'TEXT', 'nullable': True},
+            'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
+        }
+
+        expected_subscriptions_columns = {
+            'tg_id': {'type': 'BIGINT', 'nullable': False},
+            'slot_number': {'type': 'INT', 'nullable': False},
+            'remnawave_uuid': {'type': 'UUID', 'nullable': True},
+            'remnawave_username': {'type': 'TEXT', 'nullable': True},
+            'subscription_until': {'type': 'TIMESTAMP', 'nullable': True},
+            'squad_uuid': {'type': 'UUID', 'nullable': True},
+            'is_active': {'type': 'BOOLEAN', 'nullable': False, 'default': 'TRUE'},
+            'plan_kind': {'type': 'TEXT', 'nullable': True},
+            'generation': {'type': 'TEXT', 'nullable': False, 'default': "'legacy'"},
+            'is_visible': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'is_renewable': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'type_index': {'type': 'INT', 'nullable': True},
+            'purchase_days': {'type': 'INT', 'nullable': True},
+            'traffic_enabled': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'base_traffic_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
+            'current_paid_traffic_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
+            'carried_traffic_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
+            'current_period_limit_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
+            'traffic_reset_at': {'type': 'TIMESTAMP', 'nullable': True},
+            'last_known_used_traffic_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
+            'last_traffic_sync_at': {'type': 'TIMESTAMP', 'nullable': True},
+            'legacy_readonly': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'legacy_limit_removal_pending': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'hwid_device_limit': {'type': 'INT', 'nullable': False, 'default': '5'},
+            'next_notification_time': {'type': 'TIMESTAMP', 'nullable': True},
+            'notification_type': {'type': 'TEXT', 'nullable': True},
+            'subscription_url': {'type': 'TEXT', 'nullable': True},
+            'subscription_url_synced_at': {'type': 'TIMESTAMP', 'nullable': True},
+        }
+
+        expected_promo_columns = {
+            'code': {'type': 'TEXT', 'nullable': False},
+            'days': {'type': 'INT', 'nullable': False},
+            'max_uses': {'type': 'INT', 'nullable': False},
+            'used_count': {'type': 'INT', 'nullable': False, 'default': '0'},
+            'active': {'type': 'BOOLEAN', 'nullable': False, 'default': 'TRUE'},
+        }
+
+        expected_promo_usage_columns = {
+            'tg_id': {'type': 'BIGINT', 'nullable': False},
+            'promo_code': {'type': 'TEXT', 'nullable': False},
+        }
+
+        expected_discounts_columns = {
+            'name': {'type': 'TEXT', 'nullable': False},
+            'discount_type': {'type': 'TEXT', 'nullable': False},
+            'value': {'type': 'NUMERIC', 'nullable': False},
+            'target_type': {'type': 'TEXT', 'nullable': False},
+            'target_code': {'type': 'TEXT', 'nullable': True},
+            'starts_at': {'type': 'TIMESTAMP', 'nullable': False},
+            'ends_at': {'type': 'TIMESTAMP', 'nullable': False},
+            'active': {'type': 'BOOLEAN', 'nullable': False, 'default': 'TRUE'},
+        }
+
+        expected_partnerships_columns = {
+            'tg_id': {'type': 'BIGINT', 'nullable': False},
+            'percentage': {'type': 'INT', 'nullable': False},
+            'agreement_accepted': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'status': {'type': 'TEXT', 'nullable': False, 'default': "'active'"},
+        }
+
+        expected_partner_referrals_columns = {
+            'partner_id': {'type': 'BIGINT', 'nullable': False},
+            'referred_user_id': {'type': 'BIGINT', 'nullable': False},
+        }
+
+        expected_partner_earnings_columns = {
+            'partner_id': {'type': 'BIGINT', 'nullable': False},
+            'user_id': {'type': 'BIGINT', 'nullable': False},
+            'tariff_code': {'type': 'TEXT', 'nullable': False},
+            'amount': {'type': 'NUMERIC', 'nullable': False},
+            'partner_share': {'type': 'NUMERIC', 'nullable': False},
+        }
+
+        expected_partner_withdrawals_columns = {
+            'partner_id': {'type': 'BIGINT', 'nullable': False},
+            'amount': {'type': 'NUMERIC', 'nullable': False},
+            'withdrawal_type': {'type': 'TEXT', 'nullable': False},
+            'bank_name': {'type': 'TEXT', 'nullable': True},
+            'phone_number': {'type': 'TEXT', 'nullable': True},
+            'usdt_address': {'type': 'TEXT', 'nullable': True},
+            'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
+        }
+
+        expected_referral_earnings_columns = {
+            'referrer_id': {'type': 'BIGINT', 'nullable': False},
+            'referred_user_id': {'type': 'BIGINT', 'nullable': False},
+            'tariff_code': {'type': 'TEXT', 'nullable': False},
+            'amount': {'type': 'NUMERIC', 'nullable': False},
+            'referral_share': {'type': 'NUMERIC', 'nullable': False},
+            'is_first_purchase': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+        }
+
+        expected_referral_withdrawals_columns = {
+            'referrer_id': {'type': 'BIGINT', 'nullable': False},
+            'amount': {'type': 'NUMERIC', 'nullable': False},
+            'withdrawal_type': {'type': 'TEXT', 'nullable': False},
+            'bank_name': {'type': 'TEXT', 'nullable': True},
+            'phone_number': {'type': 'TEXT', 'nullable': True},
+            'usdt_address': {'type': 'TEXT', 'nullable': True},
+            'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
+        }
+
+        expected_traffic_purchases_columns = {
+            'subscription_id': {'type': 'BIGINT', 'nullable': False},
+            'package_code': {'type': 'TEXT', 'nullable': False},
+            'traffic_bytes': {'type': 'BIGINT', 'nullable': False},
+            'amount': {'type': 'NUMERIC', 'nullable': False},
+            'provider': {'type': 'TEXT', 'nullable': True},
+            'invoice_id': {'type': 'TEXT', 'nullable': True},
+            'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
+            'activated_at': {'type': 'TIMESTAMP', 'nullable': True},
+        }
+
+        expected_device_addon_purchases_columns = {
+            'subscription_id': {'type': 'BIGINT', 'nullable': False},
+            'device_count': {'type': 'INT', 'nullable': False},
+            'amount': {'type': 'NUMERIC', 'nullable': False},
+            'provider': {'type': 'TEXT', 'nullable': True},
+            'invoice_id': {'type': 'TEXT', 'nullable': True},
+            'valid_until': {'type': 'TIMESTAMP', 'nullable': False},
+            'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
+            'activated_at': {'type': 'TIMESTAMP', 'nullable': True},
+            'expired_processed_at': {'type': 'TIMESTAMP', 'nullable': True},
+        }
+
+        expected_traffic_cycles_columns = {
+            'subscription_id': {'type': 'BIGINT', 'nullable': False},
+            'period_start': {'type': 'TIMESTAMP', 'nullable': False},
+            'period_end': {'type': 'TIMESTAMP', 'nullable': False},
+            'base_traffic_bytes': {'type': 'BIGINT', 'nullable': False},
+            'carried_traffic_bytes': {'type': 'BIGINT', 'nullable': False},
+            'paid_traffic_bytes': {'type': 'BIGINT', 'nullable': False},
+            'used_traffic_bytes_before_reset': {'type': 'BIGINT', 'nullable': False},
+            'remaining_paid_traffic_bytes': {'type': 'BIGINT', 'nullable': False},
+            'reset_processed_at': {'type': 'TIMESTAMP', 'nullable': True},
+        }
+
+        expected_tracking_links_columns = {
+            'code': {'type': 'TEXT', 'nullable': False},
+            'title': {'type': 'TEXT', 'nullable': True},
+            'created_by': {'type': 'BIGINT', 'nullable': False},
+            'is_active': {'type': 'BOOLEAN', 'nullable': False, 'default': 'TRUE'},
+        }
+
+        expected_tracking_clicks_columns = {
+            'code': {'type': 'TEXT', 'nullable': False},
+            'tg_id': {'type': 'BIGINT', 'nullable': False},
+            'is_new_user': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
+            'clicked_at': {'type': 'TIMESTAMP', 'nullable': True, 'default': 'now()'},
+        }
+
+        expected_notification_state_columns = {
+            'tg_id': {'type': 'BIGINT', 'nullable': False},
+            'subscription_id': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
+            'notification_type': {'type': 'TEXT', 'nullable': False},
+            'last_sent_at': {'type': 'TIMESTAMP', 'nullable': False, 'default': 'now()'},
+            'created_at': {'type': 'TIMESTAMP', 'nullable': True, 'default': 'now()'},
+            'updated_at': {'type': 'TIMESTAMP', 'nullable': True, 'default': 'now()'},
+        }
+
+        # ═══════════════════════════════════════════════════════════
+        # ЭТАП 1: СОЗДАНИЕ ТАБЛИЦ (если не существуют)
+        # ═══════════════════════════════════════════════════════════
+
+        # Таблица пользователей
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id BIGSERIAL PRIMARY KEY,
+                tg_id BIGINT UNIQUE NOT NULL,
+                username TEXT,
+                created_at TIMESTAMP DEFAULT now(),
+                updated_at TIMESTAMP DEFAULT now(),
+
+                -- Условия и подписка
+                accepted_terms BOOLEAN DEFAULT FALSE,
+                remnawave_uuid UUID,
+                remnawave_username TEXT,
+                subscription_until TIMESTAMP,
+                squad_uuid UUID,
+
+                -- Реферальная программа
+                referrer_id BIGINT,
+                tracking_code TEXT,
+                first_payment BOOLEAN DEFAULT FALSE,
+                referral_count INT DEFAULT 0,
+                active_referrals INT DEFAULT 0,
+
+                -- Подарки
+                gift_received BOOLEAN DEFAULT FALSE,
+
+                -- Уведомления о подписке
+                next_notification_time TIMESTAMP,
+                notification_type TEXT,
+
+                -- Anti-spam тайм-стемпы
+                last_gift_attempt TIMESTAMP,
+                last_promo_attempt TIMESTAMP,
+                last_payment_check TIMESTAMP
+            )
+        """)
+        logging.info("✅ Таблица 'users' создана или уже существует")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS web_accounts (
+                id BIGSERIAL PRIMARY KEY,
+                login TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                service_user_id BIGINT UNIQUE,
+                tracking_code TEXT,
+                is_active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT now(),
+                updated_at TIMESTAMP DEFAULT now(),
+                last_login_at TIMESTAMP
+            )
+        """)
+        await conn.execute("ALTER TABLE web_accounts ADD COLUMN IF NOT EXISTS tracking_code TEXT")
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS web_sessions (
+                id BIGSERIAL PRIMARY KEY,
+                account_id BIGINT NOT NULL REFERENCES web_accounts(id) ON DELETE CASCADE,
+                token_hash TEXT UNIQUE NOT NULL,
+                expires_at TIMESTAMP NOT NULL,
+                created_at TIMESTAMP DEFAULT now(),
+                last_seen_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        logging.info("✅ Таблицы веб-аккаунтов созданы или уже существуют")
+
+        # Таблица партнёрства
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS partnerships (
+                id BIGSERIAL PRIMARY KEY,
+                tg_id BIGINT UNIQUE NOT NULL,
+                percentage INT NOT NULL,
+                agreement_accepted BOOLEAN DEFAULT FALSE,
+                status TEXT DEFAULT 'active',
+                created_at TIMESTAMP DEFAULT now(),
+                updated_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        logging.info("✅ Таблица 'partnerships' создана или уже существует")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                id BIGSERIAL PRIMARY KEY,
+                tg_id BIGINT NOT NULL,
+                slot_number INT NOT NULL,
+                remnawave_uuid UUID,
+                remnawave_username TEXT,
+                subscription_until TIMESTAMP,
+                squad_uuid UUID,
+                is_active BOOLEAN DEFAULT TRUE,
+                plan_kind TEXT,
+                generation TEXT DEFAULT 'legacy',
+                is_visible BOOLEAN DEFAULT FALSE,
+                is_renewable BOOLEAN DEFAULT FALSE,
+                type_index INT,
+                purchase_days INT,
+                traffic_enabled BOOLEAN DEFAULT FALSE,
+                base_traffic_bytes BIGINT DEFAULT 0,
+                current_paid_traffic_bytes BIGINT DEFAULT 0,
+                carried_traffic_bytes BIGINT DEFAULT 0,
+                current_period_limit_bytes BIGINT DEFAULT 0,
+                traffic_reset_at TIMESTAMP,
+                last_known_used_traffic_bytes BIGINT DEFAULT 0,
+                last_traffic_sync_at TIMESTAMP,
+                legacy_readonly BOOLEAN DEFAULT FALSE,
+                legacy_limit_removal_pending BOOLEAN DEFAULT FALSE,
+                hwid_device_limit INT DEFAULT 5,
+                next_notification_time TIMESTAMP,
+                notification_type TEXT,
+                subscription_url TEXT,
+                subscription_url_synced_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT now(),
+                updated_at TIMESTAMP DEFAULT now(),
+                UNIQUE(tg_id, slot_number)
+            )
+        """)
+        logging.info("✅ Таблица 'subscriptions' создана или уже существует")
+
+        # Таблица партнёрских рефералов и покупок
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS partner_referrals (
+                id BIGSERIAL PRIMARY KEY,
+                partner_id BIGINT NOT NULL,
+                referred_user_id BIGINT NOT NULL,
+                created_at TIMESTAMP DEFAULT now(),
+                UNIQUE(partner_id, referred_user_id),
+                FOREIGN KEY (partner_id) REFERENCES partnerships(tg_id) ON DELETE CASCADE
+            )
+        """)
+        logging.info("✅ Таблица 'partner_referrals' создана или уже существует")
+
+        # Таблица партнёрских покупок и заработков
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS partner_earnings (
+                id BIGSERIAL PRIMARY KEY,
+                partner_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                tariff_code TEXT NOT NULL,
+                amount NUMERIC NOT NULL,
+                partner_share NUMERIC NOT NULL,
+                created_at TIMESTAMP DEFAULT now(),
+                FOREIGN KEY (partner_id) REFERENCES partnerships(tg_id) ON DELETE CASCADE
+            )
+        """)
+        logging.info("✅ Таблица 'partner_earnings' создана или уже существует")
+
+        # Таблица запросов на вывод средств
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS partner_withdrawals (
+                id BIGSERIAL PRIMARY KEY,
+                partner_id BIGINT NOT NULL,
+                amount NUMERIC NOT NULL,
+                withdrawal_type TEXT NOT NULL,
+                bank_name TEXT,
+                phone_number TEXT,
+                usdt_address TEXT,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT now(),
+                FOREIGN KEY (partner_id) REFERENCES partnerships(tg_id) ON DELETE CASCADE
+            )
+        """)
+        logging.info("✅ Таблица 'partner_withdrawals' создана или уже существует")
+
+        # Таблица реферальных заработков
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS referral_earnings (
+                id BIGSERIAL PRIMARY KEY,
+                referrer_id BIGINT NOT NULL,
+                referred_user_id BIGINT NOT NULL,
+                tariff_code TEXT NOT NULL,
+                amount NUMERIC NOT NULL,
+                referral_share NUMERIC NOT NULL,
+                is_first_purchase BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT now(),
+                FOREIGN KEY (referrer_id) REFERENCES users(tg_id) ON DELETE CASCADE
+            )
+        """)
+        logging.info("✅ Таблица 'referral_earnings' создана или уже существует")
+
+        # Таблица запросов на вывод средств рефералами
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS referral_withdrawals (
+                id BIGSERIAL PRIMARY KEY,
+                referrer_id BIGINT NOT NULL,
+                amount NUMERIC NOT NULL,
+                withdrawal_type TEXT NOT NULL,
+                bank_name TEXT,
+                phone_number TEXT,
+                usdt_address TEXT,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT now(),
+                FOREIGN KEY (referrer_id) REFERENCES users(tg_id) ON DELETE CASCADE
+            )
+        """)
+        logging.info("✅ Таблица 'referral_withdrawals' создана или уже существует")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS traffic_purchases (
+                id BIGSERIAL PRIMARY KEY,
+                subscription_id BIGINT NOT NULL,
+                package_code TEXT NOT NULL,
+                traffic_bytes BIGINT NOT NULL,
+                amount NUMERIC NOT NULL,
+                provider TEXT,
+                invoice_id TEXT,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT now(),
+                activated_at TIMESTAMP
+            )
+        """)
+        logging.info("✅ Таблица 'traffic_purchases' создана или уже существует")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS device_addon_purchases (
+                id BIGSERIAL PRIMARY KEY,
+                subscription_id BIGINT NOT NULL,
+                device_count INT NOT NULL,
+                amount NUMERIC NOT NULL,
+                provider TEXT,
+                invoice_id TEXT,
+                valid_until TIMESTAMP NOT NULL,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT now(),
+                activated_at TIMESTAMP,
+                expired_processed_at TIMESTAMP
+            )
+        """)
+        logging.info("✅ Таблица 'device_addon_purchases' создана или уже существует")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS subscription_traffic_cycles (
+                id BIGSERIAL PRIMARY KEY,
+                subscription_id BIGINT NOT NULL,
+                period_start TIMESTAMP NOT NULL,
+                period_end TIMESTAMP NOT NULL,
+                base_traffic_bytes BIGINT NOT NULL,
+                carried_traffic_bytes BIGINT NOT NULL,
+                paid_traffic_bytes BIGINT NOT NULL,
+                used_traffic_bytes_before_reset BIGINT NOT NULL,
+                remaining_paid_traffic_bytes BIGINT NOT NULL,
+                reset_processed_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        logging.info("✅ Таблица 'subscription_traffic_cycles' создана или уже существует")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS tracking_links (
+                id BIGSERIAL PRIMARY KEY,
+                code TEXT UNIQUE NOT NULL,
+                title TEXT,
+                created_by BIGINT NOT NULL,
+                is_active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT now(),
+                updated_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        logging.info("✅ Таблица 'tracking_links' создана или уже существует")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS tracking_link_clicks (
+                id BIGSERIAL PRIMARY KEY,
+                code TEXT NOT NULL,
+                tg_id BIGINT NOT NULL,
+                is_new_user BOOLEAN DEFAULT FALSE,
+                clicked_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        logging.info("✅ Таблица 'tracking_link_clicks' создана или уже существует")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS notification_state (
+                id BIGSERIAL PRIMARY KEY,
+                tg_id BIGINT NOT NULL,
+                subscription_id BIGINT DEFAULT 0 NOT NULL,
+                notification_type TEXT NOT NULL,
+                last_sent_at TIMESTAMP DEFAULT now() NOT NULL,
+                created_at TIMESTAMP DEFAULT now(),
+                updated_at TIMESTAMP DEFAULT now(),
+                UNIQUE(tg_id, subscription_id, notification_type)
+            )
+        """)
+        logging.info("✅ Таблица 'notification_state' создана или уже существует")
+
+        # Таблица платежей
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS payments (
+                id BIGSERIAL PRIMARY KEY,
+                tg_id BIGINT NOT NULL,
+                tariff_code TEXT NOT NULL,
+                amount NUMERIC NOT NULL,
+                created_at TIMESTAMP DEFAULT now(),
+                updated_at TIMESTAMP DEFAULT now(),
+                provider TEXT NOT NULL,
+                invoice_id TEXT UNIQUE NOT NULL,
+                subscription_id BIGINT,
+                payment_target TEXT DEFAULT 'new',
+                target_slot_number INT,
+                payment_kind TEXT DEFAULT 'subscription',
+                traffic_package_code TEXT,
+                tracking_code TEXT,
+                refund_requested_at TIMESTAMP,
+                refund_status TEXT,
+                status TEXT DEFAULT 'pending'
+            )
+        """)
+        logging.info("✅ Таблица 'payments' создана или уже существует")
+
+        # Таблица промокодов
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS promo_codes (
+                id BIGSERIAL PRIMARY KEY,
+                code TEXT UNIQUE NOT NULL,
+                days INT NOT NULL,
+                max_uses INT NOT NULL,
+                used_count INT DEFAULT 0,
+                active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        logging.info("✅ Таблица 'promo_codes' создана или уже существует")
+
+        # Таблица использования промокодов пользователями
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS promo_code_users (
+                id BIGSERIAL PRIMARY KEY,
+                tg_id BIGINT NOT NULL,
+                promo_code TEXT NOT NULL,
+                used_at TIMESTAMP DEFAULT now(),
+                UNIQUE(tg_id, promo_code),
+                FOREIGN KEY (promo_code) REFERENCES promo_codes(code) ON DELETE CASCADE
+            )
+        """)
+        logging.info("✅ Таблица 'promo_code_users' создана или уже существует")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS discounts (
+                id BIGSERIAL PRIMARY KEY,
+                name TEXT NOT NULL,
+                discount_type TEXT NOT NULL,
+                value NUMERIC NOT NULL,
+                target_type TEXT NOT NULL,
+                target_code TEXT,
+                starts_at TIMESTAMP NOT NULL,
+                ends_at TIMESTAMP NOT NULL,
+                active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT now(),
+                updated_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        logging.info("✅ Таблица 'discounts' создана или уже существует")
+
+        # Одноразовые Telegram-challenge и мобильные сессии Way VPN.
+        # Секреты сохраняются только как SHA-256 хэши.
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS mobile_auth_challenges (
+                id UUID PRIMARY KEY,
+                start_token_hash TEXT UNIQUE NOT NULL,
+                code_challenge TEXT NOT NULL,
+                device_name TEXT,
+                candidate_tg_id BIGINT,
+                approved_tg_id BIGINT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                expires_at TIMESTAMP NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT now(),
+                approved_at TIMESTAMP,
+                consumed_at TIMESTAMP
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS mobile_sessions (
+                id UUID PRIMARY KEY,
+                tg_id BIGINT NOT NULL,
+                scoped_subscription_id BIGINT,
+                device_name TEXT,
+                access_token_hash TEXT UNIQUE NOT NULL,
+                access_expires_at TIMESTAMP NOT NULL,
+                refresh_token_hash TEXT UNIQUE NOT NULL,
+                refresh_expires_at TIMESTAMP NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT now(),
+                updated_at TIMESTAMP NOT NULL DEFAULT now(),
+                last_seen_at TIMESTAMP NOT NULL DEFAULT now(),
+                revoked_at TIMESTAMP
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS mobile_access_keys (
+                id UUID PRIMARY KEY,
+                tg_id BIGINT UNIQUE NOT NULL,
+                key_hash TEXT UNIQUE NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT now(),
+                last_used_at TIMESTAMP,
+                revoked_at TIMESTAMP
+            )
+        """)
+        logging.info("✅ Таблицы мобильной авторизации созданы или уже существуют")
+
+        # Зеркало пользователей Remnawave: срок, трафик и статус без
+        # GET /users/{uuid} на каждую подписку (services/remnawave_sync.py).
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS remnawave_users_mirror (
+                remnawave_uuid UUID PRIMARY KEY,
+                username TEXT,
+                status TEXT,
+                expire_at TIMESTAMP,
+                used_traffic_bytes BIGINT DEFAULT 0,
+                traffic_limit_bytes BIGINT,
+                subscription_url TEXT,
+                remote_updated_at TIMESTAMP,
+                changed_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'UTC')
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS background_sync_state (
+                name TEXT PRIMARY KEY,
+                last_started_at TIMESTAMP,
+                last_finished_at TIMESTAMP,
+                snapshot_at TIMESTAMP,
+                last_full_finished_at TIMESTAMP,
+                last_seen_count INT DEFAULT 0,
+                last_changed_count INT DEFAULT 0,
+                last_error TEXT,
+                updated_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        logging.info("✅ Таблицы зеркала Remnawave созданы или уже существуют")
+
+        # Массовые операции админа (services/admin_jobs.py): по строке на
+        # подписку, чтобы после рестарта продолжить с необработанных.
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS admin_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                kind TEXT NOT NULL,
+                scope TEXT NOT NULL DEFAULT 'all',
+                status TEXT NOT NULL DEFAULT 'pending',
+                created_by BIGINT,
+                notify_chat_id BIGINT,
+                notify_message_id BIGINT,
+                total INT NOT NULL DEFAULT 0,
+                processed INT NOT NULL DEFAULT 0,
+                succeeded INT NOT NULL DEFAULT 0,
+                failed INT NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT now(),
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS admin_job_items (
+                job_id BIGINT NOT NULL REFERENCES admin_jobs(id) ON DELETE CASCADE,
+                subscription_id BIGINT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INT NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at TIMESTAMP DEFAULT now(),
+                PRIMARY KEY (job_id, subscription_id)
+            )
+        """)
+        logging.info("✅ Таблицы фоновых задач админа созданы или уже существуют")
+
+        # ═══════════════════════════════════════════════════════════
+        # ЭТАП 2: СОЗДАНИЕ ИНДЕКСОВ (для быстрого поиска)
+        # ═══════════════════════════════════════════════════════════
+
+        index_queries = [
+            # users индексы
+            "CREATE INDEX IF NOT EXISTS idx_users_tg_id ON users(tg_id);",
+            "CREATE INDEX IF NOT EXISTS idx_users_remnawave_uuid ON users(remnawave_uuid);",
+            "CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users(referrer_id);",
+            "CREATE INDEX IF NOT EXISTS idx_users_tracking_code ON users(tracking_code);",
+            "CREATE INDEX IF NOT EXISTS idx_users_next_notification ON users(next_notification_time) WHERE next_notification_time IS NOT NULL;",
+            "CREATE INDEX IF NOT EXISTS idx_web_accounts_login ON web_accounts(login);",
+            "CREATE INDEX IF NOT EXISTS idx_web_accounts_service_user ON web_accounts(service_user_id);",
+            "CREATE INDEX IF NOT EXISTS idx_web_accounts_tracking_code ON web_accounts(tracking_code);",
+            "CREATE INDEX IF NOT EXISTS idx_web_sessions_token ON web_sessions(token_hash);",
+            "CREATE INDEX IF NOT EXISTS idx_web_sessions_expiry ON web_sessions(expires_at);",
+            "CREATE INDEX IF NOT EXISTS idx_mobile_auth_start_token ON mobile_auth_challenges(start_token_hash);",
+            "CREATE INDEX IF NOT EXISTS idx_mobile_auth_candidate ON mobile_auth_challenges(candidate_tg_id, expires_at);",
+            "CREATE INDEX IF NOT EXISTS idx_admin_jobs_active ON admin_jobs(kind) WHERE status IN ('pending', 'running');",
+            "CREATE INDEX IF NOT EXISTS idx_admin_job_items_pending ON admin_job_items(job_id, subscription_id) WHERE status = 'pending';",
+            "CREATE INDEX IF NOT EXISTS idx_mobile_auth_expiry ON mobile_auth_challenges(expires_at);",
+            "CREATE INDEX IF NOT EXISTS idx_mobile_sessions_access ON mobile_sessions(access_token_hash);",
+            "CREATE INDEX IF NOT EXISTS idx_mobile_sessions_refresh ON mobile_sessions(refresh_token_hash);",
+            "CREATE INDEX IF NOT EXISTS idx_mobile_sessions_user ON mobile_sessions(tg_id, revoked_at);",
+            "CREATE INDEX IF NOT EXISTS idx_mobile_access_keys_hash ON mobile_access_keys(key_hash);",
+
+            # subscriptions индексы
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_tg_id ON subscriptions(tg_id);",
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_uuid ON subscriptions(remnawave_uuid);",
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_kind_visible ON subscriptions(tg_id, plan_kind, is_visible);",
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_notification ON subscriptions(next_notification_time) WHERE next_notification_time IS NOT NULL;",
+
+            # payments индексы
+            "CREATE INDEX IF NOT EXISTS idx_payments_tg_id ON payments(tg_id);",
+            "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status);",
+            "CREATE INDEX IF NOT EXISTS idx_payments_provider ON payments(provider);",
+            "CREATE INDEX IF NOT EXISTS idx_payments_subscription_id ON payments(subscription_id);",
+            "CREATE INDEX IF NOT EXISTS idx_payments_tracking_code ON payments(tracking_code);",
+            "CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments(created_at);",
+
+            # notification_state индексы
+            "CREATE INDEX IF NOT EXISTS idx_notification_state_lookup ON notification_state(tg_id, subscription_id, notification_type);",
+            "CREATE INDEX IF NOT EXISTS idx_notification_state_last_sent ON notification_state(last_sent_at);",
+
+            # promo_codes индексы
+            "CREATE INDEX IF NOT EXISTS idx_promo_codes_code ON promo_codes(code);",
+            "CREATE INDEX IF NOT EXISTS idx_discounts_active_period ON discounts(active, starts_at, ends_at);",
+            "CREATE INDEX IF NOT EXISTS idx_promo_code_users_tg_id ON promo_code_users(tg_id);",
+            "CREATE INDEX IF NOT EXISTS idx_promo_code_users_code ON promo_code_users(promo_code);",
+
+            # partnership индексы
+            "CREATE INDEX IF NOT EXISTS idx_partnerships_tg_id ON partnerships(tg_id);",
+            "CREATE INDEX IF NOT EXISTS idx_partner_referrals_partner_id ON partner_referrals(partner_id);",
+            "CREATE INDEX IF NOT EXISTS idx_partner_earnings_partner_id ON partner_earnings(partner_id);",
+            "CREATE INDEX IF NOT EXISTS idx_partner_withdrawals_partner_id ON partner_withdrawals(partner_id);",
+
+            # referral индексы
+            "CREATE INDEX IF NOT EXISTS idx_referral_earnings_referrer_id ON referral_earnings(referrer_id);",
+            "CREATE INDEX IF NOT EXISTS idx_referral_earnings_referred_user_id ON referral_earnings(referred_user_id);",
+            "CREATE INDEX IF NOT EXISTS idx_referral_withdrawals_referrer_id ON referral_withdrawals(referrer_id);",
+            "CREATE INDEX IF NOT EXISTS idx_traffic_purchases_subscription_id ON traffic_purchases(subscription_id);",
+            "CREATE INDEX IF NOT EXISTS idx_device_addon_purchases_subscription_id ON device_addon_purchases(subscription_id);",
+            "CREATE INDEX IF NOT EXISTS idx_device_addon_purchases_invoice ON device_addon_purchases(invoice_id);",
+            "CREATE INDEX IF NOT EXISTS idx_device_addon_purchases_expiry ON device_addon_purchases(valid_until, status, expired_processed_at);",
+            "CREATE INDEX IF NOT EXISTS idx_traffic_cycles_subscription_id ON subscription_traffic_cycles(subscription_id);",
+            "CREATE INDEX IF NOT EXISTS idx_tracking_links_code ON tracking_links(code);",
+            "CREATE INDEX IF NOT EXISTS idx_tracking_clicks_code ON tracking_link_clicks(code);",
+            "CREATE INDEX IF NOT EXISTS idx_tracking_clicks_tg_id ON tracking_link_clicks(tg_id);",
+        ]
+
+        for query in index_queries:
+            try:
+                await conn.execute(query)
+            except Exception as e:
+                # Индекс уже может существовать - это нормально
+                if "already exists" not in str(e).lower():
+                    logging.debug(f"Index creation note: {e}")
+
+        logging.info("✅ Индексы созданы или уже существуют")
+
+        # ═══════════════════════════════════════════════════════════
+        # ЭТАП 3: ДОБАВЛЕНИЕ НЕДОСТАЮЩИХ СТОЛБЦОВ
+        # ═══════════════════════════════════════════════════════════
+
+        # Эти столбцы могут не существовать в старых БД - добавляем их
+        alter_queries = [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_gift_attempt TIMESTAMP;",
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_promo_attempt TIMESTAMP;",
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_payment_check TIMESTAMP;",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS subscription_id BIGINT;",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS payment_target TEXT DEFAULT 'new';",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS target_slot_number INT;",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS payment_kind TEXT DEFAULT 'subscription';",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS traffic_package_code TEXT;",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS tracking_code TEXT;",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS refund_requested_at TIMESTAMP;",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS refund_status TEXT;",
+            "ALTER TABLE mobile_sessions ADD COLUMN IF NOT EXISTS scoped_subscription_id BIGINT;",
+            "CREATE INDEX IF NOT EXISTS idx_mobile_sessions_scope ON mobile_sessions(scoped_subscription_id, revoked_at);",
+        ]
+
+        for query in alter_queries:
+            try:
+                await conn.execute(query)
+                logging.info(f"✅ Столбец добавлен: {query.strip()}")
+            except Exception as e:
+                if "already exists" in str(e).lower() or "duplicate" in str(e).lower():
+                    logging.debug(f"Столбец уже существует, пропускаем: {query.strip()}")
+                else:
+                    logging.warning(f"⚠️ Ошибка миграции: {e}")
+
+        # ═══════════════════════════════════════════════════════════
+        # ЭТАП 3.5: ОЧИСТКА ДУБЛИКАТОВ И ДОБАВЛЕНИЕ CONSTRAINTS
+        # ═══════════════════════════════════════════════════════════
+
         try:
-            logging.info("Running migrations...")
-
-            # ═══════════════════════════════════════════════════════════
-            # ОПРЕДЕЛЯЕМ ОЖИДАЕМУЮ СТРУКТУРУ ТАБЛИЦ
-            # ═══════════════════════════════════════════════════════════
-
-            expected_users_columns = {
-                'tg_id': {'type': 'BIGINT', 'nullable': False},
-                'username': {'type': 'TEXT', 'nullable': True},
-                'accepted_terms': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'remnawave_uuid': {'type': 'UUID', 'nullable': True},
-                'remnawave_username': {'type': 'TEXT', 'nullable': True},
-                'subscription_until': {'type': 'TIMESTAMP', 'nullable': True},
-                'squad_uuid': {'type': 'UUID', 'nullable': True},
-                'referrer_id': {'type': 'BIGINT', 'nullable': True},
-                'tracking_code': {'type': 'TEXT', 'nullable': True},
-                'first_payment': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'referral_count': {'type': 'INT', 'nullable': False, 'default': '0'},
-                'active_referrals': {'type': 'INT', 'nullable': False, 'default': '0'},
-                'gift_received': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'next_notification_time': {'type': 'TIMESTAMP', 'nullable': True},
-                'notification_type': {'type': 'TEXT', 'nullable': True},
-                'last_gift_attempt': {'type': 'TIMESTAMP', 'nullable': True},
-                'last_promo_attempt': {'type': 'TIMESTAMP', 'nullable': True},
-                'last_payment_check': {'type': 'TIMESTAMP', 'nullable': True},
-            }
-
-            expected_payments_columns = {
-                'tg_id': {'type': 'BIGINT', 'nullable': False},
-                'tariff_code': {'type': 'TEXT', 'nullable': False},
-                'amount': {'type': 'NUMERIC', 'nullable': False},
-                'provider': {'type': 'TEXT', 'nullable': False},
-                'invoice_id': {'type': 'TEXT', 'nullable': False},
-                'subscription_id': {'type': 'BIGINT', 'nullable': True},
-                'payment_target': {'type': 'TEXT', 'nullable': False, 'default': "'new'"},
-                'target_slot_number': {'type': 'INT', 'nullable': True},
-                'payment_kind': {'type': 'TEXT', 'nullable': False, 'default': "'subscription'"},
-                'traffic_package_code': {'type': 'TEXT', 'nullable': True},
-                'tracking_code': {'type': 'TEXT', 'nullable': True},
-                'refund_requested_at': {'type': 'TIMESTAMP', 'nullable': True},
-                'refund_status': {'type': 'TEXT', 'nullable': True},
-                'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
-            }
-
-            expected_subscriptions_columns = {
-                'tg_id': {'type': 'BIGINT', 'nullable': False},
-                'slot_number': {'type': 'INT', 'nullable': False},
-                'remnawave_uuid': {'type': 'UUID', 'nullable': True},
-                'remnawave_username': {'type': 'TEXT', 'nullable': True},
-                'subscription_until': {'type': 'TIMESTAMP', 'nullable': True},
-                'squad_uuid': {'type': 'UUID', 'nullable': True},
-                'is_active': {'type': 'BOOLEAN', 'nullable': False, 'default': 'TRUE'},
-                'plan_kind': {'type': 'TEXT', 'nullable': True},
-                'generation': {'type': 'TEXT', 'nullable': False, 'default': "'legacy'"},
-                'is_visible': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'is_renewable': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'type_index': {'type': 'INT', 'nullable': True},
-                'purchase_days': {'type': 'INT', 'nullable': True},
-                'traffic_enabled': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'base_traffic_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
-                'current_paid_traffic_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
-                'carried_traffic_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
-                'current_period_limit_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
-                'traffic_reset_at': {'type': 'TIMESTAMP', 'nullable': True},
-                'last_known_used_traffic_bytes': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
-                'last_traffic_sync_at': {'type': 'TIMESTAMP', 'nullable': True},
-                'legacy_readonly': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'legacy_limit_removal_pending': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'hwid_device_limit': {'type': 'INT', 'nullable': False, 'default': '5'},
-                'next_notification_time': {'type': 'TIMESTAMP', 'nullable': True},
-                'notification_type': {'type': 'TEXT', 'nullable': True},
-            }
-
-            expected_promo_columns = {
-                'code': {'type': 'TEXT', 'nullable': False},
-                'days': {'type': 'INT', 'nullable': False},
-                'max_uses': {'type': 'INT', 'nullable': False},
-                'used_count': {'type': 'INT', 'nullable': False, 'default': '0'},
-                'active': {'type': 'BOOLEAN', 'nullable': False, 'default': 'TRUE'},
-            }
-
-            expected_promo_usage_columns = {
-                'tg_id': {'type': 'BIGINT', 'nullable': False},
-                'promo_code': {'type': 'TEXT', 'nullable': False},
-            }
-
-            expected_discounts_columns = {
-                'name': {'type': 'TEXT', 'nullable': False},
-                'discount_type': {'type': 'TEXT', 'nullable': False},
-                'value': {'type': 'NUMERIC', 'nullable': False},
-                'target_type': {'type': 'TEXT', 'nullable': False},
-                'target_code': {'type': 'TEXT', 'nullable': True},
-                'starts_at': {'type': 'TIMESTAMP', 'nullable': False},
-                'ends_at': {'type': 'TIMESTAMP', 'nullable': False},
-                'active': {'type': 'BOOLEAN', 'nullable': False, 'default': 'TRUE'},
-            }
-
-            expected_partnerships_columns = {
-                'tg_id': {'type': 'BIGINT', 'nullable': False},
-                'percentage': {'type': 'INT', 'nullable': False},
-                'agreement_accepted': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'status': {'type': 'TEXT', 'nullable': False, 'default': "'active'"},
-            }
-
-            expected_partner_referrals_columns = {
-                'partner_id': {'type': 'BIGINT', 'nullable': False},
-                'referred_user_id': {'type': 'BIGINT', 'nullable': False},
-            }
-
-            expected_partner_earnings_columns = {
-                'partner_id': {'type': 'BIGINT', 'nullable': False},
-                'user_id': {'type': 'BIGINT', 'nullable': False},
-                'tariff_code': {'type': 'TEXT', 'nullable': False},
-                'amount': {'type': 'NUMERIC', 'nullable': False},
-                'partner_share': {'type': 'NUMERIC', 'nullable': False},
-            }
-
-            expected_partner_withdrawals_columns = {
-                'partner_id': {'type': 'BIGINT', 'nullable': False},
-                'amount': {'type': 'NUMERIC', 'nullable': False},
-                'withdrawal_type': {'type': 'TEXT', 'nullable': False},
-                'bank_name': {'type': 'TEXT', 'nullable': True},
-                'phone_number': {'type': 'TEXT', 'nullable': True},
-                'usdt_address': {'type': 'TEXT', 'nullable': True},
-                'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
-            }
-
-            expected_referral_earnings_columns = {
-                'referrer_id': {'type': 'BIGINT', 'nullable': False},
-                'referred_user_id': {'type': 'BIGINT', 'nullable': False},
-                'tariff_code': {'type': 'TEXT', 'nullable': False},
-                'amount': {'type': 'NUMERIC', 'nullable': False},
-                'referral_share': {'type': 'NUMERIC', 'nullable': False},
-                'is_first_purchase': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-            }
-
-            expected_referral_withdrawals_columns = {
-                'referrer_id': {'type': 'BIGINT', 'nullable': False},
-                'amount': {'type': 'NUMERIC', 'nullable': False},
-                'withdrawal_type': {'type': 'TEXT', 'nullable': False},
-                'bank_name': {'type': 'TEXT', 'nullable': True},
-                'phone_number': {'type': 'TEXT', 'nullable': True},
-                'usdt_address': {'type': 'TEXT', 'nullable': True},
-                'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
-            }
-
-            expected_traffic_purchases_columns = {
-                'subscription_id': {'type': 'BIGINT', 'nullable': False},
-                'package_code': {'type': 'TEXT', 'nullable': False},
-                'traffic_bytes': {'type': 'BIGINT', 'nullable': False},
-                'amount': {'type': 'NUMERIC', 'nullable': False},
-                'provider': {'type': 'TEXT', 'nullable': True},
-                'invoice_id': {'type': 'TEXT', 'nullable': True},
-                'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
-                'activated_at': {'type': 'TIMESTAMP', 'nullable': True},
-            }
-
-            expected_device_addon_purchases_columns = {
-                'subscription_id': {'type': 'BIGINT', 'nullable': False},
-                'device_count': {'type': 'INT', 'nullable': False},
-                'amount': {'type': 'NUMERIC', 'nullable': False},
-                'provider': {'type': 'TEXT', 'nullable': True},
-                'invoice_id': {'type': 'TEXT', 'nullable': True},
-                'valid_until': {'type': 'TIMESTAMP', 'nullable': False},
-                'status': {'type': 'TEXT', 'nullable': False, 'default': "'pending'"},
-                'activated_at': {'type': 'TIMESTAMP', 'nullable': True},
-                'expired_processed_at': {'type': 'TIMESTAMP', 'nullable': True},
-            }
-
-            expected_traffic_cycles_columns = {
-                'subscription_id': {'type': 'BIGINT', 'nullable': False},
-                'period_start': {'type': 'TIMESTAMP', 'nullable': False},
-                'period_end': {'type': 'TIMESTAMP', 'nullable': False},
-                'base_traffic_bytes': {'type': 'BIGINT', 'nullable': False},
-                'carried_traffic_bytes': {'type': 'BIGINT', 'nullable': False},
-                'paid_traffic_bytes': {'type': 'BIGINT', 'nullable': False},
-                'used_traffic_bytes_before_reset': {'type': 'BIGINT', 'nullable': False},
-                'remaining_paid_traffic_bytes': {'type': 'BIGINT', 'nullable': False},
-                'reset_processed_at': {'type': 'TIMESTAMP', 'nullable': True},
-            }
-
-            expected_tracking_links_columns = {
-                'code': {'type': 'TEXT', 'nullable': False},
-                'title': {'type': 'TEXT', 'nullable': True},
-                'created_by': {'type': 'BIGINT', 'nullable': False},
-                'is_active': {'type': 'BOOLEAN', 'nullable': False, 'default': 'TRUE'},
-            }
-
-            expected_tracking_clicks_columns = {
-                'code': {'type': 'TEXT', 'nullable': False},
-                'tg_id': {'type': 'BIGINT', 'nullable': False},
-                'is_new_user': {'type': 'BOOLEAN', 'nullable': False, 'default': 'FALSE'},
-                'clicked_at': {'type': 'TIMESTAMP', 'nullable': True, 'default': 'now()'},
-            }
-
-            expected_notification_state_columns = {
-                'tg_id': {'type': 'BIGINT', 'nullable': False},
-                'subscription_id': {'type': 'BIGINT', 'nullable': False, 'default': '0'},
-                'notification_type': {'type': 'TEXT', 'nullable': False},
-                'last_sent_at': {'type': 'TIMESTAMP', 'nullable': False, 'default': 'now()'},
-                'created_at': {'type': 'TIMESTAMP', 'nullable': True, 'default': 'now()'},
-                'updated_at': {'type': 'TIMESTAMP', 'nullable': True, 'default': 'now()'},
-            }
-
-            # ═══════════════════════════════════════════════════════════
-            # ЭТАП 1: СОЗДАНИЕ ТАБЛИЦ (если не существуют)
-            # ═══════════════════════════════════════════════════════════
-
-            # Таблица пользователей
+            # Удаляем дубликаты в partner_referrals (оставляем только первый)
             await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id BIGSERIAL PRIMARY KEY,
-                    tg_id BIGINT UNIQUE NOT NULL,
-                    username TEXT,
-                    created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now(),
-
-                    -- Условия и подписка
-                    accepted_terms BOOLEAN DEFAULT FALSE,
-                    remnawave_uuid UUID,
-                    remnawave_username TEXT,
-                    subscription_until TIMESTAMP,
-                    squad_uuid UUID,
-
-                    -- Реферальная программа
-                    referrer_id BIGINT,
-                    tracking_code TEXT,
-                    first_payment BOOLEAN DEFAULT FALSE,
-                    referral_count INT DEFAULT 0,
-                    active_referrals INT DEFAULT 0,
-
-                    -- Подарки
-                    gift_received BOOLEAN DEFAULT FALSE,
-
-                    -- Уведомления о подписке
-                    next_notification_time TIMESTAMP,
-                    notification_type TEXT,
-
-                    -- Anti-spam тайм-стемпы
-                    last_gift_attempt TIMESTAMP,
-                    last_promo_attempt TIMESTAMP,
-                    last_payment_check TIMESTAMP
+                DELETE FROM partner_referrals WHERE id NOT IN (
+                    SELECT MIN(id) FROM partner_referrals
+                    GROUP BY partner_id, referred_user_id
                 )
             """)
-            logging.info("✅ Таблица 'users' создана или уже существует")
+            logging.info("✅ Удалены дубликаты в таблице partner_referrals")
+        except Exception as e:
+            logging.debug(f"Дубликатов не найдено или уже удалены: {e}")
 
+        try:
+            # Добавляем UNIQUE constraint если его ещё нет
             await conn.execute("""
-                CREATE TABLE IF NOT EXISTS web_accounts (
-                    id BIGSERIAL PRIMARY KEY,
-                    login TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    service_user_id BIGINT UNIQUE,
-                    tracking_code TEXT,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now(),
-                    last_login_at TIMESTAMP
-                )
+                ALTER TABLE partner_referrals
+                ADD CONSTRAINT unique_partner_referral UNIQUE (partner_id, referred_user_id)
             """)
-            await conn.execute("ALTER TABLE web_accounts ADD COLUMN IF NOT EXISTS tracking_code TEXT")
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS web_sessions (
-                    id BIGSERIAL PRIMARY KEY,
-                    account_id BIGINT NOT NULL REFERENCES web_accounts(id) ON DELETE CASCADE,
-                    token_hash TEXT UNIQUE NOT NULL,
-                    expires_at TIMESTAMP NOT NULL,
-                    created_at TIMESTAMP DEFAULT now(),
-                    last_seen_at TIMESTAMP DEFAULT now()
+            logging.info("✅ Добавлено UNIQUE ограничение на partner_referrals (partner_id, referred_user_id)")
+        except Exception as e:
+            if "already exists" in str(e).lower() or "duplicate" in str(e).lower():
+                logging.debug("UNIQUE ограничение уже существует")
+            else:
+                logging.debug(f"Примечание по UNIQUE: {e}")
+
+        # ═══════════════════════════════════════════════════════════
+        # ЭТАП 4: СИНХРОНИЗАЦИЯ СХЕМЫ ТАБЛИЦ
+        # ═══════════════════════════════════════════════════════════
+
+        logging.info("Syncing table schemas...")
+
+        # Синхронизируем таблицы
+        await sync_table_schema(conn, 'users', expected_users_columns)
+        await sync_table_schema(conn, 'subscriptions', expected_subscriptions_columns)
+        await sync_table_schema(conn, 'payments', expected_payments_columns)
+        await sync_table_schema(conn, 'promo_codes', expected_promo_columns)
+        await sync_table_schema(conn, 'promo_code_users', expected_promo_usage_columns)
+        await sync_table_schema(conn, 'discounts', expected_discounts_columns)
+        await sync_table_schema(conn, 'partnerships', expected_partnerships_columns)
+        await sync_table_schema(conn, 'partner_referrals', expected_partner_referrals_columns)
+        await sync_table_schema(conn, 'partner_earnings', expected_partner_earnings_columns)
+        await sync_table_schema(conn, 'partner_withdrawals', expected_partner_withdrawals_columns)
+        await sync_table_schema(conn, 'referral_earnings', expected_referral_earnings_columns)
+        await sync_table_schema(conn, 'referral_withdrawals', expected_referral_withdrawals_columns)
+        await sync_table_schema(conn, 'traffic_purchases', expected_traffic_purchases_columns)
+        await sync_table_schema(conn, 'device_addon_purchases', expected_device_addon_purchases_columns)
+        await sync_table_schema(conn, 'subscription_traffic_cycles', expected_traffic_cycles_columns)
+        await sync_table_schema(conn, 'tracking_links', expected_tracking_links_columns)
+        await sync_table_schema(conn, 'tracking_link_clicks', expected_tracking_clicks_columns)
+        await sync_table_schema(conn, 'notification_state', expected_notification_state_columns)
+
+        normalized_links = await conn.fetchval(
+            """
+            WITH candidates AS (
+                SELECT id, code, LOWER(TRIM(code)) AS normalized_code
+                FROM tracking_links
+                WHERE code <> LOWER(TRIM(code))
+            ),
+            safe_candidates AS (
+                SELECT candidates.*
+                FROM candidates
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM tracking_links existing
+                    WHERE existing.code = candidates.normalized_code
+                      AND existing.id <> candidates.id
                 )
-            """)
-            logging.info("✅ Таблицы веб-аккаунтов созданы или уже существуют")
+            ),
+            updated AS (
+                UPDATE tracking_links link
+                SET code = safe_candidates.normalized_code,
+                    updated_at = now()
+                FROM safe_candidates
+                WHERE link.id = safe_candidates.id
+                RETURNING link.id
+            )
+            SELECT COUNT(*) FROM updated
+            """
+        )
+        if normalized_links:
+            logging.info("✅ Tracking-ссылки приведены к нижнему регистру: %s", normalized_links)
 
-            # Таблица партнёрства
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS partnerships (
-                    id BIGSERIAL PRIMARY KEY,
-                    tg_id BIGINT UNIQUE NOT NULL,
-                    percentage INT NOT NULL,
-                    agreement_accepted BOOLEAN DEFAULT FALSE,
-                    status TEXT DEFAULT 'active',
-                    created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now()
-                )
-            """)
-            logging.info("✅ Таблица 'partnerships' создана или уже существует")
+        await conn.execute(
+            """
+            UPDATE tracking_link_clicks
+            SET code = LOWER(TRIM(code))
+            WHERE code <> LOWER(TRIM(code))
+            """
+        )
+        await conn.execute(
+            """
+            UPDATE users
+            SET tracking_code = LOWER(TRIM(tracking_code))
+            WHERE tracking_code IS NOT NULL
+              AND tracking_code <> LOWER(TRIM(tracking_code))
+            """
+        )
+        await conn.execute(
+            """
+            UPDATE web_accounts
+            SET tracking_code = LOWER(TRIM(tracking_code))
+            WHERE tracking_code IS NOT NULL
+              AND tracking_code <> LOWER(TRIM(tracking_code))
+            """
+        )
+        await conn.execute(
+            """
+            UPDATE payments
+            SET tracking_code = LOWER(TRIM(tracking_code))
+            WHERE tracking_code IS NOT NULL
+              AND tracking_code <> LOWER(TRIM(tracking_code))
+            """
+        )
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS subscriptions (
-                    id BIGSERIAL PRIMARY KEY,
-                    tg_id BIGINT NOT NULL,
-                    slot_number INT NOT NULL,
-                    remnawave_uuid UUID,
-                    remnawave_username TEXT,
-                    subscription_until TIMESTAMP,
-                    squad_uuid UUID,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    plan_kind TEXT,
-                    generation TEXT DEFAULT 'legacy',
-                    is_visible BOOLEAN DEFAULT FALSE,
-                    is_renewable BOOLEAN DEFAULT FALSE,
-                    type_index INT,
-                    purchase_days INT,
-                    traffic_enabled BOOLEAN DEFAULT FALSE,
-                    base_traffic_bytes BIGINT DEFAULT 0,
-                    current_paid_traffic_bytes BIGINT DEFAULT 0,
-                    carried_traffic_bytes BIGINT DEFAULT 0,
-                    current_period_limit_bytes BIGINT DEFAULT 0,
-                    traffic_reset_at TIMESTAMP,
-                    last_known_used_traffic_bytes BIGINT DEFAULT 0,
-                    last_traffic_sync_at TIMESTAMP,
-                    legacy_readonly BOOLEAN DEFAULT FALSE,
-                    legacy_limit_removal_pending BOOLEAN DEFAULT FALSE,
-                    hwid_device_limit INT DEFAULT 5,
-                    next_notification_time TIMESTAMP,
-                    notification_type TEXT,
-                    created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now(),
-                    UNIQUE(tg_id, slot_number)
-                )
-            """)
-            logging.info("✅ Таблица 'subscriptions' создана или уже существует")
+        restored_tracking_users = await conn.fetchval(
+            """
+            WITH first_click AS (
+                SELECT DISTINCT ON (click.tg_id)
+                    click.tg_id,
+                    click.code
+                FROM tracking_link_clicks click
+                JOIN tracking_links link ON link.code = click.code
+                WHERE click.tg_id > 0
+                  AND link.is_active = TRUE
+                ORDER BY click.tg_id, click.clicked_at ASC, click.id ASC
+            ),
+            restored AS (
+                UPDATE users user_row
+                SET tracking_code = first_click.code
+                FROM first_click
+                WHERE user_row.tg_id = first_click.tg_id
+                  AND user_row.tracking_code IS NULL
+                RETURNING user_row.tg_id
+            )
+            SELECT COUNT(*) FROM restored
+            """
+        )
+        if restored_tracking_users:
+            logging.info(
+                "✅ Восстановлены tracking-коды пользователей по старым кликам: %s",
+                restored_tracking_users,
+            )
 
-            # Таблица партнёрских рефералов и покупок
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS partner_referrals (
-                    id BIGSERIAL PRIMARY KEY,
-                    partner_id BIGINT NOT NULL,
-                    referred_user_id BIGINT NOT NULL,
-                    created_at TIMESTAMP DEFAULT now(),
-                    UNIQUE(partner_id, referred_user_id),
-                    FOREIGN KEY (partner_id) REFERENCES partnerships(tg_id) ON DELETE CASCADE
-                )
-            """)
-            logging.info("✅ Таблица 'partner_referrals' создана или уже существует")
+        await conn.execute(
+            """
+            INSERT INTO subscriptions (
+                tg_id,
+                slot_number,
+                remnawave_uuid,
+                remnawave_username,
+                subscription_until,
+                squad_uuid,
+                is_active,
+                generation,
+                is_visible,
+                is_renewable,
+                next_notification_time,
+                notification_type
+            )
+            SELECT
+                u.tg_id,
+                1,
+                u.remnawave_uuid,
+                u.remnawave_username,
+                u.subscription_until,
+                u.squad_uuid,
+                TRUE,
+                'legacy',
+                FALSE,
+                FALSE,
+                u.next_notification_time,
+                u.notification_type
+            FROM users u
+            WHERE u.remnawave_uuid IS NOT NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM subscriptions s
+                  WHERE s.tg_id = u.tg_id AND s.slot_number = 1
+              )
+            """
+        )
 
-            # Таблица партнёрских покупок и заработков
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS partner_earnings (
-                    id BIGSERIAL PRIMARY KEY,
-                    partner_id BIGINT NOT NULL,
-                    user_id BIGINT NOT NULL,
-                    tariff_code TEXT NOT NULL,
-                    amount NUMERIC NOT NULL,
-                    partner_share NUMERIC NOT NULL,
-                    created_at TIMESTAMP DEFAULT now(),
-                    FOREIGN KEY (partner_id) REFERENCES partnerships(tg_id) ON DELETE CASCADE
-                )
-            """)
-            logging.info("✅ Таблица 'partner_earnings' создана или уже существует")
+        migrated_legacy = await conn.fetchval(
+            """
+            WITH
+            migrated AS (
+                UPDATE subscriptions AS subscription
+                SET plan_kind = 'bypass',
+                    generation = 'legacy',
+                    is_visible = FALSE,
+                    is_renewable = FALSE,
+                    legacy_readonly = TRUE,
+                    legacy_limit_removal_pending = subscription.remnawave_uuid IS NOT NULL,
+                    traffic_enabled = FALSE,
+                    base_traffic_bytes = 0,
+                    current_paid_traffic_bytes = 0,
+                    carried_traffic_bytes = 0,
+                    current_period_limit_bytes = 0,
+                    traffic_reset_at = NULL,
+                    last_traffic_sync_at = NULL,
+                    next_notification_time = NULL,
+                    notification_type = NULL,
+                    updated_at = now()
+                WHERE subscription.remnawave_uuid IS NOT NULL
+                  AND (
+                        LOWER(TRIM(COALESCE(subscription.plan_kind, ''))) NOT IN ('regular', 'bypass')
+                     OR (
+                            subscription.plan_kind = 'bypass'
+                        AND subscription.generation = 'v2'
+                        AND subscription.is_visible = TRUE
+                        AND COALESCE(subscription.remnawave_username, '') !~
+                            '^(tg_[0-9]+|web_[0-9]+)_bypass_[0-9]+$'
+                     )
+                  )
+                RETURNING subscription.id
+            )
+            SELECT COUNT(*) FROM migrated
+            """
+        )
+        if migrated_legacy:
+            logging.info(
+                "✅ Старые подписки переведены в режим только для просмотра в боте: %s",
+                migrated_legacy,
+            )
 
-            # Таблица запросов на вывод средств
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS partner_withdrawals (
-                    id BIGSERIAL PRIMARY KEY,
-                    partner_id BIGINT NOT NULL,
-                    amount NUMERIC NOT NULL,
-                    withdrawal_type TEXT NOT NULL,
-                    bank_name TEXT,
-                    phone_number TEXT,
-                    usdt_address TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT now(),
-                    FOREIGN KEY (partner_id) REFERENCES partnerships(tg_id) ON DELETE CASCADE
-                )
-            """)
-            logging.info("✅ Таблица 'partner_withdrawals' создана или уже существует")
+        await conn.execute(
+            """
+            UPDATE subscriptions
+            SET generation = 'legacy',
+                is_visible = FALSE,
+                is_renewable = FALSE
+            WHERE generation = 'legacy'
+               OR generation IS NULL
+            """
+        )
 
-            # Таблица реферальных заработков
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS referral_earnings (
-                    id BIGSERIAL PRIMARY KEY,
-                    referrer_id BIGINT NOT NULL,
-                    referred_user_id BIGINT NOT NULL,
-                    tariff_code TEXT NOT NULL,
-                    amount NUMERIC NOT NULL,
-                    referral_share NUMERIC NOT NULL,
-                    is_first_purchase BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT now(),
-                    FOREIGN KEY (referrer_id) REFERENCES users(tg_id) ON DELETE CASCADE
-                )
-            """)
-            logging.info("✅ Таблица 'referral_earnings' создана или уже существует")
+        await conn.execute(
+            """
+            UPDATE subscriptions
+            SET hwid_device_limit = CASE
+                WHEN plan_kind = 'bypass' THEN GREATEST(COALESCE(hwid_device_limit, 0), $1::INT)
+                ELSE GREATEST(COALESCE(hwid_device_limit, 0), $2::INT)
+            END
+            WHERE generation = 'v2'
+              AND is_visible = TRUE
+              AND (
+                    COALESCE(hwid_device_limit, 0) <= 0
+                 OR (plan_kind = 'bypass' AND COALESCE(hwid_device_limit, 0) < $1::INT)
+                 OR (COALESCE(plan_kind, 'regular') <> 'bypass' AND COALESCE(hwid_device_limit, 0) < $2::INT)
+              )
+            """,
+            BYPASS_HWID_DEVICE_LIMIT,
+            REGULAR_HWID_DEVICE_LIMIT,
+        )
 
-            # Таблица запросов на вывод средств рефералами
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS referral_withdrawals (
-                    id BIGSERIAL PRIMARY KEY,
-                    referrer_id BIGINT NOT NULL,
-                    amount NUMERIC NOT NULL,
-                    withdrawal_type TEXT NOT NULL,
-                    bank_name TEXT,
-                    phone_number TEXT,
-                    usdt_address TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT now(),
-                    FOREIGN KEY (referrer_id) REFERENCES users(tg_id) ON DELETE CASCADE
-                )
-            """)
-            logging.info("✅ Таблица 'referral_withdrawals' создана или уже существует")
+        await conn.execute(
+            """
+            UPDATE subscriptions
+            SET base_traffic_bytes = $1,
+                current_period_limit_bytes = GREATEST(
+                    COALESCE(current_period_limit_bytes, 0),
+                    $1 + COALESCE(carried_traffic_bytes, 0) + COALESCE(current_paid_traffic_bytes, 0)
+                ),
+                last_traffic_sync_at = NULL,
+                updated_at = now()
+            WHERE generation = 'v2'
+              AND plan_kind = 'bypass'
+              AND is_visible = TRUE
+              AND COALESCE(base_traffic_bytes, 0) < $1
+            """,
+            BYPASS_BASE_TRAFFIC_GB * GB_BYTES,
+        )
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS traffic_purchases (
-                    id BIGSERIAL PRIMARY KEY,
-                    subscription_id BIGINT NOT NULL,
-                    package_code TEXT NOT NULL,
-                    traffic_bytes BIGINT NOT NULL,
-                    amount NUMERIC NOT NULL,
-                    provider TEXT,
-                    invoice_id TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT now(),
-                    activated_at TIMESTAMP
-                )
-            """)
-            logging.info("✅ Таблица 'traffic_purchases' создана или уже существует")
+        logging.info("✅ Синхронизация схемы завершена")
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS device_addon_purchases (
-                    id BIGSERIAL PRIMARY KEY,
-                    subscription_id BIGINT NOT NULL,
-                    device_count INT NOT NULL,
-                    amount NUMERIC NOT NULL,
-                    provider TEXT,
-                    invoice_id TEXT,
-                    valid_until TIMESTAMP NOT NULL,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT now(),
-                    activated_at TIMESTAMP,
-                    expired_processed_at TIMESTAMP
-                )
-            """)
-            logging.info("✅ Таблица 'device_addon_purchases' создана или уже существует")
+        logging.info("━" * 60)
+        logging.info("✨ ВСЕ МИГРАЦИИ УСПЕШНО ЗАВЕРШЕНЫ ✨")
+        logging.info("━" * 60)
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS subscription_traffic_cycles (
-                    id BIGSERIAL PRIMARY KEY,
-                    subscription_id BIGINT NOT NULL,
-                    period_start TIMESTAMP NOT NULL,
-                    period_end TIMESTAMP NOT NULL,
-                    base_traffic_bytes BIGINT NOT NULL,
-                    carried_traffic_bytes BIGINT NOT NULL,
-                    paid_traffic_bytes BIGINT NOT NULL,
-                    used_traffic_bytes_before_reset BIGINT NOT NULL,
-                    remaining_paid_traffic_bytes BIGINT NOT NULL,
-                    reset_processed_at TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT now()
-                )
-            """)
-            logging.info("✅ Таблица 'subscription_traffic_cycles' создана или уже существует")
+    except Exception as e:
+        logging.error(f"❌ ОШИБКА МИГРАЦИИ: {e}")
+        raise
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS tracking_links (
-                    id BIGSERIAL PRIMARY KEY,
-                    code TEXT UNIQUE NOT NULL,
-                    title TEXT,
-                    created_by BIGINT NOT NULL,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now()
-                )
-            """)
-            logging.info("✅ Таблица 'tracking_links' создана или уже существует")
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS tracking_link_clicks (
-                    id BIGSERIAL PRIMARY KEY,
-                    code TEXT NOT NULL,
-                    tg_id BIGINT NOT NULL,
-                    is_new_user BOOLEAN DEFAULT FALSE,
-                    clicked_at TIMESTAMP DEFAULT now()
-                )
-            """)
-            logging.info("✅ Таблица 'tracking_link_clicks' создана или уже существует")
+async def _migrate_tracking_link_rollup(conn):
+    """Дневная сводка tracking-ссылок и её первичное заполнение."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS tracking_link_daily (
+            code TEXT NOT NULL,
+            day DATE NOT NULL,
+            tariff_code TEXT NOT NULL DEFAULT '',
+            payment_kind TEXT NOT NULL DEFAULT '',
+            clicks INT NOT NULL DEFAULT 0,
+            unique_clicks INT NOT NULL DEFAULT 0,
+            new_clicks INT NOT NULL DEFAULT 0,
+            attributed_users INT NOT NULL DEFAULT 0,
+            paid_payments INT NOT NULL DEFAULT 0,
+            purchases INT NOT NULL DEFAULT 0,
+            new_purchases INT NOT NULL DEFAULT 0,
+            unique_payers INT NOT NULL DEFAULT 0,
+            revenue NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (code, day, tariff_code, payment_kind)
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS tracking_link_visitors (
+            code TEXT NOT NULL,
+            tg_id BIGINT NOT NULL,
+            first_click_day DATE NOT NULL,
+            new_user_counted BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (code, tg_id)
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS tracking_link_payers (
+            code TEXT NOT NULL,
+            tg_id BIGINT NOT NULL,
+            first_day DATE NOT NULL,
+            active_payments INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (code, tg_id)
+        )
+    """)
+    await _rebuild_tracking_link_rollup(conn)
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS notification_state (
-                    id BIGSERIAL PRIMARY KEY,
-                    tg_id BIGINT NOT NULL,
-                    subscription_id BIGINT DEFAULT 0 NOT NULL,
-                    notification_type TEXT NOT NULL,
-                    last_sent_at TIMESTAMP DEFAULT now() NOT NULL,
-                    created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now(),
-                    UNIQUE(tg_id, subscription_id, notification_type)
-                )
-            """)
-            logging.info("✅ Таблица 'notification_state' создана или уже существует")
 
-            # Таблица платежей
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS payments (
-                    id BIGSERIAL PRIMARY KEY,
-                    tg_id BIGINT NOT NULL,
-                    tariff_code TEXT NOT NULL,
-                    amount NUMERIC NOT NULL,
-                    created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now(),
-                    provider TEXT NOT NULL,
-                    invoice_id TEXT UNIQUE NOT NULL,
-                    subscription_id BIGINT,
-                    payment_target TEXT DEFAULT 'new',
-                    target_slot_number INT,
-                    payment_kind TEXT DEFAULT 'subscription',
-                    traffic_package_code TEXT,
-                    tracking_code TEXT,
-                    refund_requested_at TIMESTAMP,
-                    refund_status TEXT,
-                    status TEXT DEFAULT 'pending'
-                )
-            """)
-            logging.info("✅ Таблица 'payments' создана или уже существует")
+async def _migrate_admin_counters(conn):
+    """Счётчики дашборда, триггер сроков подписок и первичное заполнение."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS admin_counters (
+            name TEXT PRIMARY KEY,
+            value NUMERIC NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT now()
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS admin_daily_counters (
+            day DATE PRIMARY KEY,
+            new_users INT NOT NULL DEFAULT 0,
+            revenue NUMERIC NOT NULL DEFAULT 0
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS admin_subscription_expiry (
+            day DATE PRIMARY KEY,
+            subscriptions INT NOT NULL DEFAULT 0
+        )
+    """)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_visible_until "
+        "ON subscriptions(subscription_until) WHERE is_visible = TRUE"
+    )
+    # В subscriptions пишут полтора десятка хелперов, поэтому корзины по дню
+    # окончания ведёт триггер, а не каждый из них
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION admin_subscription_expiry_sync() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND COALESCE(OLD.is_visible, FALSE) AND OLD.subscription_until IS NOT NULL THEN
+                INSERT INTO admin_subscription_expiry (day, subscriptions)
+                VALUES (OLD.subscription_until::date, -1)
+                ON CONFLICT (day) DO UPDATE
+                SET subscriptions = admin_subscription_expiry.subscriptions - 1;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND COALESCE(NEW.is_visible, FALSE) AND NEW.subscription_until IS NOT NULL THEN
+                INSERT INTO admin_subscription_expiry (day, subscriptions)
+                VALUES (NEW.subscription_until::date, 1)
+                ON CONFLICT (day) DO UPDATE
+                SET subscriptions = admin_subscription_expiry.subscriptions + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    await conn.execute("DROP TRIGGER IF EXISTS trg_admin_subscription_expiry_write ON subscriptions")
+    await conn.execute("""
+        CREATE TRIGGER trg_admin_subscription_expiry_write
+        AFTER INSERT OR DELETE ON subscriptions
+        FOR EACH ROW EXECUTE FUNCTION admin_subscription_expiry_sync()
+    """)
+    await conn.execute("DROP TRIGGER IF EXISTS trg_admin_subscription_expiry_update ON subscriptions")
+    await conn.execute("""
+        CREATE TRIGGER trg_admin_subscription_expiry_update
+        AFTER UPDATE OF subscription_until, is_visible ON subscriptions
+        FOR EACH ROW
+        WHEN (
+            OLD.subscription_until::date IS DISTINCT FROM NEW.subscription_until::date
+            OR OLD.is_visible IS DISTINCT FROM NEW.is_visible
+        )
+        EXECUTE FUNCTION admin_subscription_expiry_sync()
+    """)
+    await _reconcile_admin_counters(conn)
+
+
+async def _migrate_admin_user_summary(conn):
+    """Сводка по пользователю для поиска и списка в веб-панели."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS admin_user_summary (
+            tg_id BIGINT PRIMARY KEY,
+            search_text TEXT NOT NULL DEFAULT '',
+            created_at TIMESTAMP NOT NULL,
+            subscriptions_count INT NOT NULL DEFAULT 0,
+            latest_expiry TIMESTAMP,
+            revenue NUMERIC NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT now()
+        )
+    """)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_admin_user_summary_created "
+        "ON admin_user_summary(created_at DESC, tg_id DESC)"
+    )
+    try:
+        async with conn.transaction():
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_admin_user_summary_search "
+                "ON admin_user_summary USING gin (search_text gin_trgm_ops)"
+            )
+    except asyncpg.PostgresError as e:
+        # Без прав на расширение поиск остаётся рабочим, но идёт перебором узкой таблицы
+        logging.warning("⚠️ pg_trgm недоступен, поиск пользователей без индекса: %s", e)
+
+    # Строка пересчитывается целиком по одному пользователю: подписок и
+    # платежей у него единицы, а пересчёт не копит расхождений
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION admin_user_summary_touch(target BIGINT) RETURNS void AS $$
+            INSERT INTO admin_user_summary (
+                tg_id, search_text, created_at, subscriptions_count, latest_expiry, revenue, updated_at
+            )
+            SELECT
+                u.tg_id,
+                lower(u.tg_id::text || ' ' || COALESCE(u.username, '') || ' ' || COALESCE(wa.login, '')),
+                COALESCE(u.created_at, 'epoch'::timestamp),
+                (SELECT COUNT(*) FROM subscriptions s WHERE s.tg_id = u.tg_id AND s.is_visible = TRUE),
+                (SELECT MAX(s.subscription_until) FROM subscriptions s WHERE s.tg_id = u.tg_id AND s.is_visible = TRUE),
+                (SELECT COALESCE(SUM(p.amount), 0) FROM payments p WHERE p.tg_id = u.tg_id AND p.status = 'paid'),
+                now()
+            FROM users u
+            LEFT JOIN web_accounts wa ON wa.service_user_id = u.tg_id
+            WHERE u.tg_id = target
+            ON CONFLICT (tg_id) DO UPDATE
+            SET search_text = EXCLUDED.search_text,
+                created_at = EXCLUDED.created_at,
+                subscriptions_count = EXCLUDED.subscriptions_count,
+                latest_expiry = EXCLUDED.latest_expiry,
+                revenue = EXCLUDED.revenue,
+                updated_at = EXCLUDED.updated_at
+        $$ LANGUAGE sql
+    """)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION admin_user_summary_sync() RETURNS trigger AS $$
+        BEGIN
+            IF TG_TABLE_NAME = 'users' AND TG_OP = 'DELETE' THEN
+                DELETE FROM admin_user_summary WHERE tg_id = OLD.tg_id;
+            ELSIF TG_TABLE_NAME = 'web_accounts' THEN
+                IF TG_OP <> 'INSERT' AND OLD.service_user_id IS NOT NULL THEN
+                    PERFORM admin_user_summary_touch(OLD.service_user_id);
+                END IF;
+                IF TG_OP <> 'DELETE' AND NEW.service_user_id IS NOT NULL THEN
+                    PERFORM admin_user_summary_touch(NEW.service_user_id);
+                END IF;
+            ELSE
+                IF TG_OP <> 'INSERT' THEN
+                    PERFORM admin_user_summary_touch(OLD.tg_id);
+                END IF;
+                IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.tg_id IS DISTINCT FROM OLD.tg_id) THEN
+                    PERFORM admin_user_summary_touch(NEW.tg_id);
+                END IF;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    triggers = {
+        "users": "AFTER INSERT OR DELETE OR UPDATE OF username, created_at ON users",
+        "web_accounts": "AFTER INSERT OR DELETE OR UPDATE OF login, service_user_id ON web_accounts",
+        "subscriptions": "AFTER INSERT OR DELETE OR UPDATE OF tg_id, subscription_until, is_visible ON subscriptions",
+        "payments": "AFTER INSERT OR DELETE OR UPDATE OF tg_id, status, amount ON payments",
+    }
+    for table_name, event in triggers.items():
+        await conn.execute(f"DROP TRIGGER IF EXISTS trg_admin_user_summary ON {table_name}")
+        await conn.execute(
+            f"CREATE TRIGGER trg_admin_user_summary {event} "
+            "FOR EACH ROW EXECUTE FUNCTION admin_user_summary_sync()"
+        )
+    await _rebuild_admin_user_summary(conn)
 
-            # Таблица промокодов
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS promo_codes (
-                    id BIGSERIAL PRIMARY KEY,
-                    code TEXT UNIQUE NOT NULL,
-                    days INT NOT NULL,
-                    max_uses INT NOT NULL,
-                    used_count INT DEFAULT 0,
-                    active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT now()
-                )
-            """)
-            logging.info("✅ Таблица 'promo_codes' создана или уже существует")
 
-            # Таблица использования промокодов пользователями
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS promo_code_users (
-                    id BIGSERIAL PRIMARY KEY,
-                    tg_id BIGINT NOT NULL,
-                    promo_code TEXT NOT NULL,
-                    used_at TIMESTAMP DEFAULT now(),
-                    UNIQUE(tg_id, promo_code),
-                    FOREIGN KEY (promo_code) REFERENCES promo_codes(code) ON DELETE CASCADE
-                )
-            """)
-            logging.info("✅ Таблица 'promo_code_users' создана или уже существует")
+async def _rebuild_admin_user_summary(conn):
+    """Заполнить admin_user_summary заново одним проходом по таблицам."""
+    await conn.execute("TRUNCATE admin_user_summary")
+    await conn.execute("""
+        INSERT INTO admin_user_summary (tg_id, search_text, created_at, subscriptions_count, latest_expiry, revenue)
+        SELECT
+            u.tg_id,
+            lower(u.tg_id::text || ' ' || COALESCE(u.username, '') || ' ' || COALESCE(wa.login, '')),
+            COALESCE(u.created_at, 'epoch'::timestamp),
+            COALESCE(s.subscriptions_count, 0),
+            s.latest_expiry,
+            COALESCE(p.revenue, 0)
+        FROM users u
+        LEFT JOIN web_accounts wa ON wa.service_user_id = u.tg_id
+        LEFT JOIN (
+            SELECT tg_id, COUNT(*) AS subscriptions_count, MAX(subscription_until) AS latest_expiry
+            FROM subscriptions
+            WHERE is_visible = TRUE
+            GROUP BY tg_id
+        ) s ON s.tg_id = u.tg_id
+        LEFT JOIN (
+            SELECT tg_id, SUM(amount) AS revenue
+            FROM payments
+            WHERE status = 'paid'
+            GROUP BY tg_id
+        ) p ON p.tg_id = u.tg_id
+    """)
+
+
+async def _migrate_referral_balances(conn):
+    """Балансы рефереров и партнёров и их первичное заполнение."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_balances (
+            referrer_id BIGINT PRIMARY KEY REFERENCES users(tg_id) ON DELETE CASCADE,
+            referred_users INT NOT NULL DEFAULT 0,
+            earned NUMERIC NOT NULL DEFAULT 0,
+            withdrawn NUMERIC NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT now()
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS partner_balances (
+            partner_id BIGINT PRIMARY KEY REFERENCES partnerships(tg_id) ON DELETE CASCADE,
+            referrals INT NOT NULL DEFAULT 0,
+            earned NUMERIC NOT NULL DEFAULT 0,
+            withdrawn NUMERIC NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT now()
+        )
+    """)
+    await _rebuild_referral_balances(conn)
 
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS discounts (
-                    id BIGSERIAL PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    discount_type TEXT NOT NULL,
-                    value NUMERIC NOT NULL,
-                    target_type TEXT NOT NULL,
-                    target_code TEXT,
-                    starts_at TIMESTAMP NOT NULL,
-                    ends_at TIMESTAMP NOT NULL,
-                    active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now()
-                )
-            """)
-            logging.info("✅ Таблица 'discounts' создана или уже существует")
 
-            # Одноразовые Telegram-challenge и мобильные сессии Way VPN.
-            # Секреты сохраняются только как SHA-256 хэши.
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS mobile_auth_challenges (
-                    id UUID PRIMARY KEY,
-                    start_token_hash TEXT UNIQUE NOT NULL,
-                    code_challenge TEXT NOT NULL,
-                    device_name TEXT,
-                    candidate_tg_id BIGINT,
-                    approved_tg_id BIGINT,
-                    status TEXT NOT NULL DEFAULT 'pending',
-                    expires_at TIMESTAMP NOT NULL,
-                    created_at TIMESTAMP NOT NULL DEFAULT now(),
-                    approved_at TIMESTAMP,
-                    consumed_at TIMESTAMP
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS mobile_sessions (
-                    id UUID PRIMARY KEY,
-                    tg_id BIGINT NOT NULL,
-                    scoped_subscription_id BIGINT,
-                    device_name TEXT,
-                    access_token_hash TEXT UNIQUE NOT NULL,
-                    access_expires_at TIMESTAMP NOT NULL,
-                    refresh_token_hash TEXT UNIQUE NOT NULL,
-                    refresh_expires_at TIMESTAMP NOT NULL,
-                    created_at TIMESTAMP NOT NULL DEFAULT now(),
-                    updated_at TIMESTAMP NOT NULL DEFAULT now(),
-                    last_seen_at TIMESTAMP NOT NULL DEFAULT now(),
-                    revoked_at TIMESTAMP
-                )
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS mobile_access_keys (
-                    id UUID PRIMARY KEY,
-                    tg_id BIGINT UNIQUE NOT NULL,
-                    key_hash TEXT UNIQUE NOT NULL,
-                    created_at TIMESTAMP NOT NULL DEFAULT now(),
-                    last_used_at TIMESTAMP,
-                    revoked_at TIMESTAMP
-                )
-            """)
-            logging.info("✅ Таблицы мобильной авторизации созданы или уже существуют")
-
-            # ═══════════════════════════════════════════════════════════
-            # ЭТАП 2: СОЗДАНИЕ ИНДЕКСОВ (для быстрого поиска)
-            # ═══════════════════════════════════════════════════════════
-
-            index_queries = [
-                # users индексы
-                "CREATE INDEX IF NOT EXISTS idx_users_tg_id ON users(tg_id);",
-                "CREATE INDEX IF NOT EXISTS idx_users_remnawave_uuid ON users(remnawave_uuid);",
-                "CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users(referrer_id);",
-                "CREATE INDEX IF NOT EXISTS idx_users_tracking_code ON users(tracking_code);",
-                "CREATE INDEX IF NOT EXISTS idx_users_next_notification ON users(next_notification_time) WHERE next_notification_time IS NOT NULL;",
-                "CREATE INDEX IF NOT EXISTS idx_web_accounts_login ON web_accounts(login);",
-                "CREATE INDEX IF NOT EXISTS idx_web_accounts_service_user ON web_accounts(service_user_id);",
-                "CREATE INDEX IF NOT EXISTS idx_web_accounts_tracking_code ON web_accounts(tracking_code);",
-                "CREATE INDEX IF NOT EXISTS idx_web_sessions_token ON web_sessions(token_hash);",
-                "CREATE INDEX IF NOT EXISTS idx_web_sessions_expiry ON web_sessions(expires_at);",
-                "CREATE INDEX IF NOT EXISTS idx_mobile_auth_start_token ON mobile_auth_challenges(start_token_hash);",
-                "CREATE INDEX IF NOT EXISTS idx_mobile_auth_candidate ON mobile_auth_challenges(candidate_tg_id, expires_at);",
-                "CREATE INDEX IF NOT EXISTS idx_mobile_auth_expiry ON mobile_auth_challenges(expires_at);",
-                "CREATE INDEX IF NOT EXISTS idx_mobile_sessions_access ON mobile_sessions(access_token_hash);",
-                "CREATE INDEX IF NOT EXISTS idx_mobile_sessions_refresh ON mobile_sessions(refresh_token_hash);",
-                "CREATE INDEX IF NOT EXISTS idx_mobile_sessions_user ON mobile_sessions(tg_id, revoked_at);",
-                "CREATE INDEX IF NOT EXISTS idx_mobile_access_keys_hash ON mobile_access_keys(key_hash);",
-
-                # subscriptions индексы
-                "CREATE INDEX IF NOT EXISTS idx_subscriptions_tg_id ON subscriptions(tg_id);",
-                "CREATE INDEX IF NOT EXISTS idx_subscriptions_uuid ON subscriptions(remnawave_uuid);",
-                "CREATE INDEX IF NOT EXISTS idx_subscriptions_kind_visible ON subscriptions(tg_id, plan_kind, is_visible);",
-                "CREATE INDEX IF NOT EXISTS idx_subscriptions_notification ON subscriptions(next_notification_time) WHERE next_notification_time IS NOT NULL;",
-
-                # payments индексы
-                "CREATE INDEX IF NOT EXISTS idx_payments_tg_id ON payments(tg_id);",
-                "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status);",
-                "CREATE INDEX IF NOT EXISTS idx_payments_provider ON payments(provider);",
-                "CREATE INDEX IF NOT EXISTS idx_payments_subscription_id ON payments(subscription_id);",
-                "CREATE INDEX IF NOT EXISTS idx_payments_tracking_code ON payments(tracking_code);",
-                "CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments(created_at);",
-
-                # notification_state индексы
-                "CREATE INDEX IF NOT EXISTS idx_notification_state_lookup ON notification_state(tg_id, subscription_id, notification_type);",
-                "CREATE INDEX IF NOT EXISTS idx_notification_state_last_sent ON notification_state(last_sent_at);",
-
-                # promo_codes индексы
-                "CREATE INDEX IF NOT EXISTS idx_promo_codes_code ON promo_codes(code);",
-                "CREATE INDEX IF NOT EXISTS idx_discounts_active_period ON discounts(active, starts_at, ends_at);",
-                "CREATE INDEX IF NOT EXISTS idx_promo_code_users_tg_id ON promo_code_users(tg_id);",
-                "CREATE INDEX IF NOT EXISTS idx_promo_code_users_code ON promo_code_users(promo_code);",
-
-                # partnership индексы
-                "CREATE INDEX IF NOT EXISTS idx_partnerships_tg_id ON partnerships(tg_id);",
-                "CREATE INDEX IF NOT EXISTS idx_partner_referrals_partner_id ON partner_referrals(partner_id);",
-                "CREATE INDEX IF NOT EXISTS idx_partner_earnings_partner_id ON partner_earnings(partner_id);",
-                "CREATE INDEX IF NOT EXISTS idx_partner_withdrawals_partner_id ON partner_withdrawals(partner_id);",
-
-                # referral индексы
-                "CREATE INDEX IF NOT EXISTS idx_referral_earnings_referrer_id ON referral_earnings(referrer_id);",
-                "CREATE INDEX IF NOT EXISTS idx_referral_earnings_referred_user_id ON referral_earnings(referred_user_id);",
-                "CREATE INDEX IF NOT EXISTS idx_referral_withdrawals_referrer_id ON referral_withdrawals(referrer_id);",
-                "CREATE INDEX IF NOT EXISTS idx_traffic_purchases_subscription_id ON traffic_purchases(subscription_id);",
-                "CREATE INDEX IF NOT EXISTS idx_device_addon_purchases_subscription_id ON device_addon_purchases(subscription_id);",
-                "CREATE INDEX IF NOT EXISTS idx_device_addon_purchases_invoice ON device_addon_purchases(invoice_id);",
-                "CREATE INDEX IF NOT EXISTS idx_device_addon_purchases_expiry ON device_addon_purchases(valid_until, status, expired_processed_at);",
-                "CREATE INDEX IF NOT EXISTS idx_traffic_cycles_subscription_id ON subscription_traffic_cycles(subscription_id);",
-                "CREATE INDEX IF NOT EXISTS idx_tracking_links_code ON tracking_links(code);",
-                "CREATE INDEX IF NOT EXISTS idx_tracking_clicks_code ON tracking_link_clicks(code);",
-                "CREATE INDEX IF NOT EXISTS idx_tracking_clicks_tg_id ON tracking_link_clicks(tg_id);",
-            ]
-
-            for query in index_queries:
-                try:
-                    await conn.execute(query)
-                except Exception as e:
-                    # Индекс уже может существовать - это нормально
-                    if "already exists" not in str(e).lower():
-                        logging.debug(f"Index creation note: {e}")
-
-            logging.info("✅ Индексы созданы или уже существуют")
-
-            # ═══════════════════════════════════════════════════════════
-            # ЭТАП 3: ДОБАВЛЕНИЕ НЕДОСТАЮЩИХ СТОЛБЦОВ
-            # ═══════════════════════════════════════════════════════════
-
-            # Эти столбцы могут не существовать в старых БД - добавляем их
-            alter_queries = [
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_gift_attempt TIMESTAMP;",
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_promo_attempt TIMESTAMP;",
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_payment_check TIMESTAMP;",
-                "ALTER TABLE payments ADD COLUMN IF NOT EXISTS subscription_id BIGINT;",
-                "ALTER TABLE payments ADD COLUMN IF NOT EXISTS payment_target TEXT DEFAULT 'new';",
-                "ALTER TABLE payments ADD COLUMN IF NOT EXISTS target_slot_number INT;",
-                "ALTER TABLE payments ADD COLUMN IF NOT EXISTS payment_kind TEXT DEFAULT 'subscription';",
-                "ALTER TABLE payments ADD COLUMN IF NOT EXISTS traffic_package_code TEXT;",
-                "ALTER TABLE payments ADD COLUMN IF NOT EXISTS tracking_code TEXT;",
-                "ALTER TABLE payments ADD COLUMN IF NOT EXISTS refund_requested_at TIMESTAMP;",
-                "ALTER TABLE payments ADD COLUMN IF NOT EXISTS refund_status TEXT;",
-                "ALTER TABLE mobile_sessions ADD COLUMN IF NOT EXISTS scoped_subscription_id BIGINT;",
-                "CREATE INDEX IF NOT EXISTS idx_mobile_sessions_scope ON mobile_sessions(scoped_subscription_id, revoked_at);",
-            ]
-
-            for query in alter_queries:
-                try:
-                    await conn.execute(query)
-                    logging.info(f"✅ Столбец добавлен: {query.strip()}")
-                except Exception as e:
-                    if "already exists" in str(e).lower() or "duplicate" in str(e).lower():
-                        logging.debug(f"Столбец уже существует, пропускаем: {query.strip()}")
-                    else:
-                        logging.warning(f"⚠️ Ошибка миграции: {e}")
-
-            # ═══════════════════════════════════════════════════════════
-            # ЭТАП 3.5: ОЧИСТКА ДУБЛИКАТОВ И ДОБАВЛЕНИЕ CONSTRAINTS
-            # ═══════════════════════════════════════════════════════════
+async def _rebuild_referral_balances(conn):
+    """Пересчитать referral_balances и partner_balances из журналов начислений и выводов."""
+    await conn.execute("TRUNCATE referral_balances, partner_balances")
+    await conn.execute("""
+        INSERT INTO referral_balances (referrer_id, referred_users, earned, withdrawn)
+        SELECT
+            r.referrer_id,
+            COALESCE(e.referred_users, 0),
+            COALESCE(e.earned, 0),
+            COALESCE(w.withdrawn, 0)
+        FROM (
+            SELECT referrer_id FROM referral_earnings
+            UNION
+            SELECT referrer_id FROM referral_withdrawals
+        ) r
+        JOIN users u ON u.tg_id = r.referrer_id
+        LEFT JOIN (
+            SELECT referrer_id, COUNT(DISTINCT referred_user_id) AS referred_users, SUM(referral_share) AS earned
+            FROM referral_earnings
+            GROUP BY referrer_id
+        ) e ON e.referrer_id = r.referrer_id
+        LEFT JOIN (
+            SELECT referrer_id, SUM(amount) AS withdrawn
+            FROM referral_withdrawals
+            GROUP BY referrer_id
+        ) w ON w.referrer_id = r.referrer_id
+    """)
+    await conn.execute("""
+        INSERT INTO partner_balances (partner_id, referrals, earned, withdrawn)
+        SELECT
+            p.tg_id,
+            COALESCE(r.referrals, 0),
+            COALESCE(e.earned, 0),
+            COALESCE(w.withdrawn, 0)
+        FROM partnerships p
+        LEFT JOIN (
+            SELECT partner_id, COUNT(DISTINCT referred_user_id) AS referrals
+            FROM partner_referrals
+            GROUP BY partner_id
+        ) r ON r.partner_id = p.tg_id
+        LEFT JOIN (
+            SELECT partner_id, SUM(partner_share) AS earned
+            FROM partner_earnings
+            GROUP BY partner_id
+        ) e ON e.partner_id = p.tg_id
+        LEFT JOIN (
+            SELECT partner_id, SUM(amount) AS withdrawn
+            FROM partner_withdrawals
+            WHERE status = 'completed'
+            GROUP BY partner_id
+        ) w ON w.partner_id = p.tg_id
+    """)
+
+
+async def _migrate_broadcast_jobs(conn):
+    """Рассылки как задачи: получатели со статусом и курсор последней пачки."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            mode TEXT NOT NULL,
+            source_chat_id BIGINT NOT NULL,
+            source_message_id BIGINT NOT NULL,
+            buttons TEXT[] NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_by BIGINT,
+            notify_chat_id BIGINT,
+            notify_message_id BIGINT,
+            cursor_tg_id BIGINT NOT NULL DEFAULT 0,
+            total INT NOT NULL DEFAULT 0,
+            sent INT NOT NULL DEFAULT 0,
+            blocked INT NOT NULL DEFAULT 0,
+            unreachable INT NOT NULL DEFAULT 0,
+            errors INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT now(),
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT now()
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id BIGINT NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+            tg_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (job_id, tg_id)
+        )
+    """)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending "
+        "ON broadcast_recipients(job_id, tg_id) WHERE status = 'pending'"
+    )
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_active ON broadcast_jobs(id) "
+        "WHERE status IN ('pending', 'running')"
+    )
+
+
+async def _migrate_scheduled_notifications(conn):
+    """Очередь напоминаний об окончании подписки по времени отправки."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_notifications (
+            id BIGSERIAL PRIMARY KEY,
+            subscription_id BIGINT NOT NULL REFERENCES subscriptions(id) ON DELETE CASCADE,
+            tg_id BIGINT NOT NULL,
+            notification_type TEXT NOT NULL,
+            subscription_until TIMESTAMP NOT NULL,
+            due_at TIMESTAMP NOT NULL,
+            claimed_until TIMESTAMP,
+            created_at TIMESTAMP DEFAULT now(),
+            UNIQUE (subscription_id, notification_type)
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_notifications_due ON scheduled_notifications(due_at)")
+    await _schedule_expiry_notifications(conn, None)
+
+
+async def _migrate_expired_notification_index(conn):
+    """Индекс под выборку получателей напоминания «подписка закончилась»."""
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_renewable_v2 ON subscriptions(tg_id, subscription_until) "
+        "WHERE generation = 'v2' AND is_visible = TRUE AND is_renewable = TRUE AND tg_id > 0"
+    )
+
+
+async def _migrate_subscription_updated_at_utc(conn):
+    """subscriptions.updated_at по UTC, как снимки зеркала Remnawave."""
+    # Хелперы пишут updated_at = now() по часовому поясу сессии; триггер
+    # ставит вместо него UTC, чтобы сравнение со snapshot_at в
+    # fresh_mirror_rows и get_subscription_expiry_drift_from_mirror шло по
+    # одним часам. last_traffic_sync_at и changed_at зеркала, которые с ними
+    # сравниваются, хелперы уже пишут по UTC; накопленные значения переводим
+    # до создания триггера, иначе он перезапишет updated_at
+    session_is_utc = await conn.fetchval("SELECT now() AT TIME ZONE 'UTC' = now()::timestamp")
+    if not session_is_utc:
+        await conn.execute("""
+            UPDATE subscriptions
+            SET updated_at = updated_at::timestamptz AT TIME ZONE 'UTC',
+                last_traffic_sync_at = last_traffic_sync_at::timestamptz AT TIME ZONE 'UTC'
+        """)
+        await conn.execute(
+            "UPDATE remnawave_users_mirror SET changed_at = changed_at::timestamptz AT TIME ZONE 'UTC'"
+        )
+    await conn.execute(
+        "ALTER TABLE remnawave_users_mirror ALTER COLUMN changed_at SET DEFAULT (now() AT TIME ZONE 'UTC')"
+    )
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION subscriptions_updated_at_utc() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := now() AT TIME ZONE 'UTC';
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    await conn.execute("DROP TRIGGER IF EXISTS trg_subscriptions_updated_at_utc ON subscriptions")
+    await conn.execute("""
+        CREATE TRIGGER trg_subscriptions_updated_at_utc
+        BEFORE INSERT OR UPDATE OF updated_at ON subscriptions
+        FOR EACH ROW EXECUTE FUNCTION subscriptions_updated_at_utc()
+    """)
+
+
+async def _migrate_tracking_link_rollup_utc_days(conn):
+    """Пересобрать сводку ссылок: прежняя сборка брала дни по часам сессии."""
+    await _rebuild_tracking_link_rollup(conn)
 
-            try:
-                # Удаляем дубликаты в partner_referrals (оставляем только первый)
-                await conn.execute("""
-                    DELETE FROM partner_referrals WHERE id NOT IN (
-                        SELECT MIN(id) FROM partner_referrals
-                        GROUP BY partner_id, referred_user_id
-                    )
-                """)
-                logging.info("✅ Удалены дубликаты в таблице partner_referrals")
-            except Exception as e:
-                logging.debug(f"Дубликатов не найдено или уже удалены: {e}")
 
-            try:
-                # Добавляем UNIQUE constraint если его ещё нет
-                await conn.execute("""
-                    ALTER TABLE partner_referrals
-                    ADD CONSTRAINT unique_partner_referral UNIQUE (partner_id, referred_user_id)
-                """)
-                logging.info("✅ Добавлено UNIQUE ограничение на partner_referrals (partner_id, referred_user_id)")
-            except Exception as e:
-                if "already exists" in str(e).lower() or "duplicate" in str(e).lower():
-                    logging.debug("UNIQUE ограничение уже существует")
-                else:
-                    logging.debug(f"Примечание по UNIQUE: {e}")
-
-            # ═══════════════════════════════════════════════════════════
-            # ЭТАП 4: СИНХРОНИЗАЦИЯ СХЕМЫ ТАБЛИЦ
-            # ═══════════════════════════════════════════════════════════
-
-            logging.info("Syncing table schemas...")
-
-            # Синхронизируем таблицы
-            await sync_table_schema(conn, 'users', expected_users_columns)
-            await sync_table_schema(conn, 'subscriptions', expected_subscriptions_columns)
-            await sync_table_schema(conn, 'payments', expected_payments_columns)
-            await sync_table_schema(conn, 'promo_codes', expected_promo_columns)
-            await sync_table_schema(conn, 'promo_code_users', expected_promo_usage_columns)
-            await sync_table_schema(conn, 'discounts', expected_discounts_columns)
-            await sync_table_schema(conn, 'partnerships', expected_partnerships_columns)
-            await sync_table_schema(conn, 'partner_referrals', expected_partner_referrals_columns)
-            await sync_table_schema(conn, 'partner_earnings', expected_partner_earnings_columns)
-            await sync_table_schema(conn, 'partner_withdrawals', expected_partner_withdrawals_columns)
-            await sync_table_schema(conn, 'referral_earnings', expected_referral_earnings_columns)
-            await sync_table_schema(conn, 'referral_withdrawals', expected_referral_withdrawals_columns)
-            await sync_table_schema(conn, 'traffic_purchases', expected_traffic_purchases_columns)
-            await sync_table_schema(conn, 'device_addon_purchases', expected_device_addon_purchases_columns)
-            await sync_table_schema(conn, 'subscription_traffic_cycles', expected_traffic_cycles_columns)
-            await sync_table_schema(conn, 'tracking_links', expected_tracking_links_columns)
-            await sync_table_schema(conn, 'tracking_link_clicks', expected_tracking_clicks_columns)
-            await sync_table_schema(conn, 'notification_state', expected_notification_state_columns)
-
-            normalized_links = await conn.fetchval(
-                """
-                WITH candidates AS (
-                    SELECT id, code, LOWER(TRIM(code)) AS normalized_code
-                    FROM tracking_links
-                    WHERE code <> LOWER(TRIM(code))
-                ),
-                safe_candidates AS (
-                    SELECT candidates.*
-                    FROM candidates
-                    WHERE NOT EXISTS (
-                        SELECT 1
-                        FROM tracking_links existing
-                        WHERE existing.code = candidates.normalized_code
-                          AND existing.id <> candidates.id
-                    )
-                ),
-                updated AS (
-                    UPDATE tracking_links link
-                    SET code = safe_candidates.normalized_code,
-                        updated_at = now()
-                    FROM safe_candidates
-                    WHERE link.id = safe_candidates.id
-                    RETURNING link.id
-                )
-                SELECT COUNT(*) FROM updated
-                """
-            )
-            if normalized_links:
-                logging.info("✅ Tracking-ссылки приведены к нижнему регистру: %s", normalized_links)
+# ────────────────────────────────────────────────
+#            ЖУРНАЛ МИГРАЦИЙ
+# ────────────────────────────────────────────────
 
-            await conn.execute(
-                """
-                UPDATE tracking_link_clicks
-                SET code = LOWER(TRIM(code))
-                WHERE code <> LOWER(TRIM(code))
-                """
-            )
-            await conn.execute(
-                """
-                UPDATE users
-                SET tracking_code = LOWER(TRIM(tracking_code))
-                WHERE tracking_code IS NOT NULL
-                  AND tracking_code <> LOWER(TRIM(tracking_code))
-                """
-            )
-            await conn.execute(
-                """
-                UPDATE web_accounts
-                SET tracking_code = LOWER(TRIM(tracking_code))
-                WHERE tracking_code IS NOT NULL
-                  AND tracking_code <> LOWER(TRIM(tracking_code))
-                """
-            )
-            await conn.execute(
-                """
-                UPDATE payments
-                SET tracking_code = LOWER(TRIM(tracking_code))
-                WHERE tracking_code IS NOT NULL
-                  AND tracking_code <> LOWER(TRIM(tracking_code))
-                """
-            )
+MIGRATION_LOCK_ID = 7_300_115  # pg_advisory_lock: миграции применяет один процесс
 
-            restored_tracking_users = await conn.fetchval(
-                """
-                WITH first_click AS (
-                    SELECT DISTINCT ON (click.tg_id)
-                        click.tg_id,
-                        click.code
-                    FROM tracking_link_clicks click
-                    JOIN tracking_links link ON link.code = click.code
-                    WHERE click.tg_id > 0
-                      AND link.is_active = TRUE
-                    ORDER BY click.tg_id, click.clicked_at ASC, click.id ASC
-                ),
-                restored AS (
-                    UPDATE users user_row
-                    SET tracking_code = first_click.code
-                    FROM first_click
-                    WHERE user_row.tg_id = first_click.tg_id
-                      AND user_row.tracking_code IS NULL
-                    RETURNING user_row.tg_id
-                )
-                SELECT COUNT(*) FROM restored
-                """
-            )
-            if restored_tracking_users:
-                logging.info(
-                    "✅ Восстановлены tracking-коды пользователей по старым кликам: %s",
-                    restored_tracking_users,
-                )
 
-            await conn.execute(
-                """
-                INSERT INTO subscriptions (
-                    tg_id,
-                    slot_number,
-                    remnawave_uuid,
-                    remnawave_username,
-                    subscription_until,
-                    squad_uuid,
-                    is_active,
-                    generation,
-                    is_visible,
-                    is_renewable,
-                    next_notification_time,
-                    notification_type
-                )
-                SELECT
-                    u.tg_id,
-                    1,
-                    u.remnawave_uuid,
-                    u.remnawave_username,
-                    u.subscription_until,
-                    u.squad_uuid,
-                    TRUE,
-                    'legacy',
-                    FALSE,
-                    FALSE,
-                    u.next_notification_time,
-                    u.notification_type
-                FROM users u
-                WHERE u.remnawave_uuid IS NOT NULL
-                  AND NOT EXISTS (
-                      SELECT 1 FROM subscriptions s
-                      WHERE s.tg_id = u.tg_id AND s.slot_number = 1
-                  )
-                """
-            )
+@dataclass(frozen=True)
+class MigrationStep:
+    """Шаг миграции. Контрольная сумма — от версии, имени, revision и checksum_inputs.
 
-            migrated_legacy = await conn.fetchval(
-                """
-                WITH
-                migrated AS (
-                    UPDATE subscriptions AS subscription
-                    SET plan_kind = 'bypass',
-                        generation = 'legacy',
-                        is_visible = FALSE,
-                        is_renewable = FALSE,
-                        legacy_readonly = TRUE,
-                        legacy_limit_removal_pending = subscription.remnawave_uuid IS NOT NULL,
-                        traffic_enabled = FALSE,
-                        base_traffic_bytes = 0,
-                        current_paid_traffic_bytes = 0,
-                        carried_traffic_bytes = 0,
-                        current_period_limit_bytes = 0,
-                        traffic_reset_at = NULL,
-                        last_traffic_sync_at = NULL,
-                        next_notification_time = NULL,
-                        notification_type = NULL,
-                        updated_at = now()
-                    WHERE subscription.remnawave_uuid IS NOT NULL
-                      AND (
-                            LOWER(TRIM(COALESCE(subscription.plan_kind, ''))) NOT IN ('regular', 'bypass')
-                         OR (
-                                subscription.plan_kind = 'bypass'
-                            AND subscription.generation = 'v2'
-                            AND subscription.is_visible = TRUE
-                            AND COALESCE(subscription.remnawave_username, '') !~
-                                '^(tg_[0-9]+|web_[0-9]+)_bypass_[0-9]+$'
-                         )
-                      )
-                    RETURNING subscription.id
+    Обычный шаг выполняется один раз в транзакции, правка после применения —
+    ошибка. Повторяемый (repeatable) шаг идемпотентен и перезапускается, когда
+    меняется его контрольная сумма. Исходник в сумму не входит: правку apply
+    или его хелперов, меняющую схему или данные, отмечают подъёмом revision,
+    а комментарии и рефакторинг не трогают журнал.
+    """
+
+    version: int
+    name: str
+    apply: Callable[[asyncpg.Connection], Awaitable[None]]
+    repeatable: bool = False
+    checksum_inputs: tuple = ()
+    revision: int = 1
+
+    def checksum(self) -> str:
+        source = f"{self.version}:{self.name}:{self.revision}:{self.checksum_inputs!r}"
+        return hashlib.sha256(source.encode()).hexdigest()
+
+
+# Столбцы таблиц под sync_table_schema по-прежнему описываются в базовой схеме
+# (иначе её повторный прогон удалит их); новые таблицы, индексы и переносы
+# данных — отдельными шагами с номером больше предыдущего.
+MIGRATIONS: list[MigrationStep] = [
+    MigrationStep(
+        1,
+        "baseline_schema",
+        _migrate_baseline_schema,
+        repeatable=True,
+        checksum_inputs=(BYPASS_HWID_DEVICE_LIMIT, REGULAR_HWID_DEVICE_LIMIT, BYPASS_BASE_TRAFFIC_GB, GB_BYTES),
+    ),
+    MigrationStep(2, "tracking_link_rollup", _migrate_tracking_link_rollup),
+    MigrationStep(3, "admin_counters", _migrate_admin_counters),
+    MigrationStep(4, "admin_user_summary", _migrate_admin_user_summary),
+    MigrationStep(5, "referral_balances", _migrate_referral_balances),
+    MigrationStep(6, "broadcast_jobs", _migrate_broadcast_jobs),
+    MigrationStep(7, "scheduled_notifications", _migrate_scheduled_notifications),
+    MigrationStep(8, "expired_notification_index", _migrate_expired_notification_index),
+    MigrationStep(9, "subscription_updated_at_utc", _migrate_subscription_updated_at_utc),
+    MigrationStep(10, "tracking_link_rollup_utc_days", _migrate_tracking_link_rollup_utc_days),
+]
+
+
+async def _read_migration_ledger(conn) -> dict[int, dict]:
+    try:
+        rows = await conn.fetch("SELECT version, name, checksum, applied_at, duration_ms FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return {}
+    return {row["version"]: dict(row) for row in rows}
+
+
+def _pending_migrations(applied: dict[int, dict], force: bool = False) -> list[MigrationStep]:
+    pending = []
+    for step in sorted(MIGRATIONS, key=lambda item: item.version):
+        record = applied.get(step.version)
+        if record is None:
+            pending.append(step)
+        elif record["checksum"] != step.checksum():
+            if not step.repeatable:
+                raise RuntimeError(
+                    f"Migration {step.version} ({step.name}) changed after it was applied; add a new step instead"
                 )
-                SELECT COUNT(*) FROM migrated
-                """
+            pending.append(step)
+        elif force and step.repeatable:
+            pending.append(step)
+    return pending
+
+
+async def migration_status() -> list[dict]:
+    """Шаги миграций с отметкой, применён ли каждый и совпадает ли сумма."""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        applied = await _read_migration_ledger(conn)
+    status = []
+    for step in sorted(MIGRATIONS, key=lambda item: item.version):
+        record = applied.get(step.version)
+        status.append({
+            "version": step.version,
+            "name": step.name,
+            "repeatable": step.repeatable,
+            "applied_at": record["applied_at"] if record else None,
+            "duration_ms": record["duration_ms"] if record else None,
+            "up_to_date": bool(record) and record["checksum"] == step.checksum(),
+        })
+    return status
+
+
+async def run_migrations(*, force: bool = False) -> list[str]:
+    """Применить недостающие шаги миграций.
+
+    На тёплом старте это один SELECT из schema_migrations. force заново
+    прогоняет повторяемые шаги. Возвращает имена применённых шагов.
+    """
+    started = time.perf_counter()
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        if not _pending_migrations(await _read_migration_ledger(conn), force):
+            logging.info(
+                "✅ Схема БД актуальна (версия %s), проверка заняла %.1f мс",
+                max(step.version for step in MIGRATIONS),
+                (time.perf_counter() - started) * 1000,
             )
-            if migrated_legacy:
-                logging.info(
-                    "✅ Старые подписки переведены в режим только для просмотра в боте: %s",
-                    migrated_legacy,
+            return []
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                checksum TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now(),
+                duration_ms INT NOT NULL DEFAULT 0
+            )
+        """)
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+        try:
+            # Пока ждали блокировку, шаги мог применить другой процесс
+            applied_names = []
+            for step in _pending_migrations(await _read_migration_ledger(conn), force):
+                step_started = time.perf_counter()
+                logging.info("Applying migration %s (%s)...", step.version, step.name)
+                if step.repeatable:
+                    await step.apply(conn)
+                else:
+                    async with conn.transaction():
+                        await step.apply(conn)
+                duration_ms = int((time.perf_counter() - step_started) * 1000)
+                await conn.execute(
+                    """
+                    INSERT INTO schema_migrations (version, name, checksum, applied_at, duration_ms)
+                    VALUES ($1, $2, $3, now(), $4)
+                    ON CONFLICT (version) DO UPDATE
+                    SET name = EXCLUDED.name,
+                        checksum = EXCLUDED.checksum,
+                        applied_at = EXCLUDED.applied_at,
+                        duration_ms = EXCLUDED.duration_ms
+                    """,
+                    step.version,
+                    step.name,
+                    step.checksum(),
+                    duration_ms,
                 )
+                applied_names.append(step.name)
+                logging.info("✅ Migration %s (%s) applied in %s ms", step.version, step.name, duration_ms)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
 
-            await conn.execute(
-                """
-                UPDATE subscriptions
-                SET generation = 'legacy',
-                    is_visible = FALSE,
-                    is_renewable = FALSE
-                WHERE generation = 'legacy'
-                   OR generation IS NULL
-                """
-            )
+    logging.info(
+        "✅ Миграции применены (%s) за %.2f с",
+        ", ".join(applied_names),
+        time.perf_counter() - started,
+    )
+    return applied_names
 
-            await conn.execute(
-                """
-                UPDATE subscriptions
-                SET hwid_device_limit = CASE
-                    WHEN plan_kind = 'bypass' THEN GREATEST(COALESCE(hwid_device_limit, 0), $1::INT)
-                    ELSE GREATEST(COALESCE(hwid_device_limit, 0), $2::INT)
-                END
-                WHERE generation = 'v2'
-                  AND is_visible = TRUE
-                  AND (
-                        COALESCE(hwid_device_limit, 0) <= 0
-                     OR (plan_kind = 'bypass' AND COALESCE(hwid_device_limit, 0) < $1::INT)
-                     OR (COALESCE(plan_kind, 'regular') <> 'bypass' AND COALESCE(hwid_device_limit, 0) < $2::INT)
-                  )
-                """,
-                BYPASS_HWID_DEVICE_LIMIT,
-                REGULAR_HWID_DEVICE_LIMIT,
+
+async def init_db(migrate: bool = DB_MIGRATE_ON_STARTUP):
+    """Инициализировать пулы подключений и создать таблицы если нужно"""
+    try:
+        for name, settings in POOL_SETTINGS.items():
+            _pools[name] = await asyncpg.create_pool(
+                DATABASE_URL,
+                min_size=settings.min_size,
+                max_size=settings.max_size,
+                command_timeout=settings.command_timeout,
+            )
+        if DB_REPLICA_URL:
+            settings = POOL_SETTINGS["analytics"]
+            _pools[REPLICA_POOL] = await asyncpg.create_pool(
+                DB_REPLICA_URL,
+                min_size=settings.min_size,
+                max_size=settings.max_size,
+                command_timeout=settings.command_timeout,
             )
+        logging.info(
+            "Database pools initialized: %s",
+            ", ".join(f"{name}={pool.get_max_size()}" for name, pool in _pools.items()),
+        )
 
-            await conn.execute(
-                """
-                UPDATE subscriptions
-                SET base_traffic_bytes = $1,
-                    current_period_limit_bytes = GREATEST(
-                        COALESCE(current_period_limit_bytes, 0),
-                        $1 + COALESCE(carried_traffic_bytes, 0) + COALESCE(current_paid_traffic_bytes, 0)
-                    ),
-                    last_traffic_sync_at = NULL,
-                    updated_at = now()
-                WHERE generation = 'v2'
-                  AND plan_kind = 'bypass'
-                  AND is_visible = TRUE
-                  AND COALESCE(base_traffic_bytes, 0) < $1
-                """,
-                BYPASS_BASE_TRAFFIC_GB * GB_BYTES,
+        # Запускаем миграции при инициализации БД (на тёплом старте — одна проверка версии)
+        if migrate:
+            await run_migrations()
+        else:
+            pending = [item["name"] for item in await migration_status() if not item["up_to_date"]]
+            if pending:
+                logging.warning("⚠️ Не применены миграции: %s (python3 scripts/migrate.py apply)", ", ".join(pending))
+
+    except Exception as e:
+        logging.error(f"Failed to initialize database pool: {e}")
+        raise
+
+
+async def close_db():
+    """Закрыть пулы подключений"""
+    await _user_locks.close()
+    for name in list(_pools):
+        await _pools.pop(name).close()
+    logging.info("Database pools closed")
+
+
+_workload: ContextVar[str] = ContextVar("db_workload", default="interactive")
+
+
+@contextmanager
+def workload(name: str):
+    """Направить запросы блока (и созданных в нём задач) в пул name."""
+    if name not in POOL_SETTINGS:
+        raise ValueError(f"Unknown database workload: {name}")
+    token = _workload.set(name)
+    try:
+        yield
+    finally:
+        _workload.reset(token)
+
+
+def _analytics(func):
+    """Тяжёлое чтение для веб-панели: пул analytics, при DB_REPLICA_URL — реплика."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with workload("analytics"):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+def _raw_pool(name: str):
+    pool = _pools.get(name)
+    if pool is None:
+        raise RuntimeError("Database pool not initialized. Call init_db() first.")
+    return pool
+
+
+async def get_pool(name: str | None = None):
+    """Пул подключений: по имени или для текущей нагрузки.
+
+    acquire() этого пула учитывается в query_stats() под именем вызывающей
+    функции: ожидание пула и время, пока соединение было занято.
+    """
+    name = name or _workload.get()
+    return _InstrumentedPool(name, _raw_pool(name))
+
+
+class _InstrumentedPool:
+    """Пул, у которого pool.acquire() пишет метрики как db_execute."""
+
+    def __init__(self, name: str, pool):
+        self._name = name
+        self._pool = pool
+
+    def acquire(self, *, timeout: float | None = None):
+        return _InstrumentedAcquire(self._name, self._pool, _caller_name(), timeout)
+
+    def __getattr__(self, attr):
+        return getattr(self._pool, attr)
+
+
+class _InstrumentedAcquire:
+    def __init__(self, pool_name: str, pool, query_name: str, timeout: float | None):
+        self.pool_name = pool_name
+        self.pool = pool
+        self.query_name = query_name
+        self.timeout = timeout
+        self.conn = None
+        self.waited = 0.0
+        self.started = 0.0
+
+    async def __aenter__(self):
+        self.conn, self.waited = await _acquire(self.pool_name, self.timeout, pool=self.pool)
+        self.started = time.perf_counter()
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.pool.release(self.conn)
+        finally:
+            _record_query(
+                self.query_name,
+                time.perf_counter() - self.started,
+                None,
+                self.waited,
+                error=exc_type is not None,
             )
 
-            logging.info("✅ Синхронизация схемы завершена")
 
-            logging.info("━" * 60)
-            logging.info("✨ ВСЕ МИГРАЦИИ УСПЕШНО ЗАВЕРШЕНЫ ✨")
-            logging.info("━" * 60)
+_pool_metrics: dict[str, dict] = {}
+
+
+def _metrics_for(name: str) -> dict:
+    metrics = _pool_metrics.get(name)
+    if metrics is None:
+        metrics = _pool_metrics[name] = {
+            "acquires": 0,
+            "waiting": 0,
+            "max_waiting": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "timeouts": 0,
+        }
+    return metrics
+
+
+async def _acquire(name: str, timeout: float | None = None, *, pool=None):
+    """Взять соединение из пула name с учётом ожидания; вернуть (conn, секунды)."""
+    if pool is None:
+        pool = _raw_pool(name)
+    settings = POOL_SETTINGS.get(name, POOL_SETTINGS["analytics"])
+    timeout = timeout or settings.acquire_timeout
+    metrics = _metrics_for(name)
+    metrics["waiting"] += 1
+    metrics["max_waiting"] = max(metrics["max_waiting"], metrics["waiting"])
+    started = time.perf_counter()
+    try:
+        conn = await pool.acquire(timeout=timeout)
+    except asyncio.TimeoutError:
+        metrics["timeouts"] += 1
+        logging.warning("DB pool %s exhausted: no connection in %ss", name, timeout)
+        raise
+    finally:
+        metrics["waiting"] -= 1
+    waited = time.perf_counter() - started
+    metrics["acquires"] += 1
+    metrics["wait_seconds"] += waited
+    metrics["max_wait_seconds"] = max(metrics["max_wait_seconds"], waited)
+    return conn, waited
+
+
+def _query_pool(query: str) -> str:
+    name = _workload.get()
+    if name == "analytics" and REPLICA_POOL in _pools and not _is_write_query(query):
+        return REPLICA_POOL
+    return name
+
+
+# Ожидание свободного соединения пула: в рамках апдейтов/запросов и вне их
+# (фоновые циклы). Сравнить DB_BIND_CONNECTION=1 и 0 — по этим счётчикам.
+_pool_wait_stats = {
+    "scopes": 0,
+    "scope_acquires": 0,
+    "scope_wait_seconds": 0.0,
+    "max_scope_wait_seconds": 0.0,
+    "unscoped_acquires": 0,
+    "unscoped_wait_seconds": 0.0,
+}
+
+
+class _BoundConnection:
+    """Соединение, привязанное к одному апдейту Telegram или HTTP-запросу.
+
+    Берётся из пула при первом запросе и возвращается в конце области.
+    Принадлежит задаче, открывшей область: задачи, порождённые внутри
+    апдейта, наследуют контекст, но берут соединения из пула сами, иначе
+    пережили бы область или попали бы в чужую транзакцию.
+    """
 
-        except Exception as e:
-            logging.error(f"❌ ОШИБКА МИГРАЦИИ: {e}")
-            raise
+    def __init__(self, pool_name: str = "interactive"):
+        self.pool_name = pool_name
+        self.owner = asyncio.current_task()
+        self.conn = None
+        self.lock = asyncio.Lock()
+        self.closed = False
+        self.transactions = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.acquires = 0
+        self.wait_seconds = 0.0
+        self.memo: dict[tuple, dict] = {}
+        self.memo_generation = 0
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+    async def connection(self):
+        if self.conn is None:
+            self.conn, waited = await _acquire(self.pool_name)
+            self.record_wait(waited)
+        return self.conn
+
+    def record_wait(self, seconds: float):
+        self.acquires += 1
+        self.wait_seconds += seconds
+
+    def begin_transaction(self):
+        self.transactions += 1
+        self.idle.clear()
+
+    def end_transaction(self):
+        self.transactions -= 1
+        if not self.transactions:
+            self.idle.set()
+
+    async def _return_connection(self):
+        pool = _pools.get(self.pool_name)
+        if self.conn is not None and pool is not None:
+            conn, self.conn = self.conn, None
+            await pool.release(conn)
+
+    async def detach(self):
+        """Вернуть соединение в пул до конца области, если нет транзакции."""
+        async with self.lock:
+            if not self.transactions:
+                await self._return_connection()
+
+    async def release(self):
+        # Открытая транзакция должна зафиксироваться или откатиться на этом
+        # же соединении до возврата его в пул
+        await self.idle.wait()
+        async with self.lock:
+            self.closed = True
+            await self._return_connection()
+        _pool_wait_stats["scopes"] += 1
+        _pool_wait_stats["scope_acquires"] += self.acquires
+        _pool_wait_stats["scope_wait_seconds"] += self.wait_seconds
+        _pool_wait_stats["max_scope_wait_seconds"] = max(_pool_wait_stats["max_scope_wait_seconds"], self.wait_seconds)
+        _memo_stats["hits"] += self.memo_hits
+        _memo_stats["misses"] += self.memo_misses
+        _memo_stats["max_scope_hits"] = max(_memo_stats["max_scope_hits"], self.memo_hits)
+        if self.memo_hits:
+            logging.debug("DB memo saved %s of %s read queries in this update", self.memo_hits, self.memo_hits + self.memo_misses)
+        self.memo.clear()
+
+
+_bound_connection: ContextVar[_BoundConnection | None] = ContextVar("db_bound_connection", default=None)
+# Внутри хелпера, который сам сбрасывает свои записи мемо (_invalidates).
+_memo_write_declared: ContextVar[bool] = ContextVar("db_memo_write_declared", default=False)
+
+
+def _active_bound_connection() -> _BoundConnection | None:
+    bound = _bound_connection.get()
+    if bound is None or bound.closed or bound.owner is not asyncio.current_task():
+        return None
+    return bound
 
 
-async def init_db():
-    """Инициализировать пул подключений и создать таблицы если нужно"""
-    global _pool
+@asynccontextmanager
+async def connection_scope():
+    """Одно соединение на весь апдейт или запрос.
 
+    db_execute внутри области переиспользует его вместо pool.acquire() на
+    каждый запрос. Вложенная область ничего не делает. Без DB_BIND_CONNECTION
+    область только считает ожидание пула (для сравнения «до/после»).
+    """
+    bound = _active_bound_connection()
+    if bound is not None:
+        yield bound
+        return
+    bound = _BoundConnection(_workload.get())
+    token = _bound_connection.set(bound)
     try:
-        _pool = await asyncpg.create_pool(
-            DATABASE_URL,
-            min_size=5,
-            max_size=20,
-            command_timeout=60
+        yield bound
+    finally:
+        _bound_connection.reset(token)
+        await bound.release()
+
+
+async def release_bound_connection():
+    """Отдать соединение области в пул перед внешним запросом.
+
+    Вызывается перед Remnawave, платёжками и отправкой в Telegram: апдейт,
+    ждущий сеть, не держит соединение пула. Следующий db_execute области
+    возьмёт соединение заново; внутри транзакции ничего не делает.
+    """
+    bound = _active_bound_connection()
+    if bound is not None and bound.conn is not None:
+        await bound.detach()
+
+
+@asynccontextmanager
+async def transaction():
+    """Явная транзакция для нескольких db_execute подряд.
+
+    Все запросы внутри блока идут по одному соединению и фиксируются вместе;
+    исключение откатывает их. Вложенный блок становится savepoint.
+    """
+    async with connection_scope() as bound:
+        async with bound.lock:
+            conn = await bound.connection()
+            tx = conn.transaction()
+            await tx.start()
+            bound.begin_transaction()
+        try:
+            yield conn
+        except BaseException:
+            async with bound.lock:
+                try:
+                    await tx.rollback()
+                finally:
+                    bound.end_transaction()
+            raise
+        async with bound.lock:
+            try:
+                await tx.commit()
+            finally:
+                bound.end_transaction()
+
+
+_memo_stats = {"hits": 0, "misses": 0, "max_scope_hits": 0}
+
+
+def memo_stats() -> dict:
+    """Сколько чтений обслужено из мемо апдейта вместо запроса в БД."""
+    scopes = _pool_wait_stats["scopes"]
+    stats = dict(_memo_stats)
+    stats["saved_queries_per_scope"] = round(stats["hits"] / scopes, 2) if scopes else 0
+    return stats
+
+
+def pool_wait_stats() -> dict:
+    """Сколько соединений брали из пула и сколько ждали свободного."""
+    stats = dict(_pool_wait_stats)
+    scopes = stats["scopes"]
+    stats["bind_enabled"] = DB_BIND_CONNECTION
+    stats["avg_scope_acquires"] = round(stats["scope_acquires"] / scopes, 2) if scopes else 0
+    stats["avg_scope_wait_ms"] = round(stats["scope_wait_seconds"] * 1000 / scopes, 3) if scopes else 0
+    stats["scope_wait_seconds"] = round(stats["scope_wait_seconds"], 3)
+    stats["max_scope_wait_seconds"] = round(stats["max_scope_wait_seconds"], 3)
+    stats["unscoped_wait_seconds"] = round(stats["unscoped_wait_seconds"], 3)
+    stats["pools"] = {}
+    for name, pool in _pools.items():
+        metrics = dict(_metrics_for(name))
+        metrics["wait_seconds"] = round(metrics["wait_seconds"], 3)
+        metrics["max_wait_seconds"] = round(metrics["max_wait_seconds"], 3)
+        metrics["size"] = pool.get_size()
+        metrics["idle"] = pool.get_idle_size()
+        metrics["max_size"] = pool.get_max_size()
+        metrics["in_use"] = metrics["size"] - metrics["idle"]
+        metrics["saturated"] = metrics["in_use"] >= metrics["max_size"]
+        stats["pools"][name] = metrics
+    return stats
+
+
+# Метрики запросов по имени хелпера (функции, вызвавшей db_execute или
+# pool.acquire()): число вызовов, гистограмма времени, строки, ожидание пула.
+QUERY_LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+SLOW_QUERY_LOG_SIZE = 50
+
+_query_stats: dict[str, dict] = {}
+_slow_queries: deque = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_slow_query_logger = logging.getLogger("database.slow")
+
+
+def _redact_params(params) -> list[str]:
+    """Параметры без значений: только тип и длина (токены, телефоны, суммы не попадают в лог)."""
+    redacted = []
+    for value in params:
+        if value is None:
+            redacted.append("NULL")
+        elif isinstance(value, (str, bytes, list, tuple)):
+            redacted.append(f"<{type(value).__name__}:{len(value)}>")
+        else:
+            redacted.append(f"<{type(value).__name__}>")
+    return redacted
+
+
+def _caller_name(depth: int = 2) -> str:
+    """Имя функции, вызвавшей хелпер; для других модулей — с именем модуля."""
+    frame = sys._getframe(depth)
+    module = frame.f_globals.get("__name__", "")
+    if module == __name__:
+        return frame.f_code.co_name
+    return f"{module}.{frame.f_code.co_name}"
+
+
+def _status_rows(status: str | None) -> int | None:
+    """Число строк из статуса execute(): 'UPDATE 3' -> 3, 'INSERT 0 1' -> 1."""
+    if not status:
+        return None
+    last = status.rsplit(" ", 1)[-1]
+    return int(last) if last.isdigit() else None
+
+
+def _record_query(name: str, seconds: float, rows: int | None, wait_seconds: float, *, error: bool = False, query=None, params=()):
+    stats = _query_stats.get(name)
+    if stats is None:
+        stats = _query_stats[name] = {
+            "calls": 0,
+            "errors": 0,
+            "total_seconds": 0.0,
+            "max_seconds": 0.0,
+            "rows": 0,
+            "wait_seconds": 0.0,
+            "buckets": [0] * (len(QUERY_LATENCY_BUCKETS_MS) + 1),
+        }
+    elapsed_ms = seconds * 1000
+    stats["calls"] += 1
+    stats["errors"] += error
+    stats["total_seconds"] += seconds
+    stats["max_seconds"] = max(stats["max_seconds"], seconds)
+    stats["rows"] += rows or 0
+    stats["wait_seconds"] += wait_seconds
+    stats["buckets"][bisect.bisect_left(QUERY_LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    if DB_SLOW_QUERY_MS and elapsed_ms >= DB_SLOW_QUERY_MS:
+        statement = " ".join(query.split())[:500] if query else "(pool.acquire)"
+        entry = {
+            "at": datetime.utcnow().isoformat(),
+            "name": name,
+            "ms": round(elapsed_ms, 1),
+            "wait_ms": round(wait_seconds * 1000, 1),
+            "rows": rows,
+            "error": error,
+            "query": statement,
+            "params": _redact_params(params),
+        }
+        _slow_queries.append(entry)
+        _slow_query_logger.warning(
+            "Slow query %s: %.0f ms (pool wait %.0f ms, rows %s): %s params=%s",
+            name, elapsed_ms, entry["wait_ms"], rows, statement, entry["params"],
         )
-        logging.info("Database pool initialized successfully")
 
-        # Запускаем миграции при инициализации БД
-        await run_migrations()
 
-    except Exception as e:
-        logging.error(f"Failed to initialize database pool: {e}")
-        raise
+def _bucket_quantile(buckets: list[int], calls: int, quantile: float) -> float | None:
+    """Оценка квантиля по гистограмме: верхняя граница корзины, мс."""
+    if not calls:
+        return None
+    threshold = calls * quantile
+    seen = 0
+    for index, count in enumerate(buckets):
+        seen += count
+        if seen >= threshold:
+            break
+    if index < len(QUERY_LATENCY_BUCKETS_MS):
+        return float(QUERY_LATENCY_BUCKETS_MS[index])
+    return None
 
 
-async def close_db():
-    """Закрыть пул подключений"""
-    global _pool
-    if _pool:
-        await _pool.close()
-        _pool = None
-        logging.info("Database pool closed")
-
-
-async def get_pool():
-    """Получить пул подключений"""
-    global _pool
-    if _pool is None:
-        raise RuntimeError("Database pool not initialized. Call init_db() first.")
-    return _pool
+def query_stats(limit: int = 20, order_by: str = "total") -> dict:
+    """Топ запросов по суммарному (total), среднему (avg) или худшему (max) времени."""
+    items = []
+    for name, stats in _query_stats.items():
+        calls = stats["calls"]
+        items.append({
+            "name": name,
+            "calls": calls,
+            "errors": stats["errors"],
+            "total_ms": round(stats["total_seconds"] * 1000, 1),
+            "avg_ms": round(stats["total_seconds"] * 1000 / calls, 2) if calls else 0,
+            "max_ms": round(stats["max_seconds"] * 1000, 1),
+            "p50_ms": _bucket_quantile(stats["buckets"], calls, 0.5),
+            "p95_ms": _bucket_quantile(stats["buckets"], calls, 0.95),
+            "rows": stats["rows"],
+            "pool_wait_ms": round(stats["wait_seconds"] * 1000, 1),
+            "histogram": dict(zip([*map(str, QUERY_LATENCY_BUCKETS_MS), "inf"], stats["buckets"])),
+        })
+    sort_key = {"total": "total_ms", "avg": "avg_ms", "max": "max_ms"}.get(order_by, "total_ms")
+    items.sort(key=lambda item: item[sort_key], reverse=True)
+    return {
+        "slow_query_ms": DB_SLOW_QUERY_MS,
+        "queries": items[:limit],
+        "slow": list(reversed(_slow_queries)),
+    }
+
+
+def reset_query_stats() -> None:
+    _query_stats.clear()
+    _slow_queries.clear()
+
+
+async def _run_query(conn, query, params, fetch_one, fetch_all):
+    """Выполнить запрос; вернуть (результат, число строк)."""
+    if fetch_one:
+        row = await conn.fetchrow(query, *params)
+        return row, int(row is not None)
+    elif fetch_all:
+        rows = await conn.fetch(query, *params)
+        return rows, len(rows)
+    else:
+        return None, _status_rows(await conn.execute(query, *params))
+
+
+async def _timed_query(name, conn, query, params, fetch_one, fetch_all, wait_seconds):
+    started = time.perf_counter()
+    try:
+        result, rows = await _run_query(conn, query, params, fetch_one, fetch_all)
+    except Exception as e:
+        _record_query(name, time.perf_counter() - started, None, wait_seconds, error=True, query=query, params=params)
+        logging.error(f"Database error in {name}: {e}")
+        raise
+    _record_query(name, time.perf_counter() - started, rows, wait_seconds, query=query, params=params)
+    return result
 
 
 async def db_execute(query, params=(), fetch_one=False, fetch_all=False):
     """
     Выполнить SQL запрос
-    
+
+    Внутри connection_scope()/transaction() запрос идёт по привязанному
+    соединению, иначе соединение берётся на один запрос из пула текущей
+    нагрузки (см. workload()); чтения аналитики — из реплики, если она есть.
+    Время, строки и ожидание пула пишутся в query_stats() под именем
+    вызывающей функции.
+
     Args:
         query: SQL запрос
         params: Параметры для запроса (кортеж или список)
@@ -1168,19 +2355,142 @@ async def db_execute(query, params=(), fetch_one=False, fetch_all=False):
     Returns:
         Результат запроса или None
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        try:
-            if fetch_one:
-                return await conn.fetchrow(query, *params)
-            elif fetch_all:
-                return await conn.fetch(query, *params)
+    return await _execute(_caller_name(), query, params, fetch_one, fetch_all)
+
+
+async def _execute(name, query, params=(), fetch_one=False, fetch_all=False):
+    bound = _active_bound_connection()
+    if bound is not None and bound.memo and not _memo_write_declared.get() and _is_write_query(query):
+        invalidate_memo()
+    pool_name = _query_pool(query)
+    if bound is not None and (bound.transactions or (DB_BIND_CONNECTION and bound.pool_name == pool_name)):
+        started = time.perf_counter()
+        async with bound.lock:
+            conn = await bound.connection()
+            waited = time.perf_counter() - started
+            return await _timed_query(name, conn, query, params, fetch_one, fetch_all, waited)
+
+    conn, waited = await _acquire(pool_name)
+    try:
+        if bound is not None:
+            bound.record_wait(waited)
+        else:
+            _pool_wait_stats["unscoped_acquires"] += 1
+            _pool_wait_stats["unscoped_wait_seconds"] += waited
+        return await _timed_query(name, conn, query, params, fetch_one, fetch_all, waited)
+    finally:
+        await _pools[pool_name].release(conn)
+
+
+async def iter_row_batches(query, params=(), *, key="id", batch_size: int | None = None):
+    """Читать большой результат пачками по ключу, не держа его целиком в памяти.
+
+    query — SELECT без ORDER BY и LIMIT, key — уникальная колонка результата
+    или кортеж колонок. Каждая пачка — отдельный короткий запрос (keyset:
+    ключ больше последнего прочитанного), так что между пачками соединение
+    возвращается в пул и медленная обработка строк не держит транзакцию, как
+    держал бы серверный курсор. Строки, изменённые вызывающим кодом, не
+    перечитываются: курсор уже ушёл дальше них.
+    """
+    name = _caller_name()
+    keys = (key,) if isinstance(key, str) else tuple(key)
+    columns = ", ".join(keys)
+    batch_size = max(1, batch_size or BACKGROUND_BATCH_SIZE)
+    params = tuple(params)
+    last = None
+    while True:
+        page_params = params if last is None else params + last
+        after = ""
+        if last is not None:
+            placeholders = ", ".join(f"${len(params) + index}" for index in range(1, len(keys) + 1))
+            after = f"WHERE ({columns}) > ({placeholders})"
+        rows = await _execute(
+            name,
+            f"SELECT * FROM ({query}) AS page {after} ORDER BY {columns} LIMIT ${len(page_params) + 1}",
+            page_params + (batch_size,),
+            fetch_all=True,
+        )
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last = tuple(rows[-1][column] for column in keys)
+
+
+def _is_write_query(query: str) -> bool:
+    return query.lstrip().split(None, 1)[0].upper() != "SELECT"
+
+
+def invalidate_memo(namespace: str | None = None, key=None) -> None:
+    """Сбросить мемо текущего апдейта: всё, одно пространство или одну запись."""
+    bound = _active_bound_connection()
+    if bound is None:
+        return
+    bound.memo_generation += 1
+    if namespace is None:
+        bound.memo.clear()
+    elif key is None:
+        for bucket in [bucket for bucket in bound.memo if bucket[0] == namespace]:
+            del bound.memo[bucket]
+    else:
+        bound.memo.pop((namespace, key), None)
+
+
+def _memoized(namespace: str):
+    """Запоминать результат чтения до конца апдейта/запроса.
+
+    Работает только внутри connection_scope(); первый аргумент хелпера —
+    ключ, по которому запись сбрасывают пишущие хелперы. Любой другой
+    пишущий запрос через db_execute сбрасывает мемо целиком.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = _active_bound_connection()
+            if bound is None or not args:
+                return await func(*args, **kwargs)
+            bucket_key = (namespace, args[0])
+            call_key = (func.__name__, args, tuple(sorted(kwargs.items())))
+            bucket = bound.memo.get(bucket_key)
+            if bucket is not None and call_key in bucket:
+                bound.memo_hits += 1
+                result = bucket[call_key]
             else:
-                await conn.execute(query, *params)
-                return None
-        except Exception as e:
-            logging.error(f"Database error: {e}")
-            raise
+                bound.memo_misses += 1
+                generation = bound.memo_generation
+                result = await func(*args, **kwargs)
+                # Запись, сброшенная пока шёл запрос, могла прочитать старые данные
+                if generation == bound.memo_generation:
+                    bound.memo.setdefault(bucket_key, {})[call_key] = result
+            return list(result) if isinstance(result, list) else result
+        return wrapper
+    return decorator
+
+
+def _invalidates(*targets: tuple[str, bool]):
+    """Пишущий хелпер сам сбрасывает нужные записи мемо.
+
+    targets — пары (пространство, по ключу ли): True — запись с ключом из
+    первого аргумента хелпера, False — всё пространство.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = _memo_write_declared.set(True)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _memo_write_declared.reset(token)
+                for namespace, by_key in targets:
+                    invalidate_memo(namespace, args[0] if by_key and args else None)
+        return wrapper
+    return decorator
+
+
+# Подписка по ID и списки подписок пользователей: запись в подписку сбрасывает
+# и её, и списки (владелец в пишущих хелперах неизвестен).
+_SUBSCRIPTION_WRITE = (("subscription", True), ("subscriptions", False))
 
 
 # ────────────────────────────────────────────────
@@ -1222,6 +2532,9 @@ async def create_web_account(login: str, password_hash: str, tracking_code: str
                 f"web:{login}",
                 tracking_code,
             )
+            await _bump_admin_counters(users=1, conn=conn)
+            if tracking_code:
+                await _add_tracking_rollup(tracking_code, conn=conn, attributed_users=1)
             return await conn.fetchrow("SELECT * FROM web_accounts WHERE id = $1", account["id"])
 
 
@@ -1234,31 +2547,32 @@ async def get_web_account_by_login(login: str):
 
 
 async def create_web_session(account_id: int, token_hash: str, expires_at):
-    await db_execute(
-        "DELETE FROM web_sessions WHERE expires_at <= now() AT TIME ZONE 'UTC'",
-    )
-    session = await db_execute(
-        """
-        INSERT INTO web_sessions (account_id, token_hash, expires_at)
-        VALUES ($1, $2, $3)
-        RETURNING id
-        """,
-        (account_id, token_hash, expires_at),
-        fetch_one=True,
-    )
-    await db_execute(
-        """
-        DELETE FROM web_sessions
-        WHERE account_id = $1
-          AND id NOT IN (
-              SELECT id FROM web_sessions
-              WHERE account_id = $1
-              ORDER BY created_at DESC
-              LIMIT 10
-          )
-        """,
-        (account_id,),
-    )
+    async with transaction():
+        await db_execute(
+            "DELETE FROM web_sessions WHERE expires_at <= now() AT TIME ZONE 'UTC'",
+        )
+        session = await db_execute(
+            """
+            INSERT INTO web_sessions (account_id, token_hash, expires_at)
+            VALUES ($1, $2, $3)
+            RETURNING id
+            """,
+            (account_id, token_hash, expires_at),
+            fetch_one=True,
+        )
+        await db_execute(
+            """
+            DELETE FROM web_sessions
+            WHERE account_id = $1
+              AND id NOT IN (
+                  SELECT id FROM web_sessions
+                  WHERE account_id = $1
+                  ORDER BY created_at DESC
+                  LIMIT 10
+              )
+            """,
+            (account_id,),
+        )
     return session
 
 
@@ -1306,28 +2620,163 @@ async def list_web_account_payments(service_user_id: int, limit: int = 30):
     )
 
 
+# Блокировки пользователя — неблокирующие: занятая сразу даёт False, поэтому
+# хранить нужно только множество занятых tg_id, и отпущенные не копятся.
+# Бот, webhook-сервер и фоновые задачи работают в одном процессе — хватает
+# локального бэкенда; при нескольких процессах USER_LOCK_BACKEND=postgres
+# дополнительно берёт pg_try_advisory_lock на отдельных соединениях (не из
+# пула: пул при возврате соединения снимает все advisory-блокировки).
+# Advisory-блокировку снимает только взявшая её сессия, поэтому tg_id
+# закреплён за одним из USER_LOCK_CONNECTIONS соединений по ключу.
+USER_LOCK_NAMESPACE = 7_300_116
+
+
+def _user_lock_key(tg_id: int) -> int:
+    """Свернуть BIGINT tg_id в int4 для двухключевого pg_advisory_lock."""
+    folded = (tg_id ^ (tg_id >> 32)) & 0xFFFFFFFF
+    return folded - 0x1_0000_0000 if folded >= 0x8000_0000 else folded
+
+
+class _LocalUserLocks:
+    """Блокировки в пределах процесса."""
+
+    backend = "local"
+
+    def __init__(self):
+        self.held: set[int] = set()
+        self.acquired = 0
+        self.busy = 0
+
+    async def try_acquire(self, tg_id: int) -> bool:
+        if tg_id in self.held:
+            self.busy += 1
+            return False
+        self.held.add(tg_id)
+        self.acquired += 1
+        return True
+
+    async def release(self, tg_id: int) -> None:
+        self.held.discard(tg_id)
+
+    async def close(self) -> None:
+        self.held.clear()
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "held": len(self.held), "acquired": self.acquired, "busy": self.busy}
+
+
+class _PostgresUserLocks(_LocalUserLocks):
+    """Локальная блокировка плюс pg_try_advisory_lock для нескольких процессов."""
+
+    backend = "postgres"
+
+    def __init__(self, connections: int = USER_LOCK_CONNECTIONS):
+        super().__init__()
+        self.conns: list = [None] * connections
+        self.conn_locks = [asyncio.Lock() for _ in range(connections)]
+        self.reconnects = 0
+
+    def _stripe(self, tg_id: int) -> int:
+        return _user_lock_key(tg_id) % len(self.conns)
+
+    async def _connection(self, stripe: int, pending: int):
+        conn = self.conns[stripe]
+        if conn is not None and not conn.is_closed():
+            return conn
+        reconnected = conn is not None
+        conn = await asyncpg.connect(DATABASE_URL)
+        self.conns[stripe] = conn
+        if not reconnected:
+            return conn
+        # Сессия оборвалась вместе с блокировками — берём заново те, что
+        # держат пользователи этого соединения
+        self.reconnects += 1
+        lost = 0
+        for tg_id in list(self.held):
+            if tg_id == pending or self._stripe(tg_id) != stripe:
+                continue
+            relocked = await conn.fetchval(
+                "SELECT pg_try_advisory_lock($1, $2)",
+                USER_LOCK_NAMESPACE,
+                _user_lock_key(tg_id),
+            )
+            if not relocked:
+                lost += 1
+        if lost:
+            logging.warning("User lock connection %s reconnected; %s locks are now held by another process", stripe, lost)
+        return conn
+
+    async def try_acquire(self, tg_id: int) -> bool:
+        if tg_id in self.held:
+            self.busy += 1
+            return False
+        # Занимаем локально до await, чтобы второй вызов из процесса не прошёл
+        self.held.add(tg_id)
+        stripe = self._stripe(tg_id)
+        try:
+            async with self.conn_locks[stripe]:
+                conn = await self._connection(stripe, tg_id)
+                locked = await conn.fetchval(
+                    "SELECT pg_try_advisory_lock($1, $2)",
+                    USER_LOCK_NAMESPACE,
+                    _user_lock_key(tg_id),
+                )
+        except Exception:
+            self.held.discard(tg_id)
+            raise
+        if not locked:
+            self.held.discard(tg_id)
+            self.busy += 1
+            return False
+        self.acquired += 1
+        return True
+
+    async def release(self, tg_id: int) -> None:
+        if tg_id not in self.held:
+            return
+        stripe = self._stripe(tg_id)
+        try:
+            async with self.conn_locks[stripe]:
+                conn = self.conns[stripe]
+                if conn is not None and not conn.is_closed():
+                    await conn.fetchval(
+                        "SELECT pg_advisory_unlock($1, $2)",
+                        USER_LOCK_NAMESPACE,
+                        _user_lock_key(tg_id),
+                    )
+        finally:
+            self.held.discard(tg_id)
+
+    async def close(self) -> None:
+        await super().close()
+        conns, self.conns = self.conns, [None] * len(self.conns)
+        for conn in conns:
+            if conn is not None:
+                await conn.close()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "connections": len(self.conns), "reconnects": self.reconnects}
+
+
+_user_locks = _PostgresUserLocks() if USER_LOCK_BACKEND == "postgres" else _LocalUserLocks()
+
+
+def user_lock_stats() -> dict:
+    return _user_locks.stats()
+
+
 async def acquire_user_lock(tg_id: int) -> bool:
     """
-    Получить блокировку пользователя используя PostgreSQL advisory lock
-    
+    Получить блокировку пользователя (без ожидания)
+
     Args:
         tg_id: ID пользователя Telegram
-        
+
     Returns:
         True если удалось получить блокировку, False иначе
     """
     try:
-        async with _user_locks_guard:
-            lock = _user_locks.get(tg_id)
-            if lock is None:
-                lock = asyncio.Lock()
-                _user_locks[tg_id] = lock
-
-            if lock.locked():
-                return False
-
-            await lock.acquire()
-            return True
+        return await _user_locks.try_acquire(tg_id)
     except Exception as e:
         logging.error(f"Lock error: {e}")
         return False
@@ -1341,10 +2790,7 @@ async def release_user_lock(tg_id: int):
         tg_id: ID пользователя Telegram
     """
     try:
-        async with _user_locks_guard:
-            lock = _user_locks.get(tg_id)
-            if lock and lock.locked():
-                lock.release()
+        await _user_locks.release(tg_id)
     except Exception as e:
         logging.error(f"Unlock error: {e}")
 
@@ -1353,6 +2799,7 @@ async def release_user_lock(tg_id: int):
 #                USER MANAGEMENT
 # ────────────────────────────────────────────────
 
+@_memoized("user")
 async def get_user(tg_id: int):
     """Получить информацию о пользователе"""
     return await db_execute(
@@ -1375,20 +2822,33 @@ async def user_exists(tg_id: int) -> bool:
 async def create_user(tg_id: int, username: str, referrer_id=None, tracking_code: str | None = None):
     """Создать или обновить пользователя"""
     tracking_code = tracking_code.strip().lower() if tracking_code else None
-    await db_execute(
-        """
-        INSERT INTO users (tg_id, username, referrer_id, tracking_code)
-        VALUES ($1, $2, $3, $4)
-        ON CONFLICT (tg_id) DO UPDATE
-        SET username = COALESCE(EXCLUDED.username, users.username),
-            tracking_code = CASE
-                WHEN users.tracking_code IS NULL AND EXCLUDED.tracking_code IS NOT NULL
-                THEN EXCLUDED.tracking_code
-                ELSE users.tracking_code
-            END
-        """,
-        (tg_id, username, referrer_id, tracking_code)
-    )
+    async with transaction():
+        user = await db_execute(
+            """
+            WITH previous AS (
+                SELECT tracking_code FROM users WHERE tg_id = $1
+            )
+            INSERT INTO users (tg_id, username, referrer_id, tracking_code)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (tg_id) DO UPDATE
+            SET username = COALESCE(EXCLUDED.username, users.username),
+                tracking_code = CASE
+                    WHEN users.tracking_code IS NULL AND EXCLUDED.tracking_code IS NOT NULL
+                    THEN EXCLUDED.tracking_code
+                    ELSE users.tracking_code
+                END
+            RETURNING tracking_code,
+                      (SELECT tracking_code FROM previous) AS previous_tracking_code,
+                      (xmax = 0) AS inserted
+            """,
+            (tg_id, username, referrer_id, tracking_code),
+            fetch_one=True
+        )
+        if user and user['inserted']:
+            await _bump_admin_counters(users=1)
+        # First-touch код проставился только что — пользователь пришёл по ссылке
+        if user and user['tracking_code'] and not user['previous_tracking_code']:
+            await _add_tracking_rollup(user['tracking_code'], attributed_users=1)
 
 
 # ────────────────────────────────────────────────
@@ -1451,21 +2911,7 @@ async def get_user_subscriptions(tg_id: int):
     )
 
 
-async def get_subscriptions_with_remnawave_uuid(active_only: bool = False):
-    """Получить подписки, для которых можно перевыпустить ссылку в Remnawave."""
-    where_active = "AND subscription_until IS NOT NULL AND subscription_until > now() AT TIME ZONE 'UTC'" if active_only else ""
-    return await db_execute(
-        f"""
-        SELECT id, tg_id, slot_number, type_index, plan_kind, remnawave_uuid, remnawave_username, subscription_until
-        FROM subscriptions
-        WHERE remnawave_uuid IS NOT NULL
-          {where_active}
-        ORDER BY tg_id ASC, id ASC
-        """,
-        fetch_all=True,
-    )
-
-
+@_memoized("subscriptions")
 async def get_visible_subscriptions(tg_id: int):
     """Получить видимые пользователю подписки новой модели."""
     return await db_execute(
@@ -1573,6 +3019,7 @@ async def count_visible_subscriptions_by_kind(tg_id: int, plan_kind: str) -> int
     return result['count'] if result else 0
 
 
+@_memoized("subscription")
 async def get_subscription_by_id(subscription_id: int, tg_id: int | None = None):
     """Получить подписку по ID."""
     if tg_id is None:
@@ -1711,135 +3158,777 @@ async def sync_primary_subscription_to_user(tg_id: int):
         )
 
 
-async def update_subscription_record(subscription_id: int, uuid: str, username: str, subscription_until, squad_uuid: str | None):
-    """Обновить конкретную подписку пользователя."""
-    next_notification, notification_type = _calculate_notification_fields(subscription_until)
+@_invalidates(*_SUBSCRIPTION_WRITE, ("user", False))
+async def update_subscription_record(
+    subscription_id: int,
+    uuid: str,
+    username: str,
+    subscription_until,
+    squad_uuid: str | None,
+    subscription_url: str | None = None,
+):
+    """Обновить конкретную подписку пользователя.
+
+    subscription_url сохраняется, только если передан: иначе остаётся прежняя
+    ссылка, а при смене uuid она сбрасывается до следующего чтения из Remnawave.
+    """
+    next_notification, notification_type = _calculate_notification_fields(subscription_until)
+
+    await db_execute(
+        """
+        UPDATE subscriptions
+        SET remnawave_uuid = $1,
+            remnawave_username = $2,
+            subscription_until = $3,
+            squad_uuid = $4,
+            next_notification_time = $6,
+            notification_type = $7,
+            subscription_url = CASE
+                WHEN $8::text IS NOT NULL THEN $8
+                WHEN remnawave_uuid IS DISTINCT FROM $1::uuid THEN NULL
+                ELSE subscription_url
+            END,
+            subscription_url_synced_at = CASE
+                WHEN $8::text IS NOT NULL THEN now() AT TIME ZONE 'UTC'
+                WHEN remnawave_uuid IS DISTINCT FROM $1::uuid THEN NULL
+                ELSE subscription_url_synced_at
+            END,
+            is_active = TRUE,
+            updated_at = now()
+        WHERE id = $5
+        """,
+        (uuid, username, subscription_until, squad_uuid, subscription_id, next_notification, notification_type, subscription_url)
+    )
+    await schedule_expiry_notifications(subscription_id)
+
+    subscription = await get_subscription_by_id(subscription_id)
+    if subscription:
+        await sync_primary_subscription_to_user(subscription['tg_id'])
+
+
+@_invalidates(*_SUBSCRIPTION_WRITE)
+async def set_subscription_url(subscription_id: int, subscription_url: str | None):
+    """Сохранить ссылку подписки. None сбрасывает её до следующего чтения из Remnawave."""
+    await db_execute(
+        """
+        UPDATE subscriptions
+        SET subscription_url = $1,
+            subscription_url_synced_at = CASE WHEN $1::text IS NULL THEN NULL ELSE now() AT TIME ZONE 'UTC' END
+        WHERE id = $2
+        """,
+        (subscription_url, subscription_id),
+    )
+
+
+async def refresh_subscription_urls_from_mirror(snapshot_at, older_than: datetime) -> int:
+    """Обновить сохранённые ссылки, проверенные раньше older_than, из зеркала Remnawave.
+
+    Ссылки, записанные после снимка (например, перевыпуск), не трогаем.
+    """
+    rows = await db_execute(
+        """
+        UPDATE subscriptions s
+        SET subscription_url = m.subscription_url,
+            subscription_url_synced_at = $1
+        FROM remnawave_users_mirror m
+        WHERE m.remnawave_uuid = s.remnawave_uuid
+          AND m.subscription_url IS NOT NULL
+          AND (s.subscription_url_synced_at IS NULL OR s.subscription_url_synced_at < $2)
+        RETURNING s.id
+        """,
+        (snapshot_at, older_than),
+        fetch_all=True,
+    )
+    return len(rows or [])
+
+
+@_invalidates(*_SUBSCRIPTION_WRITE, ("user", False))
+async def sync_subscription_expiry(subscription_id: int, subscription_until):
+    """Синхронизировать фактический срок подписки из Remnawave."""
+    next_notification, notification_type = _calculate_notification_fields(subscription_until)
+    is_active = bool(subscription_until and subscription_until > datetime.utcnow())
+
+    await db_execute(
+        """
+        UPDATE subscriptions
+        SET subscription_until = $1,
+            is_active = $2,
+            next_notification_time = $3,
+            notification_type = $4,
+            updated_at = now()
+        WHERE id = $5
+        """,
+        (subscription_until, is_active, next_notification, notification_type, subscription_id),
+    )
+    await schedule_expiry_notifications(subscription_id)
+
+    subscription = await get_subscription_by_id(subscription_id)
+    if subscription:
+        await sync_primary_subscription_to_user(subscription['tg_id'])
+
+
+async def update_subscription(
+    tg_id: int,
+    uuid: str,
+    username: str,
+    subscription_until,
+    squad_uuid: str | None,
+    *,
+    subscription_id: int | None = None,
+    slot_number: int | None = 1,
+):
+    """Совместимый wrapper обновления подписки."""
+    target_subscription = None
+
+    if subscription_id is not None:
+        target_subscription = await get_subscription_by_id(subscription_id, tg_id)
+
+    if target_subscription is None and uuid:
+        target_subscription = await get_subscription_by_uuid(uuid)
+        if target_subscription and target_subscription['tg_id'] != tg_id:
+            target_subscription = None
+
+    if target_subscription is None and slot_number is not None:
+        target_subscription = await get_subscription_by_slot(tg_id, slot_number)
+
+    if target_subscription is None:
+        resolved_slot = slot_number if slot_number is not None else await get_next_subscription_slot(tg_id)
+        if resolved_slot is None:
+            raise RuntimeError(f"No free subscription slots for user {tg_id}")
+        target_subscription = await create_subscription_record(tg_id, resolved_slot)
+
+    await update_subscription_record(target_subscription['id'], uuid, username, subscription_until, squad_uuid)
+    return target_subscription['id']
+
+
+@_invalidates(*_SUBSCRIPTION_WRITE, ("device_addons", True), ("user", False))
+async def delete_subscription_record(subscription_id: int):
+    """Удалить запись подписки и синхронизировать legacy-поля."""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            subscription = await conn.fetchrow(
+                "SELECT * FROM subscriptions WHERE id = $1 FOR UPDATE",
+                subscription_id,
+            )
+            if not subscription:
+                return False
+
+            tg_id = subscription["tg_id"]
+            await conn.execute(
+                "DELETE FROM notification_state WHERE subscription_id = $1",
+                subscription_id,
+            )
+            await conn.execute(
+                "UPDATE payments SET subscription_id = NULL, updated_at = now() WHERE subscription_id = $1",
+                subscription_id,
+            )
+            await conn.execute(
+                "DELETE FROM traffic_purchases WHERE subscription_id = $1",
+                subscription_id,
+            )
+            await conn.execute(
+                "DELETE FROM device_addon_purchases WHERE subscription_id = $1",
+                subscription_id,
+            )
+            await conn.execute(
+                "DELETE FROM subscription_traffic_cycles WHERE subscription_id = $1",
+                subscription_id,
+            )
+            await conn.execute("DELETE FROM subscriptions WHERE id = $1", subscription_id)
+
+    await sync_primary_subscription_to_user(tg_id)
+    return True
+
+
+async def has_subscription(tg_id: int) -> bool:
+    """Проверить есть ли хотя бы одна подписка."""
+    result = await db_execute(
+        "SELECT 1 FROM subscriptions WHERE tg_id = $1 LIMIT 1",
+        (tg_id,),
+        fetch_one=True
+    )
+    return result is not None
+
+
+# ────────────────────────────────────────────────
+#               REMNAWAVE MIRROR
+# ────────────────────────────────────────────────
+
+async def upsert_remnawave_mirror_rows(rows: list[dict]) -> list[str]:
+    """Записать страницу пользователей Remnawave; вернуть UUID изменившихся строк."""
+    if not rows:
+        return []
+    changed = await db_execute(
+        """
+        INSERT INTO remnawave_users_mirror AS mirror (
+            remnawave_uuid,
+            username,
+            status,
+            expire_at,
+            used_traffic_bytes,
+            traffic_limit_bytes,
+            subscription_url,
+            remote_updated_at,
+            changed_at
+        )
+        SELECT *, now() AT TIME ZONE 'UTC' FROM unnest(
+            $1::uuid[], $2::text[], $3::text[], $4::timestamp[],
+            $5::bigint[], $6::bigint[], $7::text[], $8::timestamp[]
+        )
+        ON CONFLICT (remnawave_uuid) DO UPDATE
+        SET username = EXCLUDED.username,
+            status = EXCLUDED.status,
+            expire_at = EXCLUDED.expire_at,
+            used_traffic_bytes = EXCLUDED.used_traffic_bytes,
+            traffic_limit_bytes = EXCLUDED.traffic_limit_bytes,
+            subscription_url = EXCLUDED.subscription_url,
+            remote_updated_at = EXCLUDED.remote_updated_at,
+            changed_at = EXCLUDED.changed_at
+        WHERE (
+            mirror.username, mirror.status, mirror.expire_at, mirror.used_traffic_bytes,
+            mirror.traffic_limit_bytes, mirror.subscription_url, mirror.remote_updated_at
+        ) IS DISTINCT FROM (
+            EXCLUDED.username, EXCLUDED.status, EXCLUDED.expire_at, EXCLUDED.used_traffic_bytes,
+            EXCLUDED.traffic_limit_bytes, EXCLUDED.subscription_url, EXCLUDED.remote_updated_at
+        )
+        RETURNING remnawave_uuid
+        """,
+        (
+            [row["remnawave_uuid"] for row in rows],
+            [row["username"] for row in rows],
+            [row["status"] for row in rows],
+            [row["expire_at"] for row in rows],
+            [row["used_traffic_bytes"] for row in rows],
+            [row["traffic_limit_bytes"] for row in rows],
+            [row["subscription_url"] for row in rows],
+            [row["remote_updated_at"] for row in rows],
+        ),
+        fetch_all=True,
+    )
+    return [str(row["remnawave_uuid"]) for row in changed or []]
+
+
+async def delete_remnawave_mirror_rows_except(seen_uuids: list[str]) -> int:
+    """Удалить из зеркала пользователей, которых больше нет в Remnawave."""
+    deleted = await db_execute(
+        """
+        DELETE FROM remnawave_users_mirror
+        WHERE NOT (remnawave_uuid = ANY($1::uuid[]))
+        RETURNING 1
+        """,
+        (seen_uuids,),
+        fetch_all=True,
+    )
+    return len(deleted or [])
+
+
+async def get_remnawave_mirror_rows(remnawave_uuids: list[str]) -> dict:
+    """Получить строки зеркала по списку UUID одним запросом."""
+    if not remnawave_uuids:
+        return {}
+    rows = await db_execute(
+        "SELECT * FROM remnawave_users_mirror WHERE remnawave_uuid = ANY($1::uuid[])",
+        ([str(value) for value in remnawave_uuids],),
+        fetch_all=True,
+    )
+    return {str(row["remnawave_uuid"]): row for row in rows or []}
+
+
+async def get_subscription_expiry_drift_from_mirror(snapshot_at, changed_since=None):
+    """Подписки, чей срок расходится с зеркалом и не менялся локально после снимка.
+
+    ``changed_since`` ограничивает проверку строками зеркала, изменившимися в
+    текущем проходе; None — сверить все (полный проход).
+    """
+    return await db_execute(
+        """
+        SELECT s.id, s.subscription_until, m.expire_at
+        FROM subscriptions s
+        JOIN remnawave_users_mirror m ON m.remnawave_uuid = s.remnawave_uuid
+        WHERE m.expire_at IS NOT NULL
+          AND s.updated_at < $1
+          AND ($2::TIMESTAMP IS NULL OR m.changed_at >= $2)
+          AND (
+                s.subscription_until IS NULL
+             OR ABS(EXTRACT(EPOCH FROM (m.expire_at - s.subscription_until))) >= 1
+          )
+        ORDER BY s.id ASC
+        """,
+        (snapshot_at, changed_since),
+        fetch_all=True,
+    )
+
+
+async def get_remnawave_mirror_watermark():
+    """Самая поздняя отметка updatedAt Remnawave в зеркале (по часам панели)."""
+    row = await db_execute(
+        "SELECT MAX(remote_updated_at) AS watermark FROM remnawave_users_mirror",
+        fetch_one=True,
+    )
+    return row["watermark"] if row else None
+
+
+async def start_background_sync(name: str):
+    """Отметить начало прохода фоновой синхронизации; вернуть время начала по часам БД."""
+    row = await db_execute(
+        """
+        INSERT INTO background_sync_state (name, last_started_at, updated_at)
+        VALUES ($1, now() AT TIME ZONE 'UTC', now())
+        ON CONFLICT (name) DO UPDATE
+        SET last_started_at = EXCLUDED.last_started_at,
+            updated_at = now()
+        RETURNING last_started_at
+        """,
+        (name,),
+        fetch_one=True,
+    )
+    return row["last_started_at"]
+
+
+async def finish_background_sync(
+    name: str,
+    *,
+    snapshot_at,
+    full: bool,
+    seen_count: int,
+    changed_count: int,
+    error: str | None = None,
+):
+    """Сохранить итог прохода; снимок считается актуальным на момент его начала."""
+    await db_execute(
+        """
+        UPDATE background_sync_state
+        SET last_finished_at = now() AT TIME ZONE 'UTC',
+            snapshot_at = CASE WHEN $5::TEXT IS NULL THEN $2 ELSE snapshot_at END,
+            last_full_finished_at = CASE
+                WHEN $3 AND $5::TEXT IS NULL THEN now() AT TIME ZONE 'UTC'
+                ELSE last_full_finished_at
+            END,
+            last_seen_count = $4,
+            last_changed_count = $6,
+            last_error = $5,
+            updated_at = now()
+        WHERE name = $1
+        """,
+        (name, snapshot_at, full, seen_count, error, changed_count),
+    )
+
+
+async def get_background_sync_state(name: str):
+    return await db_execute(
+        "SELECT * FROM background_sync_state WHERE name = $1",
+        (name,),
+        fetch_one=True,
+    )
+
+
+# ────────────────────────────────────────────────
+#               ADMIN JOBS
+# ────────────────────────────────────────────────
+
+# Какие подписки попадают в задачу каждого типа (снимок на момент создания).
+_ADMIN_JOB_TARGETS = {
+    "reissue_links": "remnawave_uuid IS NOT NULL",
+    "reset_traffic": """
+        generation = 'v2'
+        AND plan_kind = 'bypass'
+        AND is_visible = TRUE
+        AND traffic_enabled = TRUE
+        AND remnawave_uuid IS NOT NULL
+        AND subscription_until IS NOT NULL
+        AND subscription_until > now() AT TIME ZONE 'UTC'
+    """,
+}
+
+
+async def create_admin_job(
+    kind: str,
+    scope: str,
+    created_by: int | None,
+    *,
+    notify_chat_id: int | None = None,
+    notify_message_id: int | None = None,
+):
+    """Создать задачу со снимком целевых подписок.
+
+    Возвращает (задача, создана ли новая): пока задача того же типа не
+    завершена, вторую не создаём и отдаём существующую.
+    """
+    where_targets = _ADMIN_JOB_TARGETS[kind]
+    where_active = "AND subscription_until IS NOT NULL AND subscription_until > now() AT TIME ZONE 'UTC'" if scope == "active" else ""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('admin_job:' || $1))", kind)
+            existing = await conn.fetchrow(
+                "SELECT * FROM admin_jobs WHERE kind = $1 AND status IN ('pending', 'running') ORDER BY id LIMIT 1",
+                kind,
+            )
+            if existing:
+                return existing, False
+
+            job = await conn.fetchrow(
+                """
+                INSERT INTO admin_jobs (kind, scope, created_by, notify_chat_id, notify_message_id)
+                VALUES ($1, $2, $3, $4, $5)
+                RETURNING id
+                """,
+                kind,
+                scope,
+                created_by,
+                notify_chat_id,
+                notify_message_id,
+            )
+            await conn.execute(
+                f"""
+                INSERT INTO admin_job_items (job_id, subscription_id)
+                SELECT $1::BIGINT, id FROM subscriptions
+                WHERE {where_targets}
+                  {where_active}
+                """,
+                job["id"],
+            )
+            job = await conn.fetchrow(
+                """
+                UPDATE admin_jobs
+                SET total = (SELECT count(*) FROM admin_job_items WHERE job_id = $1)
+                WHERE id = $1
+                RETURNING *
+                """,
+                job["id"],
+            )
+            return job, True
+
+
+async def set_admin_job_notify_message(job_id: int, chat_id: int, message_id: int):
+    await db_execute(
+        "UPDATE admin_jobs SET notify_chat_id = $2, notify_message_id = $3 WHERE id = $1",
+        (job_id, chat_id, message_id),
+    )
+
+
+async def get_admin_job(job_id: int):
+    return await db_execute("SELECT * FROM admin_jobs WHERE id = $1", (job_id,), fetch_one=True)
+
+
+async def list_admin_jobs(limit: int = 20):
+    return await db_execute(
+        "SELECT * FROM admin_jobs ORDER BY id DESC LIMIT $1",
+        (limit,),
+        fetch_all=True,
+    )
+
+
+async def get_resumable_admin_jobs():
+    """Задачи, которые надо запустить или продолжить после рестарта."""
+    return await db_execute(
+        "SELECT * FROM admin_jobs WHERE status IN ('pending', 'running') ORDER BY id ASC",
+        fetch_all=True,
+    )
+
+
+async def mark_admin_job_running(job_id: int) -> bool:
+    row = await db_execute(
+        """
+        UPDATE admin_jobs
+        SET status = 'running',
+            started_at = COALESCE(started_at, now() AT TIME ZONE 'UTC'),
+            updated_at = now()
+        WHERE id = $1 AND status IN ('pending', 'running')
+        RETURNING id
+        """,
+        (job_id,),
+        fetch_one=True,
+    )
+    return row is not None
+
+
+async def finish_admin_job(job_id: int, status: str, error: str | None = None):
+    """Закрыть задачу; отменённую не перезаписываем."""
+    return await db_execute(
+        """
+        UPDATE admin_jobs
+        SET status = $2,
+            last_error = COALESCE($3, last_error),
+            finished_at = now() AT TIME ZONE 'UTC',
+            updated_at = now()
+        WHERE id = $1 AND status IN ('pending', 'running')
+        RETURNING *
+        """,
+        (job_id, status, error),
+        fetch_one=True,
+    )
+
+
+async def cancel_admin_job(job_id: int) -> bool:
+    row = await db_execute(
+        """
+        UPDATE admin_jobs
+        SET status = 'cancelled',
+            finished_at = now() AT TIME ZONE 'UTC',
+            updated_at = now()
+        WHERE id = $1 AND status IN ('pending', 'running')
+        RETURNING id
+        """,
+        (job_id,),
+        fetch_one=True,
+    )
+    return row is not None
+
+
+async def get_pending_admin_job_items(job_id: int, limit: int) -> list[int]:
+    rows = await db_execute(
+        """
+        SELECT subscription_id FROM admin_job_items
+        WHERE job_id = $1 AND status = 'pending'
+        ORDER BY subscription_id ASC
+        LIMIT $2
+        """,
+        (job_id, limit),
+        fetch_all=True,
+    )
+    return [row["subscription_id"] for row in rows or []]
+
+
+async def finish_admin_job_item(job_id: int, subscription_id: int, ok: bool, error: str | None = None):
+    """Отметить результат по подписке и сразу обновить счётчики задачи."""
+    return await db_execute(
+        """
+        WITH item AS (
+            UPDATE admin_job_items
+            SET status = CASE WHEN $3 THEN 'done' ELSE 'failed' END,
+                attempts = attempts + 1,
+                error = $4,
+                updated_at = now()
+            WHERE job_id = $1 AND subscription_id = $2 AND status = 'pending'
+            RETURNING 1
+        )
+        UPDATE admin_jobs
+        SET processed = processed + (SELECT count(*) FROM item),
+            succeeded = succeeded + CASE WHEN $3 THEN (SELECT count(*) FROM item) ELSE 0 END,
+            failed = failed + CASE WHEN $3 THEN 0 ELSE (SELECT count(*) FROM item) END,
+            updated_at = now()
+        WHERE id = $1
+        RETURNING *
+        """,
+        (job_id, subscription_id, ok, error),
+        fetch_one=True,
+    )
+
+
+async def get_failed_admin_job_items(job_id: int, limit: int = 50):
+    return await db_execute(
+        """
+        SELECT subscription_id, error, attempts, updated_at
+        FROM admin_job_items
+        WHERE job_id = $1 AND status = 'failed'
+        ORDER BY subscription_id ASC
+        LIMIT $2
+        """,
+        (job_id, limit),
+        fetch_all=True,
+    )
+
+
+# ────────────────────────────────────────────────
+#               РАССЫЛКИ
+# ────────────────────────────────────────────────
+
+# Получатели рассылки каждого режима (снимок на момент создания задачи).
+_BROADCAST_RECIPIENTS = {
+    "all": "SELECT tg_id FROM users",
+    "no_sub": """
+        SELECT tg_id FROM users
+        WHERE NOT EXISTS (
+            SELECT 1 FROM subscriptions
+            WHERE subscriptions.tg_id = users.tg_id
+              AND subscriptions.subscription_until IS NOT NULL
+              AND subscriptions.subscription_until > now() AT TIME ZONE 'UTC'
+        )
+    """,
+}
+# Исход по получателю -> счётчик в broadcast_jobs
+BROADCAST_OUTCOMES = {"sent": "sent", "blocked": "blocked", "unreachable": "unreachable", "error": "errors"}
+
+
+async def create_broadcast_job(
+    mode: str,
+    source_chat_id: int,
+    source_message_id: int,
+    buttons: list[str],
+    created_by: int | None,
+):
+    """Создать рассылку со снимком получателей; вернуть задачу."""
+    async with transaction() as conn:
+        job = await conn.fetchrow(
+            """
+            INSERT INTO broadcast_jobs (mode, source_chat_id, source_message_id, buttons, created_by)
+            VALUES ($1, $2, $3, $4, $5)
+            RETURNING id
+            """,
+            mode,
+            source_chat_id,
+            source_message_id,
+            buttons,
+            created_by,
+        )
+        await conn.execute(
+            f"""
+            INSERT INTO broadcast_recipients (job_id, tg_id)
+            SELECT $1::BIGINT, tg_id FROM ({_BROADCAST_RECIPIENTS[mode]}) AS recipients
+            WHERE tg_id > 0
+            """,
+            job["id"],
+        )
+        return await conn.fetchrow(
+            """
+            UPDATE broadcast_jobs
+            SET total = (SELECT count(*) FROM broadcast_recipients WHERE job_id = $1)
+            WHERE id = $1
+            RETURNING *
+            """,
+            job["id"],
+        )
+
+
+async def set_broadcast_job_notify_message(job_id: int, chat_id: int, message_id: int):
+    await db_execute(
+        "UPDATE broadcast_jobs SET notify_chat_id = $2, notify_message_id = $3 WHERE id = $1",
+        (job_id, chat_id, message_id),
+    )
+
+
+async def get_broadcast_job(job_id: int):
+    return await db_execute("SELECT * FROM broadcast_jobs WHERE id = $1", (job_id,), fetch_one=True)
 
-    await db_execute(
-        """
-        UPDATE subscriptions
-        SET remnawave_uuid = $1,
-            remnawave_username = $2,
-            subscription_until = $3,
-            squad_uuid = $4,
-            next_notification_time = $6,
-            notification_type = $7,
-            is_active = TRUE,
-            updated_at = now()
-        WHERE id = $5
-        """,
-        (uuid, username, subscription_until, squad_uuid, subscription_id, next_notification, notification_type)
+
+async def list_broadcast_jobs(limit: int = 10):
+    return await db_execute(
+        "SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT $1",
+        (limit,),
+        fetch_all=True,
     )
 
-    subscription = await get_subscription_by_id(subscription_id)
-    if subscription:
-        await sync_primary_subscription_to_user(subscription['tg_id'])
 
+async def get_resumable_broadcast_jobs():
+    """Рассылки, которые надо запустить или продолжить после рестарта."""
+    return await db_execute(
+        "SELECT * FROM broadcast_jobs WHERE status IN ('pending', 'running') ORDER BY id ASC",
+        fetch_all=True,
+    )
 
-async def sync_subscription_expiry(subscription_id: int, subscription_until):
-    """Синхронизировать фактический срок подписки из Remnawave."""
-    next_notification, notification_type = _calculate_notification_fields(subscription_until)
-    is_active = bool(subscription_until and subscription_until > datetime.utcnow())
 
-    await db_execute(
+async def mark_broadcast_job_running(job_id: int) -> bool:
+    row = await db_execute(
         """
-        UPDATE subscriptions
-        SET subscription_until = $1,
-            is_active = $2,
-            next_notification_time = $3,
-            notification_type = $4,
+        UPDATE broadcast_jobs
+        SET status = 'running',
+            started_at = COALESCE(started_at, now() AT TIME ZONE 'UTC'),
             updated_at = now()
-        WHERE id = $5
+        WHERE id = $1 AND status IN ('pending', 'running')
+        RETURNING id
         """,
-        (subscription_until, is_active, next_notification, notification_type, subscription_id),
+        (job_id,),
+        fetch_one=True,
     )
+    return row is not None
 
-    subscription = await get_subscription_by_id(subscription_id)
-    if subscription:
-        await sync_primary_subscription_to_user(subscription['tg_id'])
-
-
-async def update_subscription(
-    tg_id: int,
-    uuid: str,
-    username: str,
-    subscription_until,
-    squad_uuid: str | None,
-    *,
-    subscription_id: int | None = None,
-    slot_number: int | None = 1,
-):
-    """Совместимый wrapper обновления подписки."""
-    target_subscription = None
 
-    if subscription_id is not None:
-        target_subscription = await get_subscription_by_id(subscription_id, tg_id)
+async def finish_broadcast_job(job_id: int, status: str, error: str | None = None):
+    """Закрыть рассылку; остановленную админом не перезаписываем."""
+    return await db_execute(
+        """
+        UPDATE broadcast_jobs
+        SET status = $2,
+            last_error = COALESCE($3, last_error),
+            finished_at = now() AT TIME ZONE 'UTC',
+            updated_at = now()
+        WHERE id = $1 AND status IN ('pending', 'running')
+        RETURNING *
+        """,
+        (job_id, status, error),
+        fetch_one=True,
+    )
 
-    if target_subscription is None and uuid:
-        target_subscription = await get_subscription_by_uuid(uuid)
-        if target_subscription and target_subscription['tg_id'] != tg_id:
-            target_subscription = None
 
-    if target_subscription is None and slot_number is not None:
-        target_subscription = await get_subscription_by_slot(tg_id, slot_number)
+async def stop_broadcast_job(job_id: int):
+    """Остановить рассылку; её можно продолжить resume_broadcast_job."""
+    return await db_execute(
+        """
+        UPDATE broadcast_jobs
+        SET status = 'stopped', updated_at = now()
+        WHERE id = $1 AND status IN ('pending', 'running')
+        RETURNING *
+        """,
+        (job_id,),
+        fetch_one=True,
+    )
 
-    if target_subscription is None:
-        resolved_slot = slot_number if slot_number is not None else await get_next_subscription_slot(tg_id)
-        if resolved_slot is None:
-            raise RuntimeError(f"No free subscription slots for user {tg_id}")
-        target_subscription = await create_subscription_record(tg_id, resolved_slot)
 
-    await update_subscription_record(target_subscription['id'], uuid, username, subscription_until, squad_uuid)
-    return target_subscription['id']
+async def resume_broadcast_job(job_id: int):
+    """Вернуть остановленную или упавшую рассылку в очередь с места остановки."""
+    return await db_execute(
+        """
+        UPDATE broadcast_jobs
+        SET status = 'pending', finished_at = NULL, updated_at = now()
+        WHERE id = $1 AND status IN ('stopped', 'failed')
+        RETURNING *
+        """,
+        (job_id,),
+        fetch_one=True,
+    )
 
 
-async def delete_subscription_record(subscription_id: int):
-    """Удалить запись подписки и синхронизировать legacy-поля."""
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            subscription = await conn.fetchrow(
-                "SELECT * FROM subscriptions WHERE id = $1 FOR UPDATE",
-                subscription_id,
-            )
-            if not subscription:
-                return False
+async def get_broadcast_batch(job_id: int, after_tg_id: int, limit: int) -> list[int]:
+    """Следующие необработанные получатели после курсора."""
+    rows = await db_execute(
+        """
+        SELECT tg_id FROM broadcast_recipients
+        WHERE job_id = $1 AND status = 'pending' AND tg_id > $2
+        ORDER BY tg_id ASC
+        LIMIT $3
+        """,
+        (job_id, after_tg_id, limit),
+        fetch_all=True,
+    )
+    return [row["tg_id"] for row in rows or []]
 
-            tg_id = subscription["tg_id"]
-            await conn.execute(
-                "DELETE FROM notification_state WHERE subscription_id = $1",
-                subscription_id,
-            )
-            await conn.execute(
-                "UPDATE payments SET subscription_id = NULL, updated_at = now() WHERE subscription_id = $1",
-                subscription_id,
-            )
-            await conn.execute(
-                "DELETE FROM traffic_purchases WHERE subscription_id = $1",
-                subscription_id,
-            )
-            await conn.execute(
-                "DELETE FROM device_addon_purchases WHERE subscription_id = $1",
-                subscription_id,
-            )
-            await conn.execute(
-                "DELETE FROM subscription_traffic_cycles WHERE subscription_id = $1",
-                subscription_id,
-            )
-            await conn.execute("DELETE FROM subscriptions WHERE id = $1", subscription_id)
 
-    await sync_primary_subscription_to_user(tg_id)
-    return True
+async def record_broadcast_outcome(job_id: int, tg_id: int, outcome: str, error: str | None = None):
+    """Записать исход по получателю и сразу обновить счётчики рассылки."""
+    counter = BROADCAST_OUTCOMES.get(outcome)
+    if counter is None:
+        raise ValueError(f"Unknown broadcast outcome: {outcome}")
+    await db_execute(
+        f"""
+        WITH item AS (
+            UPDATE broadcast_recipients
+            SET status = $3, error = $4, updated_at = now()
+            WHERE job_id = $1 AND tg_id = $2 AND status = 'pending'
+            RETURNING 1
+        )
+        UPDATE broadcast_jobs
+        SET {counter} = {counter} + (SELECT count(*) FROM item),
+            updated_at = now()
+        WHERE id = $1
+        """,
+        (job_id, tg_id, outcome, error),
+    )
 
 
-async def has_subscription(tg_id: int) -> bool:
-    """Проверить есть ли хотя бы одна подписка."""
-    result = await db_execute(
-        "SELECT 1 FROM subscriptions WHERE tg_id = $1 LIMIT 1",
-        (tg_id,),
-        fetch_one=True
+async def checkpoint_broadcast_job(job_id: int, cursor_tg_id: int):
+    """Сдвинуть курсор: все получатели до него уже обработаны."""
+    return await db_execute(
+        """
+        UPDATE broadcast_jobs
+        SET cursor_tg_id = GREATEST(cursor_tg_id, $2), updated_at = now()
+        WHERE id = $1
+        RETURNING *
+        """,
+        (job_id, cursor_tg_id),
+        fetch_one=True,
     )
-    return result is not None
 
 
 # ────────────────────────────────────────────────
@@ -1902,20 +3991,42 @@ async def set_tracking_link_active(code: str, is_active: bool) -> bool:
     return result is not None
 
 
+@_invalidates()
 async def record_tracking_link_click(code: str, tg_id: int, is_new_user: bool) -> bool:
-    """Записать переход по активной tracking-ссылке."""
+    """Записать переход по активной tracking-ссылке и учесть его в сводке."""
     code = code.strip().lower()
     link = await get_tracking_link(code)
     if not link or not link['is_active']:
         return False
 
-    await db_execute(
-        """
-        INSERT INTO tracking_link_clicks (code, tg_id, is_new_user)
-        VALUES ($1, $2, $3)
-        """,
-        (code, tg_id, is_new_user)
-    )
+    async with transaction():
+        await db_execute(
+            """
+            INSERT INTO tracking_link_clicks (code, tg_id, is_new_user)
+            VALUES ($1, $2, $3)
+            """,
+            (code, tg_id, is_new_user)
+        )
+        # Строка появляется на первом переходе, флаг новичка — на первом
+        # переходе новичком: так уникальные считаются один раз за всё время
+        visitor = await db_execute(
+            """
+            INSERT INTO tracking_link_visitors (code, tg_id, first_click_day, new_user_counted)
+            VALUES ($1, $2, (now() AT TIME ZONE 'UTC')::date, $3)
+            ON CONFLICT (code, tg_id) DO UPDATE
+            SET new_user_counted = TRUE
+            WHERE $3 AND NOT tracking_link_visitors.new_user_counted
+            RETURNING (xmax = 0) AS first_visit, new_user_counted
+            """,
+            (code, tg_id, is_new_user),
+            fetch_one=True
+        )
+        await _add_tracking_rollup(
+            code,
+            clicks=1,
+            unique_clicks=1 if visitor and visitor['first_visit'] else 0,
+            new_clicks=1 if visitor and visitor['new_user_counted'] else 0,
+        )
     return True
 
 
@@ -1950,92 +4061,272 @@ async def get_payment_tracking_code(tg_id: int) -> str | None:
     return await get_user_tracking_code(tg_id)
 
 
+@_analytics
 async def get_tracking_link_stats(code: str):
-    """Получить статистику tracking-ссылки."""
+    """Получить статистику tracking-ссылки из дневной сводки одним запросом."""
     code = code.strip().lower()
-    link = await get_tracking_link(code)
-    if not link:
+    row = await db_execute(
+        """
+        SELECT
+            l.id, l.code, l.title, l.is_active, l.created_by, l.created_at, l.updated_at,
+            COALESCE(SUM(d.clicks), 0) AS total_clicks,
+            COALESCE(SUM(d.unique_clicks), 0) AS unique_clicks,
+            COALESCE(SUM(d.new_clicks), 0) AS new_clicks,
+            COALESCE(SUM(d.attributed_users), 0) AS attributed_users,
+            COALESCE(SUM(d.paid_payments), 0) AS paid_payments,
+            COALESCE(SUM(d.purchases) FILTER (WHERE d.payment_kind = 'subscription'), 0) AS paid_subscriptions,
+            COALESCE(SUM(d.new_purchases) FILTER (WHERE d.payment_kind = 'subscription'), 0) AS new_subscriptions,
+            COALESCE(SUM(d.unique_payers), 0) AS unique_payers,
+            COALESCE(SUM(d.revenue), 0) AS revenue,
+            COALESCE(SUM(d.revenue) FILTER (WHERE d.payment_kind = 'subscription'), 0) AS subscription_revenue,
+            (
+                SELECT json_agg(t ORDER BY t.payment_kind, t.tariff_code)
+                FROM (
+                    SELECT tariff_code, payment_kind, SUM(purchases) AS purchase_count, SUM(revenue) AS revenue
+                    FROM tracking_link_daily
+                    WHERE code = l.code AND payment_kind <> ''
+                    GROUP BY tariff_code, payment_kind
+                    HAVING SUM(purchases) > 0
+                ) t
+            ) AS payments_by_tariff
+        FROM tracking_links l
+        LEFT JOIN tracking_link_daily d ON d.code = l.code
+        WHERE l.code = $1
+        GROUP BY l.id
+        """,
+        (code,),
+        fetch_one=True
+    )
+    if not row:
         return None
 
-    clicks = await db_execute(
+    return {
+        'link': {key: row[key] for key in ('id', 'code', 'title', 'is_active', 'created_by', 'created_at', 'updated_at')},
+        'total_clicks': row['total_clicks'],
+        'unique_clicks': row['unique_clicks'],
+        'new_clicks': row['new_clicks'],
+        'attributed_users': row['attributed_users'],
+        'paid_payments': row['paid_payments'],
+        'paid_subscriptions': row['paid_subscriptions'],
+        'new_subscriptions': row['new_subscriptions'],
+        'unique_payers': row['unique_payers'],
+        'revenue': float(row['revenue'] or 0),
+        'subscription_revenue': float(row['subscription_revenue'] or 0),
+        'payments_by_tariff': json.loads(row['payments_by_tariff']) if row['payments_by_tariff'] else [],
+    }
+
+
+@_analytics
+async def get_tracking_link_daily_stats(code: str, days: int = 30):
+    """Ряд по дням за последние days дней (UTC) для графика ссылки."""
+    code = code.strip().lower()
+    return await db_execute(
         """
         SELECT
-            COUNT(*) AS total_clicks,
-            COUNT(DISTINCT tg_id) AS unique_clicks,
-            COUNT(DISTINCT tg_id) FILTER (WHERE is_new_user = TRUE) AS new_clicks
-        FROM tracking_link_clicks
+            day,
+            SUM(clicks) AS clicks,
+            SUM(unique_clicks) AS unique_clicks,
+            SUM(new_clicks) AS new_clicks,
+            SUM(attributed_users) AS attributed_users,
+            SUM(paid_payments) AS paid_payments,
+            SUM(purchases) AS purchases,
+            SUM(unique_payers) AS unique_payers,
+            SUM(revenue) AS revenue
+        FROM tracking_link_daily
         WHERE code = $1
+          AND day > (now() AT TIME ZONE 'UTC')::date - $2::integer
+        GROUP BY day
+        ORDER BY day
         """,
-        (code,),
-        fetch_one=True
+        (code, days),
+        fetch_all=True
     )
 
-    users_count = await db_execute(
-        "SELECT COUNT(*) AS count FROM users WHERE tracking_code = $1",
-        (code,),
+
+# Счётчики дневной сводки. Строка с пустыми tariff_code/payment_kind несёт
+# переходы, пользователей и уникальных плательщиков, остальные — оплаты по
+# тарифу. Возврат вычитается из строки дня платежа, поэтому суммы по всем
+# дням совпадают с пересчётом из сырых таблиц.
+_TRACKING_ROLLUP_COUNTERS = (
+    'clicks',
+    'unique_clicks',
+    'new_clicks',
+    'attributed_users',
+    'paid_payments',
+    'purchases',
+    'new_purchases',
+    'unique_payers',
+    'revenue',
+)
+_TRACKING_ROLLUP_UPSERT = f"""
+    INSERT INTO tracking_link_daily (code, day, tariff_code, payment_kind, {', '.join(_TRACKING_ROLLUP_COUNTERS)})
+    VALUES ($1, COALESCE($2::date, (now() AT TIME ZONE 'UTC')::date), $3, $4,
+            {', '.join(f'${index}' for index in range(5, 5 + len(_TRACKING_ROLLUP_COUNTERS)))})
+    ON CONFLICT (code, day, tariff_code, payment_kind) DO UPDATE
+    SET {', '.join(f'{name} = tracking_link_daily.{name} + EXCLUDED.{name}' for name in _TRACKING_ROLLUP_COUNTERS)}
+"""
+
+
+async def _add_tracking_rollup(
+    code: str,
+    day=None,
+    *,
+    tariff_code: str = '',
+    payment_kind: str = '',
+    conn=None,
+    **deltas,
+):
+    """Прибавить счётчики к строке сводки; без day — за сегодня (UTC)."""
+    params = (code, day, tariff_code, payment_kind, *(deltas.get(name, 0) for name in _TRACKING_ROLLUP_COUNTERS))
+    if conn is not None:
+        await conn.execute(_TRACKING_ROLLUP_UPSERT, *params)
+    else:
+        await db_execute(_TRACKING_ROLLUP_UPSERT, params)
+
+
+async def _apply_tracking_payment(payment, sign: int, *, status_change: bool = False):
+    """Учесть в сводке оплату (sign=1) или возврат (sign=-1) платежа ссылки.
+
+    status_change — платёж перешёл в 'paid' или вышел из него: вместе с
+    покупкой меняется и число оплат. Покупку платежа с заявкой на возврат
+    возврат уже вычел, её не трогаем. payment['tracking_day'] — день
+    создания платежа по UTC.
+    """
+    code = payment['tracking_code']
+    day = payment['tracking_day']
+    purchase = 0 if status_change and payment['refund_requested_at'] is not None else sign
+    await _add_tracking_rollup(
+        code,
+        day,
+        tariff_code=payment['tariff_code'],
+        payment_kind=payment['payment_kind'],
+        paid_payments=sign if status_change else 0,
+        purchases=purchase,
+        new_purchases=purchase if payment['payment_target'] == 'new' else 0,
+        revenue=purchase * payment['amount'],
+    )
+    if payment['payment_kind'] != 'subscription' or not purchase:
+        return
+
+    payer = await db_execute(
+        """
+        INSERT INTO tracking_link_payers (code, tg_id, first_day, active_payments)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (code, tg_id) DO UPDATE
+        SET active_payments = tracking_link_payers.active_payments + EXCLUDED.active_payments,
+            first_day = CASE
+                WHEN tracking_link_payers.active_payments <= 0 THEN EXCLUDED.first_day
+                ELSE tracking_link_payers.first_day
+            END
+        RETURNING first_day, active_payments
+        """,
+        (code, payment['tg_id'], day, sign),
         fetch_one=True
     )
+    if (sign > 0 and payer['active_payments'] == 1) or (sign < 0 and payer['active_payments'] == 0):
+        await _add_tracking_rollup(code, payer['first_day'], unique_payers=sign)
+
 
-    payments_summary = await db_execute(
+async def _rebuild_tracking_link_rollup(conn):
+    """Заполнить сводку заново; conn должен быть в транзакции.
+
+    Метки времени в таблицах — по часам сессии; дни сводки, как и у живых
+    инкрементов, — по UTC.
+    """
+    truncate_and_fill = [
+        "TRUNCATE tracking_link_daily, tracking_link_visitors, tracking_link_payers",
+        """
+        INSERT INTO tracking_link_visitors (code, tg_id, first_click_day, new_user_counted)
+        SELECT code, tg_id, (MIN(clicked_at)::timestamptz AT TIME ZONE 'UTC')::date, BOOL_OR(COALESCE(is_new_user, FALSE))
+        FROM tracking_link_clicks
+        GROUP BY code, tg_id
+        """,
+        """
+        INSERT INTO tracking_link_daily (code, day, clicks)
+        SELECT code, (clicked_at::timestamptz AT TIME ZONE 'UTC')::date, COUNT(*)
+        FROM tracking_link_clicks
+        GROUP BY code, (clicked_at::timestamptz AT TIME ZONE 'UTC')::date
+        """,
         """
+        INSERT INTO tracking_link_daily (code, day, unique_clicks)
+        SELECT code, first_click_day, COUNT(*)
+        FROM tracking_link_visitors
+        GROUP BY code, first_click_day
+        ON CONFLICT (code, day, tariff_code, payment_kind) DO UPDATE
+        SET unique_clicks = EXCLUDED.unique_clicks
+        """,
+        """
+        INSERT INTO tracking_link_daily (code, day, new_clicks)
+        SELECT code, day, COUNT(*)
+        FROM (
+            SELECT code, tg_id, (MIN(clicked_at)::timestamptz AT TIME ZONE 'UTC')::date AS day
+            FROM tracking_link_clicks
+            WHERE is_new_user = TRUE
+            GROUP BY code, tg_id
+        ) first_new_click
+        GROUP BY code, day
+        ON CONFLICT (code, day, tariff_code, payment_kind) DO UPDATE
+        SET new_clicks = EXCLUDED.new_clicks
+        """,
+        """
+        INSERT INTO tracking_link_daily (code, day, attributed_users)
+        SELECT tracking_code, (COALESCE(created_at::timestamptz, now()) AT TIME ZONE 'UTC')::date, COUNT(*)
+        FROM users
+        WHERE tracking_code IS NOT NULL
+        GROUP BY tracking_code, (COALESCE(created_at::timestamptz, now()) AT TIME ZONE 'UTC')::date
+        ON CONFLICT (code, day, tariff_code, payment_kind) DO UPDATE
+        SET attributed_users = EXCLUDED.attributed_users
+        """,
+        """
+        INSERT INTO tracking_link_daily (
+            code, day, tariff_code, payment_kind, paid_payments, purchases, new_purchases, revenue
+        )
         SELECT
-            COUNT(*) AS paid_payments,
-            COUNT(*) FILTER (
-                WHERE payment_kind = 'subscription'
-                  AND refund_requested_at IS NULL
-            ) AS paid_subscriptions,
-            COUNT(*) FILTER (
-                WHERE payment_kind = 'subscription'
-                  AND payment_target = 'new'
-                  AND refund_requested_at IS NULL
-            ) AS new_subscriptions,
-            COUNT(DISTINCT tg_id) FILTER (
-                WHERE payment_kind = 'subscription'
-                  AND refund_requested_at IS NULL
-            ) AS unique_payers,
-            COALESCE(SUM(amount) FILTER (
-                WHERE refund_requested_at IS NULL
-            ), 0) AS revenue,
-            COALESCE(SUM(amount) FILTER (
-                WHERE payment_kind = 'subscription'
-                  AND refund_requested_at IS NULL
-            ), 0) AS subscription_revenue
+            tracking_code,
+            (COALESCE(created_at::timestamptz, now()) AT TIME ZONE 'UTC')::date,
+            tariff_code,
+            payment_kind,
+            COUNT(*),
+            COUNT(*) FILTER (WHERE refund_requested_at IS NULL),
+            COUNT(*) FILTER (WHERE refund_requested_at IS NULL AND payment_target = 'new'),
+            COALESCE(SUM(amount) FILTER (WHERE refund_requested_at IS NULL), 0)
         FROM payments
-        WHERE tracking_code = $1
+        WHERE tracking_code IS NOT NULL
           AND status = 'paid'
+        GROUP BY tracking_code, (COALESCE(created_at::timestamptz, now()) AT TIME ZONE 'UTC')::date, tariff_code, payment_kind
         """,
-        (code,),
-        fetch_one=True
-    )
-
-    payments_by_tariff = await db_execute(
         """
-        SELECT tariff_code, payment_kind, COUNT(*) AS purchase_count, COALESCE(SUM(amount), 0) AS revenue
+        INSERT INTO tracking_link_payers (code, tg_id, first_day, active_payments)
+        SELECT tracking_code, tg_id, (MIN(COALESCE(created_at::timestamptz, now())) AT TIME ZONE 'UTC')::date, COUNT(*)
         FROM payments
-        WHERE tracking_code = $1
+        WHERE tracking_code IS NOT NULL
           AND status = 'paid'
+          AND payment_kind = 'subscription'
           AND refund_requested_at IS NULL
-        GROUP BY tariff_code, payment_kind
-        ORDER BY payment_kind ASC, tariff_code ASC
+        GROUP BY tracking_code, tg_id
         """,
-        (code,),
-        fetch_all=True
-    )
+        """
+        INSERT INTO tracking_link_daily (code, day, unique_payers)
+        SELECT code, first_day, COUNT(*)
+        FROM tracking_link_payers
+        GROUP BY code, first_day
+        ON CONFLICT (code, day, tariff_code, payment_kind) DO UPDATE
+        SET unique_payers = EXCLUDED.unique_payers
+        """,
+    ]
+    for query in truncate_and_fill:
+        await conn.execute(query)
 
-    return {
-        'link': link,
-        'total_clicks': clicks['total_clicks'] if clicks else 0,
-        'unique_clicks': clicks['unique_clicks'] if clicks else 0,
-        'new_clicks': clicks['new_clicks'] if clicks else 0,
-        'attributed_users': users_count['count'] if users_count else 0,
-        'paid_payments': payments_summary['paid_payments'] if payments_summary else 0,
-        'paid_subscriptions': payments_summary['paid_subscriptions'] if payments_summary else 0,
-        'new_subscriptions': payments_summary['new_subscriptions'] if payments_summary else 0,
-        'unique_payers': payments_summary['unique_payers'] if payments_summary else 0,
-        'revenue': float(payments_summary['revenue'] or 0) if payments_summary else 0,
-        'subscription_revenue': float(payments_summary['subscription_revenue'] or 0) if payments_summary else 0,
-        'payments_by_tariff': payments_by_tariff or [],
-    }
+
+async def rebuild_tracking_link_rollup():
+    """Пересобрать дневную сводку ссылок из переходов, пользователей и платежей.
+
+    Нужна, если сводка разошлась с сырыми данными (ручные правки в БД).
+    TRUNCATE держит блокировку до коммита, так что живые инкременты ждут и
+    ложатся уже поверх пересчёта.
+    """
+    async with transaction() as conn:
+        await _rebuild_tracking_link_rollup(conn)
 
 
 # ────────────────────────────────────────────────
@@ -2262,35 +4553,39 @@ async def get_latest_subscription_payment_for_refund(subscription_id: int, tg_id
                     subscription_id IS NULL
                 AND payment_target = 'new'
                 AND target_slot_number = $3
-                AND tariff_code LIKE $4
-             )
-          )
-        ORDER BY updated_at DESC, created_at DESC, id DESC
-        LIMIT 1
-        """,
-        (tg_id, subscription_id, type_index, tariff_like),
-        fetch_one=True,
-    )
-
-
-async def request_payment_refund(payment_id: int, tg_id: int) -> bool:
-    """Зафиксировать заявку на возврат по оплаченному платежу."""
-    result = await db_execute(
-        """
-        UPDATE payments
-        SET refund_requested_at = now(),
-            refund_status = 'requested',
-            updated_at = now()
-        WHERE id = $1
-          AND tg_id = $2
-          AND status = 'paid'
-          AND refund_requested_at IS NULL
-        RETURNING id
+                AND tariff_code LIKE $4
+             )
+          )
+        ORDER BY updated_at DESC, created_at DESC, id DESC
+        LIMIT 1
         """,
-        (payment_id, tg_id),
+        (tg_id, subscription_id, type_index, tariff_like),
         fetch_one=True,
     )
-    return result is not None
+
+
+async def request_payment_refund(payment_id: int, tg_id: int) -> bool:
+    """Зафиксировать заявку на возврат по оплаченному платежу."""
+    async with transaction():
+        payment = await db_execute(
+            """
+            UPDATE payments
+            SET refund_requested_at = now(),
+                refund_status = 'requested',
+                updated_at = now()
+            WHERE id = $1
+              AND tg_id = $2
+              AND status = 'paid'
+              AND refund_requested_at IS NULL
+            RETURNING tracking_code, tg_id, tariff_code, payment_kind, payment_target, amount,
+                      (COALESCE(created_at::timestamptz, now()) AT TIME ZONE 'UTC')::date AS tracking_day
+            """,
+            (payment_id, tg_id),
+            fetch_one=True,
+        )
+        if payment and payment['tracking_code']:
+            await _apply_tracking_payment(payment, -1)
+    return payment is not None
 
 
 async def link_payment_to_subscription(invoice_id: str, subscription_id: int) -> None:
@@ -2332,6 +4627,7 @@ async def deactivate_subscription_for_refund(subscription_id: int, tg_id: int, e
             "DELETE FROM notification_state WHERE tg_id = $1 AND subscription_id = $2",
             (tg_id, subscription_id),
         )
+        await db_execute("DELETE FROM scheduled_notifications WHERE subscription_id = $1", (subscription_id,))
     return result is not None
 
 
@@ -2368,7 +4664,7 @@ async def add_traffic_to_subscription(subscription_id: int, traffic_bytes: int)
         UPDATE subscriptions
         SET current_paid_traffic_bytes = current_paid_traffic_bytes + $1,
             current_period_limit_bytes = current_period_limit_bytes + $1,
-            last_traffic_sync_at = now(),
+            last_traffic_sync_at = now() AT TIME ZONE 'UTC',
             updated_at = now()
         WHERE id = $2
         """,
@@ -2427,6 +4723,7 @@ async def activate_device_addon_purchase(invoice_id: str) -> bool:
     return True
 
 
+@_memoized("device_addons")
 async def get_active_device_addon_count(subscription_id: int):
     """Посчитать активные докупленные устройства для подписки."""
     result = await db_execute(
@@ -2443,6 +4740,7 @@ async def get_active_device_addon_count(subscription_id: int):
     return int(result["device_count"] or 0) if result else 0
 
 
+@_invalidates(*_SUBSCRIPTION_WRITE)
 async def set_subscription_device_limit(subscription_id: int, device_limit: int) -> None:
     """Обновить локальный лимит устройств у подписки."""
     await db_execute(
@@ -2456,22 +4754,47 @@ async def set_subscription_device_limit(subscription_id: int, device_limit: int)
     )
 
 
-async def get_subscriptions_with_expired_device_addons():
-    """Получить подписки, у которых истекли докупленные устройства и надо пересчитать лимит."""
-    return await db_execute(
+async def get_active_device_addon_counts(subscription_ids: list[int]) -> dict[int, int]:
+    """Активные докупленные устройства для пачки подписок одним запросом."""
+    if not subscription_ids:
+        return {}
+    rows = await db_execute(
         """
-        SELECT DISTINCT s.*
-        FROM subscriptions s
-        JOIN device_addon_purchases dap ON dap.subscription_id = s.id
-        WHERE dap.status = 'paid'
-          AND dap.valid_until <= now() AT TIME ZONE 'UTC'
-          AND dap.expired_processed_at IS NULL
-          AND s.generation = 'v2'
-          AND s.remnawave_uuid IS NOT NULL
-        ORDER BY s.id ASC
+        SELECT subscription_id, COALESCE(SUM(device_count), 0) AS device_count
+        FROM device_addon_purchases
+        WHERE subscription_id = ANY($1::BIGINT[])
+          AND status = 'paid'
+          AND valid_until > now() AT TIME ZONE 'UTC'
+        GROUP BY subscription_id
         """,
+        (list(subscription_ids),),
         fetch_all=True,
     )
+    counts = {subscription_id: 0 for subscription_id in subscription_ids}
+    for row in rows or []:
+        counts[row["subscription_id"]] = int(row["device_count"] or 0)
+    return counts
+
+
+async def iter_subscriptions_with_expired_device_addons(batch_size: int | None = None):
+    """Пачки подписок, у которых истекли докупленные устройства и надо пересчитать лимит."""
+    async for batch in iter_row_batches(
+        """
+        SELECT s.*
+        FROM subscriptions s
+        WHERE s.generation = 'v2'
+          AND s.remnawave_uuid IS NOT NULL
+          AND EXISTS (
+              SELECT 1 FROM device_addon_purchases dap
+              WHERE dap.subscription_id = s.id
+                AND dap.status = 'paid'
+                AND dap.valid_until <= now() AT TIME ZONE 'UTC'
+                AND dap.expired_processed_at IS NULL
+          )
+        """,
+        batch_size=batch_size,
+    ):
+        yield batch
 
 
 async def mark_expired_device_addons_processed(subscription_id: int) -> None:
@@ -2489,18 +4812,18 @@ async def mark_expired_device_addons_processed(subscription_id: int) -> None:
     )
 
 
-async def get_legacy_subscriptions_pending_limit_removal():
-    """Получить старые подписки, с которых надо убрать ранее установленный лимит."""
-    return await db_execute(
+async def iter_legacy_subscriptions_pending_limit_removal(batch_size: int | None = None):
+    """Пачки старых подписок, с которых надо убрать ранее установленный лимит."""
+    async for batch in iter_row_batches(
         """
         SELECT * FROM subscriptions
         WHERE legacy_readonly = TRUE
           AND legacy_limit_removal_pending = TRUE
           AND remnawave_uuid IS NOT NULL
-        ORDER BY id ASC
         """,
-        fetch_all=True,
-    )
+        batch_size=batch_size,
+    ):
+        yield batch
 
 
 async def mark_legacy_subscription_limit_removed(subscription_id: int) -> None:
@@ -2515,7 +4838,7 @@ async def mark_legacy_subscription_limit_removed(subscription_id: int) -> None:
             carried_traffic_bytes = 0,
             current_period_limit_bytes = 0,
             traffic_reset_at = NULL,
-            last_traffic_sync_at = now(),
+            last_traffic_sync_at = now() AT TIME ZONE 'UTC',
             updated_at = now()
         WHERE id = $1
         """,
@@ -2523,9 +4846,9 @@ async def mark_legacy_subscription_limit_removed(subscription_id: int) -> None:
     )
 
 
-async def get_bypass_subscriptions_for_limit_sync():
-    """Получить активные bypass-подписки, лимит которых надо синхронизировать с Remnawave."""
-    return await db_execute(
+async def iter_bypass_subscriptions_for_limit_sync(batch_size: int | None = None):
+    """Пачки активных bypass-подписок, лимит которых надо синхронизировать с Remnawave."""
+    async for batch in iter_row_batches(
         """
         SELECT * FROM subscriptions
         WHERE generation = 'v2'
@@ -2540,10 +4863,10 @@ async def get_bypass_subscriptions_for_limit_sync():
               last_traffic_sync_at IS NULL
               OR updated_at > last_traffic_sync_at
           )
-        ORDER BY updated_at ASC
         """,
-        fetch_all=True,
-    )
+        batch_size=batch_size,
+    ):
+        yield batch
 
 
 async def mark_traffic_limit_synced(subscription_id: int) -> None:
@@ -2551,16 +4874,16 @@ async def mark_traffic_limit_synced(subscription_id: int) -> None:
     await db_execute(
         """
         UPDATE subscriptions
-        SET last_traffic_sync_at = now()
+        SET last_traffic_sync_at = now() AT TIME ZONE 'UTC'
         WHERE id = $1
         """,
         (subscription_id,)
     )
 
 
-async def get_bypass_subscriptions_for_traffic_reset():
-    """Получить bypass-подписки, которым пора сбросить трафик."""
-    return await db_execute(
+async def iter_bypass_subscriptions_for_traffic_reset(batch_size: int | None = None):
+    """Пачки bypass-подписок, которым пора сбросить трафик."""
+    async for batch in iter_row_batches(
         """
         SELECT * FROM subscriptions
         WHERE generation = 'v2'
@@ -2572,28 +4895,10 @@ async def get_bypass_subscriptions_for_traffic_reset():
           AND subscription_until > now() AT TIME ZONE 'UTC'
           AND traffic_reset_at IS NOT NULL
           AND traffic_reset_at <= now() AT TIME ZONE 'UTC'
-        ORDER BY traffic_reset_at ASC
-        """,
-        fetch_all=True
-    )
-
-
-async def get_active_bypass_subscriptions_for_manual_traffic_reset():
-    """Получить все активные bypass-подписки для ручного массового сброса трафика."""
-    return await db_execute(
-        """
-        SELECT * FROM subscriptions
-        WHERE generation = 'v2'
-          AND plan_kind = 'bypass'
-          AND is_visible = TRUE
-          AND traffic_enabled = TRUE
-          AND remnawave_uuid IS NOT NULL
-          AND subscription_until IS NOT NULL
-          AND subscription_until > now() AT TIME ZONE 'UTC'
-        ORDER BY tg_id ASC, type_index ASC, id ASC
         """,
-        fetch_all=True,
-    )
+        batch_size=batch_size,
+    ):
+        yield batch
 
 
 async def record_traffic_cycle(
@@ -2645,7 +4950,7 @@ async def apply_traffic_reset(subscription_id: int, remaining_paid_traffic_bytes
             current_period_limit_bytes = $2,
             last_known_used_traffic_bytes = 0,
             traffic_reset_at = $3,
-            last_traffic_sync_at = now(),
+            last_traffic_sync_at = now() AT TIME ZONE 'UTC',
             updated_at = now()
         WHERE id = $4
         """,
@@ -2675,7 +4980,7 @@ async def update_subscription_traffic_period(
             current_period_limit_bytes = $6,
             traffic_reset_at = $7,
             last_known_used_traffic_bytes = $8,
-            last_traffic_sync_at = now(),
+            last_traffic_sync_at = now() AT TIME ZONE 'UTC',
             updated_at = now()
         WHERE id = $1
         """,
@@ -2701,11 +5006,34 @@ async def update_payment_status(payment_id: int, status: str):
 
 
 async def update_payment_status_by_invoice(invoice_id: str, status: str):
-    """Обновить статус платежа по invoice_id"""
-    await db_execute(
-        "UPDATE payments SET status = $1, updated_at = now() WHERE invoice_id = $2",
-        (status, invoice_id)
-    )
+    """Обновить статус платежа по invoice_id
+
+    Переход в 'paid' и обратно сразу попадает в счётчики дашборда и дневную
+    сводку tracking-ссылки.
+    """
+    async with transaction():
+        payment = await db_execute(
+            """
+            WITH previous AS (
+                SELECT id, status FROM payments WHERE invoice_id = $2 FOR UPDATE
+            )
+            UPDATE payments p
+            SET status = $1, updated_at = now()
+            FROM previous
+            WHERE p.id = previous.id
+            RETURNING p.tracking_code, p.tg_id, p.tariff_code, p.payment_kind, p.payment_target,
+                      p.amount, p.refund_requested_at, previous.status AS previous_status,
+                      (COALESCE(p.created_at::timestamptz, now()) AT TIME ZONE 'UTC')::date AS tracking_day
+            """,
+            (status, invoice_id),
+            fetch_one=True
+        )
+        if not payment or (status == 'paid') == (payment['previous_status'] == 'paid'):
+            return
+        sign = 1 if status == 'paid' else -1
+        await _bump_admin_counters(paid_payments=sign, revenue=sign * payment['amount'])
+        if payment['tracking_code']:
+            await _apply_tracking_payment(payment, sign, status_change=True)
 
 
 # ────────────────────────────────────────────────
@@ -2774,6 +5102,7 @@ async def mark_gift_received(tg_id: int):
     )
 
 
+@_invalidates(("user", True))
 async def mark_gift_received_atomic(tg_id: int) -> bool:
     """
     Атомарно проверить и отметить что пользователь получил подарок.
@@ -2977,56 +5306,6 @@ async def update_last_payment_check(tg_id: int):
 #        SUBSCRIPTION NOTIFICATION MANAGEMENT
 # ────────────────────────────────────────────────
 
-async def get_users_needing_notification():
-    """
-    Получить пользователей которым нужно отправить уведомление о заканчивающейся подписке
-
-    Returns:
-        Список пользователей у которых next_notification_time <= now и есть активная подписка
-    """
-    from datetime import datetime
-
-    now = datetime.utcnow()
-
-    # Сначала получаем всех с установленным временем уведомления для логирования
-    all_with_notifications = await db_execute(
-        """
-        SELECT tg_id, next_notification_time, subscription_until, notification_type
-        FROM users
-        WHERE tg_id > 0
-        AND next_notification_time IS NOT NULL
-        AND subscription_until IS NOT NULL
-        ORDER BY next_notification_time ASC
-        """,
-        fetch_all=True
-    )
-
-    if all_with_notifications:
-        logging.debug(f"Total users with notifications set: {len(all_with_notifications)}")
-        for user in all_with_notifications[:5]:  # Показываем первых 5
-            logging.debug(f"  User {user['tg_id']}: notification_time={user['next_notification_time']}, subscription_until={user['subscription_until']}, type={user['notification_type']}")
-
-    # Теперь получаем только тех кому нужно отправить уведомление
-    result = await db_execute(
-        """
-        SELECT tg_id, remnawave_uuid, subscription_until, notification_type
-        FROM users
-        WHERE tg_id > 0
-        AND next_notification_time IS NOT NULL
-        AND next_notification_time <= $1
-        AND subscription_until IS NOT NULL
-        ORDER BY next_notification_time ASC
-        """,
-        (now,),
-        fetch_all=True
-    )
-
-    if result:
-        logging.info(f"Users needing notification (now={now}): {len(result)}")
-
-    return result
-
-
 async def mark_notification_sent(tg_id: int):
     """Отметить что уведомление было отправлено пользователю"""
     from datetime import datetime, timedelta
@@ -3154,6 +5433,208 @@ async def mark_notification_state_sent(tg_id: int, notification_type: str, subsc
     )
 
 
+# ────────────────────────────────────────────────
+#         ЗАПЛАНИРОВАННЫЕ УВЕДОМЛЕНИЯ
+# ────────────────────────────────────────────────
+
+# За сколько до окончания подписки напоминать; отправка — в ближайшие
+# EXPIRY_NOTIFICATION_HOUR по Москве после начала окна
+EXPIRY_NOTIFICATION_LEADS = {
+    "expires_today": timedelta(hours=12),
+    "expires_1d": timedelta(days=1),
+    "expires_3d": timedelta(days=3),
+    "expires_7d": timedelta(days=7),
+}
+EXPIRY_NOTIFICATION_HOUR = 19
+
+_SCHEDULE_EXPIRY_NOTIFICATIONS = """
+    WITH planned AS (
+        SELECT s.id AS subscription_id, s.tg_id, stage.notification_type, s.subscription_until, due.due_at
+        FROM subscriptions s
+        CROSS JOIN unnest($2::text[], $3::interval[]) AS stage(notification_type, lead_time)
+        CROSS JOIN LATERAL (
+            SELECT (
+                date_trunc(
+                    'day',
+                    GREATEST(s.subscription_until - stage.lead_time, now() AT TIME ZONE 'UTC')
+                        AT TIME ZONE 'UTC' AT TIME ZONE 'Europe/Moscow'
+                        - make_interval(hours => $4) - INTERVAL '1 microsecond'
+                ) + INTERVAL '1 day' + make_interval(hours => $4)
+            ) AT TIME ZONE 'Europe/Moscow' AT TIME ZONE 'UTC' AS due_at
+        ) due
+        WHERE ($1::BIGINT[] IS NULL OR s.id = ANY($1::BIGINT[]))
+          AND s.tg_id > 0
+          AND s.generation = 'v2'
+          AND s.is_visible = TRUE
+          AND s.is_renewable = TRUE
+          AND s.remnawave_uuid IS NOT NULL
+          AND s.subscription_until > now() AT TIME ZONE 'UTC'
+          AND due.due_at < s.subscription_until
+          AND NOT EXISTS (
+              SELECT 1 FROM notification_state ns
+              WHERE ns.tg_id = s.tg_id
+                AND ns.subscription_id = s.id
+                AND ns.notification_type = stage.notification_type
+          )
+    ),
+    dropped AS (
+        DELETE FROM scheduled_notifications sn
+        WHERE sn.subscription_id = ANY($1::BIGINT[])
+          AND NOT EXISTS (
+              SELECT 1 FROM planned p
+              WHERE p.subscription_id = sn.subscription_id
+                AND p.notification_type = sn.notification_type
+          )
+    )
+    INSERT INTO scheduled_notifications (subscription_id, tg_id, notification_type, subscription_until, due_at)
+    SELECT subscription_id, tg_id, notification_type, subscription_until, due_at FROM planned
+    ON CONFLICT (subscription_id, notification_type) DO UPDATE
+    SET tg_id = EXCLUDED.tg_id,
+        subscription_until = EXCLUDED.subscription_until,
+        due_at = EXCLUDED.due_at,
+        claimed_until = NULL
+"""
+
+
+def _expiry_notification_params(subscription_ids) -> tuple:
+    return (
+        subscription_ids,
+        list(EXPIRY_NOTIFICATION_LEADS),
+        list(EXPIRY_NOTIFICATION_LEADS.values()),
+        EXPIRY_NOTIFICATION_HOUR,
+    )
+
+
+async def _schedule_expiry_notifications(conn, subscription_ids: list[int] | None):
+    """Перепланировать напоминания подписок (None — всех) на соединении миграции."""
+    await conn.execute(_SCHEDULE_EXPIRY_NOTIFICATIONS, *_expiry_notification_params(subscription_ids))
+
+
+async def schedule_expiry_notifications(subscription_id: int):
+    """Перепланировать напоминания после создания, продления или правки срока.
+
+    Этапы, которые уже нельзя отправить до окончания или уже отправленные,
+    не ставятся; старые строки подписки заменяются новыми сроками.
+    """
+    await db_execute(_SCHEDULE_EXPIRY_NOTIFICATIONS, _expiry_notification_params([subscription_id]))
+
+
+async def claim_due_notifications(limit: int, lease_seconds: int):
+    """Забрать созревшие напоминания: FOR UPDATE SKIP LOCKED и аренда на lease_seconds.
+
+    Возвращает строки очереди вместе с текущим состоянием подписки. Строку
+    с истёкшей арендой (обработчик упал) заберёт следующий проход.
+    """
+    return await db_execute(
+        """
+        WITH due AS (
+            SELECT id FROM scheduled_notifications
+            WHERE due_at <= now() AT TIME ZONE 'UTC'
+              AND (claimed_until IS NULL OR claimed_until < now() AT TIME ZONE 'UTC')
+            ORDER BY due_at ASC
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        ),
+        claimed AS (
+            UPDATE scheduled_notifications sn
+            SET claimed_until = now() AT TIME ZONE 'UTC' + make_interval(secs => $2)
+            FROM due
+            WHERE sn.id = due.id
+            RETURNING sn.*
+        )
+        SELECT claimed.*,
+               s.slot_number, s.type_index, s.plan_kind, s.generation, s.is_visible, s.is_renewable,
+               s.remnawave_uuid, s.subscription_until AS current_subscription_until
+        FROM claimed
+        JOIN subscriptions s ON s.id = claimed.subscription_id
+        ORDER BY claimed.due_at ASC, claimed.id ASC
+        """,
+        (limit, lease_seconds),
+        fetch_all=True,
+    )
+
+
+async def finish_scheduled_notification(notification_id: int, subscription_until, retry_at=None):
+    """Убрать напоминание из очереди или отложить до retry_at.
+
+    Если подписку успели перепланировать (другой срок), строку не трогаем.
+    """
+    if retry_at is None:
+        await db_execute(
+            "DELETE FROM scheduled_notifications WHERE id = $1 AND subscription_until = $2",
+            (notification_id, subscription_until),
+        )
+        return
+    await db_execute(
+        """
+        UPDATE scheduled_notifications
+        SET due_at = $3, claimed_until = NULL
+        WHERE id = $1 AND subscription_until = $2
+        """,
+        (notification_id, subscription_until, retry_at),
+    )
+
+
+async def iter_expired_notification_recipients(
+    notification_type: str,
+    cooldown_hours: int,
+    blocked_notification_type: str,
+    batch_size: int | None = None,
+):
+    """Пачки пользователей без активной подписки, которым пора напомнить.
+
+    Один запрос: у пользователя есть продлеваемая v2-подписка, но нет
+    действующей (v2 или старой legacy_readonly), напоминание не отправлялось
+    cooldown_hours и чат не помечен недоступным. last_expired_at — последний
+    истёкший срок или NULL, если подписка ещё не оплачивалась.
+    """
+    async for batch in iter_row_batches(
+        """
+        SELECT s.tg_id,
+               max(s.subscription_until) FILTER (
+                   WHERE s.subscription_until <= now() AT TIME ZONE 'UTC'
+               ) AS last_expired_at
+        FROM subscriptions s
+        WHERE s.tg_id > 0
+          AND s.generation = 'v2'
+          AND s.is_visible = TRUE
+          AND s.is_renewable = TRUE
+          AND NOT EXISTS (
+              SELECT 1 FROM subscriptions a
+              WHERE a.tg_id = s.tg_id
+                AND a.subscription_until > now() AT TIME ZONE 'UTC'
+                AND (
+                    (a.generation = 'v2' AND a.is_visible = TRUE AND a.is_renewable = TRUE)
+                    OR a.legacy_readonly = TRUE
+                )
+          )
+          AND NOT EXISTS (
+              SELECT 1 FROM notification_state ns
+              WHERE ns.tg_id = s.tg_id
+                AND ns.subscription_id = 0
+                AND (
+                    (ns.notification_type = $1 AND ns.last_sent_at > now() - make_interval(hours => $2))
+                    OR ns.notification_type = $3
+                )
+          )
+        GROUP BY s.tg_id
+        """,
+        (notification_type, cooldown_hours, blocked_notification_type),
+        key="tg_id",
+        batch_size=batch_size,
+    ):
+        yield batch
+
+
+async def get_next_notification_due_at():
+    """Время ближайшего незабранного напоминания или None."""
+    row = await db_execute(
+        "SELECT min(due_at) AS due_at FROM scheduled_notifications WHERE claimed_until IS NULL",
+        fetch_one=True,
+    )
+    return row["due_at"] if row else None
+
+
 # ────────────────────────────────────────────────
 #             PARTNERSHIP MANAGEMENT
 # ────────────────────────────────────────────────
@@ -3255,9 +5736,16 @@ async def add_partner_referral(partner_id: int, referred_user_id: int) -> bool:
     try:
         await db_execute(
             """
-            INSERT INTO partner_referrals (partner_id, referred_user_id)
-            VALUES ($1, $2)
-            ON CONFLICT (partner_id, referred_user_id) DO NOTHING
+            WITH added AS (
+                INSERT INTO partner_referrals (partner_id, referred_user_id)
+                VALUES ($1, $2)
+                ON CONFLICT (partner_id, referred_user_id) DO NOTHING
+                RETURNING partner_id
+            )
+            INSERT INTO partner_balances (partner_id, referrals)
+            SELECT partner_id, 1 FROM added
+            ON CONFLICT (partner_id) DO UPDATE
+            SET referrals = partner_balances.referrals + 1, updated_at = now()
             """,
             (partner_id, referred_user_id)
         )
@@ -3278,71 +5766,66 @@ async def get_partner_referral_count(partner_id: int) -> int:
 
 
 async def add_partner_earning(partner_id: int, user_id: int, tariff_code: str, amount: float, percentage: int):
-    """Записать партнёрский доход"""
+    """Записать партнёрский доход и прибавить его к балансу партнёра"""
     partner_share = amount * percentage / 100
     await db_execute(
         """
-        INSERT INTO partner_earnings (partner_id, user_id, tariff_code, amount, partner_share)
-        VALUES ($1, $2, $3, $4, $5)
+        WITH earning AS (
+            INSERT INTO partner_earnings (partner_id, user_id, tariff_code, amount, partner_share)
+            VALUES ($1, $2, $3, $4, $5)
+            RETURNING partner_id, partner_share
+        )
+        INSERT INTO partner_balances (partner_id, earned)
+        SELECT partner_id, partner_share FROM earning
+        ON CONFLICT (partner_id) DO UPDATE
+        SET earned = partner_balances.earned + EXCLUDED.earned, updated_at = now()
         """,
         (partner_id, user_id, tariff_code, amount, partner_share)
     )
 
 
 async def get_partner_stats(partner_id: int):
-    """Получить полную статистику партнёра"""
-    partnership = await get_partnership(partner_id)
-    if not partnership:
-        return None
-
-    # Всего рефералов
-    total_referrals = await db_execute(
-        "SELECT COUNT(DISTINCT referred_user_id) as count FROM partner_referrals WHERE partner_id = $1",
-        (partner_id,),
-        fetch_one=True
-    )
+    """Получить полную статистику партнёра
 
-    # Заработок по тарифам
-    earnings = await db_execute(
+    Итоги берутся из partner_balances, разбивка по тарифам — одним
+    сгруппированным запросом по начислениям партнёра.
+    """
+    row = await db_execute(
         """
         SELECT
-            tariff_code,
-            COUNT(*) as purchase_count,
-            SUM(partner_share) as total_share
-        FROM partner_earnings
-        WHERE partner_id = $1
-        GROUP BY tariff_code
+            p.percentage,
+            COALESCE(b.referrals, 0) AS referrals,
+            COALESCE(b.earned, 0) AS earned,
+            COALESCE(b.withdrawn, 0) AS withdrawn,
+            (
+                SELECT json_agg(t ORDER BY t.tariff_code)
+                FROM (
+                    SELECT tariff_code, COUNT(*) AS purchase_count, SUM(partner_share) AS total_share
+                    FROM partner_earnings
+                    WHERE partner_id = p.tg_id
+                    GROUP BY tariff_code
+                ) t
+            ) AS earnings_by_tariff
+        FROM partnerships p
+        LEFT JOIN partner_balances b ON b.partner_id = p.tg_id
+        WHERE p.tg_id = $1
         """,
         (partner_id,),
-        fetch_all=True
-    )
-
-    # Общий заработок
-    total_earned = await db_execute(
-        "SELECT SUM(partner_share) as total FROM partner_earnings WHERE partner_id = $1",
-        (partner_id,),
-        fetch_one=True
-    )
-
-    # Всего выведено
-    total_withdrawn = await db_execute(
-        "SELECT SUM(amount) as total FROM partner_withdrawals WHERE partner_id = $1 AND status = 'completed'",
-        (partner_id,),
         fetch_one=True
     )
+    if not row:
+        return None
 
     # Текущий баланс = заработано - выведено
-    earned = float(total_earned['total'] or 0)
-    withdrawn = float(total_withdrawn['total'] or 0)
-    balance = earned - withdrawn
-
+    earned = float(row['earned'])
+    withdrawn = float(row['withdrawn'])
     return {
-        'percentage': partnership['percentage'],
-        'total_referrals': total_referrals['count'] if total_referrals else 0,
-        'earnings_by_tariff': earnings or [],
+        'percentage': row['percentage'],
+        'total_referrals': row['referrals'],
+        'earnings_by_tariff': json.loads(row['earnings_by_tariff']) if row['earnings_by_tariff'] else [],
         'total_earned': earned,
         'total_withdrawn': withdrawn,
-        'current_balance': balance
+        'current_balance': earned - withdrawn
     }
 
 
@@ -3385,9 +5868,19 @@ async def get_pending_withdrawals():
 
 
 async def mark_withdrawal_completed(withdrawal_id: int):
-    """Отметить вывод как выполненный"""
+    """Отметить вывод как выполненный и списать сумму с баланса партнёра"""
     await db_execute(
-        "UPDATE partner_withdrawals SET status = 'completed' WHERE id = $1",
+        """
+        WITH completed AS (
+            UPDATE partner_withdrawals SET status = 'completed'
+            WHERE id = $1 AND status IS DISTINCT FROM 'completed'
+            RETURNING partner_id, amount
+        )
+        INSERT INTO partner_balances (partner_id, withdrawn)
+        SELECT partner_id, amount FROM completed
+        ON CONFLICT (partner_id) DO UPDATE
+        SET withdrawn = partner_balances.withdrawn + EXCLUDED.withdrawn, updated_at = now()
+        """,
         (withdrawal_id,)
     )
 
@@ -3420,10 +5913,27 @@ async def add_referral_earning(
     percentage = 35 if is_first_purchase else 15
     referral_share = amount * percentage / 100
 
+    # Счётчик рефералов растёт на первом начислении от этого реферала:
+    # подзапрос в CTE видит таблицу до вставки
     await db_execute(
         """
-        INSERT INTO referral_earnings (referrer_id, referred_user_id, tariff_code, amount, referral_share, is_first_purchase)
-        VALUES ($1, $2, $3, $4, $5, $6)
+        WITH earning AS (
+            INSERT INTO referral_earnings (referrer_id, referred_user_id, tariff_code, amount, referral_share, is_first_purchase)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            RETURNING referrer_id, referral_share
+        )
+        INSERT INTO referral_balances (referrer_id, referred_users, earned)
+        SELECT
+            referrer_id,
+            CASE WHEN EXISTS (
+                SELECT 1 FROM referral_earnings WHERE referrer_id = $1 AND referred_user_id = $2
+            ) THEN 0 ELSE 1 END,
+            referral_share
+        FROM earning
+        ON CONFLICT (referrer_id) DO UPDATE
+        SET referred_users = referral_balances.referred_users + EXCLUDED.referred_users,
+            earned = referral_balances.earned + EXCLUDED.earned,
+            updated_at = now()
         """,
         (referrer_id, referred_user_id, tariff_code, amount, referral_share, is_first_purchase)
     )
@@ -3522,6 +6032,9 @@ async def get_referral_stats(referrer_id: int) -> dict:
     """
     Получить полную статистику рефератора
 
+    Итоги берутся из referral_balances, разбивка по тарифам — одним
+    сгруппированным запросом по начислениям рефератора.
+
     Returns:
         Словарь с:
         - active_referrals: количество активных рефералов
@@ -3530,60 +6043,48 @@ async def get_referral_stats(referrer_id: int) -> dict:
         - total_withdrawn: всего выведено
         - current_balance: текущий баланс
     """
-    # Активные рефералы (те у кого есть хотя бы одна покупка)
-    active_referrals = await db_execute(
-        """
-        SELECT COUNT(DISTINCT referred_user_id) as count
-        FROM referral_earnings
-        WHERE referrer_id = $1
-        """,
-        (referrer_id,),
-        fetch_one=True
-    )
-
-    # Заработок по тарифам
-    earnings = await db_execute(
+    row = await db_execute(
         """
         SELECT
-            tariff_code,
-            COUNT(*) as purchase_count,
-            SUM(referral_share) as total_share
-        FROM referral_earnings
-        WHERE referrer_id = $1
-        GROUP BY tariff_code
-        ORDER BY tariff_code
+            COALESCE(b.referred_users, 0) AS referred_users,
+            COALESCE(b.earned, 0) AS earned,
+            COALESCE(b.withdrawn, 0) AS withdrawn,
+            (
+                SELECT json_agg(t ORDER BY t.tariff_code)
+                FROM (
+                    SELECT tariff_code, COUNT(*) AS purchase_count, SUM(referral_share) AS total_share
+                    FROM referral_earnings
+                    WHERE referrer_id = $1
+                    GROUP BY tariff_code
+                ) t
+            ) AS earnings_by_tariff
+        FROM (SELECT 1) AS one
+        LEFT JOIN referral_balances b ON b.referrer_id = $1
         """,
         (referrer_id,),
-        fetch_all=True
-    )
-
-    # Общий заработок
-    total_earned = await db_execute(
-        "SELECT SUM(referral_share) as total FROM referral_earnings WHERE referrer_id = $1",
-        (referrer_id,),
-        fetch_one=True
-    )
-
-    # Всего выведено/зарезервировано на вывод
-    total_withdrawn = await db_execute(
-        "SELECT SUM(amount) as total FROM referral_withdrawals WHERE referrer_id = $1",
-        (referrer_id,),
         fetch_one=True
     )
 
-    earned = float(total_earned['total'] or 0)
-    withdrawn = float(total_withdrawn['total'] or 0)
-    balance = earned - withdrawn
-
+    earned = float(row['earned'])
+    withdrawn = float(row['withdrawn'])
     return {
-        'active_referrals': active_referrals['count'] if active_referrals else 0,
-        'earnings_by_tariff': earnings or [],
+        'active_referrals': row['referred_users'],
+        'earnings_by_tariff': json.loads(row['earnings_by_tariff']) if row['earnings_by_tariff'] else [],
         'total_earned': earned,
         'total_withdrawn': withdrawn,
-        'current_balance': balance
+        'current_balance': earned - withdrawn
     }
 
 
+async def rebuild_referral_balances():
+    """Пересчитать балансы рефереров и партнёров из начислений и выводов.
+
+    Нужна после ручных правок этих таблиц в БД.
+    """
+    async with transaction() as conn:
+        await _rebuild_referral_balances(conn)
+
+
 async def create_referral_withdrawal_request(
     referrer_id: int,
     amount: float,
@@ -3603,10 +6104,18 @@ async def create_referral_withdrawal_request(
     phone_number = kwargs.get('phone_number')
     usdt_address = kwargs.get('usdt_address')
 
+    # Заявка резервирует сумму сразу, поэтому попадает в withdrawn до выплаты
     await db_execute(
         """
-        INSERT INTO referral_withdrawals (referrer_id, amount, withdrawal_type, bank_name, phone_number, usdt_address)
-        VALUES ($1, $2, $3, $4, $5, $6)
+        WITH withdrawal AS (
+            INSERT INTO referral_withdrawals (referrer_id, amount, withdrawal_type, bank_name, phone_number, usdt_address)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            RETURNING referrer_id, amount
+        )
+        INSERT INTO referral_balances (referrer_id, withdrawn)
+        SELECT referrer_id, amount FROM withdrawal
+        ON CONFLICT (referrer_id) DO UPDATE
+        SET withdrawn = referral_balances.withdrawn + EXCLUDED.withdrawn, updated_at = now()
         """,
         (referrer_id, amount, withdrawal_type, bank_name, phone_number, usdt_address)
     )
@@ -3621,8 +6130,15 @@ async def spend_referral_balance_for_subscription(
     """Списать баланс рефералов за оплату подписки"""
     await db_execute(
         """
-        INSERT INTO referral_withdrawals (referrer_id, amount, withdrawal_type, status)
-        VALUES ($1, $2, $3, 'completed')
+        WITH withdrawal AS (
+            INSERT INTO referral_withdrawals (referrer_id, amount, withdrawal_type, status)
+            VALUES ($1, $2, $3, 'completed')
+            RETURNING referrer_id, amount
+        )
+        INSERT INTO referral_balances (referrer_id, withdrawn)
+        SELECT referrer_id, amount FROM withdrawal
+        ON CONFLICT (referrer_id) DO UPDATE
+        SET withdrawn = referral_balances.withdrawn + EXCLUDED.withdrawn, updated_at = now()
         """,
         (referrer_id, amount, f'subscription_{tariff_code}')
     )
@@ -3663,60 +6179,283 @@ async def mark_referral_withdrawal_completed(withdrawal_id: int):
 #                WEB ADMIN PANEL
 # ────────────────────────────────────────────────
 
+# Показатели дашборда читаются из счётчиков: итоги — по строке на имя, окна
+# 7/30 дней — из дневных строк, активные подписки — из корзин по дню
+# окончания плюс подписки, истекающие сегодня позже текущего момента.
+_ADMIN_DASHBOARD_QUERY = """
+    SELECT
+        (SELECT COALESCE(MAX(value), 0)::bigint FROM admin_counters WHERE name = 'total_users') AS total_users,
+        (SELECT COALESCE(SUM(new_users), 0)::bigint FROM admin_daily_counters WHERE day > CURRENT_DATE - 7) AS new_users_7d,
+        (
+            SELECT COALESCE(SUM(subscriptions), 0)::bigint
+            FROM admin_subscription_expiry
+            WHERE day > (now() AT TIME ZONE 'UTC')::date
+        ) + (
+            SELECT COUNT(*)
+            FROM subscriptions
+            WHERE is_visible = TRUE
+              AND subscription_until > now() AT TIME ZONE 'UTC'
+              AND subscription_until < ((now() AT TIME ZONE 'UTC')::date + 1)::timestamp
+        ) AS active_subscriptions,
+        (SELECT COALESCE(MAX(value), 0)::bigint FROM admin_counters WHERE name = 'paid_payments') AS paid_payments,
+        (SELECT COALESCE(MAX(value), 0) FROM admin_counters WHERE name = 'total_revenue') AS total_revenue,
+        (SELECT COALESCE(SUM(revenue), 0) FROM admin_daily_counters WHERE day > CURRENT_DATE - 30) AS revenue_30d
+"""
+ADMIN_DAILY_COUNTERS_DAYS = 31
+
+
+@_analytics
 async def admin_dashboard_stats():
-    """Ключевые показатели для веб-панели."""
-    return await db_execute(
-        """
-        SELECT
-            (SELECT COUNT(*) FROM users) AS total_users,
-            (SELECT COUNT(*) FROM users WHERE created_at >= now() - interval '7 days') AS new_users_7d,
-            (SELECT COUNT(*) FROM subscriptions WHERE is_visible = TRUE AND subscription_until > now() AT TIME ZONE 'UTC') AS active_subscriptions,
-            (SELECT COUNT(*) FROM payments WHERE status = 'paid') AS paid_payments,
-            (SELECT COALESCE(SUM(amount), 0) FROM payments WHERE status = 'paid') AS total_revenue,
-            (SELECT COALESCE(SUM(amount), 0) FROM payments WHERE status = 'paid' AND updated_at >= now() - interval '30 days') AS revenue_30d
-        """,
-        fetch_one=True,
+    """Ключевые показатели для веб-панели: O(1) от размера таблиц."""
+    return await db_execute(_ADMIN_DASHBOARD_QUERY, fetch_one=True)
+
+
+_ADMIN_COUNTERS_UPSERT = """
+    WITH totals AS (
+        INSERT INTO admin_counters (name, value)
+        SELECT name, value
+        FROM (
+            VALUES ('total_users', $1::numeric), ('paid_payments', $2::numeric), ('total_revenue', $3::numeric)
+        ) AS delta(name, value)
+        WHERE value <> 0
+        ON CONFLICT (name) DO UPDATE
+        SET value = admin_counters.value + EXCLUDED.value,
+            updated_at = now()
     )
+    INSERT INTO admin_daily_counters (day, new_users, revenue)
+    VALUES (CURRENT_DATE, $1, $3)
+    ON CONFLICT (day) DO UPDATE
+    SET new_users = admin_daily_counters.new_users + EXCLUDED.new_users,
+        revenue = admin_daily_counters.revenue + EXCLUDED.revenue
+"""
+
+
+async def _bump_admin_counters(*, users: int = 0, paid_payments: int = 0, revenue=0, conn=None):
+    """Прибавить к счётчикам дашборда в транзакции пишущего хелпера."""
+    params = (users, paid_payments, revenue)
+    if conn is not None:
+        await conn.execute(_ADMIN_COUNTERS_UPSERT, *params)
+    else:
+        await db_execute(_ADMIN_COUNTERS_UPSERT, params)
+
+
+# Расхождение счётчиков с таблицами в одном снимке: и агрегаты, и сохранённые
+# значения видят одни и те же зафиксированные транзакции
+_ADMIN_COUNTERS_DRIFT_QUERY = """
+    WITH actual_totals AS (
+        SELECT 'total_users' AS name, COUNT(*)::numeric AS value FROM users
+        UNION ALL
+        SELECT 'paid_payments', COUNT(*) FROM payments WHERE status = 'paid'
+        UNION ALL
+        SELECT 'total_revenue', COALESCE(SUM(amount), 0) FROM payments WHERE status = 'paid'
+    ),
+    actual_users AS (
+        SELECT created_at::date AS day, COUNT(*) AS new_users
+        FROM users
+        WHERE created_at >= CURRENT_DATE - $1::integer
+        GROUP BY created_at::date
+    ),
+    actual_revenue AS (
+        SELECT updated_at::date AS day, SUM(amount) AS revenue
+        FROM payments
+        WHERE status = 'paid'
+          AND updated_at >= CURRENT_DATE - $1::integer
+        GROUP BY updated_at::date
+    ),
+    actual_daily AS (
+        SELECT COALESCE(u.day, r.day) AS day,
+               COALESCE(u.new_users, 0) AS new_users,
+               COALESCE(r.revenue, 0) AS revenue
+        FROM actual_users u
+        FULL JOIN actual_revenue r ON r.day = u.day
+    ),
+    stored_daily AS (
+        SELECT day, new_users, revenue
+        FROM admin_daily_counters
+        WHERE day >= CURRENT_DATE - $1::integer
+    ),
+    actual_expiry AS (
+        SELECT subscription_until::date AS day, COUNT(*) AS subscriptions
+        FROM subscriptions
+        WHERE is_visible = TRUE
+          AND subscription_until IS NOT NULL
+        GROUP BY subscription_until::date
+    )
+    SELECT 'total' AS kind, a.name, NULL::date AS day,
+           a.value - COALESCE(s.value, 0) AS delta, 0::numeric AS revenue_delta
+    FROM actual_totals a
+    LEFT JOIN admin_counters s ON s.name = a.name
+    WHERE a.value IS DISTINCT FROM s.value
+    UNION ALL
+    SELECT 'daily', NULL, COALESCE(a.day, s.day),
+           COALESCE(a.new_users, 0) - COALESCE(s.new_users, 0),
+           COALESCE(a.revenue, 0) - COALESCE(s.revenue, 0)
+    FROM actual_daily a
+    FULL JOIN stored_daily s ON s.day = a.day
+    WHERE COALESCE(a.new_users, 0) <> COALESCE(s.new_users, 0)
+       OR COALESCE(a.revenue, 0) <> COALESCE(s.revenue, 0)
+    UNION ALL
+    SELECT 'expiry', NULL, COALESCE(a.day, s.day),
+           COALESCE(a.subscriptions, 0) - COALESCE(s.subscriptions, 0), 0
+    FROM actual_expiry a
+    FULL JOIN admin_subscription_expiry s ON s.day = a.day
+    WHERE COALESCE(a.subscriptions, 0) <> COALESCE(s.subscriptions, 0)
+"""
+
+
+async def _reconcile_admin_counters(conn) -> dict:
+    """Пересчитать счётчики из таблиц; вернуть расхождения показателей.
+
+    Полные проходы по таблицам идут без блокировок: в одном снимке считается
+    разница между таблицами и счётчиками, а потом она прибавляется к текущим
+    значениям. Инкременты, зафиксированные после снимка, уже лежат в счётчиках
+    и не теряются; строки счётчиков заняты только на время короткой записи.
+    """
+    stored = await conn.fetchrow(_ADMIN_DASHBOARD_QUERY)
+    drift = await conn.fetch(_ADMIN_COUNTERS_DRIFT_QUERY, ADMIN_DAILY_COUNTERS_DAYS)
+    totals = [row for row in drift if row["kind"] == "total"]
+    daily = [row for row in drift if row["kind"] == "daily"]
+    expiry = [row for row in drift if row["kind"] == "expiry"]
+    async with conn.transaction():
+        if totals:
+            await conn.execute(
+                """
+                INSERT INTO admin_counters (name, value, updated_at)
+                SELECT name, delta, now()
+                FROM unnest($1::text[], $2::numeric[]) AS drift(name, delta)
+                ON CONFLICT (name) DO UPDATE
+                SET value = admin_counters.value + EXCLUDED.value,
+                    updated_at = EXCLUDED.updated_at
+                """,
+                [row["name"] for row in totals],
+                [row["delta"] for row in totals],
+            )
+        if daily:
+            await conn.execute(
+                """
+                INSERT INTO admin_daily_counters (day, new_users, revenue)
+                SELECT day, new_users, revenue
+                FROM unnest($1::date[], $2::integer[], $3::numeric[]) AS drift(day, new_users, revenue)
+                ON CONFLICT (day) DO UPDATE
+                SET new_users = admin_daily_counters.new_users + EXCLUDED.new_users,
+                    revenue = admin_daily_counters.revenue + EXCLUDED.revenue
+                """,
+                [row["day"] for row in daily],
+                [int(row["delta"]) for row in daily],
+                [row["revenue_delta"] for row in daily],
+            )
+        if expiry:
+            await conn.execute(
+                """
+                INSERT INTO admin_subscription_expiry (day, subscriptions)
+                SELECT day, subscriptions
+                FROM unnest($1::date[], $2::integer[]) AS drift(day, subscriptions)
+                ON CONFLICT (day) DO UPDATE
+                SET subscriptions = admin_subscription_expiry.subscriptions + EXCLUDED.subscriptions
+                """,
+                [row["day"] for row in expiry],
+                [int(row["delta"]) for row in expiry],
+            )
+        await conn.execute(
+            "DELETE FROM admin_daily_counters WHERE day < CURRENT_DATE - $1::integer",
+            ADMIN_DAILY_COUNTERS_DAYS,
+        )
+    actual = await conn.fetchrow(_ADMIN_DASHBOARD_QUERY)
+    return {
+        key: {'stored': stored[key], 'actual': actual[key]}
+        for key in actual.keys()
+        if stored[key] != actual[key]
+    }
+
+
+async def reconcile_admin_counters() -> dict:
+    """Сверить счётчики дашборда с таблицами и исправить расхождения."""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await _reconcile_admin_counters(conn)
+
 
+def encode_admin_users_cursor(row) -> str:
+    """Курсор следующей страницы: ключ сортировки последней строки."""
+    return f"{row['created_at'].isoformat()}~{row['tg_id']}"
 
-async def admin_list_users(search: str = "", limit: int = 50, offset: int = 0):
-    pattern = f"%{search.strip()}%"
-    where = "WHERE CAST(u.tg_id AS TEXT) ILIKE $1 OR COALESCE(u.username, '') ILIKE $1 OR COALESCE(wa.login, '') ILIKE $1" if search.strip() else ""
-    params = (pattern, limit, offset) if search.strip() else (limit, offset)
-    limit_param = "$2" if search.strip() else "$1"
-    offset_param = "$3" if search.strip() else "$2"
 
-    users = await db_execute(
+def decode_admin_users_cursor(cursor: str) -> tuple[datetime, int]:
+    created_at, tg_id = cursor.rsplit("~", 1)
+    return datetime.fromisoformat(created_at), int(tg_id)
+
+
+@_analytics
+async def admin_list_users(search: str = "", limit: int = 50, cursor: str | None = None):
+    """Страница пользователей для веб-панели по admin_user_summary.
+
+    Листание по ключу (created_at, tg_id) вместо OFFSET: каждая страница
+    читает limit строк из индекса, как бы далеко ни ушли. Подстрока ищется
+    по search_text через триграммный индекс.
+    """
+    search = search.strip().lower()
+    conditions = []
+    params: list = []
+    if search:
+        params.append(f"%{search}%")
+        conditions.append(f"s.search_text LIKE ${len(params)}")
+    if cursor:
+        params.extend(decode_admin_users_cursor(cursor))
+        conditions.append(f"(s.created_at, s.tg_id) < (${len(params) - 1}, ${len(params)})")
+    params.append(limit + 1)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    rows = await db_execute(
         f"""
         SELECT
-            u.tg_id,
+            s.tg_id,
             u.username,
             wa.login AS web_login,
             CASE WHEN wa.id IS NULL THEN 'telegram' ELSE 'web' END AS account_type,
-            u.created_at,
+            s.created_at,
             u.tracking_code,
             u.first_payment,
-            (SELECT COUNT(*) FROM subscriptions s WHERE s.tg_id = u.tg_id AND s.is_visible = TRUE) AS subscriptions_count,
-            (SELECT COUNT(*) FROM subscriptions s WHERE s.tg_id = u.tg_id AND s.is_visible = TRUE AND s.subscription_until > now() AT TIME ZONE 'UTC') AS active_subscriptions,
-            (SELECT MAX(s.subscription_until) FROM subscriptions s WHERE s.tg_id = u.tg_id AND s.is_visible = TRUE) AS latest_expiry,
-            (SELECT COALESCE(SUM(p.amount), 0) FROM payments p WHERE p.tg_id = u.tg_id AND p.status = 'paid') AS revenue
-        FROM users u
-        LEFT JOIN web_accounts wa ON wa.service_user_id = u.tg_id
+            s.subscriptions_count,
+            CASE
+                WHEN s.latest_expiry > now() AT TIME ZONE 'UTC' THEN (
+                    SELECT COUNT(*)
+                    FROM subscriptions sub
+                    WHERE sub.tg_id = s.tg_id
+                      AND sub.is_visible = TRUE
+                      AND sub.subscription_until > now() AT TIME ZONE 'UTC'
+                )
+                ELSE 0
+            END AS active_subscriptions,
+            s.latest_expiry,
+            s.revenue
+        FROM admin_user_summary s
+        JOIN users u ON u.tg_id = s.tg_id
+        LEFT JOIN web_accounts wa ON wa.service_user_id = s.tg_id
         {where}
-        ORDER BY u.created_at DESC, u.tg_id DESC
-        LIMIT {limit_param} OFFSET {offset_param}
+        ORDER BY s.created_at DESC, s.tg_id DESC
+        LIMIT ${len(params)}
         """,
-        params,
+        tuple(params),
         fetch_all=True,
     )
-
-    count_params = (pattern,) if search.strip() else ()
-    total = await db_execute(
-        f"SELECT COUNT(*) AS count FROM users u LEFT JOIN web_accounts wa ON wa.service_user_id = u.tg_id {where}",
-        count_params,
-        fetch_one=True,
-    )
-    return {"items": users or [], "total": total["count"] if total else 0}
+    rows = list(rows or [])
+    has_more = len(rows) > limit
+    items = rows[:limit]
+
+    # Без поиска итог берётся из счётчиков дашборда; COUNT(*) по совпадениям
+    # прочитал бы их все, поэтому при поиске итога нет
+    total = None
+    if not search:
+        counter = await db_execute(
+            "SELECT COALESCE(MAX(value), 0)::bigint AS count FROM admin_counters WHERE name = 'total_users'",
+            fetch_one=True,
+        )
+        total = counter["count"] if counter else 0
+    return {
+        "items": items,
+        "total": total,
+        "next_cursor": encode_admin_users_cursor(items[-1]) if has_more and items else None,
+    }
 
 
 async def admin_get_user_bundle(tg_id: int):
@@ -3763,6 +6502,7 @@ async def set_promo_code_active(code: str, active: bool) -> bool:
     return result is not None
 
 
+@_analytics
 async def list_tracking_links_with_stats():
     return await db_execute(
         """
@@ -3771,11 +6511,13 @@ async def list_tracking_links_with_stats():
             l.title,
             l.is_active,
             l.created_at,
-            (SELECT COUNT(*) FROM tracking_link_clicks c WHERE c.code = l.code) AS clicks,
-            (SELECT COUNT(DISTINCT c.tg_id) FROM tracking_link_clicks c WHERE c.code = l.code) AS unique_clicks,
-            (SELECT COUNT(*) FROM users u WHERE u.tracking_code = l.code) AS users_count,
-            (SELECT COALESCE(SUM(p.amount), 0) FROM payments p WHERE p.tracking_code = l.code AND p.status = 'paid') AS revenue
+            COALESCE(SUM(d.clicks), 0) AS clicks,
+            COALESCE(SUM(d.unique_clicks), 0) AS unique_clicks,
+            COALESCE(SUM(d.attributed_users), 0) AS users_count,
+            COALESCE(SUM(d.revenue), 0) AS revenue
         FROM tracking_links l
+        LEFT JOIN tracking_link_daily d ON d.code = l.code
+        GROUP BY l.id
         ORDER BY l.created_at DESC, l.code ASC
         """,
         fetch_all=True,
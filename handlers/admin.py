@@ -1,15 +1,10 @@
-import asyncio
 import logging
-import aiohttp
-import asyncio
 import html
 import re
-import uuid
 from datetime import datetime, timedelta, timezone
 from aiogram import F, Router
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
-from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message, WebAppInfo
+from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from config import (
@@ -17,12 +12,10 @@ from config import (
     BYPASS_HWID_DEVICE_LIMIT,
     BYPASS_SQUAD_UUID,
     DEFAULT_SQUAD_UUID,
-    MINIAPP_URL,
     PUBLIC_SITE_URL,
     REGULAR_HWID_DEVICE_LIMIT,
     REGULAR_SQUAD_UUID,
     SUBSCRIPTION_PUBLIC_BASE_URL,
-    SUPPORT_URL,
 )
 import database as db
 from services.remnawave import (
@@ -32,21 +25,27 @@ from services.remnawave import (
     remnawave_get_user_info,
     remnawave_get_subscription_url,
     remnawave_reset_user_traffic,
-    remnawave_revoke_subscription,
     remnawave_delete_user,
 )
 from services.subscription_adjustment import SubscriptionAdjustmentError, adjust_subscription_days
 from services.device_addons import effective_device_limit
 from services.traffic_periods import build_traffic_period_state
-from services.traffic_resets import reset_all_active_bypass_traffic
+from services.admin_jobs import enqueue_admin_job, format_admin_job
+from services.broadcasts import (
+    BROADCAST_BUTTON_ORDER,
+    BROADCAST_BUTTONS,
+    broadcast_job_keyboard,
+    build_broadcast_user_keyboard,
+    classify_broadcast_exception,
+    format_broadcast_job,
+    wake_broadcasts,
+)
+from services.telegram_sender import copy_telegram_message, send_telegram_message
 
 logger = logging.getLogger(__name__)
 
 router = Router()
 
-ACTIVE_BROADCASTS: dict[str, dict] = {}
-
-
 class BroadcastStates(StatesGroup):
     """Состояния для рассылок сообщений"""
     waiting_for_broadcast_all = State()
@@ -91,8 +90,10 @@ async def admin_help(message: Message):
         "• <code>/give_sub ТГ_ИД ТИП [НОМЕР] ДНЕЙ</code> — выдать или продлить подписку. Тип: <code>regular</code> / <code>bypass</code>.\n"
         "• <code>/sub_days ТГ_ИД ID_ПОДПИСКИ +/-ДНИ</code> — добавить или убрать дни у конкретной подписки.\n"
         "• <code>/take_sub ТГ_ИД [СЛОТ] ДНЕЙ</code> — убрать дни по старому номеру слота; если дней больше остатка, подписка удалится.\n"
-        "• <code>/reset_traffic_all</code> — сразу сбросить трафик всем активным подпискам с антиглушилкой.\n"
-        "• <code>/reissue_sub_links [active]</code> — перевыпустить ссылки подписок; <code>active</code> только для активных.\n\n"
+        "• <code>/reset_traffic_all</code> — сбросить трафик всем активным подпискам с антиглушилкой (в фоне).\n"
+        "• <code>/reissue_sub_links [active]</code> — перевыпустить ссылки подписок; <code>active</code> только для активных.\n"
+        "• <code>/jobs</code> — ход массовых задач (сброс трафика, перевыпуск ссылок).\n"
+        "• <code>/cancel_job ID</code> — отменить массовую задачу.\n\n"
         "<b>Промо и ссылки</b>\n"
         "• <code>/new_code КОД ДНЕЙ ЛИМИТ</code> — создать промокод.\n"
         "• <code>/new_link КОД [Название]</code> — создать tracking-ссылку.\n"
@@ -104,12 +105,52 @@ async def admin_help(message: Message):
         "• <code>/send ТГ_ИД текст</code> — отправить сообщение пользователю. Можно ответить командой на фото/сообщение.\n"
         "• <code>/all_sms</code> — рассылка всем пользователям.\n"
         "• <code>/not_sub_sms</code> — рассылка пользователям без активной подписки.\n"
+        "• <code>/broadcasts</code> — ход последних рассылок.\n"
+        "• <code>/stop_broadcast ID</code> / <code>/resume_broadcast ID</code> — остановить или продолжить рассылку.\n"
         "• <code>/enable_collab ТГ_ИД %</code> — включить партнёрство: 15, 20, 25 или 30%.\n"
-        "• <code>/stats</code> — статистика бота.\n\n"
+        "• <code>/stats</code> — статистика бота.\n"
+        "• <code>/db_top [total|avg|max]</code> — самые тяжёлые запросы к БД.\n\n"
         "Подсказка: ID подписки удобнее брать из веб-админки."
     )
 
 
+async def _start_admin_job(message: Message, kind: str, scope: str, intro: str):
+    """Поставить массовую задачу и привязать к ней сообщение с прогрессом."""
+    status_message = await message.answer(intro)
+    try:
+        job, created = await enqueue_admin_job(
+            kind,
+            scope,
+            created_by=message.from_user.id,
+            notify_chat_id=status_message.chat.id,
+            notify_message_id=status_message.message_id,
+        )
+    except Exception as exc:
+        logger.error("Admin %s failed to enqueue %s job: %s", message.from_user.id, kind, exc, exc_info=True)
+        await status_message.edit_text(f"❌ Не удалось запустить задачу: {html.escape(str(exc)[:200])}")
+        return
+
+    if not created:
+        await status_message.edit_text(
+            "⏳ <b>Такая задача уже выполняется</b>\n\n"
+            f"{format_admin_job(job)}\n\n"
+            f"Отменить: <code>/cancel_job {job['id']}</code>"
+        )
+        return
+
+    if not job["total"]:
+        await db.finish_admin_job(job["id"], "done")
+        await status_message.edit_text("Подписок для обработки не найдено")
+        return
+
+    await status_message.edit_text(
+        f"{intro}\n\n{format_admin_job(job)}\n\n"
+        "Сообщение будет обновляться по ходу работы. "
+        f"Все задачи: /jobs, отменить: <code>/cancel_job {job['id']}</code>"
+    )
+    logger.info("Admin %s enqueued %s job %s: total=%s", message.from_user.id, kind, job["id"], job["total"])
+
+
 @router.message(Command("reset_traffic_all", "reset_all_traffic"))
 async def admin_reset_all_traffic(message: Message):
     """Принудительно сбросить трафик всем активным bypass-подпискам."""
@@ -119,43 +160,95 @@ async def admin_reset_all_traffic(message: Message):
         logger.warning("Unauthorized /reset_traffic_all attempt from user %s", admin_id)
         return
 
-    status_message = await message.answer(
+    await _start_admin_job(
+        message,
+        "reset_traffic",
+        "active",
         "🔄 <b>Запустил массовый сброс трафика</b>\n\n"
-        "Сбрасываю только активные подписки с антиглушилкой.\n"
-        "Это может занять немного времени."
+        "Сбрасываю только активные подписки с антиглушилкой. "
+        "Следующий плановый сброс для обработанных подписок встанет примерно через 30 дней.",
     )
 
-    try:
-        result = await reset_all_active_bypass_traffic()
-    except Exception as exc:
-        logger.error("Admin %s failed to reset all active bypass traffic: %s", admin_id, exc, exc_info=True)
-        await status_message.edit_text(f"❌ Ошибка массового сброса трафика: {html.escape(str(exc)[:200])}")
+
+@router.message(Command("jobs"))
+async def admin_jobs(message: Message):
+    """Показать последние массовые задачи."""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Эта команда доступна только администратору")
         return
 
-    failed_ids = result.get("failed_ids") or []
-    failed_text = ""
-    if failed_ids:
-        preview = ", ".join(str(item) for item in failed_ids[:20])
-        suffix = "..." if len(failed_ids) > 20 else ""
-        failed_text = f"\n\nНе удалось сбросить subscription id: <code>{preview}{suffix}</code>"
+    jobs = await db.list_admin_jobs(limit=10)
+    if not jobs:
+        await message.answer("Массовых задач ещё не было")
+        return
 
-    await status_message.edit_text(
-        "✅ <b>Массовый сброс трафика завершён</b>\n\n"
-        f"Найдено активных антиглушилок: <b>{result.get('total', 0)}</b>\n"
-        f"Успешно сброшено: <b>{result.get('success', 0)}</b>\n"
-        f"Ошибок: <b>{result.get('failed', 0)}</b>\n\n"
-        "Следующий плановый сброс для успешно обработанных подписок поставлен примерно через 30 дней."
-        f"{failed_text}"
-    )
-    logger.info(
-        "Admin %s reset all active bypass traffic: total=%s success=%s failed=%s",
-        admin_id,
-        result.get("total", 0),
-        result.get("success", 0),
-        result.get("failed", 0),
+    await message.answer(
+        "📋 <b>Массовые задачи</b>\n\n" + "\n\n".join(format_admin_job(job) for job in jobs)
     )
 
 
+@router.message(Command("cancel_job"))
+async def admin_cancel_job(message: Message):
+    """Отменить массовую задачу: уже обработанные подписки не откатываются."""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Эта команда доступна только администратору")
+        return
+
+    parts = (message.text or "").split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        await message.answer("Использование: <code>/cancel_job ID</code>")
+        return
+
+    if await db.cancel_admin_job(int(parts[1])):
+        await message.answer(f"🛑 Задача #{parts[1]} отменена. Текущая пачка ещё завершится.")
+    else:
+        await message.answer("Задача не найдена или уже завершена")
+
+
+@router.message(Command("broadcasts"))
+async def admin_broadcasts(message: Message):
+    """Показать последние рассылки с прогрессом."""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Эта команда доступна только администратору")
+        return
+
+    jobs = await db.list_broadcast_jobs(limit=10)
+    if not jobs:
+        await message.answer("Рассылок ещё не было")
+        return
+
+    await message.answer("📤 <b>Рассылки</b>\n\n" + "\n\n".join(format_broadcast_job(job) for job in jobs))
+
+
+@router.message(Command("stop_broadcast", "resume_broadcast"))
+async def admin_toggle_broadcast(message: Message):
+    """Остановить рассылку или продолжить её с места остановки."""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Эта команда доступна только администратору")
+        return
+
+    parts = (message.text or "").split()
+    command = parts[0].lstrip("/").split("@", 1)[0] if parts else ""
+    if len(parts) != 2 or not parts[1].isdigit():
+        await message.answer(f"Использование: <code>/{command} ID</code>")
+        return
+
+    if command == "stop_broadcast":
+        job = await db.stop_broadcast_job(int(parts[1]))
+        if not job:
+            await message.answer("Рассылка не найдена или уже не идёт")
+            return
+        await message.answer(f"⛔ Рассылка #{job['id']} остановлена. Текущая пачка ещё допишется.")
+        return
+
+    job = await db.resume_broadcast_job(int(parts[1]))
+    if not job:
+        await message.answer("Рассылка не найдена или её нельзя продолжить")
+        return
+    wake_broadcasts()
+    await message.answer(f"▶️ Рассылка #{job['id']} продолжится с места остановки.")
+
+
 def _parse_admin_subscription_command(parts: list[str]) -> tuple[int, int, int]:
     """Распарсить /give_sub и /take_sub в формат tg_id, slot, days."""
     if len(parts) == 3:
@@ -167,42 +260,6 @@ def _parse_admin_subscription_command(parts: list[str]) -> tuple[int, int, int]:
     raise ValueError("Invalid arguments")
 
 
-def _classify_broadcast_exception(exc: Exception) -> tuple[str, float | None]:
-    """Классифицировать типовую ошибку Telegram при рассылке."""
-    if isinstance(exc, TelegramRetryAfter):
-        retry_after = float(getattr(exc, "retry_after", 1.0) or 1.0)
-        return "rate_limited", retry_after
-
-    if isinstance(exc, TelegramForbiddenError):
-        error_msg = str(exc).lower()
-        if "blocked" in error_msg or "deactivated" in error_msg:
-            return "blocked", None
-        return "unreachable", None
-
-    if isinstance(exc, TelegramBadRequest):
-        error_msg = str(exc).lower()
-        if (
-            "chat not found" in error_msg
-            or "user not found" in error_msg
-            or "private chat not found" in error_msg
-            or "have no rights to send a message" in error_msg
-            or "can't initiate conversation" in error_msg
-            or "bot can't initiate conversation" in error_msg
-            or "peers not found" in error_msg
-        ):
-            return "unreachable", None
-
-    error_msg = str(exc).lower()
-    if "429" in error_msg or "too many requests" in error_msg:
-        return "rate_limited", 1.0
-    if "blocked" in error_msg or "user is deactivated" in error_msg or "bot was blocked" in error_msg:
-        return "blocked", None
-    if "chat not found" in error_msg or "can't initiate conversation" in error_msg:
-        return "unreachable", None
-
-    return "error", None
-
-
 async def _send_direct_message(
     message: Message,
     target_id: int,
@@ -210,65 +267,15 @@ async def _send_direct_message(
     source_message: Message | None = None,
 ) -> None:
     """Отправить текст или копию сообщения конкретному пользователю."""
-    try:
-        if source_message:
-            await message.bot.copy_message(
-                chat_id=target_id,
-                from_chat_id=source_message.chat.id,
-                message_id=source_message.message_id,
-            )
-        else:
-            await message.bot.send_message(target_id, text or "", parse_mode=None)
-    except TelegramRetryAfter as exc:
-        await asyncio.sleep(float(exc.retry_after) + 0.2)
-        if source_message:
-            await message.bot.copy_message(
-                chat_id=target_id,
-                from_chat_id=source_message.chat.id,
-                message_id=source_message.message_id,
-            )
-        else:
-            await message.bot.send_message(target_id, text or "", parse_mode=None)
-
-
-BROADCAST_BUTTONS = {
-    "buy_subscription": {"text": "💳 Купить / Продлить", "callback_data": "buy_subscription", "style": "success"},
-    "my_subscriptions": {"text": "🔐 Мои подписки", "callback_data": "my_subscriptions", "style": "primary"},
-    "buy_gb": {"text": "📦 Купить ГБ", "callback_data": "buy_gb", "style": "success"},
-    "miniapp": {"text": "📱 Личный кабинет", "web_app": MINIAPP_URL, "style": "primary"},
-    "how_to_connect": {"text": "📲 Инструкция", "callback_data": "how_to_connect", "style": "primary"},
-    "support": {"text": "🆘 Поддержка", "url": SUPPORT_URL, "style": "primary"},
-    "back_to_menu": {"text": "🏠 Главное меню", "callback_data": "back_to_menu", "style": "danger"},
-}
-
-BROADCAST_BUTTON_ORDER = (
-    "buy_subscription",
-    "my_subscriptions",
-    "buy_gb",
-    "miniapp",
-    "how_to_connect",
-    "support",
-    "back_to_menu",
-)
-
-
-def _make_broadcast_button(key: str) -> InlineKeyboardButton:
-    spec = BROADCAST_BUTTONS[key]
-    kwargs = {"text": spec["text"], "style": spec["style"]}
-    if "callback_data" in spec:
-        kwargs["callback_data"] = spec["callback_data"]
-    if "url" in spec:
-        kwargs["url"] = spec["url"]
-    if "web_app" in spec:
-        kwargs["web_app"] = WebAppInfo(url=spec["web_app"])
-    return InlineKeyboardButton(**kwargs)
-
-
-def _build_broadcast_user_keyboard(selected_buttons: list[str] | None) -> InlineKeyboardMarkup | None:
-    if not selected_buttons:
-        return None
-    rows = [[_make_broadcast_button(key)] for key in BROADCAST_BUTTON_ORDER if key in selected_buttons]
-    return InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+    if source_message:
+        await copy_telegram_message(
+            message.bot,
+            target_id,
+            source_message.chat.id,
+            source_message.message_id,
+        )
+    else:
+        await send_telegram_message(message.bot, target_id, text or "", parse_mode=None)
 
 
 def _build_broadcast_admin_keyboard(selected_buttons: list[str] | None) -> InlineKeyboardMarkup:
@@ -335,12 +342,6 @@ def _build_broadcast_ready_keyboard() -> InlineKeyboardMarkup:
     ])
 
 
-def _build_broadcast_stop_keyboard(broadcast_id: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⛔ Остановить рассылку", callback_data=f"broadcast_stop:{broadcast_id}", style="danger")],
-    ])
-
-
 async def _send_broadcast_preview(callback: CallbackQuery, state: FSMContext) -> bool:
     data = await state.get_data()
     source_chat_id = data.get("source_chat_id")
@@ -351,130 +352,17 @@ async def _send_broadcast_preview(callback: CallbackQuery, state: FSMContext) ->
         await state.clear()
         return False
 
-    await callback.bot.copy_message(
-        chat_id=callback.from_user.id,
-        from_chat_id=source_chat_id,
-        message_id=source_message_id,
-        reply_markup=_build_broadcast_user_keyboard(selected_buttons),
+    await copy_telegram_message(
+        callback.bot,
+        callback.from_user.id,
+        source_chat_id,
+        source_message_id,
+        reply_markup=build_broadcast_user_keyboard(selected_buttons),
     )
     await state.update_data(preview_sent=True)
     return True
 
 
-async def _get_broadcast_users(mode: str):
-    pool = await db.get_pool()
-    async with pool.acquire() as conn:
-        if mode == "no_sub":
-            return await conn.fetch(
-                """
-                SELECT tg_id FROM users
-                WHERE NOT EXISTS (
-                    SELECT 1 FROM subscriptions
-                    WHERE subscriptions.tg_id = users.tg_id
-                      AND subscriptions.subscription_until IS NOT NULL
-                      AND subscriptions.subscription_until > now() AT TIME ZONE 'UTC'
-                )
-                ORDER BY tg_id
-                """
-            )
-
-        return await conn.fetch("SELECT tg_id FROM users ORDER BY tg_id")
-
-
-async def _run_broadcast_copy(
-    bot,
-    status_message: Message,
-    users,
-    source_chat_id: int,
-    source_message_id: int,
-    reply_markup: InlineKeyboardMarkup | None,
-    mode: str,
-    broadcast_id: str,
-):
-    total_users = len(users)
-    sent_count = 0
-    error_count = 0
-    blocked_count = 0
-    unreachable_count = 0
-    rate_limited_delay = 0.3
-    mode_text = "пользователям без подписки" if mode == "no_sub" else "всем пользователям"
-
-    progress_message = await status_message.answer(
-        f"📤 <b>Начинаю рассылку {mode_text}: {total_users} получателей...</b>\n\n"
-        "Отправлено: <b>0</b>\n"
-        "Заблокировано: <b>0</b>\n"
-        "Недоступно: <b>0</b>\n"
-        "Ошибок: <b>0</b>",
-        reply_markup=_build_broadcast_stop_keyboard(broadcast_id),
-    )
-
-    stopped = False
-    for index, user_record in enumerate(users, start=1):
-        if ACTIVE_BROADCASTS.get(broadcast_id, {}).get("stop_requested"):
-            stopped = True
-            logger.info(f"Broadcast {broadcast_id} stopped by admin before next recipient")
-            break
-
-        user_id = user_record['tg_id']
-        try:
-            await bot.copy_message(
-                chat_id=user_id,
-                from_chat_id=source_chat_id,
-                message_id=source_message_id,
-                reply_markup=reply_markup,
-            )
-            sent_count += 1
-            logger.info(f"Broadcast message copied to user {user_id} ({mode})")
-            rate_limited_delay = 0.3
-        except Exception as e:
-            status, retry_after = _classify_broadcast_exception(e)
-            if status == "blocked":
-                blocked_count += 1
-                logger.warning(f"User {user_id} has blocked bot or deactivated account")
-            elif status == "unreachable":
-                unreachable_count += 1
-                logger.info(f"User {user_id} is unreachable for broadcast: {str(e)[:100]}")
-            elif status == "rate_limited":
-                rate_limited_delay = min(max(retry_after or rate_limited_delay * 1.5, 0.5), 5.0)
-                logger.warning(f"Rate limited during broadcast for user {user_id}. New delay: {rate_limited_delay}s")
-                await asyncio.sleep(rate_limited_delay)
-                continue
-            else:
-                error_count += 1
-                logger.warning(f"Failed to send broadcast to user {user_id}: {str(e)[:100]}")
-
-        if index == total_users or index % 25 == 0:
-            try:
-                await progress_message.edit_text(
-                    f"📤 <b>Рассылка идет: {mode_text}</b>\n\n"
-                    f"Прогресс: <b>{index}/{total_users}</b>\n"
-                    f"Отправлено: <b>{sent_count}</b>\n"
-                    f"Заблокировано: <b>{blocked_count}</b>\n"
-                    f"Недоступно: <b>{unreachable_count}</b>\n"
-                    f"Ошибок: <b>{error_count}</b>",
-                    reply_markup=_build_broadcast_stop_keyboard(broadcast_id),
-                )
-            except Exception as e:
-                logger.debug(f"Failed to update broadcast progress: {e}")
-
-        await asyncio.sleep(rate_limited_delay)
-
-    title = "⛔ <b>Рассылка остановлена!</b>" if stopped else "✅ <b>Рассылка завершена!</b>"
-    await status_message.answer(
-        f"{title}\n\n"
-        "📊 <b>Статистика:</b>\n"
-        f"• ✅ Отправлено: {sent_count}/{total_users}\n"
-        f"• 🚫 Заблокировано: {blocked_count}\n"
-        f"• 📴 Недоступно: {unreachable_count}\n"
-        f"• ❌ Ошибок: {error_count}"
-    )
-
-    logger.info(
-        f"Admin broadcast completed ({mode}, stopped={stopped}): sent={sent_count}, blocked={blocked_count}, "
-        f"unreachable={unreachable_count}, errors={error_count}"
-    )
-
-
 def _normalize_tracking_code(value: str) -> str:
     return value.strip().lower()
 
@@ -666,65 +554,13 @@ async def admin_reissue_subscription_links(message: Message):
         )
         return
 
-    active_only = mode == "active"
-    subscriptions = await db.get_subscriptions_with_remnawave_uuid(active_only=active_only)
-    if not subscriptions:
-        await message.answer("Подписок для перевыпуска не найдено")
-        return
-
-    total = len(subscriptions)
-    status_message = await message.answer(
-        f"🔁 <b>Перевыпуск подписочных ссылок запущен</b>\n\n"
-        f"Режим: <b>{'только активные' if active_only else 'все'}</b>\n"
-        f"Найдено: <b>{total}</b>\n"
-        "Готово: <b>0</b>"
-    )
-
-    success_count = 0
-    error_count = 0
-    failed_ids = []
-
-    connector = aiohttp.TCPConnector()
-    timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        for index, subscription in enumerate(subscriptions, start=1):
-            try:
-                ok = await remnawave_revoke_subscription(session, subscription["remnawave_uuid"])
-                if ok:
-                    success_count += 1
-                else:
-                    error_count += 1
-                    failed_ids.append(subscription["id"])
-            except Exception as e:
-                error_count += 1
-                failed_ids.append(subscription["id"])
-                logger.warning("Failed to reissue subscription link for subscription %s: %s", subscription["id"], e)
-
-            if index == total or index % 10 == 0:
-                try:
-                    await status_message.edit_text(
-                        f"🔁 <b>Перевыпуск подписочных ссылок идёт</b>\n\n"
-                        f"Прогресс: <b>{index}/{total}</b>\n"
-                        f"Успешно: <b>{success_count}</b>\n"
-                        f"Ошибок: <b>{error_count}</b>"
-                    )
-                except Exception:
-                    pass
-            await asyncio.sleep(0.2)
-
-    failed_text = ""
-    if failed_ids:
-        failed_preview = ", ".join(str(item) for item in failed_ids[:20])
-        suffix = "..." if len(failed_ids) > 20 else ""
-        failed_text = f"\n\nНе удалось для subscription id: <code>{failed_preview}{suffix}</code>"
-
-    await status_message.edit_text(
-        "✅ <b>Перевыпуск подписочных ссылок завершён</b>\n\n"
-        f"Всего: <b>{total}</b>\n"
-        f"Успешно: <b>{success_count}</b>\n"
-        f"Ошибок: <b>{error_count}</b>"
-        f"{failed_text}\n\n"
-        f"После этого бот и MiniApp будут показывать ссылки на <code>{SUBSCRIPTION_PUBLIC_BASE_URL}</code>."
+    await _start_admin_job(
+        message,
+        "reissue_links",
+        mode,
+        "🔁 <b>Перевыпуск подписочных ссылок запущен</b>\n\n"
+        f"Режим: <b>{'только активные' if mode == 'active' else 'все'}</b>\n"
+        f"После перевыпуска бот и MiniApp будут показывать ссылки на <code>{SUBSCRIPTION_PUBLIC_BASE_URL}</code>.",
     )
 
 
@@ -926,95 +762,92 @@ async def admin_give_sub(message: Message):
         else:
             new_until = now + timedelta(days=days)
 
-        connector = aiohttp.TCPConnector()
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            uuid, username = await remnawave_get_or_create_user(
-                session,
-                tg_id,
-                days=days,
-                extend_if_exists=False,
-                remna_username=subscription.get('remnawave_username') or _build_v2_remnawave_username(tg_id, plan_kind, type_index),
-                traffic_limit_bytes=traffic_limit_bytes if plan_kind == "bypass" else 0,
-                traffic_limit_strategy="NO_RESET",
-                active_internal_squads=[squad_uuid],
-                hwid_device_limit=device_limit,
-                telegram_id=tg_id,
+        uuid, username = await remnawave_get_or_create_user(
+            None,
+            tg_id,
+            days=days,
+            extend_if_exists=False,
+            remna_username=subscription.get('remnawave_username') or _build_v2_remnawave_username(tg_id, plan_kind, type_index),
+            traffic_limit_bytes=traffic_limit_bytes if plan_kind == "bypass" else 0,
+            traffic_limit_strategy="NO_RESET",
+            active_internal_squads=[squad_uuid],
+            hwid_device_limit=device_limit,
+            telegram_id=tg_id,
+        )
+
+        if not uuid:
+            await message.answer(
+                f"❌ <b>Ошибка Remnawave API</b>\n\n"
+                f"Не удалось создать/обновить аккаунт для пользователя {tg_id}\n\n"
+                "Попробуй позже"
             )
+            logger.error(f"Failed to get/create Remnawave user for TG {tg_id} by admin {admin_id}")
+            return
 
-            if not uuid:
-                await message.answer(
-                    f"❌ <b>Ошибка Remnawave API</b>\n\n"
-                    f"Не удалось создать/обновить аккаунт для пользователя {tg_id}\n\n"
-                    "Попробуй позже"
+        should_reset_traffic_now = (
+            traffic_state.enabled
+            and not traffic_state.was_active
+            and bool(uuid)
+            and bool(subscription.get("remnawave_uuid"))
+        )
+        if should_reset_traffic_now:
+            reset_ok = await remnawave_reset_user_traffic(None, uuid)
+            if reset_ok:
+                logger.info(
+                    "Traffic reset immediately after admin reactivated expired bypass subscription %s",
+                    subscription["id"],
                 )
-                logger.error(f"Failed to get/create Remnawave user for TG {tg_id} by admin {admin_id}")
-                return
-
-            should_reset_traffic_now = (
-                traffic_state.enabled
-                and not traffic_state.was_active
-                and bool(uuid)
-                and bool(subscription.get("remnawave_uuid"))
-            )
-            if should_reset_traffic_now:
-                reset_ok = await remnawave_reset_user_traffic(session, uuid)
-                if reset_ok:
-                    logger.info(
-                        "Traffic reset immediately after admin reactivated expired bypass subscription %s",
-                        subscription["id"],
-                    )
-                else:
-                    logger.warning(
-                        "Immediate traffic reset failed for admin-reactivated subscription %s; queued retry",
-                        subscription["id"],
-                    )
-                    traffic_state.reset_at = now
-                    traffic_state.last_known_used_bytes = int(subscription.get("last_known_used_traffic_bytes") or 0)
-
-            success = await remnawave_set_subscription_expiry(session, uuid, new_until)
-            if not success:
-                logger.warning(f"Failed to set subscription expiry in Remnawave for {tg_id} {plan_kind} #{type_index}, but continuing")
-
-            sub_url = await remnawave_get_subscription_url(session, uuid)
-
-            await db.update_subscription_record(subscription['id'], uuid, username, new_until, squad_uuid)
-            await db.db_execute(
-                """
-                UPDATE subscriptions
-                SET plan_kind = $1,
-                    generation = 'v2',
-                    is_visible = TRUE,
-                    is_renewable = TRUE,
-                    type_index = $2,
-                    purchase_days = $3,
-                    traffic_enabled = $4,
-                    base_traffic_bytes = $5,
-                    carried_traffic_bytes = $6,
-                    current_paid_traffic_bytes = $7,
-                    current_period_limit_bytes = $8,
-                    traffic_reset_at = $9,
-                    hwid_device_limit = $10,
-                    last_known_used_traffic_bytes = $11,
-                    last_traffic_sync_at = now(),
-                    updated_at = now()
-                WHERE id = $12
-                """,
-                (
-                    plan_kind,
-                    type_index,
-                    days,
-                    traffic_state.enabled,
-                    traffic_state.base_bytes,
-                    traffic_state.carried_bytes,
-                    traffic_state.paid_bytes,
-                    traffic_limit_bytes,
-                    traffic_state.reset_at,
-                    device_limit,
-                    traffic_state.last_known_used_bytes,
-                    subscription['id'],
+            else:
+                logger.warning(
+                    "Immediate traffic reset failed for admin-reactivated subscription %s; queued retry",
+                    subscription["id"],
                 )
+                traffic_state.reset_at = now
+                traffic_state.last_known_used_bytes = int(subscription.get("last_known_used_traffic_bytes") or 0)
+
+        success = await remnawave_set_subscription_expiry(None, uuid, new_until)
+        if not success:
+            logger.warning(f"Failed to set subscription expiry in Remnawave for {tg_id} {plan_kind} #{type_index}, but continuing")
+
+        sub_url = await remnawave_get_subscription_url(None, uuid)
+
+        await db.update_subscription_record(subscription['id'], uuid, username, new_until, squad_uuid, sub_url)
+        await db.db_execute(
+            """
+            UPDATE subscriptions
+            SET plan_kind = $1,
+                generation = 'v2',
+                is_visible = TRUE,
+                is_renewable = TRUE,
+                type_index = $2,
+                purchase_days = $3,
+                traffic_enabled = $4,
+                base_traffic_bytes = $5,
+                carried_traffic_bytes = $6,
+                current_paid_traffic_bytes = $7,
+                current_period_limit_bytes = $8,
+                traffic_reset_at = $9,
+                hwid_device_limit = $10,
+                last_known_used_traffic_bytes = $11,
+                last_traffic_sync_at = now(),
+                updated_at = now()
+            WHERE id = $12
+            """,
+            (
+                plan_kind,
+                type_index,
+                days,
+                traffic_state.enabled,
+                traffic_state.base_bytes,
+                traffic_state.carried_bytes,
+                traffic_state.paid_bytes,
+                traffic_limit_bytes,
+                traffic_state.reset_at,
+                device_limit,
+                traffic_state.last_known_used_bytes,
+                subscription['id'],
             )
+        )
 
         await message.answer(
             f"✅ <b>Подписка выдана успешно!</b>\n\n"
@@ -1028,7 +861,8 @@ async def admin_give_sub(message: Message):
 
         # Уведомляем пользователя
         try:
-            await message.bot.send_message(
+            await send_telegram_message(
+                message.bot,
                 tg_id,
                 f"🎉 <b>Поздравляем!</b>\n\n"
                 f"Вам выдана/продлена подписка <b>{_plan_title(plan_kind)} #{type_index}</b> на <b>{days} дней</b>\n\n"
@@ -1219,10 +1053,7 @@ async def admin_take_sub(message: Message):
             logger.info(f"Admin {admin_id} /take_sub - user {tg_id} slot {slot_number} has no Remnawave UUID")
             return
 
-        connector = aiohttp.TCPConnector()
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            user_info = await remnawave_get_user_info(session, remnawave_uuid)
+        user_info = await remnawave_get_user_info(None, remnawave_uuid)
 
         if not user_info or 'expireAt' not in user_info:
             await message.answer(f"❌ Не удалось получить информацию о подписке из Remnawave")
@@ -1256,7 +1087,8 @@ async def admin_take_sub(message: Message):
             )
 
             try:
-                await message.bot.send_message(
+                await send_telegram_message(
+                    message.bot,
                     tg_id,
                     f"❌ <b>Ваша подписка была аннулирована</b>\n\n"
                     f"Администратор удалил подписку <b>#{slot_number}</b> на {days} дней.\n\n"
@@ -1269,16 +1101,13 @@ async def admin_take_sub(message: Message):
             logger.info(f"Admin {admin_id} cancelled subscription for user {tg_id} slot {slot_number} (removed {days} days)")
 
         else:
-            connector = aiohttp.TCPConnector()
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-                success = await remnawave_set_subscription_expiry(
-                    session,
-                    remnawave_uuid,
-                    new_subscription_until
-                )
-                if not success:
-                    logger.warning(f"Failed to update Remnawave for user {tg_id}, but continuing with DB update")
+            success = await remnawave_set_subscription_expiry(
+                None,
+                remnawave_uuid,
+                new_subscription_until
+            )
+            if not success:
+                logger.warning(f"Failed to update Remnawave for user {tg_id}, but continuing with DB update")
 
             await db.update_subscription_record(
                 subscription['id'],
@@ -1301,7 +1130,8 @@ async def admin_take_sub(message: Message):
             )
 
             try:
-                await message.bot.send_message(
+                await send_telegram_message(
+                    message.bot,
                     tg_id,
                     f"⚠️ <b>Ваша подписка была сокращена</b>\n\n"
                     f"Администратор удалил {days} дней из подписки <b>#{slot_number}</b>.\n\n"
@@ -1392,7 +1222,8 @@ async def admin_enable_collab(message: Message):
 
     # Уведомляем пользователя
     try:
-        await message.bot.send_message(
+        await send_telegram_message(
+            message.bot,
             tg_id,
             f"🎉 <b>Поздравляем!</b>\n\n"
             f"Вы активированы как партнёр нашего сервиса!\n\n"
@@ -1421,16 +1252,15 @@ async def admin_stats(message: Message):
         return
 
     try:
-        # TODO: Реализовать получение полной статистики из БД
+        stats = await db.admin_dashboard_stats()
         await message.answer(
             "📊 <b>Статистика бота</b>\n\n"
-            "Функция в разработке...\n\n"
-            "<i>Будут доступны:</i>\n"
-            "• 👥 Количество активных пользователей\n"
-            "• 💳 Статистика платежей\n"
-            "• 🎁 Активированные подарки\n"
-            "• 🎟 Использованные промокоды\n"
-            "• 👥 Статистика рефералов"
+            f"👥 <b>Пользователей:</b> {stats['total_users']}\n"
+            f"🆕 <b>Новых за 7 дней:</b> {stats['new_users_7d']}\n"
+            f"🔑 <b>Активных подписок:</b> {stats['active_subscriptions']}\n\n"
+            f"💳 <b>Оплаченных платежей:</b> {stats['paid_payments']}\n"
+            f"💰 <b>Выручка всего:</b> {float(stats['total_revenue'] or 0):.2f} ₽\n"
+            f"📅 <b>Выручка за 30 дней:</b> {float(stats['revenue_30d'] or 0):.2f} ₽"
         )
         logger.info(f"Admin {admin_id} requested /stats")
     except Exception as e:
@@ -1438,6 +1268,32 @@ async def admin_stats(message: Message):
         logger.error(f"Error getting stats for admin {admin_id}: {e}")
 
 
+@router.message(Command("db_top"))
+async def admin_db_top(message: Message):
+    """Админ команда: топ запросов к БД по времени с момента запуска"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Эта команда доступна только администратору")
+        return
+
+    parts = message.text.split()
+    order = parts[1] if len(parts) > 1 and parts[1] in ("total", "avg", "max") else "total"
+    report = db.query_stats(10, order)
+    if not report["queries"]:
+        await message.answer("Запросов к БД ещё не было")
+        return
+
+    lines = [f"🐢 <b>Запросы к БД</b> (сортировка: {order})\n"]
+    for item in report["queries"]:
+        lines.append(
+            f"<code>{html.escape(item['name'])}</code>\n"
+            f"  {item['calls']} выз., всего {item['total_ms'] / 1000:.1f} с, "
+            f"ср. {item['avg_ms']:.1f} мс, макс. {item['max_ms']:.0f} мс, "
+            f"ожидание пула {item['pool_wait_ms'] / 1000:.1f} с"
+        )
+    lines.append(f"\nМедленных (≥ {report['slow_query_ms']} мс) в журнале: {len(report['slow'])}")
+    await message.answer("\n".join(lines))
+
+
 @router.message(Command("send", "sms"))
 async def admin_send_direct_message(message: Message, state: FSMContext):
     """Отправить сообщение одному пользователю по Telegram ID."""
@@ -1480,7 +1336,7 @@ async def admin_send_direct_message(message: Message, state: FSMContext):
             await message.answer(f"✅ Сообщение отправлено пользователю <code>{target_id}</code>")
             logger.info("Admin %s sent a direct message to %s", admin_id, target_id)
         except Exception as exc:
-            status, _ = _classify_broadcast_exception(exc)
+            status, _ = classify_broadcast_exception(exc)
             if status == "blocked":
                 error_text = "Пользователь заблокировал бота"
             elif status == "unreachable":
@@ -1530,7 +1386,7 @@ async def handle_direct_message(message: Message, state: FSMContext):
         await message.answer(f"✅ Сообщение отправлено пользователю <code>{target_id}</code>")
         logger.info("Admin %s sent a direct message to %s", message.from_user.id, target_id)
     except Exception as exc:
-        status, _ = _classify_broadcast_exception(exc)
+        status, _ = classify_broadcast_exception(exc)
         if status == "blocked":
             error_text = "Пользователь заблокировал бота"
         elif status == "unreachable":
@@ -1745,24 +1601,39 @@ async def stop_active_broadcast(callback: CallbackQuery):
         await callback.answer("❌ У вас нет доступа", show_alert=True)
         return
 
-    broadcast_id = callback.data.split(":", 1)[1]
-    broadcast = ACTIVE_BROADCASTS.get(broadcast_id)
-    if not broadcast:
-        await callback.answer("Эта рассылка уже завершена", show_alert=True)
+    job = await db.stop_broadcast_job(int(callback.data.split(":", 1)[1]))
+    if not job:
+        await callback.answer("Эта рассылка уже завершена или остановлена", show_alert=True)
         return
 
-    if broadcast.get("stop_requested"):
-        await callback.answer("Остановка уже запрошена")
-        return
-
-    broadcast["stop_requested"] = True
     await callback.message.edit_text(
         "⛔ <b>Остановка запрошена</b>\n\n"
-        "Рассылка остановится перед следующим получателем."
+        f"{format_broadcast_job(job)}\n\n"
+        "Текущая пачка ещё допишется. Продолжить можно кнопкой ниже.",
+        reply_markup=broadcast_job_keyboard(job),
     )
     await callback.answer("Останавливаю рассылку")
 
 
+@router.callback_query(F.data.startswith("broadcast_resume:"))
+async def resume_stopped_broadcast(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет доступа", show_alert=True)
+        return
+
+    job = await db.resume_broadcast_job(int(callback.data.split(":", 1)[1]))
+    if not job:
+        await callback.answer("Эту рассылку нельзя продолжить", show_alert=True)
+        return
+
+    wake_broadcasts()
+    await callback.message.edit_text(
+        f"📤 {format_broadcast_job(job)}",
+        reply_markup=broadcast_job_keyboard(job),
+    )
+    await callback.answer("Продолжаю рассылку")
+
+
 @router.callback_query(BroadcastStates.reviewing_broadcast, F.data == "broadcast_start")
 @router.callback_query(BroadcastStates.choosing_broadcast_buttons, F.data == "broadcast_start")
 async def start_selected_broadcast(callback: CallbackQuery, state: FSMContext):
@@ -1787,38 +1658,32 @@ async def start_selected_broadcast(callback: CallbackQuery, state: FSMContext):
         return
 
     try:
-        users = await _get_broadcast_users(mode)
-        if not users:
+        job = await db.create_broadcast_job(mode, source_chat_id, source_message_id, selected_buttons, admin_id)
+        if not job["total"]:
+            await db.finish_broadcast_job(job["id"], "done")
             text = "❌ В БД нет пользователей" if mode == "all" else "❌ Не найдено пользователей без подписки"
             await callback.message.answer(text)
-            await state.clear()
             await callback.answer()
             return
 
         await callback.message.edit_text("✅ <b>Рассылка подтверждена</b>")
         await callback.answer("Запускаю рассылку")
-        broadcast_id = uuid.uuid4().hex
-        ACTIVE_BROADCASTS[broadcast_id] = {
-            "admin_id": admin_id,
-            "mode": mode,
-            "stop_requested": False,
-            "started_at": datetime.utcnow(),
-        }
-        await _run_broadcast_copy(
-            callback.bot,
-            callback.message,
-            users,
-            source_chat_id,
-            source_message_id,
-            _build_broadcast_user_keyboard(selected_buttons),
+        progress_message = await callback.message.answer(
+            f"📤 {format_broadcast_job(job)}",
+            reply_markup=broadcast_job_keyboard(job),
+        )
+        await db.set_broadcast_job_notify_message(job["id"], progress_message.chat.id, progress_message.message_id)
+        wake_broadcasts()
+        logger.info(
+            "Admin %s enqueued broadcast %s mode=%s buttons=%s total=%s",
+            admin_id,
+            job["id"],
             mode,
-            broadcast_id,
+            selected_buttons,
+            job["total"],
         )
-        logger.info(f"Admin {admin_id} completed selected broadcast mode={mode} buttons={selected_buttons}")
     except Exception as e:
         logger.error(f"Selected broadcast error: {e}", exc_info=True)
         await callback.message.answer(f"❌ Ошибка при рассылке: {str(e)[:100]}")
     finally:
-        if 'broadcast_id' in locals():
-            ACTIVE_BROADCASTS.pop(broadcast_id, None)
         await state.clear()
@@ -7,6 +7,7 @@ import database as db
 from handlers.start import mobile_auth_keyboard, show_main_menu
 from services.image_handler import edit_text_with_photo
 from services.mobile_auth import approve_challenge, pending_challenge_for_user
+from services.telegram_sender import send_telegram_message
 
 
 logger = logging.getLogger(__name__)
@@ -27,7 +28,8 @@ async def process_accept_terms(callback: CallbackQuery, state: FSMContext):
     await callback.message.delete()
     await state.clear()
 
-    await callback.bot.send_message(
+    await send_telegram_message(
+        callback.bot,
         callback.message.chat.id,
         "Соглашение принято! Добро пожаловать!"
     )
@@ -38,7 +40,7 @@ async def process_accept_terms(callback: CallbackQuery, state: FSMContext):
             str(pending_challenge["id"]),
             pending_challenge.get("device_name"),
         )
-        await callback.bot.send_message(callback.message.chat.id, text, reply_markup=keyboard)
+        await send_telegram_message(callback.bot, callback.message.chat.id, text, reply_markup=keyboard)
     else:
         await show_main_menu(callback.message, callback.from_user.id)
 
@@ -6,6 +6,7 @@ from config import PARTNERSHIP_AGREEMENTS
 from states import UserStates
 import database as db
 from services.image_handler import edit_text_with_photo, send_text_with_photo
+from services.telegram_sender import send_telegram_message
 
 
 logger = logging.getLogger(__name__)
@@ -276,7 +277,7 @@ async def process_sbp_phone(message: Message, state: FSMContext):
 
     try:
         from config import ADMIN_ID
-        await message.bot.send_message(ADMIN_ID, admin_text)
+        await send_telegram_message(message.bot, ADMIN_ID, admin_text)
     except Exception as e:
         logging.error(f"Failed to send withdrawal notification to admin: {e}")
 
@@ -386,7 +387,7 @@ async def process_usdt_address(message: Message, state: FSMContext):
 
     try:
         from config import ADMIN_ID
-        await message.bot.send_message(ADMIN_ID, admin_text)
+        await send_telegram_message(message.bot, ADMIN_ID, admin_text)
     except Exception as e:
         logging.error(f"Failed to send withdrawal notification to admin: {e}")
 
@@ -283,6 +283,7 @@ async def process_promo_input(message: Message, state: FSMContext):
             username,
             new_until,
             squad_uuid,
+            sub_url,
         )
         await db.update_subscription_traffic_period(
             subscription['id'],
@@ -2,7 +2,6 @@ import logging
 import html
 from datetime import datetime, timedelta, timezone
 
-import aiohttp
 from aiogram import F, Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
@@ -47,7 +46,8 @@ from services.subscription_deletion import (
     delete_subscription_everywhere,
 )
 from services.yookassa import create_yookassa_payment, get_payment_status, process_paid_yookassa_payment
-from services.subscription_sync import refresh_subscription_expiry
+from services.subscription_sync import refresh_subscription_expiry, stored_subscription_url
+from services.telegram_sender import send_telegram_message
 from services.discounts import calculate_discounted_price, current_price
 from services.traffic_periods import build_traffic_period_state
 from states import UserStates
@@ -182,18 +182,15 @@ async def _get_subscription_access_data(subscription) -> tuple[str | None, str,
     effective_until = subscription.get('subscription_until')
     sub_url = None
 
-    connector = aiohttp.TCPConnector()
-    timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        if subscription.get('remnawave_uuid'):
-            try:
-                sub_url = await remnawave_get_subscription_url(session, subscription['remnawave_uuid'])
-            except Exception as e:
-                logging.error(f"Error fetching subscription URL from Remnawave: {e}")
-            try:
-                effective_until = await refresh_subscription_expiry(subscription, session)
-            except Exception as e:
-                logging.error(f"Error fetching subscription expiry from Remnawave: {e}")
+    if subscription.get('remnawave_uuid'):
+        try:
+            sub_url = await stored_subscription_url(subscription)
+        except Exception as e:
+            logging.error(f"Error fetching subscription URL from Remnawave: {e}")
+        try:
+            effective_until = await refresh_subscription_expiry(subscription)
+        except Exception as e:
+            logging.error(f"Error fetching subscription expiry from Remnawave: {e}")
 
     remaining_str = _format_remaining(effective_until.replace(tzinfo=timezone.utc).isoformat()) if effective_until else "неизвестно"
     return sub_url, remaining_str, effective_until
@@ -414,11 +411,8 @@ async def _show_subscription_card(callback: CallbackQuery, subscription_id: int,
         used_bytes = subscription.get('last_known_used_traffic_bytes') or 0
         try:
             if subscription.get('remnawave_uuid'):
-                connector = aiohttp.TCPConnector()
-                timeout = aiohttp.ClientTimeout(total=30)
-                async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-                    user_info = await remnawave_get_user_info(session, subscription['remnawave_uuid'])
-                    used_bytes = (user_info.get('userTraffic') or {}).get('usedTrafficBytes') or used_bytes if user_info else used_bytes
+                user_info = await remnawave_get_user_info(None, subscription['remnawave_uuid'])
+                used_bytes = (user_info.get('userTraffic') or {}).get('usedTrafficBytes') or used_bytes if user_info else used_bytes
         except Exception as e:
             logging.warning(f"Failed to fetch traffic for subscription {subscription_id}: {e}")
 
@@ -479,10 +473,7 @@ async def _show_subscription_devices(callback: CallbackQuery, subscription_id: i
 
     devices = []
     try:
-        connector = aiohttp.TCPConnector()
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            devices = await remnawave_get_hwid_devices(session, subscription['remnawave_uuid']) or []
+        devices = await remnawave_get_hwid_devices(None, subscription['remnawave_uuid']) or []
     except Exception as e:
         logging.error(f"Failed to get devices for subscription {subscription_id}: {e}")
         await callback.answer("Не удалось загрузить устройства", show_alert=True)
@@ -527,15 +518,12 @@ async def _delete_subscription_device(callback: CallbackQuery, subscription_id:
         await callback.answer("Подписка не найдена", show_alert=True)
         return
 
-    connector = aiohttp.TCPConnector()
-    timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        devices = await remnawave_get_hwid_devices(session, subscription['remnawave_uuid']) or []
-        if device_index < 0 or device_index >= len(devices) or not devices[device_index].get('hwid'):
-            await callback.answer("Устройство не найдено", show_alert=True)
-            return
+    devices = await remnawave_get_hwid_devices(None, subscription['remnawave_uuid']) or []
+    if device_index < 0 or device_index >= len(devices) or not devices[device_index].get('hwid'):
+        await callback.answer("Устройство не найдено", show_alert=True)
+        return
 
-        deleted = await remnawave_delete_hwid_device(session, subscription['remnawave_uuid'], devices[device_index]['hwid'])
+    deleted = await remnawave_delete_hwid_device(None, subscription['remnawave_uuid'], devices[device_index]['hwid'])
 
     if not deleted:
         await callback.answer("Не удалось удалить устройство", show_alert=True)
@@ -553,10 +541,7 @@ async def _delete_all_subscription_devices(callback: CallbackQuery, subscription
         await callback.answer("Подписка не найдена", show_alert=True)
         return
 
-    connector = aiohttp.TCPConnector()
-    timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        deleted = await remnawave_delete_all_hwid_devices(session, subscription['remnawave_uuid'])
+    deleted = await remnawave_delete_all_hwid_devices(None, subscription['remnawave_uuid'])
 
     if not deleted:
         await callback.answer("Не удалось удалить устройства", show_alert=True)
@@ -854,12 +839,9 @@ async def process_refund_confirm(callback: CallbackQuery):
             return
 
         expired_at = datetime.utcnow() - timedelta(seconds=1)
-        connector = aiohttp.TCPConnector()
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            if not await remnawave_set_subscription_expiry(session, subscription["remnawave_uuid"], expired_at):
-                await callback.answer("Не удалось деактивировать подписку. Попробуй позже.", show_alert=True)
-                return
+        if not await remnawave_set_subscription_expiry(None, subscription["remnawave_uuid"], expired_at):
+            await callback.answer("Не удалось деактивировать подписку. Попробуй позже.", show_alert=True)
+            return
 
         if not await db.deactivate_subscription_for_refund(subscription_id, tg_id, expired_at):
             await callback.answer("Не удалось деактивировать подписку в базе. Напиши в поддержку.", show_alert=True)
@@ -891,7 +873,8 @@ async def process_refund_confirm(callback: CallbackQuery):
 
         if ADMIN_ID:
             try:
-                await callback.bot.send_message(
+                await send_telegram_message(
+                    callback.bot,
                     ADMIN_ID,
                     "↩️ <b>Новая заявка на возврат</b>\n\n"
                     f"Пользователь: <code>{tg_id}</code>\n"
@@ -1651,41 +1634,38 @@ async def process_pay_referral_balance(callback: CallbackQuery, state: FSMContex
             await callback.answer("Не удалось определить целевую подписку", show_alert=True)
             return
 
-        connector = aiohttp.TCPConnector()
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            plan_kind = subscription.get("plan_kind") or tariff.get("kind", "regular")
-            squad_uuid = REGULAR_SQUAD_UUID if plan_kind == "regular" else BYPASS_SQUAD_UUID
-            now = datetime.utcnow()
-            traffic_state = build_traffic_period_state(subscription, plan_kind, now)
-            active_device_addons = await db.get_active_device_addon_count(subscription['id'])
-            device_limit = effective_device_limit(plan_kind, active_device_addons)
-            traffic_limit_bytes = traffic_state.limit_bytes
-            remna_username = subscription.get("remnawave_username") or _build_new_remnawave_username(
-                tg_id,
-                plan_kind,
-                subscription.get('type_index') or subscription['id'],
-            )
-            uuid, username = await remnawave_get_or_create_user(
-                session,
-                tg_id,
-                tariff["days"],
-                extend_if_exists=purchase_mode == "renew" and bool(subscription.get("remnawave_uuid")),
-                remna_username=remna_username,
-                traffic_limit_bytes=traffic_limit_bytes,
-                traffic_limit_strategy="NO_RESET",
-                active_internal_squads=[squad_uuid],
-                hwid_device_limit=device_limit,
-                telegram_id=tg_id,
-            )
+        plan_kind = subscription.get("plan_kind") or tariff.get("kind", "regular")
+        squad_uuid = REGULAR_SQUAD_UUID if plan_kind == "regular" else BYPASS_SQUAD_UUID
+        now = datetime.utcnow()
+        traffic_state = build_traffic_period_state(subscription, plan_kind, now)
+        active_device_addons = await db.get_active_device_addon_count(subscription['id'])
+        device_limit = effective_device_limit(plan_kind, active_device_addons)
+        traffic_limit_bytes = traffic_state.limit_bytes
+        remna_username = subscription.get("remnawave_username") or _build_new_remnawave_username(
+            tg_id,
+            plan_kind,
+            subscription.get('type_index') or subscription['id'],
+        )
+        uuid, username = await remnawave_get_or_create_user(
+            None,
+            tg_id,
+            tariff["days"],
+            extend_if_exists=purchase_mode == "renew" and bool(subscription.get("remnawave_uuid")),
+            remna_username=remna_username,
+            traffic_limit_bytes=traffic_limit_bytes,
+            traffic_limit_strategy="NO_RESET",
+            active_internal_squads=[squad_uuid],
+            hwid_device_limit=device_limit,
+            telegram_id=tg_id,
+        )
 
-            if not uuid:
-                await callback.answer("Ошибка получения доступа в VPN. Попробуй позже.", show_alert=True)
-                return
+        if not uuid:
+            await callback.answer("Ошибка получения доступа в VPN. Попробуй позже.", show_alert=True)
+            return
 
-            sub_url = await remnawave_get_subscription_url(session, uuid)
-            if not sub_url:
-                logging.warning(f"Failed to get subscription URL for {uuid}")
+        sub_url = await remnawave_get_subscription_url(None, uuid)
+        if not sub_url:
+            logging.warning(f"Failed to get subscription URL for {uuid}")
 
         existing_subscription = subscription.get("subscription_until")
         if existing_subscription and existing_subscription > now:
@@ -1693,32 +1673,29 @@ async def process_pay_referral_balance(callback: CallbackQuery, state: FSMContex
         else:
             new_until = now + timedelta(days=tariff["days"])
 
-        connector = aiohttp.TCPConnector()
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            should_reset_traffic_now = (
-                traffic_state.enabled
-                and not traffic_state.was_active
-                and bool(uuid)
-                and (purchase_mode == "renew" or bool(subscription.get("remnawave_uuid")))
-            )
-            if should_reset_traffic_now:
-                reset_ok = await remnawave_reset_user_traffic(session, uuid)
-                if reset_ok:
-                    logging.info(
-                        "Traffic reset immediately after reactivating expired bypass subscription %s",
-                        subscription["id"],
-                    )
-                else:
-                    logging.warning(
-                        "Immediate traffic reset failed for reactivated subscription %s; queued retry",
-                        subscription["id"],
-                    )
-                    traffic_state.reset_at = now
-                    traffic_state.last_known_used_bytes = int(subscription.get("last_known_used_traffic_bytes") or 0)
+        should_reset_traffic_now = (
+            traffic_state.enabled
+            and not traffic_state.was_active
+            and bool(uuid)
+            and (purchase_mode == "renew" or bool(subscription.get("remnawave_uuid")))
+        )
+        if should_reset_traffic_now:
+            reset_ok = await remnawave_reset_user_traffic(None, uuid)
+            if reset_ok:
+                logging.info(
+                    "Traffic reset immediately after reactivating expired bypass subscription %s",
+                    subscription["id"],
+                )
+            else:
+                logging.warning(
+                    "Immediate traffic reset failed for reactivated subscription %s; queued retry",
+                    subscription["id"],
+                )
+                traffic_state.reset_at = now
+                traffic_state.last_known_used_bytes = int(subscription.get("last_known_used_traffic_bytes") or 0)
 
-            if not await remnawave_set_subscription_expiry(session, uuid, new_until):
-                logging.warning(f"Failed to sync Remnawave expiry for referral balance subscription {subscription['id']}")
+        if not await remnawave_set_subscription_expiry(None, uuid, new_until):
+            logging.warning(f"Failed to sync Remnawave expiry for referral balance subscription {subscription['id']}")
 
         await db.update_subscription_record(
             subscription['id'],
@@ -1726,6 +1703,7 @@ async def process_pay_referral_balance(callback: CallbackQuery, state: FSMContex
             username,
             new_until,
             squad_uuid,
+            sub_url,
         )
         await db.db_execute(
             """
@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import signal
+import time
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
@@ -14,9 +15,15 @@ import database as db
 from handlers import start, callbacks, subscription, gift, referral, promo, admin, partnership, smart_assistant
 from services.cryptobot import check_cryptobot_invoices
 from services.yookassa import check_yookassa_payments, cleanup_expired_payments
-from services.subscription_notifications import check_and_send_notifications
+from services.subscription_notifications import check_and_send_notifications, run_scheduled_notifications_loop
 from services.traffic_resets import run_traffic_reset_loop
 from services.device_addon_expiry import run_device_addon_expiry_loop
+from services.remnawave import close_remnawave_session, get_remnawave_session
+from services.remnawave_sync import run_remnawave_sync_loop
+from services.admin_jobs import run_admin_jobs_loop
+from services.broadcasts import run_broadcasts_loop
+from services.admin_counters import run_admin_counters_reconcile_loop
+from services.db_scope import DatabaseScopeMiddleware
 import webhooks
 
 
@@ -51,6 +58,7 @@ dp = Dispatcher(storage=storage)
 
 def setup_handlers():
     """Регистрируем все роутеры обработчиков"""
+    dp.update.outer_middleware(DatabaseScopeMiddleware())
     dp.include_router(start.router)
     dp.include_router(callbacks.router)
     dp.include_router(subscription.router)
@@ -82,6 +90,7 @@ async def setup_menu_button():
                     BotCommand(command="all_sms", description="Рассылка всем"),
                     BotCommand(command="not_sub_sms", description="Рассылка без подписки"),
                     BotCommand(command="reset_traffic_all", description="Сбросить трафик антиглушилок"),
+                    BotCommand(command="jobs", description="Массовые задачи"),
                 ],
                 scope=BotCommandScopeChat(chat_id=ADMIN_ID),
             )
@@ -135,8 +144,12 @@ async def main():
     logger.info("=" * 60)
 
     # Инициализируем БД
+    db_started = time.perf_counter()
     await db.init_db()
-    logger.info("✅ Database initialized")
+    logger.info("✅ Database initialized in %.2fs", time.perf_counter() - db_started)
+
+    # Общий keep-alive клиент Remnawave для всех хендлеров и фоновых задач
+    get_remnawave_session()
 
     # Регистрируем обработчики
     setup_handlers()
@@ -162,13 +175,21 @@ async def main():
     else:
         logger.info("Webhook mode enabled; YooKassa fallback checker is active")
 
-    # Запускаем задачу очистки истёкших платежей
-    tasks.append(asyncio.create_task(cleanup_expired_payments()))
-
-    # Запускаем задачу отправки уведомлений о заканчивающихся подписках
-    tasks.append(asyncio.create_task(check_and_send_notifications(bot)))
-    tasks.append(asyncio.create_task(run_traffic_reset_loop()))
-    tasks.append(asyncio.create_task(run_device_addon_expiry_loop()))
+    # Проверки оплат выше идут через пул interactive вместе с вебхуками,
+    # остальные циклы берут соединения из отдельного пула background
+    with db.workload("background"):
+        # Запускаем задачу очистки истёкших платежей
+        tasks.append(asyncio.create_task(cleanup_expired_payments()))
+
+        # Запускаем задачу отправки уведомлений о заканчивающихся подписках
+        tasks.append(asyncio.create_task(check_and_send_notifications(bot)))
+        tasks.append(asyncio.create_task(run_scheduled_notifications_loop(bot)))
+        tasks.append(asyncio.create_task(run_traffic_reset_loop()))
+        tasks.append(asyncio.create_task(run_device_addon_expiry_loop()))
+        tasks.append(asyncio.create_task(run_remnawave_sync_loop()))
+        tasks.append(asyncio.create_task(run_admin_jobs_loop(bot)))
+        tasks.append(asyncio.create_task(run_broadcasts_loop(bot)))
+        tasks.append(asyncio.create_task(run_admin_counters_reconcile_loop()))
     logger.info("✅ Background tasks started")
 
     # Запускаем webhook сервер (асинхронно)
@@ -225,6 +246,11 @@ async def main():
         except Exception as e:
             logger.warning(f"Error closing bot session: {e}")
 
+        try:
+            await close_remnawave_session()
+        except Exception as e:
+            logger.warning(f"Error closing Remnawave client: {e}")
+
         # Закрываем БД при выходе
         try:
             await db.close_db()
@@ -3,11 +3,14 @@
 from __future__ import annotations
 
 import base64
+import binascii
+import hashlib
 import html
+import io
 import json
 import re
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -50,8 +53,8 @@ from services.remnawave import (
     remnawave_delete_hwid_device,
     remnawave_fetch_subscription_profile,
     remnawave_get_hwid_devices,
-    remnawave_get_subscription_url,
 )
+from services.subscription_sync import stored_subscription_url
 from services.yookassa import create_yookassa_payment
 
 
@@ -59,7 +62,13 @@ router = APIRouter(prefix="/mobile/api/v1", tags=["Way VPN mobile"])
 public_router = APIRouter(tags=["Way VPN public"])
 HWID_RE = re.compile(r"^[A-Za-z0-9=-]{10,64}$")
 ALLOWED_PROFILE_SCHEMES = ("vless://", "trojan://", "ss://")
+ALLOWED_PROFILE_SCHEMES_BYTES = tuple(scheme.encode() for scheme in ALLOWED_PROFILE_SCHEMES)
 _rate_events: dict[str, deque[float]] = defaultdict(deque)
+MOBILE_PROFILE_CACHE_TTL = 60  # секунд отдаём профиль устройства без запроса к Remnawave
+MOBILE_PROFILE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# (subscription_id, hwid) -> отфильтрованный профиль; LRU по суммарному размеру
+_profile_cache: OrderedDict[tuple[int, str], dict] = OrderedDict()
+_profile_cache_bytes = 0
 RELEASE_DIR = Path(__file__).resolve().parent / "release"
 PUBLIC_RELEASE_ARTIFACTS = {
     "WayVPN-1.2.0-universal-release.apk": "application/vnd.android.package-archive",
@@ -244,28 +253,97 @@ def _serialize_tariffs(tariffs: dict, discounts) -> list[dict]:
     ]
 
 
+def _profile_lines(data: bytes):
+    """Строки профиля по одной, без промежуточных копий всего текста."""
+    for raw in io.BytesIO(data):
+        line = raw.strip()
+        if line:
+            yield line
+
+
+def _base64_profile_lines(data: bytes):
+    """Строки base64-профиля, декодируемого кусками."""
+    pending = b""
+    tail = b""
+    for chunk in _profile_lines(data):
+        pending += chunk
+        usable = len(pending) - len(pending) % 4
+        if not usable:
+            continue
+        decoded = tail + binascii.a2b_base64(pending[:usable], strict_mode=True)
+        pending = pending[usable:]
+        *lines, tail = decoded.split(b"\n")
+        yield from lines
+    if pending:
+        tail += binascii.a2b_base64(pending + b"=" * (-len(pending) % 4), strict_mode=True)
+    yield tail
+
+
+def _allowed_profile_lines(lines) -> list[bytes]:
+    allowed = []
+    for raw in lines:
+        line = raw.strip()
+        if not line.lower().startswith(ALLOWED_PROFILE_SCHEMES_BYTES):
+            continue
+        line.decode("utf-8")
+        allowed.append(line)
+    return allowed
+
+
 def _filter_profile(profile: bytes) -> bytes:
     """Оставить только VLESS, Trojan и Shadowsocks subscription-ссылки."""
     try:
-        text = profile.decode("utf-8").strip()
+        allowed = _allowed_profile_lines(_profile_lines(profile))
     except UnicodeDecodeError as exc:
         raise HTTPException(status_code=502, detail={"code": "invalid_profile", "message": "Профиль имеет неизвестный формат"}) from exc
 
     was_base64 = False
-    decoded = text
-    if not any(line.strip().lower().startswith(ALLOWED_PROFILE_SCHEMES) for line in text.splitlines()):
+    if not allowed:
         try:
-            decoded = base64.b64decode(text + "=" * (-len(text) % 4), validate=True).decode("utf-8")
+            allowed = _allowed_profile_lines(_base64_profile_lines(profile))
             was_base64 = True
-        except (ValueError, UnicodeDecodeError):
-            decoded = text
-    allowed = [line.strip() for line in decoded.splitlines() if line.strip().lower().startswith(ALLOWED_PROFILE_SCHEMES)]
+        except (binascii.Error, ValueError, UnicodeDecodeError):
+            allowed = []
     if not allowed:
         raise HTTPException(status_code=502, detail={"code": "unsupported_profile", "message": "В профиле нет поддерживаемых узлов"})
-    filtered = ("\n".join(allowed) + "\n").encode("utf-8")
+    filtered = b"\n".join(allowed) + b"\n"
     return base64.b64encode(filtered) if was_base64 else filtered
 
 
+def _profile_cache_get(key: tuple[int, str]) -> dict | None:
+    entry = _profile_cache.get(key)
+    if entry is not None:
+        _profile_cache.move_to_end(key)
+    return entry
+
+
+def _profile_cache_put(key: tuple[int, str], entry: dict) -> None:
+    global _profile_cache_bytes
+    _profile_cache_drop(key)
+    size = len(entry["body"])
+    if size > MOBILE_PROFILE_CACHE_MAX_BYTES // 16:
+        return
+    _profile_cache[key] = entry
+    _profile_cache_bytes += size
+    while _profile_cache_bytes > MOBILE_PROFILE_CACHE_MAX_BYTES:
+        _, evicted = _profile_cache.popitem(last=False)
+        _profile_cache_bytes -= len(evicted["body"])
+
+
+def _profile_cache_drop(key: tuple[int, str]) -> None:
+    global _profile_cache_bytes
+    entry = _profile_cache.pop(key, None)
+    if entry is not None:
+        _profile_cache_bytes -= len(entry["body"])
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {item.strip().removeprefix("W/") for item in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
 @router.post("/auth/challenges")
 async def auth_challenges(request: Request):
     _rate_limit(request, "challenge", 5, 15 * 60)
@@ -397,45 +475,64 @@ async def mobile_subscription_profile(subscription_id: int, request: Request, se
     if not subscription.get("subscription_until") or subscription["subscription_until"] <= datetime.utcnow():
         raise HTTPException(status_code=403, detail={"code": "subscription_expired", "message": "Срок подписки истёк"})
 
-    subscription_url = await remnawave_get_subscription_url(None, subscription["remnawave_uuid"])
+    subscription_url = await stored_subscription_url(subscription)
     if not subscription_url:
         raise HTTPException(status_code=502, detail={"code": "profile_unavailable", "message": "Профиль временно недоступен"})
-    upstream = await remnawave_fetch_subscription_profile(subscription_url, {
-        "x-hwid": hwid,
-        "x-device-os": str(body.get("device_os") or "Android")[:64],
-        "x-ver-os": str(body.get("os_version") or "")[:64],
-        "x-device-model": str(body.get("device_model") or "")[:120],
-        "user-agent": str(body.get("user_agent") or request.headers.get("User-Agent") or "WayVPN/Android")[:200],
-    })
-    hwid_headers = upstream["headers"]
-    if upstream["status"] != 200:
-        if "x-hwid-max-devices-reached" in hwid_headers:
-            return JSONResponse(
-                {
-                    "error": {
-                        "code": "hwid_limit_reached",
-                        "message": "Достигнут лимит устройств",
-                        "active": hwid_headers.get("x-hwid-active"),
-                        "limit": hwid_headers.get("x-hwid-max-devices-reached"),
-                    }
-                },
-                status_code=409,
-                headers={"Cache-Control": "no-store"},
-            )
-        code = "hwid_not_supported" if "x-hwid-not-supported" in hwid_headers else "profile_unavailable"
-        status = 400 if code == "hwid_not_supported" else 502
-        return JSONResponse({"error": {"code": code, "message": "Профиль не выдан сервером"}}, status_code=status)
-
-    filtered_profile = _filter_profile(upstream["body"])
-    return Response(
-        content=filtered_profile,
-        media_type=upstream["content_type"].split(";", 1)[0],
-        headers={
-            "Cache-Control": "no-store",
-            "Pragma": "no-cache",
-            "X-Way-Subscription-Expires-At": _format_dt(subscription["subscription_until"]) or "",
-        },
-    )
+
+    cache_key = (int(subscription["id"]), hwid)
+    cached = _profile_cache_get(cache_key)
+    if cached is not None and cached["subscription_url"] != subscription_url:
+        _profile_cache_drop(cache_key)
+        cached = None
+    if cached is None or time.monotonic() - cached["fetched_at"] >= MOBILE_PROFILE_CACHE_TTL:
+        upstream = await remnawave_fetch_subscription_profile(subscription_url, {
+            "x-hwid": hwid,
+            "x-device-os": str(body.get("device_os") or "Android")[:64],
+            "x-ver-os": str(body.get("os_version") or "")[:64],
+            "x-device-model": str(body.get("device_model") or "")[:120],
+            "user-agent": str(body.get("user_agent") or request.headers.get("User-Agent") or "WayVPN/Android")[:200],
+        })
+        hwid_headers = upstream["headers"]
+        if upstream["status"] != 200:
+            _profile_cache_drop(cache_key)
+            if "x-hwid-max-devices-reached" in hwid_headers:
+                return JSONResponse(
+                    {
+                        "error": {
+                            "code": "hwid_limit_reached",
+                            "message": "Достигнут лимит устройств",
+                            "active": hwid_headers.get("x-hwid-active"),
+                            "limit": hwid_headers.get("x-hwid-max-devices-reached"),
+                        }
+                    },
+                    status_code=409,
+                    headers={"Cache-Control": "no-store"},
+                )
+            code = "hwid_not_supported" if "x-hwid-not-supported" in hwid_headers else "profile_unavailable"
+            status = 400 if code == "hwid_not_supported" else 502
+            return JSONResponse({"error": {"code": code, "message": "Профиль не выдан сервером"}}, status_code=status)
+
+        upstream_hash = hashlib.sha256(upstream["body"]).hexdigest()
+        if cached is None or cached["upstream_hash"] != upstream_hash:
+            filtered_profile = _filter_profile(upstream["body"])
+            cached = {
+                "subscription_url": subscription_url,
+                "upstream_hash": upstream_hash,
+                "body": filtered_profile,
+                "etag": f'"{hashlib.sha256(filtered_profile).hexdigest()[:32]}"',
+                "media_type": upstream["content_type"].split(";", 1)[0],
+            }
+        cached["fetched_at"] = time.monotonic()
+        _profile_cache_put(cache_key, cached)
+
+    headers = {
+        "Cache-Control": "private, no-cache",
+        "ETag": cached["etag"],
+        "X-Way-Subscription-Expires-At": _format_dt(subscription["subscription_until"]) or "",
+    }
+    if _etag_matches(request.headers.get("If-None-Match"), cached["etag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached["body"], media_type=cached["media_type"], headers=headers)
 
 
 @router.get("/subscriptions/{subscription_id}/devices")
@@ -452,6 +549,7 @@ async def mobile_delete_subscription_device(subscription_id: int, hwid: str, ses
     if not HWID_RE.fullmatch(hwid):
         raise HTTPException(status_code=400, detail={"code": "invalid_hwid", "message": "Некорректный HWID"})
     subscription = await _owned_subscription(subscription_id, session)
+    _profile_cache_drop((int(subscription["id"]), hwid))
     if not await remnawave_delete_hwid_device(None, subscription["remnawave_uuid"], hwid):
         raise HTTPException(status_code=502, detail="Could not delete device")
     return JSONResponse({"ok": True})
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""Local Remnawave API stand-in for load tests and manual runs.
+
+Covers the endpoints used by services/remnawave.py: user CRUD, traffic reset,
+subscription revoke, HWID devices, squads and the public subscription profile.
+State lives in memory; latency and failures are injected per request.
+
+Usage examples:
+  python3 scripts/fake_remnawave.py --port 3010
+  python3 scripts/fake_remnawave.py --port 3010 --latency-ms 120 --jitter-ms 60 --error-rate 0.02
+
+Then point the bot at it:
+  REMNAWAVE_BASE_URL=http://127.0.0.1:3010/api REMNAWAVE_API_TOKEN=fake-token python3 main.py
+
+The profile endpoint (/sub/{shortUuid}) is served over HTTPS only when
+--tls-cert/--tls-key are given, because the bot refuses non-HTTPS profile URLs.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import random
+import secrets
+import ssl
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+
+API_PREFIX = "/api"
+
+
+@dataclass
+class FaultInjection:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 503
+    rate_limit_rate: float = 0.0
+
+    async def apply(self) -> web.Response | None:
+        delay = self.latency_ms + (random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return web.json_response({"message": "Too many requests"}, status=429, headers={"Retry-After": "1"})
+        if roll < self.rate_limit_rate + self.error_rate:
+            return web.json_response({"message": "Injected failure"}, status=self.error_status)
+        return None
+
+
+@dataclass
+class FakeRemnawaveState:
+    public_base_url: str = ""
+    users: dict[str, dict] = field(default_factory=dict)
+    devices: dict[str, list[dict]] = field(default_factory=dict)
+    requests: dict[str, int] = field(default_factory=dict)
+    usernames: dict[str, str] = field(default_factory=dict)
+    short_uuids: dict[str, str] = field(default_factory=dict)
+
+    def by_username(self, username: str) -> dict | None:
+        return self.users.get(self.usernames.get(username, ""))
+
+    def by_short_uuid(self, short_uuid: str) -> dict | None:
+        return self.users.get(self.short_uuids.get(short_uuid, ""))
+
+    def public_user(self, user: dict) -> dict:
+        return {
+            **user,
+            "subscriptionUrl": f"{self.public_base_url}/sub/{user['shortUuid']}",
+            "userTraffic": {"usedTrafficBytes": user["usedTrafficBytes"]},
+        }
+
+
+STATE_KEY: web.AppKey[FakeRemnawaveState] = web.AppKey("state", FakeRemnawaveState)
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _normalize_expire_at(value) -> str:
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _not_found(code: str = "A025") -> web.Response:
+    return web.json_response({"message": "User not found", "errorCode": code}, status=404)
+
+
+def create_app(
+    *,
+    faults: FaultInjection | None = None,
+    api_token: str | None = None,
+    public_base_url: str = "",
+    profile_nodes: int = 20,
+) -> web.Application:
+    """Build the fake API; state is available as app[STATE_KEY] for assertions."""
+    faults = faults or FaultInjection()
+    state = FakeRemnawaveState(public_base_url=public_base_url.rstrip("/"))
+
+    @web.middleware
+    async def inject(request: web.Request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        key = f"{request.method} {route}"
+        state.requests[key] = state.requests.get(key, 0) + 1
+        if request.path.startswith(API_PREFIX) and api_token:
+            if request.headers.get("Authorization") != f"Bearer {api_token}":
+                return web.json_response({"message": "Unauthorized"}, status=401)
+        failure = await faults.apply()
+        if failure is not None:
+            return failure
+        return await handler(request)
+
+    routes = web.RouteTableDef()
+
+    @routes.get(f"{API_PREFIX}/users")
+    async def list_users(request: web.Request):
+        start = int(request.query.get("start", "0"))
+        size = int(request.query.get("size", "25"))
+        users = list(state.users.values())[start:start + size]
+        return web.json_response({
+            "response": {"users": [state.public_user(user) for user in users], "total": len(state.users)}
+        })
+
+    @routes.post(f"{API_PREFIX}/users")
+    async def create_user(request: web.Request):
+        payload = await request.json()
+        if state.by_username(payload["username"]):
+            return web.json_response({"message": "User already exists", "errorCode": "A019"}, status=400)
+        user_uuid = str(uuid.uuid4())
+        user = {
+            "uuid": user_uuid,
+            "shortUuid": secrets.token_urlsafe(12),
+            "username": payload["username"],
+            "status": "ACTIVE",
+            "expireAt": _normalize_expire_at(payload["expireAt"]),
+            "trafficLimitBytes": int(payload.get("trafficLimitBytes") or 0),
+            "trafficLimitStrategy": payload.get("trafficLimitStrategy") or "NO_RESET",
+            "activeInternalSquads": list(payload.get("activeInternalSquads") or []),
+            "hwidDeviceLimit": payload.get("hwidDeviceLimit"),
+            "telegramId": payload.get("telegramId"),
+            "usedTrafficBytes": 0,
+            "createdAt": _now_iso(),
+            "updatedAt": _now_iso(),
+        }
+        state.users[user_uuid] = user
+        state.usernames[user["username"]] = user_uuid
+        state.short_uuids[user["shortUuid"]] = user_uuid
+        return web.json_response({"response": state.public_user(user)}, status=201)
+
+    @routes.patch(f"{API_PREFIX}/users")
+    async def update_user(request: web.Request):
+        payload = await request.json()
+        user = state.users.get(str(payload.get("uuid")))
+        if user is None:
+            return _not_found()
+        for key in ("trafficLimitBytes", "trafficLimitStrategy", "activeInternalSquads", "hwidDeviceLimit", "telegramId"):
+            if key in payload:
+                user[key] = payload[key]
+        if "expireAt" in payload:
+            user["expireAt"] = _normalize_expire_at(payload["expireAt"])
+        user["updatedAt"] = _now_iso()
+        return web.json_response({"response": state.public_user(user)})
+
+    @routes.get(f"{API_PREFIX}/users/by-username/{{username}}")
+    async def get_by_username(request: web.Request):
+        user = state.by_username(request.match_info["username"])
+        return web.json_response({"response": state.public_user(user)}) if user else _not_found()
+
+    @routes.get(f"{API_PREFIX}/users/by-short-uuid/{{short_uuid}}")
+    async def get_by_short_uuid(request: web.Request):
+        user = state.by_short_uuid(request.match_info["short_uuid"])
+        return web.json_response({"response": state.public_user(user)}) if user else _not_found()
+
+    @routes.get(f"{API_PREFIX}/users/{{user_uuid}}")
+    async def get_user(request: web.Request):
+        user = state.users.get(request.match_info["user_uuid"])
+        return web.json_response({"response": state.public_user(user)}) if user else _not_found()
+
+    @routes.delete(f"{API_PREFIX}/users/{{user_uuid}}")
+    async def delete_user(request: web.Request):
+        user = state.users.pop(request.match_info["user_uuid"], None)
+        if user is None:
+            return _not_found()
+        state.usernames.pop(user["username"], None)
+        state.short_uuids.pop(user["shortUuid"], None)
+        state.devices.pop(request.match_info["user_uuid"], None)
+        return web.json_response({"response": {"isDeleted": True}})
+
+    @routes.post(f"{API_PREFIX}/users/{{user_uuid}}/actions/reset-traffic")
+    async def reset_traffic(request: web.Request):
+        user = state.users.get(request.match_info["user_uuid"])
+        if user is None:
+            return _not_found()
+        user["usedTrafficBytes"] = 0
+        user["updatedAt"] = _now_iso()
+        return web.json_response({"response": state.public_user(user)})
+
+    @routes.post(f"{API_PREFIX}/users/{{user_uuid}}/actions/revoke-subscription")
+    async def revoke_subscription(request: web.Request):
+        user = state.users.get(request.match_info["user_uuid"])
+        if user is None:
+            return _not_found()
+        state.short_uuids.pop(user["shortUuid"], None)
+        user["shortUuid"] = secrets.token_urlsafe(12)
+        state.short_uuids[user["shortUuid"]] = user["uuid"]
+        user["updatedAt"] = _now_iso()
+        return web.json_response({"response": state.public_user(user)})
+
+    @routes.get(f"{API_PREFIX}/hwid/devices/{{user_uuid}}")
+    async def list_devices(request: web.Request):
+        devices = state.devices.get(request.match_info["user_uuid"], [])
+        return web.json_response({"response": {"devices": devices, "total": len(devices)}})
+
+    @routes.post(f"{API_PREFIX}/hwid/devices/delete")
+    async def delete_device(request: web.Request):
+        payload = await request.json()
+        devices = state.devices.get(str(payload.get("userUuid")), [])
+        devices[:] = [device for device in devices if device["hwid"] != payload.get("hwid")]
+        return web.json_response({"response": {"devices": devices, "total": len(devices)}})
+
+    @routes.post(f"{API_PREFIX}/hwid/devices/delete-all")
+    async def delete_all_devices(request: web.Request):
+        payload = await request.json()
+        state.devices.pop(str(payload.get("userUuid")), None)
+        return web.json_response({"response": {"devices": [], "total": 0}})
+
+    @routes.post(f"{API_PREFIX}/internal-squads/{{squad_uuid}}/bulk-actions/add-users")
+    async def add_to_squad(request: web.Request):
+        payload = await request.json()
+        for user_uuid in payload.get("userUuids") or []:
+            user = state.users.get(str(user_uuid))
+            if user is not None and request.match_info["squad_uuid"] not in user["activeInternalSquads"]:
+                user["activeInternalSquads"].append(request.match_info["squad_uuid"])
+        return web.json_response({"response": {"eventSent": True}})
+
+    @routes.get("/sub/{short_uuid}")
+    async def subscription_profile(request: web.Request):
+        user = state.by_short_uuid(request.match_info["short_uuid"])
+        if user is None:
+            return web.Response(status=404, text="Not found")
+        hwid = request.headers.get("x-hwid")
+        if hwid:
+            devices = state.devices.setdefault(user["uuid"], [])
+            if not any(device["hwid"] == hwid for device in devices):
+                limit = user.get("hwidDeviceLimit")
+                if limit is not None and len(devices) >= int(limit):
+                    return web.Response(
+                        status=404,
+                        headers={"x-hwid-max-devices-reached": str(limit), "x-hwid-active": str(len(devices))},
+                    )
+                devices.append({
+                    "hwid": hwid,
+                    "userUuid": user["uuid"],
+                    "platform": request.headers.get("x-device-os"),
+                    "osVersion": request.headers.get("x-ver-os"),
+                    "deviceModel": request.headers.get("x-device-model"),
+                    "userAgent": request.headers.get("user-agent"),
+                    "createdAt": _now_iso(),
+                    "updatedAt": _now_iso(),
+                })
+        lines = [
+            f"vless://{user['uuid']}@node{index}.example:443?security=reality#node-{index}"
+            for index in range(profile_nodes)
+        ]
+        body = base64.b64encode(("\n".join(lines) + "\n").encode())
+        return web.Response(body=body, content_type="text/plain")
+
+    app = web.Application(middlewares=[inject])
+    app.add_routes(routes)
+    app[STATE_KEY] = state
+    return app
+
+
+async def start_fake_remnawave(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    *,
+    ssl_context: ssl.SSLContext | None = None,
+    **app_options,
+) -> tuple[web.AppRunner, str]:
+    """Start the server in the current loop; returns (runner, base URL without /api)."""
+    app = create_app(**app_options)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, ssl_context=ssl_context)
+    await site.start()
+    bound_port = runner.addresses[0][1]
+    scheme = "https" if ssl_context else "http"
+    base_url = f"{scheme}://{host}:{bound_port}"
+    if not app[STATE_KEY].public_base_url:
+        app[STATE_KEY].public_base_url = base_url
+    return runner, base_url
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3010)
+    parser.add_argument("--api-token", default="fake-token", help="expected Bearer token; empty disables the check")
+    parser.add_argument("--public-base-url", default="", help="host used in subscriptionUrl (defaults to this server)")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--profile-nodes", type=int, default=20)
+    parser.add_argument("--tls-cert")
+    parser.add_argument("--tls-key")
+    return parser.parse_args()
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    ssl_context = None
+    if args.tls_cert and args.tls_key:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.tls_cert, args.tls_key)
+
+    runner, base_url = await start_fake_remnawave(
+        args.host,
+        args.port,
+        ssl_context=ssl_context,
+        faults=FaultInjection(
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            rate_limit_rate=args.rate_limit_rate,
+        ),
+        api_token=args.api_token or None,
+        public_base_url=args.public_base_url,
+        profile_nodes=args.profile_nodes,
+    )
+    print(f"Fake Remnawave listening on {base_url}{API_PREFIX}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main() -> None:
+    try:
+        asyncio.run(_serve(_parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Apply or inspect database migrations outside of bot startup.
+
+  python3 scripts/migrate.py status          list steps and whether they are applied
+  python3 scripts/migrate.py apply           apply pending steps
+  python3 scripts/migrate.py apply --force   also re-run repeatable steps
+
+Uses DATABASE_URL from the environment / .env like the bot itself. Run it
+before a deploy and start the bot with DB_MIGRATE_ON_STARTUP=false so a
+restart never takes schema locks on hot tables.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import database as db  # noqa: E402
+
+
+def _print_status(status: list[dict]) -> None:
+    header = f"{'version':>7}  {'name':<28}{'state':<12}{'applied at':<22}{'ms':>8}"
+    print(header)
+    print("-" * len(header))
+    for item in status:
+        state = "ok" if item["up_to_date"] else ("changed" if item["applied_at"] else "pending")
+        applied_at = item["applied_at"].strftime("%Y-%m-%d %H:%M:%S") if item["applied_at"] else "-"
+        duration = item["duration_ms"] if item["duration_ms"] is not None else "-"
+        print(f"{item['version']:>7}  {item['name']:<28}{state:<12}{applied_at:<22}{duration:>8}")
+
+
+async def _main(args: argparse.Namespace) -> int:
+    await db.init_db(migrate=False)
+    try:
+        if args.command == "apply":
+            applied = await db.run_migrations(force=args.force)
+            print(f"Applied: {', '.join(applied)}" if applied else "Schema is up to date")
+        _print_status(await db.migration_status())
+    finally:
+        await db.close_db()
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("status", "apply"))
+    parser.add_argument("--force", action="store_true", help="re-run repeatable steps even if unchanged")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    sys.exit(asyncio.run(_main(args)))
+
+
+if __name__ == "__main__":
+    main()
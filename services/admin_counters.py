@@ -0,0 +1,50 @@
+"""Периодическая сверка счётчиков дашборда с таблицами."""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+import database as db
+
+
+logger = logging.getLogger(__name__)
+
+ADMIN_COUNTERS_RECONCILE_INTERVAL = 3600
+
+_last_reconciliation: dict = {}
+
+
+def last_reconciliation() -> dict:
+    """Итог последней сверки: когда, сколько шла и что разошлось."""
+    return dict(_last_reconciliation)
+
+
+async def reconcile_admin_counters_now() -> dict:
+    started = time.monotonic()
+    drift = await db.reconcile_admin_counters()
+    _last_reconciliation.clear()
+    _last_reconciliation.update({
+        "finished_at": datetime.utcnow().isoformat(),
+        "duration_seconds": round(time.monotonic() - started, 3),
+        "drift": {
+            name: {key: float(value) for key, value in values.items()}
+            for name, values in drift.items()
+        },
+    })
+    if drift:
+        logger.warning("Admin counters drifted, fixed: %s", _last_reconciliation["drift"])
+    else:
+        logger.info("Admin counters reconciled without drift in %.2fs", _last_reconciliation["duration_seconds"])
+    return _last_reconciliation
+
+
+async def run_admin_counters_reconcile_loop():
+    while True:
+        await asyncio.sleep(ADMIN_COUNTERS_RECONCILE_INTERVAL)
+        try:
+            await reconcile_admin_counters_now()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Admin counters reconcile error: %s", e, exc_info=True)
@@ -0,0 +1,223 @@
+"""Фоновые массовые операции админа, продолжающиеся после рестарта."""
+
+import asyncio
+import html
+import logging
+import time
+from datetime import datetime
+
+import database as db
+from services.remnawave import remnawave_get_subscription_url, remnawave_revoke_subscription
+from services.traffic_resets import reset_bypass_traffic_now
+
+
+logger = logging.getLogger(__name__)
+
+ADMIN_JOB_CONCURRENCY = 5
+ADMIN_JOB_RATE_PER_SECOND = 10
+ADMIN_JOB_BATCH_SIZE = 50
+ADMIN_JOB_PROGRESS_INTERVAL = 5
+ADMIN_JOBS_POLL_INTERVAL = 30
+
+JOB_TITLES = {
+    "reissue_links": "Перевыпуск подписочных ссылок",
+    "reset_traffic": "Сброс трафика антиглушилок",
+}
+STATUS_TITLES = {
+    "pending": "в очереди",
+    "running": "идёт",
+    "done": "завершена",
+    "failed": "упала",
+    "cancelled": "отменена",
+}
+
+_running_jobs: dict[int, asyncio.Task] = {}
+_wakeup = asyncio.Event()
+
+
+class _RateLimiter:
+    """Равномерно разносит запросы: не чаще rate в секунду на задачу."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def _reissue_link(subscription) -> tuple[bool, str | None]:
+    if not subscription.get("remnawave_uuid"):
+        return False, "нет remnawave_uuid"
+    if not await remnawave_revoke_subscription(None, subscription["remnawave_uuid"]):
+        return False, "Remnawave не перевыпустил ссылку"
+    # None сбросит старую ссылку: её подтянет первое же чтение
+    new_url = await remnawave_get_subscription_url(None, subscription["remnawave_uuid"])
+    await db.set_subscription_url(subscription["id"], new_url)
+    return True, None
+
+
+async def _reset_traffic(subscription) -> tuple[bool, str | None]:
+    until = subscription.get("subscription_until")
+    if not subscription.get("traffic_enabled") or not until or until <= datetime.utcnow():
+        return False, "подписка больше не подходит для сброса"
+    return await reset_bypass_traffic_now(None, subscription)
+
+
+JOB_HANDLERS = {
+    "reissue_links": _reissue_link,
+    "reset_traffic": _reset_traffic,
+}
+
+
+def format_admin_job(job) -> str:
+    """Короткая сводка задачи для сообщения в боте."""
+    title = JOB_TITLES.get(job["kind"], job["kind"])
+    status = STATUS_TITLES.get(job["status"], job["status"])
+    scope = " (только активные)" if job["scope"] == "active" else ""
+    text = (
+        f"<b>#{job['id']} {title}{scope}</b> — {status}\n"
+        f"Прогресс: <b>{job['processed']}/{job['total']}</b>, "
+        f"успешно <b>{job['succeeded']}</b>, ошибок <b>{job['failed']}</b>"
+    )
+    if job.get("last_error"):
+        text += f"\nОшибка: <code>{html.escape(str(job['last_error'])[:200])}</code>"
+    return text
+
+
+async def enqueue_admin_job(
+    kind: str,
+    scope: str = "all",
+    *,
+    created_by: int | None = None,
+    notify_chat_id: int | None = None,
+    notify_message_id: int | None = None,
+):
+    """Создать задачу и разбудить обработчик.
+
+    Возвращает (задача, создана ли новая); если такая же задача ещё идёт,
+    возвращается она.
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown admin job kind: {kind}")
+    if scope not in {"all", "active"}:
+        raise ValueError(f"Unknown admin job scope: {scope}")
+    job, created = await db.create_admin_job(
+        kind,
+        scope,
+        created_by,
+        notify_chat_id=notify_chat_id,
+        notify_message_id=notify_message_id,
+    )
+    _wakeup.set()
+    return job, created
+
+
+async def _notify(bot, job, *, final: bool = False):
+    if bot is None or not job or not job.get("notify_chat_id") or not job.get("notify_message_id"):
+        return
+    text = ("✅ " if final and job["status"] == "done" else "🔁 ") + format_admin_job(job)
+    if final and job["status"] == "done" and job["failed"]:
+        failed = await db.get_failed_admin_job_items(job["id"], limit=20)
+        preview = ", ".join(str(item["subscription_id"]) for item in failed or [])
+        suffix = "..." if job["failed"] > 20 else ""
+        text += f"\n\nНе удалось для subscription id: <code>{preview}{suffix}</code>"
+    try:
+        await bot.edit_message_text(
+            text,
+            chat_id=job["notify_chat_id"],
+            message_id=job["notify_message_id"],
+        )
+    except Exception as e:
+        logger.debug("Admin job %s progress message not updated: %s", job["id"], e)
+
+
+async def run_admin_job(job_id: int, bot=None):
+    """Обработать все необработанные подписки задачи."""
+    job = await db.get_admin_job(job_id)
+    if not job or not await db.mark_admin_job_running(job_id):
+        return
+    handler = JOB_HANDLERS.get(job["kind"])
+    if handler is None:
+        await _notify(bot, await db.finish_admin_job(job_id, "failed", f"unknown kind {job['kind']}"), final=True)
+        return
+
+    semaphore = asyncio.Semaphore(ADMIN_JOB_CONCURRENCY)
+    limiter = _RateLimiter(ADMIN_JOB_RATE_PER_SECOND)
+
+    async def process(subscription_id: int):
+        async with semaphore:
+            await limiter.wait()
+            try:
+                subscription = await db.get_subscription_by_id(subscription_id)
+                if subscription is None:
+                    ok, error = False, "подписка удалена"
+                else:
+                    ok, error = await handler(dict(subscription))
+            except Exception as e:
+                logger.warning("Admin job %s failed for subscription %s: %s", job_id, subscription_id, e)
+                ok, error = False, str(e)[:500]
+            return await db.finish_admin_job_item(job_id, subscription_id, ok, error)
+
+    logger.info("Admin job %s (%s) started", job_id, job["kind"])
+    last_progress_at = time.monotonic()
+    try:
+        while True:
+            job = await db.get_admin_job(job_id)
+            if not job or job["status"] != "running":
+                logger.info("Admin job %s stopped with status %s", job_id, job["status"] if job else None)
+                await _notify(bot, job, final=True)
+                return
+            subscription_ids = await db.get_pending_admin_job_items(job_id, ADMIN_JOB_BATCH_SIZE)
+            if not subscription_ids:
+                break
+            await asyncio.gather(*(process(subscription_id) for subscription_id in subscription_ids))
+            if time.monotonic() - last_progress_at >= ADMIN_JOB_PROGRESS_INTERVAL:
+                last_progress_at = time.monotonic()
+                await _notify(bot, await db.get_admin_job(job_id))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error("Admin job %s crashed: %s", job_id, e, exc_info=True)
+        await _notify(bot, await db.finish_admin_job(job_id, "failed", str(e)[:500]), final=True)
+        return
+
+    job = await db.finish_admin_job(job_id, "done")
+    if job:
+        logger.info(
+            "Admin job %s (%s) finished: total=%s succeeded=%s failed=%s",
+            job_id,
+            job["kind"],
+            job["total"],
+            job["succeeded"],
+            job["failed"],
+        )
+    await _notify(bot, job, final=True)
+
+
+async def run_admin_jobs_loop(bot):
+    """Подхватывать новые задачи и продолжать прерванные рестартом."""
+    while True:
+        try:
+            for job in await db.get_resumable_admin_jobs() or []:
+                task = _running_jobs.get(job["id"])
+                if task is None or task.done():
+                    _running_jobs[job["id"]] = asyncio.create_task(run_admin_job(job["id"], bot))
+            for job_id in [job_id for job_id, task in _running_jobs.items() if task.done()]:
+                _running_jobs.pop(job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Admin jobs loop error: %s", e, exc_info=True)
+
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=ADMIN_JOBS_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
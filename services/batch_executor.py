@@ -0,0 +1,102 @@
+"""Пакетная обработка подписок в фоновых циклах."""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+import database as db
+from config import BACKGROUND_BATCH_SIZE, BACKGROUND_BATCH_WORKERS
+
+
+logger = logging.getLogger(__name__)
+
+_batch_stats: dict[str, dict] = {}
+
+
+def background_batch_stats() -> dict:
+    """Последний прогон каждого цикла: пачки, длительность, ошибки."""
+    return {name: dict(stats) for name, stats in _batch_stats.items()}
+
+
+async def run_subscription_batches(
+    name: str,
+    subscriptions,
+    handle,
+    *,
+    workers: int | None = None,
+    batch_size: int | None = None,
+    prefetch_device_addons: bool = True,
+) -> dict:
+    """Обработать подписки пачками.
+
+    subscriptions — список (режется по batch_size) или асинхронный итератор
+    готовых пачек. handle(subscription, active_device_addons) возвращает True при успехе;
+    False или исключение считаются ошибкой и попадают в статистику, а
+    подписка остаётся на следующий проход цикла. Без prefetch_device_addons
+    счётчик устройств не запрашивается и передаётся 0.
+    """
+    workers = max(1, workers or BACKGROUND_BATCH_WORKERS)
+    batch_size = max(1, batch_size or BACKGROUND_BATCH_SIZE)
+    semaphore = asyncio.Semaphore(workers)
+    stats = {
+        "started_at": datetime.utcnow().isoformat(),
+        "total": 0,
+        "succeeded": 0,
+        "failed": 0,
+        "batches": 0,
+        "duration_seconds": 0.0,
+        "max_batch_seconds": 0.0,
+    }
+    started = time.monotonic()
+
+    async def process(subscription, addon_counts) -> bool:
+        async with semaphore:
+            try:
+                return bool(await handle(subscription, addon_counts.get(subscription["id"], 0)))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("%s failed for subscription %s: %s", name, subscription.get("id"), e, exc_info=True)
+                return False
+
+    async for batch in _iter_batches(subscriptions, batch_size):
+        batch_started = time.monotonic()
+        addon_counts = (
+            await db.get_active_device_addon_counts([item["id"] for item in batch])
+            if prefetch_device_addons
+            else {}
+        )
+        results = await asyncio.gather(*(process(item, addon_counts) for item in batch))
+        batch_seconds = time.monotonic() - batch_started
+        failed = results.count(False)
+
+        stats["batches"] += 1
+        stats["total"] += len(batch)
+        stats["succeeded"] += len(batch) - failed
+        stats["failed"] += failed
+        stats["max_batch_seconds"] = round(max(stats["max_batch_seconds"], batch_seconds), 3)
+        logger.info(
+            "%s batch %s: size=%s failed=%s duration=%.2fs",
+            name,
+            stats["batches"],
+            len(batch),
+            failed,
+            batch_seconds,
+        )
+
+    stats["duration_seconds"] = round(time.monotonic() - started, 3)
+    if stats["total"]:
+        _batch_stats[name] = stats
+    return stats
+
+
+async def _iter_batches(subscriptions, batch_size: int):
+    if hasattr(subscriptions, "__aiter__"):
+        async for batch in subscriptions:
+            if batch:
+                yield list(batch)
+        return
+    subscriptions = list(subscriptions or [])
+    for offset in range(0, len(subscriptions), batch_size):
+        yield subscriptions[offset:offset + batch_size]
@@ -0,0 +1,274 @@
+"""Рассылки админа как задачи в БД: продолжаются после рестарта и остановки."""
+
+import asyncio
+import html
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+
+import database as db
+from config import BROADCAST_WORKERS, MINIAPP_URL, SUPPORT_URL
+from services.telegram_sender import PRIORITY_BULK, copy_telegram_message
+
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCASTS_POLL_INTERVAL = 30
+BROADCAST_RATE_WINDOW = 30  # секунд для оценки текущей скорости
+
+BROADCAST_BUTTONS = {
+    "buy_subscription": {"text": "💳 Купить / Продлить", "callback_data": "buy_subscription", "style": "success"},
+    "my_subscriptions": {"text": "🔐 Мои подписки", "callback_data": "my_subscriptions", "style": "primary"},
+    "buy_gb": {"text": "📦 Купить ГБ", "callback_data": "buy_gb", "style": "success"},
+    "miniapp": {"text": "📱 Личный кабинет", "web_app": MINIAPP_URL, "style": "primary"},
+    "how_to_connect": {"text": "📲 Инструкция", "callback_data": "how_to_connect", "style": "primary"},
+    "support": {"text": "🆘 Поддержка", "url": SUPPORT_URL, "style": "primary"},
+    "back_to_menu": {"text": "🏠 Главное меню", "callback_data": "back_to_menu", "style": "danger"},
+}
+
+BROADCAST_BUTTON_ORDER = (
+    "buy_subscription",
+    "my_subscriptions",
+    "buy_gb",
+    "miniapp",
+    "how_to_connect",
+    "support",
+    "back_to_menu",
+)
+
+STATUS_TITLES = {
+    "pending": "в очереди",
+    "running": "идёт",
+    "stopped": "остановлена",
+    "done": "завершена",
+    "failed": "упала",
+}
+
+_running_jobs: dict[int, asyncio.Task] = {}
+_recent_sends: dict[int, deque] = {}
+_wakeup = asyncio.Event()
+
+
+def _make_broadcast_button(key: str) -> InlineKeyboardButton:
+    spec = BROADCAST_BUTTONS[key]
+    kwargs = {"text": spec["text"], "style": spec["style"]}
+    if "callback_data" in spec:
+        kwargs["callback_data"] = spec["callback_data"]
+    if "url" in spec:
+        kwargs["url"] = spec["url"]
+    if "web_app" in spec:
+        kwargs["web_app"] = WebAppInfo(url=spec["web_app"])
+    return InlineKeyboardButton(**kwargs)
+
+
+def build_broadcast_user_keyboard(selected_buttons: list[str] | None) -> InlineKeyboardMarkup | None:
+    if not selected_buttons:
+        return None
+    rows = [[_make_broadcast_button(key)] for key in BROADCAST_BUTTON_ORDER if key in selected_buttons]
+    return InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+
+def classify_broadcast_exception(exc: Exception) -> tuple[str, float | None]:
+    """Классифицировать типовую ошибку Telegram при рассылке."""
+    if isinstance(exc, TelegramRetryAfter):
+        retry_after = float(getattr(exc, "retry_after", 1.0) or 1.0)
+        return "rate_limited", retry_after
+
+    if isinstance(exc, TelegramForbiddenError):
+        error_msg = str(exc).lower()
+        if "blocked" in error_msg or "deactivated" in error_msg:
+            return "blocked", None
+        return "unreachable", None
+
+    if isinstance(exc, TelegramBadRequest):
+        error_msg = str(exc).lower()
+        if (
+            "chat not found" in error_msg
+            or "user not found" in error_msg
+            or "private chat not found" in error_msg
+            or "have no rights to send a message" in error_msg
+            or "can't initiate conversation" in error_msg
+            or "bot can't initiate conversation" in error_msg
+            or "peers not found" in error_msg
+        ):
+            return "unreachable", None
+
+    error_msg = str(exc).lower()
+    if "429" in error_msg or "too many requests" in error_msg:
+        return "rate_limited", 1.0
+    if "blocked" in error_msg or "user is deactivated" in error_msg or "bot was blocked" in error_msg:
+        return "blocked", None
+    if "chat not found" in error_msg or "can't initiate conversation" in error_msg:
+        return "unreachable", None
+
+    return "error", None
+
+
+def broadcast_rate(job_id: int) -> float:
+    """Сообщений в секунду за последние BROADCAST_RATE_WINDOW секунд."""
+    recent = _recent_sends.get(job_id)
+    if not recent or len(recent) < 2:
+        return 0.0
+    span = recent[-1] - recent[0]
+    return round((len(recent) - 1) / span, 1) if span > 0 else 0.0
+
+
+def _record_send(job_id: int) -> None:
+    now = time.monotonic()
+    recent = _recent_sends.setdefault(job_id, deque())
+    recent.append(now)
+    while recent and recent[0] < now - BROADCAST_RATE_WINDOW:
+        recent.popleft()
+
+
+def format_broadcast_job(job) -> str:
+    """Короткая сводка рассылки для сообщения в боте."""
+    audience = "без подписки" if job["mode"] == "no_sub" else "всем"
+    status = STATUS_TITLES.get(job["status"], job["status"])
+    processed = job["sent"] + job["blocked"] + job["unreachable"] + job["errors"]
+    text = (
+        f"<b>#{job['id']} Рассылка {audience}</b> — {status}\n"
+        f"Прогресс: <b>{processed}/{job['total']}</b>, "
+        f"отправлено <b>{job['sent']}</b>, заблокировали <b>{job['blocked']}</b>, "
+        f"недоступно <b>{job['unreachable']}</b>, ошибок <b>{job['errors']}</b>"
+    )
+    rate = broadcast_rate(job["id"])
+    if job["status"] == "running" and rate:
+        remaining = max(job["total"] - processed, 0)
+        text += f"\nСкорость: <b>{rate:.1f}/с</b>, осталось ~<b>{int(remaining / rate // 60)} мин</b>"
+    if job.get("last_error"):
+        text += f"\nОшибка: <code>{html.escape(str(job['last_error'])[:200])}</code>"
+    return text
+
+
+def broadcast_job_keyboard(job) -> InlineKeyboardMarkup | None:
+    if job["status"] in ("pending", "running"):
+        button = InlineKeyboardButton(text="⛔ Остановить рассылку", callback_data=f"broadcast_stop:{job['id']}", style="danger")
+    elif job["status"] in ("stopped", "failed"):
+        button = InlineKeyboardButton(text="▶️ Продолжить рассылку", callback_data=f"broadcast_resume:{job['id']}", style="success")
+    else:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[[button]])
+
+
+def wake_broadcasts() -> None:
+    """Разбудить обработчик: новая или продолженная рассылка."""
+    _wakeup.set()
+
+
+async def _notify(bot, job):
+    if bot is None or not job or not job.get("notify_chat_id") or not job.get("notify_message_id"):
+        return
+    prefix = "✅ " if job["status"] == "done" else "📤 "
+    try:
+        await bot.edit_message_text(
+            prefix + format_broadcast_job(job),
+            chat_id=job["notify_chat_id"],
+            message_id=job["notify_message_id"],
+            reply_markup=broadcast_job_keyboard(job),
+        )
+    except Exception as e:
+        logger.debug("Broadcast %s progress message not updated: %s", job["id"], e)
+
+
+async def _deliver(bot, job, tg_id: int, reply_markup) -> tuple[str, str | None]:
+    try:
+        await copy_telegram_message(
+            bot,
+            tg_id,
+            job["source_chat_id"],
+            job["source_message_id"],
+            reply_markup=reply_markup,
+            priority=PRIORITY_BULK,
+        )
+        return "sent", None
+    except Exception as e:
+        status, _ = classify_broadcast_exception(e)
+        # retry_after уже выдержан отправителем; раз не помогло — это ошибка
+        return ("error" if status == "rate_limited" else status), str(e)[:300]
+
+
+async def run_broadcast_job(job_id: int, bot):
+    """Разослать сообщение всем необработанным получателям задачи."""
+    job = await db.get_broadcast_job(job_id)
+    if not job or not await db.mark_broadcast_job_running(job_id):
+        return
+    reply_markup = build_broadcast_user_keyboard(list(job["buttons"] or []))
+    semaphore = asyncio.Semaphore(BROADCAST_WORKERS)
+    cursor = job["cursor_tg_id"]
+
+    async def process(tg_id: int):
+        async with semaphore:
+            outcome, error = await _deliver(bot, job, tg_id, reply_markup)
+            if outcome == "sent":
+                _record_send(job_id)
+            elif outcome == "error":
+                logger.warning("Broadcast %s failed for user %s: %s", job_id, tg_id, error)
+            await db.record_broadcast_outcome(job_id, tg_id, outcome, error)
+
+    logger.info("Broadcast %s (%s) started from tg_id > %s", job_id, job["mode"], cursor)
+    last_progress_at = time.monotonic()
+    try:
+        while True:
+            job = await db.get_broadcast_job(job_id)
+            if not job or job["status"] != "running":
+                logger.info("Broadcast %s stopped with status %s", job_id, job["status"] if job else None)
+                await _notify(bot, job)
+                return
+            recipients = await db.get_broadcast_batch(job_id, cursor, BROADCAST_BATCH_SIZE)
+            if not recipients:
+                break
+            await asyncio.gather(*(process(tg_id) for tg_id in recipients))
+            cursor = recipients[-1]
+            job = await db.checkpoint_broadcast_job(job_id, cursor)
+            if time.monotonic() - last_progress_at >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress_at = time.monotonic()
+                await _notify(bot, job)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error("Broadcast %s crashed: %s", job_id, e, exc_info=True)
+        await _notify(bot, await db.finish_broadcast_job(job_id, "failed", str(e)[:500]))
+        return
+    finally:
+        _recent_sends.pop(job_id, None)
+
+    job = await db.finish_broadcast_job(job_id, "done")
+    if job:
+        logger.info(
+            "Broadcast %s finished: total=%s sent=%s blocked=%s unreachable=%s errors=%s",
+            job_id,
+            job["total"],
+            job["sent"],
+            job["blocked"],
+            job["unreachable"],
+            job["errors"],
+        )
+    await _notify(bot, job)
+
+
+async def run_broadcasts_loop(bot):
+    """Подхватывать новые рассылки и продолжать прерванные рестартом."""
+    while True:
+        try:
+            for job in await db.get_resumable_broadcast_jobs() or []:
+                task = _running_jobs.get(job["id"])
+                if task is None or task.done():
+                    _running_jobs[job["id"]] = asyncio.create_task(run_broadcast_job(job["id"], bot))
+            for job_id in [job_id for job_id, task in _running_jobs.items() if task.done()]:
+                _running_jobs.pop(job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Broadcasts loop error: %s", e, exc_info=True)
+
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=BROADCASTS_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
@@ -62,6 +62,7 @@ async def create_cryptobot_invoice(
 
         timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
 
+        await db.release_bound_connection()
         async with aiohttp.ClientSession(timeout=timeout) as session:
             async with session.post(url, headers=headers, json=payload) as resp:
                 if resp.status == 200:
@@ -94,6 +95,7 @@ async def get_invoice_status(invoice_id: str) -> dict | None:
     async def _get_status():
         timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
 
+        await db.release_bound_connection()
         async with aiohttp.ClientSession(timeout=timeout) as session:
             headers = {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
             url = f"{CRYPTOBOT_API_URL}/getInvoices"
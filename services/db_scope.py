@@ -0,0 +1,34 @@
+"""Привязка соединения БД к апдейту Telegram и HTTP-запросу."""
+
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from fastapi import Request
+
+import database as db
+
+
+class DatabaseScopeMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: одно соединение на апдейт."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        async with db.connection_scope():
+            return await handler(event, data)
+
+
+async def database_scope(request: Request):
+    """Зависимость FastAPI: одно соединение на HTTP-запрос.
+
+    Вебхуки оплат и порождённая ими выдача подписки идут в пул payments,
+    чтобы поток апдейтов бота не задерживал подтверждение оплаты.
+    """
+    name = "payments" if request.url.path.startswith("/webhook/") else "interactive"
+    with db.workload(name):
+        async with db.connection_scope():
+            yield
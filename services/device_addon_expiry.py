@@ -1,9 +1,8 @@
 import asyncio
 import logging
 
-import aiohttp
-
 import database as db
+from services.batch_executor import run_subscription_batches
 from services.device_addons import effective_device_limit
 from services.remnawave import remnawave_update_user_profile
 
@@ -13,32 +12,28 @@ DEVICE_ADDON_EXPIRY_CHECK_INTERVAL = 900
 
 
 async def process_expired_device_addons_once() -> None:
-    subscriptions = await db.get_subscriptions_with_expired_device_addons()
-    if not subscriptions:
-        return
-
-    connector = aiohttp.TCPConnector()
-    timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        for subscription in subscriptions:
-            subscription_id = subscription["id"]
-            active_addons = await db.get_active_device_addon_count(subscription_id)
-            new_limit = effective_device_limit(subscription.get("plan_kind"), active_addons)
-            try:
-                updated = await remnawave_update_user_profile(
-                    session,
-                    subscription["remnawave_uuid"],
-                    hwid_device_limit=new_limit,
-                    telegram_id=subscription["tg_id"] if subscription["tg_id"] > 0 else None,
-                )
-                if not updated:
-                    logger.warning("Could not sync expired device add-ons for subscription %s", subscription_id)
-                    continue
-                await db.set_subscription_device_limit(subscription_id, new_limit)
-                await db.mark_expired_device_addons_processed(subscription_id)
-                logger.info("Expired device add-ons processed for subscription %s, limit=%s", subscription_id, new_limit)
-            except Exception as exc:
-                logger.error("Device add-on expiry processing failed for subscription %s: %s", subscription_id, exc, exc_info=True)
+    async def recalc_limit(subscription, active_addons):
+        subscription_id = subscription["id"]
+        new_limit = effective_device_limit(subscription.get("plan_kind"), active_addons)
+        updated = await remnawave_update_user_profile(
+            None,
+            subscription["remnawave_uuid"],
+            hwid_device_limit=new_limit,
+            telegram_id=subscription["tg_id"] if subscription["tg_id"] > 0 else None,
+        )
+        if not updated:
+            logger.warning("Could not sync expired device add-ons for subscription %s", subscription_id)
+            return False
+        await db.set_subscription_device_limit(subscription_id, new_limit)
+        await db.mark_expired_device_addons_processed(subscription_id)
+        logger.info("Expired device add-ons processed for subscription %s, limit=%s", subscription_id, new_limit)
+        return True
+
+    await run_subscription_batches(
+        "device_addon_expiry",
+        db.iter_subscriptions_with_expired_device_addons(),
+        recalc_limit,
+    )
 
 
 async def run_device_addon_expiry_loop() -> None:
@@ -1,4 +1,6 @@
 import aiohttp
+import asyncio
+import contextlib
 import hmac
 import json
 import logging
@@ -6,7 +8,9 @@ import re
 import secrets
 import ssl
 import string
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from urllib.parse import quote, urlsplit, urlunsplit
 from config import (
@@ -16,18 +20,349 @@ from config import (
     API_REQUEST_TIMEOUT,
     SUBSCRIPTION_PUBLIC_BASE_URL,
     REMNAWAVE_CA_BUNDLE,
+    REMNAWAVE_POOL_LIMIT,
+    REMNAWAVE_POOL_LIMIT_PER_HOST,
+    REMNAWAVE_KEEPALIVE_TIMEOUT,
+    REMNAWAVE_DNS_CACHE_TTL,
+    REMNAWAVE_USER_INFO_CACHE_TTL,
+    REMNAWAVE_USER_INFO_STALE_TTL,
+    REMNAWAVE_USER_INFO_CACHE_SIZE,
+    REMNAWAVE_USER_INFO_FALLBACK_TTL,
+    REMNAWAVE_BREAKER_FAILURES,
+    REMNAWAVE_BREAKER_OPEN_SECONDS,
+    REMNAWAVE_CONCURRENCY_MIN,
+    REMNAWAVE_CONCURRENCY_MAX,
+    REMNAWAVE_LATENCY_TARGET,
+    REMNAWAVE_QUEUE_TIMEOUT,
 )
-from utils import retry_with_backoff, safe_api_call
+import database as db
+from utils import NonRetryableError, retry_with_backoff, safe_api_call
 
 
 MAX_SUBSCRIPTION_PROFILE_BYTES = 4 * 1024 * 1024
 SUBSCRIPTION_SHORT_UUID_RE = re.compile(r"^[A-Za-z0-9_-]{8,128}$")
 
 
-def _verified_connector() -> aiohttp.TCPConnector:
+_ssl_context: ssl.SSLContext | None = None
+_client_session: aiohttp.ClientSession | None = None
+_client_loop: asyncio.AbstractEventLoop | None = None
+_closing_sessions: set[asyncio.Task] = set()
+
+
+def _verified_ssl_context() -> ssl.SSLContext:
     """TLS всегда проверяется; частный CA разрешён только явным bundle."""
-    context = ssl.create_default_context(cafile=REMNAWAVE_CA_BUNDLE or None)
-    return aiohttp.TCPConnector(ssl=context)
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context(cafile=REMNAWAVE_CA_BUNDLE or None)
+    return _ssl_context
+
+
+def _verified_connector() -> aiohttp.TCPConnector:
+    return aiohttp.TCPConnector(
+        ssl=_verified_ssl_context(),
+        limit=REMNAWAVE_POOL_LIMIT,
+        limit_per_host=REMNAWAVE_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=REMNAWAVE_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=REMNAWAVE_DNS_CACHE_TTL,
+    )
+
+
+def get_remnawave_session() -> aiohttp.ClientSession:
+    """Общий клиент Remnawave: keep-alive пул, один TLS context и DNS-кеш на процесс."""
+    global _client_session, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client_session is None or _client_session.closed or _client_loop is not loop:
+        if _client_session is not None and not _client_session.closed:
+            # Клиент остался от прошлого event loop (повторный asyncio.run):
+            # закрываем его пул здесь, иначе соединения висят до выхода
+            task = loop.create_task(_client_session.close())
+            _closing_sessions.add(task)
+            task.add_done_callback(_closing_sessions.discard)
+        _client_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT),
+            connector=_verified_connector(),
+        )
+        _client_loop = loop
+        logging.info("✅ Remnawave HTTP client initialized")
+    return _client_session
+
+
+class RemnawaveUnavailableError(NonRetryableError, RuntimeError):
+    """Панель деградировала: запрос отклонён без обращения к сети."""
+
+
+class _CircuitBreaker:
+    """closed → open после N ошибок подряд → half_open (один пробный запрос) → closed."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def before_request(self) -> None:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < REMNAWAVE_BREAKER_OPEN_SECONDS:
+                self.rejected += 1
+                raise RemnawaveUnavailableError(f"Remnawave circuit is open for {self.name}")
+            self.state = "half_open"
+            self.probe_in_flight = False
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                self.rejected += 1
+                raise RemnawaveUnavailableError(f"Remnawave circuit is half-open for {self.name}")
+            self.probe_in_flight = True
+
+    def record(self, ok: bool | None) -> None:
+        """ok=None — запрос прерван без ответа (отмена), результат не учитываем."""
+        if self.state == "half_open":
+            self.probe_in_flight = False
+        if ok is None:
+            return
+        if ok:
+            if self.state != "closed":
+                logging.info("✅ Remnawave circuit closed for %s", self.name)
+            self.state = "closed"
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= REMNAWAVE_BREAKER_FAILURES:
+            if self.state != "open":
+                self.times_opened += 1
+                logging.warning("⚠️ Remnawave circuit opened for %s after %s failures", self.name, self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+class _AdaptiveLimiter:
+    """AIMD-ограничение параллельных запросов к панели.
+
+    Быстрый успешный ответ увеличивает лимит на 1/limit (≈ +1 за «окно»),
+    ошибка или ответ медленнее REMNAWAVE_LATENCY_TARGET уменьшает его вдвое.
+    """
+
+    def __init__(self):
+        self.limit = float(REMNAWAVE_CONCURRENCY_MAX)
+        self.in_flight = 0
+        self.rejected = 0
+        self._waiters: list[asyncio.Future] = []
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # Слот передаёт освободивший его запрос (см. _wake).
+            await asyncio.wait_for(waiter, REMNAWAVE_QUEUE_TIMEOUT)
+        except BaseException as exc:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                # Слот успели выдать одновременно с отменой — возвращаем его.
+                self.in_flight -= 1
+                self._wake()
+            if isinstance(exc, asyncio.TimeoutError):
+                self.rejected += 1
+                raise RemnawaveUnavailableError("Remnawave concurrency limit saturated") from None
+            raise
+
+    def release(self, ok: bool | None, latency: float) -> None:
+        self.in_flight -= 1
+        if ok is True and latency <= REMNAWAVE_LATENCY_TARGET:
+            self.limit = min(float(REMNAWAVE_CONCURRENCY_MAX), self.limit + 1 / self.limit)
+        elif ok is not None:
+            self.limit = max(float(REMNAWAVE_CONCURRENCY_MIN), self.limit / 2)
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+        }
+
+
+_UUID_SEGMENT_RE = re.compile(r"^[0-9a-fA-F-]{32,36}$")
+_breakers: dict[str, _CircuitBreaker] = {}
+_limiter = _AdaptiveLimiter()
+
+
+def _endpoint_name(method: str, url: str) -> str:
+    """Шаблон эндпоинта без UUID/имён, чтобы breaker был один на тип запроса."""
+    path = urlsplit(url).path
+    base_path = urlsplit(REMNAWAVE_BASE_URL).path.rstrip("/")
+    if base_path and path.startswith(base_path):
+        path = path[len(base_path):]
+    parts = []
+    previous = None
+    for part in (item for item in path.split("/") if item):
+        if _UUID_SEGMENT_RE.fullmatch(part) or previous in ("by-username", "by-short-uuid"):
+            parts.append("{id}")
+        else:
+            parts.append(part)
+        previous = part
+    return f"{method.upper()} /{'/'.join(parts)}"
+
+
+@contextlib.asynccontextmanager
+async def _remnawave_request(method: str, url: str, *, endpoint: str | None = None, limited: bool = True, **kwargs):
+    """Запрос через общий клиент с circuit breaker и адаптивным лимитом параллелизма."""
+    await db.release_bound_connection()
+    name = endpoint or _endpoint_name(method, url)
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = _CircuitBreaker(name)
+    breaker.before_request()
+    if limited:
+        try:
+            await _limiter.acquire()
+        except BaseException:
+            breaker.record(None)
+            raise
+
+    ok = None
+    started_at = time.monotonic()
+    try:
+        client = get_remnawave_session()
+        try:
+            async with getattr(client, method)(url, **kwargs) as resp:
+                ok = resp.status < 500 and resp.status != 429
+                yield resp
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if ok is None:
+                ok = False
+            raise
+    finally:
+        breaker.record(ok)
+        if limited:
+            _limiter.release(ok, time.monotonic() - started_at)
+
+
+def remnawave_is_degraded() -> bool:
+    return any(breaker.state != "closed" for breaker in _breakers.values())
+
+
+def remnawave_resilience_stats() -> dict:
+    """Состояние circuit breaker'ов и текущий лимит параллелизма."""
+    return {
+        "limiter": _limiter.snapshot(),
+        "breakers": {name: breaker.snapshot() for name, breaker in sorted(_breakers.items())},
+    }
+
+
+# Кеш GET /users/{uuid}: uuid -> (monotonic время записи, данные или None-метка инвалидации).
+# Метка инвалидации не даёт фоновому обновлению, начатому до изменения, записать старые данные.
+_user_info_cache: OrderedDict[str, tuple[float, dict | None]] = OrderedDict()
+_user_info_refreshes: dict[str, asyncio.Task] = {}
+_user_info_cache_stats = {"hits": 0, "stale_hits": 0, "misses": 0, "fallbacks": 0, "invalidations": 0}
+
+
+def _user_info_cache_put(key: str, stored_at: float, data: dict | None) -> None:
+    _user_info_cache[key] = (stored_at, data)
+    _user_info_cache.move_to_end(key)
+    while len(_user_info_cache) > REMNAWAVE_USER_INFO_CACHE_SIZE:
+        _user_info_cache.popitem(last=False)
+
+
+def _user_info_cache_store(key: str, started_at: float, data: dict) -> None:
+    current = _user_info_cache.get(key)
+    if current is not None and current[0] > started_at:
+        # Запись изменили или инвалидировали, пока шёл запрос.
+        return
+    _user_info_cache_put(key, time.monotonic(), data)
+
+
+def invalidate_remnawave_user_info(user_uuid: str) -> None:
+    """Сбросить кешированную информацию пользователя после изменения в Remnawave."""
+    _user_info_cache_stats["invalidations"] += 1
+    _user_info_cache_put(str(user_uuid), time.monotonic(), None)
+    _forget_inflight(user_uuid, "user_info", "subscription_url")
+
+
+def remnawave_user_info_cache_stats() -> dict:
+    """Счётчики кеша user info для подбора TTL."""
+    lookups = _user_info_cache_stats["hits"] + _user_info_cache_stats["stale_hits"] + _user_info_cache_stats["misses"]
+    served = _user_info_cache_stats["hits"] + _user_info_cache_stats["stale_hits"]
+    return {
+        **_user_info_cache_stats,
+        "size": sum(1 for _, data in _user_info_cache.values() if data is not None),
+        "refreshing": len(_user_info_refreshes),
+        "hit_ratio": round(served / lookups, 4) if lookups else None,
+        "ttl_seconds": REMNAWAVE_USER_INFO_CACHE_TTL,
+        "stale_ttl_seconds": REMNAWAVE_USER_INFO_STALE_TTL,
+        "max_size": REMNAWAVE_USER_INFO_CACHE_SIZE,
+    }
+
+
+# Single-flight: одновременные чтения одного (endpoint, uuid) делят один запрос.
+_inflight_requests: dict[tuple[str, str], asyncio.Task] = {}
+_coalescing_stats: dict[str, dict[str, int]] = {}
+
+
+async def _single_flight(endpoint: str, user_uuid: str, fetch):
+    key = (endpoint, str(user_uuid))
+    stats = _coalescing_stats.setdefault(endpoint, {"calls": 0, "deduplicated": 0})
+    stats["calls"] += 1
+    task = _inflight_requests.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch(str(user_uuid)))
+        _inflight_requests[key] = task
+
+        def _forget(done, key=key):
+            if _inflight_requests.get(key) is done:
+                del _inflight_requests[key]
+
+        task.add_done_callback(_forget)
+    else:
+        stats["deduplicated"] += 1
+    # shield: отмена одного ожидающего не отменяет общий запрос для остальных.
+    return await asyncio.shield(task)
+
+
+def _forget_inflight(user_uuid: str, *endpoints: str) -> None:
+    """После изменения новые чтения не должны присоединяться к запросу, начатому до него."""
+    for endpoint in endpoints:
+        _inflight_requests.pop((endpoint, str(user_uuid)), None)
+
+
+def remnawave_coalescing_stats() -> dict:
+    """Сколько чтений Remnawave было объединено с уже идущим запросом."""
+    return {
+        "endpoints": {name: dict(values) for name, values in _coalescing_stats.items()},
+        "deduplicated": sum(values["deduplicated"] for values in _coalescing_stats.values()),
+        "in_flight": len(_inflight_requests),
+    }
+
+
+async def close_remnawave_session() -> None:
+    """Закрыть общий клиент Remnawave при остановке процесса."""
+    global _client_session, _client_loop
+    client, _client_session, _client_loop = _client_session, None, None
+    if client is not None and not client.closed:
+        await client.close()
+        logging.info("✅ Remnawave HTTP client closed")
 
 
 def extract_public_subscription_short_uuid(sub_url: str) -> str:
@@ -75,15 +410,13 @@ async def remnawave_resolve_user_uuid_by_short_uuid(short_uuid: str) -> str | No
         return None
     url = f"{REMNAWAVE_BASE_URL.rstrip('/')}/users/by-short-uuid/{quote(short_uuid, safe='')}"
     headers = {"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
-    timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
     try:
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as session:
-            async with session.get(url, headers=headers, allow_redirects=False) as response:
-                if response.status == 404:
-                    return None
-                if response.status != 200:
-                    raise RuntimeError("Remnawave rejected subscription credential validation")
-                data = await response.json()
+        async with _remnawave_request("get", url, headers=headers, allow_redirects=False) as response:
+            if response.status == 404:
+                return None
+            if response.status != 200:
+                raise RuntimeError("Remnawave rejected subscription credential validation")
+            data = await response.json()
     except (aiohttp.ClientError, TimeoutError, ValueError) as exc:
         raise RuntimeError("Remnawave subscription credential validation failed") from exc
     user = data.get("response") if isinstance(data, dict) else None
@@ -103,24 +436,29 @@ async def remnawave_fetch_subscription_profile(sub_url: str, device_headers: dic
         for name in ("x-hwid", "x-device-os", "x-ver-os", "x-device-model", "user-agent")
         if device_headers.get(name)
     }
-    timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-    async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as session:
-        async with session.get(safe_url, headers=forwarded, allow_redirects=False) as resp:
-            if resp.content_length and resp.content_length > MAX_SUBSCRIPTION_PROFILE_BYTES:
-                raise RuntimeError("Subscription profile is too large")
-            body = await resp.content.read(MAX_SUBSCRIPTION_PROFILE_BYTES + 1)
-            if len(body) > MAX_SUBSCRIPTION_PROFILE_BYTES:
-                raise RuntimeError("Subscription profile is too large")
-            return {
-                "status": resp.status,
-                "body": body,
-                "content_type": resp.headers.get("Content-Type", "text/plain; charset=utf-8"),
-                "headers": {
-                    key.lower(): value
-                    for key, value in resp.headers.items()
-                    if key.lower().startswith("x-hwid-")
-                },
-            }
+    async with _remnawave_request(
+        "get",
+        safe_url,
+        endpoint="subscription_profile",
+        limited=False,
+        headers=forwarded,
+        allow_redirects=False,
+    ) as resp:
+        if resp.content_length and resp.content_length > MAX_SUBSCRIPTION_PROFILE_BYTES:
+            raise RuntimeError("Subscription profile is too large")
+        body = await resp.content.read(MAX_SUBSCRIPTION_PROFILE_BYTES + 1)
+        if len(body) > MAX_SUBSCRIPTION_PROFILE_BYTES:
+            raise RuntimeError("Subscription profile is too large")
+        return {
+            "status": resp.status,
+            "body": body,
+            "content_type": resp.headers.get("Content-Type", "text/plain; charset=utf-8"),
+            "headers": {
+                key.lower(): value
+                for key, value in resp.headers.items()
+                if key.lower().startswith("x-hwid-")
+            },
+        }
 
 
 def normalize_subscription_url(sub_url: str | None) -> str | None:
@@ -189,20 +527,18 @@ async def remnawave_get_or_create_user(
         url = f"{REMNAWAVE_BASE_URL}/users/by-username/{remna_username}"
         headers = {"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
 
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.get(url, headers=headers) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    user_data = data.get("response", {})
-                    uuid = user_data.get("uuid")
-                    if uuid:
-                        return uuid
-                elif resp.status == 404:
-                    return None  # Пользователь не существует
-                else:
-                    error_text = await resp.text()
-                    raise RuntimeError(f"Remnawave HTTP {resp.status}: {error_text}")
+        async with _remnawave_request("get", url, headers=headers) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                user_data = data.get("response", {})
+                uuid = user_data.get("uuid")
+                if uuid:
+                    return uuid
+            elif resp.status == 404:
+                return None  # Пользователь не существует
+            else:
+                error_text = await resp.text()
+                raise RuntimeError(f"Remnawave HTTP {resp.status}: {error_text}")
 
     try:
         uuid = await retry_with_backoff(_get_existing_user, max_attempts=2)
@@ -258,21 +594,19 @@ async def remnawave_get_or_create_user(
             "Content-Type": "application/json"
         }
 
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.post(create_url, headers=headers, json=payload) as resp:
-                if resp.status in (200, 201):
-                    data = await resp.json()
-                    user_data = data.get("response", {})
-                    uuid = user_data.get("uuid")
-                    if uuid:
-                        logging.info(f"Created new Remnawave user: {remna_username}")
-                        return uuid
-                    else:
-                        raise RuntimeError("No UUID in response")
+        async with _remnawave_request("post", create_url, headers=headers, json=payload) as resp:
+            if resp.status in (200, 201):
+                data = await resp.json()
+                user_data = data.get("response", {})
+                uuid = user_data.get("uuid")
+                if uuid:
+                    logging.info(f"Created new Remnawave user: {remna_username}")
+                    return uuid
                 else:
-                    error_text = await resp.text()
-                    raise RuntimeError(f"Remnawave HTTP {resp.status}: {error_text}")
+                    raise RuntimeError("No UUID in response")
+            else:
+                error_text = await resp.text()
+                raise RuntimeError(f"Remnawave HTTP {resp.status}: {error_text}")
 
     try:
         uuid = await safe_api_call(
@@ -322,34 +656,34 @@ async def remnawave_update_user_profile(
         payload["telegramId"] = telegram_id
 
     async def _update():
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.patch(
-                f"{REMNAWAVE_BASE_URL}/users",
-                headers={
-                    "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
-                    "Content-Type": "application/json"
-                },
-                json=payload
-            ) as resp:
-                if resp.status == 200:
+        async with _remnawave_request(
+            "patch",
+            f"{REMNAWAVE_BASE_URL}/users",
+            headers={
+                "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
+                "Content-Type": "application/json"
+            },
+            json=payload
+        ) as resp:
+            if resp.status == 200:
+                return True
+            error_text = await resp.text()
+            if missing_user_is_success and resp.status == 404:
+                try:
+                    error_data = json.loads(error_text)
+                except (TypeError, ValueError):
+                    error_data = {}
+                if error_data.get("errorCode") == "A025":
+                    logging.info(
+                        "Remnawave user %s is already absent; profile cleanup is complete",
+                        user_uuid,
+                    )
                     return True
-                error_text = await resp.text()
-                if missing_user_is_success and resp.status == 404:
-                    try:
-                        error_data = json.loads(error_text)
-                    except (TypeError, ValueError):
-                        error_data = {}
-                    if error_data.get("errorCode") == "A025":
-                        logging.info(
-                            "Remnawave user %s is already absent; profile cleanup is complete",
-                            user_uuid,
-                        )
-                        return True
-                raise RuntimeError(f"Update user failed ({resp.status}): {error_text}")
+            raise RuntimeError(f"Update user failed ({resp.status}): {error_text}")
 
     try:
         result = await safe_api_call(_update, error_message=f"Failed to update Remnawave user {user_uuid}")
+        invalidate_remnawave_user_info(user_uuid)
         return result is not None
     except Exception as e:
         logging.error(f"Update Remnawave user profile error: {e}")
@@ -359,41 +693,41 @@ async def remnawave_update_user_profile(
 async def remnawave_delete_user(session: aiohttp.ClientSession, user_uuid: str) -> bool:
     """Физически удалить пользователя из Remnawave."""
     async def _delete():
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.delete(
-                f"{REMNAWAVE_BASE_URL}/users/{user_uuid}",
-                headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"},
-            ) as resp:
-                if resp.status in (200, 201, 204):
-                    if resp.status != 204:
-                        data = {}
-                        if resp.content_length != 0:
-                            try:
-                                data = await resp.json(content_type=None)
-                            except Exception:
-                                data = {}
-                        response = data.get("response", data) if isinstance(data, dict) else {}
-                        deleted_flag = None
-                        for key in ("isDeleted", "is_deleted", "deleted"):
-                            if isinstance(response, dict) and key in response:
-                                deleted_flag = response[key]
-                                break
-                            if isinstance(data, dict) and key in data:
-                                deleted_flag = data[key]
-                                break
-                        if deleted_flag is False:
-                            raise RuntimeError(f"Delete user returned false: {data}")
-                    logging.info("Deleted Remnawave user %s", user_uuid)
-                    return True
-                if resp.status == 404:
-                    logging.info("Remnawave user %s already deleted", user_uuid)
-                    return True
-                error_text = await resp.text()
-                raise RuntimeError(f"Delete user failed ({resp.status}): {error_text}")
+        async with _remnawave_request(
+            "delete",
+            f"{REMNAWAVE_BASE_URL}/users/{user_uuid}",
+            headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"},
+        ) as resp:
+            if resp.status in (200, 201, 204):
+                if resp.status != 204:
+                    data = {}
+                    if resp.content_length != 0:
+                        try:
+                            data = await resp.json(content_type=None)
+                        except Exception:
+                            data = {}
+                    response = data.get("response", data) if isinstance(data, dict) else {}
+                    deleted_flag = None
+                    for key in ("isDeleted", "is_deleted", "deleted"):
+                        if isinstance(response, dict) and key in response:
+                            deleted_flag = response[key]
+                            break
+                        if isinstance(data, dict) and key in data:
+                            deleted_flag = data[key]
+                            break
+                    if deleted_flag is False:
+                        raise RuntimeError(f"Delete user returned false: {data}")
+                logging.info("Deleted Remnawave user %s", user_uuid)
+                return True
+            if resp.status == 404:
+                logging.info("Remnawave user %s already deleted", user_uuid)
+                return True
+            error_text = await resp.text()
+            raise RuntimeError(f"Delete user failed ({resp.status}): {error_text}")
 
     try:
         result = await safe_api_call(_delete, error_message=f"Failed to delete Remnawave user {user_uuid}")
+        invalidate_remnawave_user_info(user_uuid)
         return bool(result)
     except Exception as e:
         logging.error(f"Delete Remnawave user error: {e}")
@@ -403,19 +737,19 @@ async def remnawave_delete_user(session: aiohttp.ClientSession, user_uuid: str)
 async def remnawave_reset_user_traffic(session: aiohttp.ClientSession, user_uuid: str) -> bool:
     """Сбросить трафик пользователя в Remnawave."""
     async def _reset():
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.post(
-                f"{REMNAWAVE_BASE_URL}/users/{user_uuid}/actions/reset-traffic",
-                headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
-            ) as resp:
-                if resp.status == 200:
-                    return True
-                error_text = await resp.text()
-                raise RuntimeError(f"Reset traffic failed ({resp.status}): {error_text}")
+        async with _remnawave_request(
+            "post",
+            f"{REMNAWAVE_BASE_URL}/users/{user_uuid}/actions/reset-traffic",
+            headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
+        ) as resp:
+            if resp.status == 200:
+                return True
+            error_text = await resp.text()
+            raise RuntimeError(f"Reset traffic failed ({resp.status}): {error_text}")
 
     try:
         result = await safe_api_call(_reset, error_message=f"Failed to reset traffic for {user_uuid}")
+        invalidate_remnawave_user_info(user_uuid)
         return result is not None
     except Exception as e:
         logging.error(f"Reset traffic error: {e}")
@@ -425,29 +759,29 @@ async def remnawave_reset_user_traffic(session: aiohttp.ClientSession, user_uuid
 async def remnawave_revoke_subscription(session: aiohttp.ClientSession, user_uuid: str) -> bool:
     """Перевыпустить подписочную ссылку пользователя в Remnawave."""
     async def _revoke():
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
         endpoints = [
             f"{REMNAWAVE_BASE_URL}/users/{user_uuid}/actions/revoke-subscription",
             f"{REMNAWAVE_BASE_URL}/users/{user_uuid}/actions/reset-subscription",
             f"{REMNAWAVE_BASE_URL}/users/{user_uuid}/actions/revoke-subscription-url",
         ]
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            errors = []
-            for endpoint in endpoints:
-                async with temp_session.post(
-                    endpoint,
-                    headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
-                ) as resp:
-                    if resp.status in (200, 201, 204):
-                        return True
-                    error_text = await resp.text()
-                    errors.append(f"{endpoint} -> {resp.status}: {error_text[:300]}")
-                    if resp.status not in (404, 405):
-                        break
-            raise RuntimeError("Revoke subscription failed: " + " | ".join(errors))
+        errors = []
+        for endpoint in endpoints:
+            async with _remnawave_request(
+                "post",
+                endpoint,
+                headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
+            ) as resp:
+                if resp.status in (200, 201, 204):
+                    return True
+                error_text = await resp.text()
+                errors.append(f"{endpoint} -> {resp.status}: {error_text[:300]}")
+                if resp.status not in (404, 405):
+                    break
+        raise RuntimeError("Revoke subscription failed: " + " | ".join(errors))
 
     try:
         result = await safe_api_call(_revoke, error_message=f"Failed to revoke subscription for {user_uuid}")
+        invalidate_remnawave_user_info(user_uuid)
         return result is not None
     except Exception as e:
         logging.error(f"Revoke subscription error: {e}")
@@ -456,29 +790,27 @@ async def remnawave_revoke_subscription(session: aiohttp.ClientSession, user_uui
 
 async def remnawave_get_user_usage(session: aiohttp.ClientSession, user_uuid: str) -> dict | None:
     """Получить traffic usage пользователя."""
-    user_info = await remnawave_get_user_info(session, user_uuid)
+    user_info = await remnawave_get_user_info(session, user_uuid, use_cache=False)
     if not user_info:
         return None
     return user_info.get("userTraffic") or {}
 
 
-async def remnawave_get_hwid_devices(session: aiohttp.ClientSession, user_uuid: str) -> list[dict] | None:
-    """Получить список HWID-устройств пользователя."""
+async def _fetch_hwid_devices(user_uuid: str) -> list[dict] | None:
     async def _get_devices():
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.get(
-                f"{REMNAWAVE_BASE_URL}/hwid/devices/{user_uuid}",
-                headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
-            ) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    response = data.get("response", {})
-                    return response.get("devices") or []
-                if resp.status == 404:
-                    return []
-                error_text = await resp.text()
-                raise RuntimeError(f"Get HWID devices failed ({resp.status}): {error_text}")
+        async with _remnawave_request(
+            "get",
+            f"{REMNAWAVE_BASE_URL}/hwid/devices/{user_uuid}",
+            headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
+        ) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                response = data.get("response", {})
+                return response.get("devices") or []
+            if resp.status == 404:
+                return []
+            error_text = await resp.text()
+            raise RuntimeError(f"Get HWID devices failed ({resp.status}): {error_text}")
 
     return await safe_api_call(
         _get_devices,
@@ -486,29 +818,35 @@ async def remnawave_get_hwid_devices(session: aiohttp.ClientSession, user_uuid:
     )
 
 
+async def remnawave_get_hwid_devices(session: aiohttp.ClientSession, user_uuid: str) -> list[dict] | None:
+    """Получить список HWID-устройств пользователя."""
+    devices = await _single_flight("hwid_devices", user_uuid, _fetch_hwid_devices)
+    return list(devices) if devices is not None else None
+
+
 async def remnawave_delete_hwid_device(session: aiohttp.ClientSession, user_uuid: str, hwid: str) -> bool:
     """Удалить одно HWID-устройство пользователя."""
     async def _delete_device():
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.post(
-                f"{REMNAWAVE_BASE_URL}/hwid/devices/delete",
-                headers={
-                    "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
-                    "Content-Type": "application/json",
-                },
-                json={"userUuid": str(user_uuid), "hwid": hwid},
-            ) as resp:
-                if resp.status == 200:
-                    return True
-                error_text = await resp.text()
-                raise RuntimeError(f"Delete HWID device failed ({resp.status}): {error_text}")
+        async with _remnawave_request(
+            "post",
+            f"{REMNAWAVE_BASE_URL}/hwid/devices/delete",
+            headers={
+                "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
+                "Content-Type": "application/json",
+            },
+            json={"userUuid": str(user_uuid), "hwid": hwid},
+        ) as resp:
+            if resp.status == 200:
+                return True
+            error_text = await resp.text()
+            raise RuntimeError(f"Delete HWID device failed ({resp.status}): {error_text}")
 
     try:
         result = await safe_api_call(
             _delete_device,
             error_message=f"Failed to delete HWID device for {user_uuid}"
         )
+        _forget_inflight(user_uuid, "hwid_devices")
         return result is not None
     except Exception as e:
         logging.error(f"Delete HWID device error: {e}")
@@ -518,26 +856,26 @@ async def remnawave_delete_hwid_device(session: aiohttp.ClientSession, user_uuid
 async def remnawave_delete_all_hwid_devices(session: aiohttp.ClientSession, user_uuid: str) -> bool:
     """Удалить все HWID-устройства пользователя."""
     async def _delete_all_devices():
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.post(
-                f"{REMNAWAVE_BASE_URL}/hwid/devices/delete-all",
-                headers={
-                    "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
-                    "Content-Type": "application/json",
-                },
-                json={"userUuid": str(user_uuid)},
-            ) as resp:
-                if resp.status == 200:
-                    return True
-                error_text = await resp.text()
-                raise RuntimeError(f"Delete all HWID devices failed ({resp.status}): {error_text}")
+        async with _remnawave_request(
+            "post",
+            f"{REMNAWAVE_BASE_URL}/hwid/devices/delete-all",
+            headers={
+                "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
+                "Content-Type": "application/json",
+            },
+            json={"userUuid": str(user_uuid)},
+        ) as resp:
+            if resp.status == 200:
+                return True
+            error_text = await resp.text()
+            raise RuntimeError(f"Delete all HWID devices failed ({resp.status}): {error_text}")
 
     try:
         result = await safe_api_call(
             _delete_all_devices,
             error_message=f"Failed to delete all HWID devices for {user_uuid}"
         )
+        _forget_inflight(user_uuid, "hwid_devices")
         return result is not None
     except Exception as e:
         logging.error(f"Delete all HWID devices error: {e}")
@@ -569,28 +907,28 @@ async def remnawave_set_subscription_expiry(
             "expireAt": expire_iso
         }
 
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.patch(
-                f"{REMNAWAVE_BASE_URL}/users",
-                headers={
-                    "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
-                    "Content-Type": "application/json"
-                },
-                json=payload
-            ) as resp:
-                if resp.status == 200:
-                    logging.info(f"Set subscription expiry for {user_uuid} to {expire_iso}")
-                    return True
-                else:
-                    error_text = await resp.text()
-                    raise RuntimeError(f"Set expiry failed ({resp.status}): {error_text}")
+        async with _remnawave_request(
+            "patch",
+            f"{REMNAWAVE_BASE_URL}/users",
+            headers={
+                "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
+                "Content-Type": "application/json"
+            },
+            json=payload
+        ) as resp:
+            if resp.status == 200:
+                logging.info(f"Set subscription expiry for {user_uuid} to {expire_iso}")
+                return True
+            else:
+                error_text = await resp.text()
+                raise RuntimeError(f"Set expiry failed ({resp.status}): {error_text}")
 
     try:
         result = await safe_api_call(
             _set_expiry,
             error_message=f"Failed to set subscription expiry for {user_uuid}"
         )
+        invalidate_remnawave_user_info(user_uuid)
         return result is not None
     except Exception as e:
         logging.error(f"Set subscription expiry error: {e}")
@@ -615,20 +953,19 @@ async def remnawave_extend_subscription(
     """
     async def _extend():
         # 1. Получаем текущий expireAt
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.get(
-                f"{REMNAWAVE_BASE_URL}/users/{user_uuid}",
-                headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
-            ) as resp:
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    raise RuntimeError(f"Get user failed ({resp.status}): {error_text}")
+        async with _remnawave_request(
+            "get",
+            f"{REMNAWAVE_BASE_URL}/users/{user_uuid}",
+            headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
+        ) as resp:
+            if resp.status != 200:
+                error_text = await resp.text()
+                raise RuntimeError(f"Get user failed ({resp.status}): {error_text}")
 
-                data = await resp.json()
-                current_expire = data["response"].get("expireAt")
-                if not current_expire:
-                    raise RuntimeError("expireAt not found in response")
+            data = await resp.json()
+            current_expire = data["response"].get("expireAt")
+            if not current_expire:
+                raise RuntimeError("expireAt not found in response")
 
         # 2. Считаем новую дату
         current_dt = datetime.fromisoformat(current_expire.replace("Z", "+00:00"))
@@ -640,27 +977,28 @@ async def remnawave_extend_subscription(
         }
 
         # 3. PATCH /users для обновления
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.patch(
-                f"{REMNAWAVE_BASE_URL}/users",
-                headers={
-                    "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
-                    "Content-Type": "application/json"
-                },
-                json=payload
-            ) as resp:
-                if resp.status == 200:
-                    logging.info(f"Extended subscription for {user_uuid} by {days} days")
-                    return True
-                else:
-                    error_text = await resp.text()
-                    raise RuntimeError(f"Extend failed ({resp.status}): {error_text}")
+        async with _remnawave_request(
+            "patch",
+            f"{REMNAWAVE_BASE_URL}/users",
+            headers={
+                "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
+                "Content-Type": "application/json"
+            },
+            json=payload
+        ) as resp:
+            if resp.status == 200:
+                logging.info(f"Extended subscription for {user_uuid} by {days} days")
+                return True
+            else:
+                error_text = await resp.text()
+                raise RuntimeError(f"Extend failed ({resp.status}): {error_text}")
 
     try:
         result = await safe_api_call(
             _extend,
             error_message=f"Failed to extend subscription for {user_uuid}"
         )
+        invalidate_remnawave_user_info(user_uuid)
         return result is not None
     except Exception as e:
         logging.error(f"Extend subscription error: {e}")
@@ -691,15 +1029,13 @@ async def remnawave_add_to_squad(
             "Content-Type": "application/json"
         }
 
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.post(url, headers=headers, json=payload) as resp:
-                if resp.status in (200, 201):
-                    logging.info(f"Added user {user_uuid} to squad {squad_uuid}")
-                    return True
-                else:
-                    error_text = await resp.text()
-                    raise RuntimeError(f"Add to squad failed: {resp.status} → {error_text}")
+        async with _remnawave_request("post", url, headers=headers, json=payload) as resp:
+            if resp.status in (200, 201):
+                logging.info(f"Added user {user_uuid} to squad {squad_uuid}")
+                return True
+            else:
+                error_text = await resp.text()
+                raise RuntimeError(f"Add to squad failed: {resp.status} → {error_text}")
 
     try:
         result = await safe_api_call(
@@ -731,57 +1067,152 @@ async def remnawave_get_subscription_url(
         url = f"{REMNAWAVE_BASE_URL}/users/{user_uuid}"
         headers = {"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
 
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.get(url, headers=headers) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    user_data = data.get("response", {})
-                    sub_url = _extract_subscription_url(user_data)
-                    if sub_url:
-                        return sub_url
-                    else:
-                        available_keys = ", ".join(sorted(user_data.keys()))
-                        raise RuntimeError(f"subscriptionUrl not found in response. Keys: {available_keys}")
+        async with _remnawave_request("get", url, headers=headers) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                user_data = data.get("response", {})
+                sub_url = _extract_subscription_url(user_data)
+                if sub_url:
+                    return sub_url
                 else:
-                    error_text = await resp.text()
-                    raise RuntimeError(f"Get subscription URL failed ({resp.status}): {error_text}")
+                    available_keys = ", ".join(sorted(user_data.keys()))
+                    raise RuntimeError(f"subscriptionUrl not found in response. Keys: {available_keys}")
+            else:
+                error_text = await resp.text()
+                raise RuntimeError(f"Get subscription URL failed ({resp.status}): {error_text}")
+
+    async def _fetch(_):
+        return await safe_api_call(
+            _get_url,
+            error_message=f"Failed to get subscription URL for {user_uuid}"
+        )
+
+    return await _single_flight("subscription_url", user_uuid, _fetch)
+
+
+async def _fetch_user_info(user_uuid: str) -> dict | None:
+    async def _get_info():
+        url = f"{REMNAWAVE_BASE_URL}/users/{user_uuid}"
+        headers = {"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
+
+        async with _remnawave_request("get", url, headers=headers) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                return data.get("response", {})
+            else:
+                error_text = await resp.text()
+                raise RuntimeError(f"Get user info failed ({resp.status}): {error_text}")
 
     return await safe_api_call(
-        _get_url,
-        error_message=f"Failed to get subscription URL for {user_uuid}"
+        _get_info,
+        error_message=f"Failed to get user info for {user_uuid}"
     )
 
 
+async def _refresh_user_info(key: str) -> None:
+    started_at = time.monotonic()
+    try:
+        data = await _single_flight("user_info", key, _fetch_user_info)
+        if data is not None:
+            _user_info_cache_store(key, started_at, data)
+    finally:
+        _user_info_refreshes.pop(key, None)
+
+
 async def remnawave_get_user_info(
     session: aiohttp.ClientSession,
-    user_uuid: str
+    user_uuid: str,
+    *,
+    use_cache: bool = True,
 ) -> dict | None:
     """
     Получить информацию о пользователе из Remnawave с retry логикой
 
+    Ответ кешируется на REMNAWAVE_USER_INFO_CACHE_TTL секунд. Устаревшая запись
+    (до REMNAWAVE_USER_INFO_STALE_TTL) отдаётся сразу, а обновляется в фоне.
+
     Args:
         session: aiohttp сессия
         user_uuid: UUID пользователя в Remnawave
+        use_cache: False — всегда идти в Remnawave (учёт трафика перед сбросом)
 
     Returns:
         Словарь с информацией пользователя или None
     """
-    async def _get_info():
-        url = f"{REMNAWAVE_BASE_URL}/users/{user_uuid}"
-        headers = {"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
+    key = str(user_uuid)
+    if use_cache:
+        cached = _user_info_cache.get(key)
+        if cached is not None and cached[1] is not None:
+            age = time.monotonic() - cached[0]
+            if age < REMNAWAVE_USER_INFO_CACHE_TTL:
+                _user_info_cache_stats["hits"] += 1
+                _user_info_cache.move_to_end(key)
+                return dict(cached[1])
+            if age < REMNAWAVE_USER_INFO_STALE_TTL:
+                _user_info_cache_stats["stale_hits"] += 1
+                if key not in _user_info_refreshes:
+                    _user_info_refreshes[key] = asyncio.create_task(_refresh_user_info(key))
+                return dict(cached[1])
+        _user_info_cache_stats["misses"] += 1
+
+    started_at = time.monotonic()
+    data = await _single_flight("user_info", key, _fetch_user_info)
+    if data is not None:
+        _user_info_cache_store(key, started_at, data)
+        return dict(data)
+
+    # Панель деградировала — лучше показать последние известные данные, чем ничего.
+    cached = _user_info_cache.get(key)
+    if (
+        use_cache
+        and cached is not None
+        and cached[1] is not None
+        and remnawave_is_degraded()
+        and time.monotonic() - cached[0] < REMNAWAVE_USER_INFO_FALLBACK_TTL
+    ):
+        _user_info_cache_stats["fallbacks"] += 1
+        return dict(cached[1])
+    return None
 
-        timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout, connector=_verified_connector()) as temp_session:
-            async with temp_session.get(url, headers=headers) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data.get("response", {})
-                else:
-                    error_text = await resp.text()
-                    raise RuntimeError(f"Get user info failed ({resp.status}): {error_text}")
+
+async def remnawave_list_users(
+    session: aiohttp.ClientSession,
+    start: int = 0,
+    size: int = 500,
+    *,
+    newest_first: bool = False,
+) -> dict | None:
+    """
+    Получить страницу пользователей Remnawave для массовой синхронизации
+
+    newest_first сортирует по updatedAt по убыванию: инкрементальному проходу
+    хватает первых страниц.
+
+    Returns:
+        {"users": [...], "total": N} или None
+    """
+    params = {"start": str(start), "size": str(size)}
+    if newest_first:
+        params["sorting"] = json.dumps([{"id": "updatedAt", "desc": True}])
+
+    async def _list_users():
+        async with _remnawave_request(
+            "get",
+            f"{REMNAWAVE_BASE_URL}/users",
+            headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"},
+            params=params,
+        ) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                response = data.get("response", {})
+                return {
+                    "users": response.get("users") or [],
+                    "total": int(response.get("total") or 0),
+                }
+            error_text = await resp.text()
+            raise RuntimeError(f"List users failed ({resp.status}): {error_text}")
 
     return await safe_api_call(
-        _get_info,
-        error_message=f"Failed to get user info for {user_uuid}"
+        _list_users,
+        error_message=f"Failed to list Remnawave users from {start}"
     )
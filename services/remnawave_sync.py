@@ -0,0 +1,202 @@
+"""Фоновое зеркало пользователей Remnawave в Postgres."""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import database as db
+from config import SUBSCRIPTION_URL_REFRESH_TTL
+from services.remnawave import _extract_subscription_url, remnawave_list_users
+
+
+logger = logging.getLogger(__name__)
+
+SYNC_NAME = "remnawave_users"
+REMNAWAVE_SYNC_INTERVAL = 300
+REMNAWAVE_SYNC_PAGE_SIZE = 500
+REMNAWAVE_FULL_SYNC_EVERY = 12  # каждый N-й проход чистит зеркало от удалённых пользователей
+REMNAWAVE_MIRROR_MAX_AGE = 900
+REMNAWAVE_SYNC_OVERLAP = 120  # запас к отметке updatedAt на записи, шедшие во время прошлого прохода
+
+
+def _parse_remote_datetime(value) -> datetime | None:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def mirror_row_from_user(user: dict) -> dict | None:
+    """Привести пользователя из GET /users к строке remnawave_users_mirror."""
+    user_uuid = user.get("uuid")
+    if not user_uuid:
+        return None
+    traffic = user.get("userTraffic") or {}
+    used_bytes = traffic.get("usedTrafficBytes", user.get("usedTrafficBytes")) or 0
+    limit_bytes = user.get("trafficLimitBytes")
+    return {
+        "remnawave_uuid": str(user_uuid),
+        "username": user.get("username"),
+        "status": user.get("status"),
+        "expire_at": _parse_remote_datetime(user.get("expireAt")),
+        "used_traffic_bytes": int(used_bytes),
+        "traffic_limit_bytes": int(limit_bytes) if limit_bytes is not None else None,
+        "subscription_url": _extract_subscription_url(user),
+        "remote_updated_at": _parse_remote_datetime(user.get("updatedAt")),
+    }
+
+
+def _page_reaches_watermark(rows: list[dict], watermark: datetime) -> bool | None:
+    """Дошла ли страница, отсортированная по updatedAt, до уже известных изменений.
+
+    None — страница не отсортирована (панель не поддерживает сортировку) и
+    по ней нельзя остановиться.
+    """
+    stamps = [row["remote_updated_at"] for row in rows]
+    if not stamps or None in stamps or stamps != sorted(stamps, reverse=True):
+        return None
+    return stamps[-1] < watermark
+
+
+async def sync_remnawave_users_once(*, full: bool = False) -> dict:
+    """Один проход синхронизации.
+
+    Обычный проход читает пользователей от недавно изменённых и
+    останавливается на отметке updatedAt, уже лежащей в зеркале; полный
+    читает всех и удаляет из зеркала пользователей, которых больше нет в
+    Remnawave.
+    """
+    snapshot_at = await db.start_background_sync(SYNC_NAME)
+    watermark = None if full else await db.get_remnawave_mirror_watermark()
+    if watermark is not None:
+        watermark -= timedelta(seconds=REMNAWAVE_SYNC_OVERLAP)
+    seen: list[str] = []
+    changed = 0
+    start = 0
+    try:
+        while True:
+            page = await remnawave_list_users(
+                None,
+                start,
+                REMNAWAVE_SYNC_PAGE_SIZE,
+                newest_first=watermark is not None,
+            )
+            if page is None:
+                raise RuntimeError(f"Remnawave user list unavailable at offset {start}")
+            users = page["users"]
+            rows = [row for row in (mirror_row_from_user(user) for user in users) if row]
+            changed += len(await db.upsert_remnawave_mirror_rows(rows))
+            seen.extend(row["remnawave_uuid"] for row in rows)
+            start += len(users)
+            if not users or start >= page["total"]:
+                break
+            if watermark is not None:
+                reached = _page_reaches_watermark(rows, watermark)
+                if reached:
+                    break
+                if reached is None:
+                    logger.warning("Remnawave ignored updatedAt sorting, reading the full user list")
+                    watermark = None
+
+        removed = await db.delete_remnawave_mirror_rows_except(seen) if full and seen else 0
+
+        drift = await db.get_subscription_expiry_drift_from_mirror(
+            snapshot_at,
+            None if full else snapshot_at,
+        )
+        for subscription in drift or []:
+            await db.sync_subscription_expiry(subscription["id"], subscription["expire_at"])
+
+        urls_refreshed = 0
+        if SUBSCRIPTION_URL_REFRESH_TTL > 0:
+            urls_refreshed = await db.refresh_subscription_urls_from_mirror(
+                snapshot_at,
+                snapshot_at - timedelta(seconds=SUBSCRIPTION_URL_REFRESH_TTL),
+            )
+    except Exception as e:
+        await db.finish_background_sync(
+            SYNC_NAME,
+            snapshot_at=snapshot_at,
+            full=full,
+            seen_count=len(seen),
+            changed_count=changed,
+            error=str(e)[:500],
+        )
+        raise
+
+    await db.finish_background_sync(
+        SYNC_NAME,
+        snapshot_at=snapshot_at,
+        full=full,
+        seen_count=len(seen),
+        changed_count=changed,
+    )
+    stats = {
+        "seen": len(seen),
+        "changed": changed,
+        "removed": removed,
+        "expiry_synced": len(drift or []),
+        "urls_refreshed": urls_refreshed,
+        "full": full,
+    }
+    logger.info("✅ Remnawave mirror synced: %s", stats)
+    return stats
+
+
+async def get_mirror_status() -> dict:
+    """Насколько устарело зеркало (секунды с начала последнего успешного прохода)."""
+    state = await db.get_background_sync_state(SYNC_NAME)
+    if not state or not state["snapshot_at"]:
+        return {"snapshot_at": None, "staleness_seconds": None, "fresh": False}
+    staleness = (datetime.utcnow() - state["snapshot_at"]).total_seconds()
+    return {
+        "snapshot_at": state["snapshot_at"].isoformat(),
+        "staleness_seconds": int(staleness),
+        "fresh": staleness < REMNAWAVE_MIRROR_MAX_AGE,
+        "last_full_finished_at": state["last_full_finished_at"].isoformat() if state["last_full_finished_at"] else None,
+        "last_seen_count": state["last_seen_count"],
+        "last_changed_count": state["last_changed_count"],
+        "last_error": state["last_error"],
+    }
+
+
+async def fresh_mirror_rows(subscriptions) -> dict:
+    """Строки зеркала, которым можно верить для данных подписок.
+
+    Подписку, изменённую локально после снимка (продление, сброс трафика),
+    пропускаем: для неё вызывающий код идёт в Remnawave напрямую.
+    """
+    uuids = [str(item["remnawave_uuid"]) for item in subscriptions if item.get("remnawave_uuid")]
+    if not uuids:
+        return {}
+    state = await db.get_background_sync_state(SYNC_NAME)
+    snapshot_at = state["snapshot_at"] if state else None
+    if not snapshot_at or (datetime.utcnow() - snapshot_at).total_seconds() >= REMNAWAVE_MIRROR_MAX_AGE:
+        return {}
+
+    rows = await db.get_remnawave_mirror_rows(uuids)
+    trusted = {}
+    for subscription in subscriptions:
+        key = str(subscription.get("remnawave_uuid") or "")
+        updated_at = subscription.get("updated_at")
+        if key in rows and (updated_at is None or updated_at < snapshot_at):
+            trusted[key] = rows[key]
+    return trusted
+
+
+async def run_remnawave_sync_loop():
+    runs = 0
+    while True:
+        try:
+            await sync_remnawave_users_once(full=runs % REMNAWAVE_FULL_SYNC_EVERY == 0)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Remnawave mirror sync error: %s", e, exc_info=True)
+        runs += 1
+        await asyncio.sleep(REMNAWAVE_SYNC_INTERVAL)
@@ -21,7 +21,7 @@ async def adjust_subscription_days(subscription, days: int) -> datetime:
     if days == 0:
         raise SubscriptionAdjustmentError("Количество дней не может быть нулём")
 
-    current_until = await refresh_subscription_expiry(subscription)
+    current_until = await refresh_subscription_expiry(subscription, prefer_mirror=False)
     now = datetime.utcnow()
     subscription_snapshot = dict(subscription)
     subscription_snapshot["subscription_until"] = current_until
@@ -3,53 +3,56 @@ import logging
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
-import aiohttp
 from aiogram.exceptions import TelegramAPIError
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 import database as db
 from config import GB_BYTES
 from services.notification_delivery import (
+    TELEGRAM_DELIVERY_BLOCKED_NOTIFICATION_TYPE,
     is_telegram_delivery_blocked,
     mark_telegram_delivery_blocked,
 )
 from services.remnawave import remnawave_get_user_info
+from services.remnawave_sync import fresh_mirror_rows
+from services.telegram_sender import PRIORITY_NOTIFICATION, send_telegram_message
 
 
 logger = logging.getLogger(__name__)
 
 MSK = ZoneInfo("Europe/Moscow")
-TELEGRAM_RATE_LIMIT = 0.1
 
 EXPIRED_NOTIFICATION_TYPE = "expired_or_no_subscription"
 LOW_TRAFFIC_NOTIFICATION_TYPE = "low_bypass_traffic"
 
 EXPIRING_ONCE_COOLDOWN_HOURS = 24 * 365 * 20
+SCHEDULED_NOTIFICATIONS_BATCH = 100
+SCHEDULED_NOTIFICATIONS_LEASE_SECONDS = 600
 EXPIRED_COOLDOWN_HOURS = 86
 LOW_TRAFFIC_COOLDOWN_HOURS = 36
 
 EXPIRING_STAGES = [
     {
         "type": "expires_today",
-        "threshold": timedelta(hours=12),
+        "threshold": db.EXPIRY_NOTIFICATION_LEADS["expires_today"],
         "title": "Подписка заканчивается сегодня",
         "body": "Лучше продлить сейчас, чтобы ключ не отключился.",
     },
     {
         "type": "expires_1d",
-        "threshold": timedelta(days=1),
+        "threshold": db.EXPIRY_NOTIFICATION_LEADS["expires_1d"],
         "title": "Остался 1 день подписки",
         "body": "Продлите заранее: оставшиеся дни сохранятся и добавятся к новому сроку.",
     },
     {
         "type": "expires_3d",
-        "threshold": timedelta(days=3),
+        "threshold": db.EXPIRY_NOTIFICATION_LEADS["expires_3d"],
         "title": "До окончания осталось меньше 3 дней",
         "body": "Можно продлить в пару кликов, чтобы доступ продолжил работать без пауз.",
     },
     {
         "type": "expires_7d",
-        "threshold": timedelta(days=7),
+        "threshold": db.EXPIRY_NOTIFICATION_LEADS["expires_7d"],
         "title": "До окончания осталось меньше 7 дней",
         "body": "Если продлите заранее, текущие дни не сгорят.",
     },
@@ -98,24 +101,16 @@ async def _has_multiple_active_visible_subscriptions(tg_id: int) -> bool:
 async def check_and_send_notifications(bot):
     """
     Фоновая задача уведомлений:
-    - подписка истекает: ежедневно в 19:00 МСК на этапах 7/3/1 день и сегодня;
     - мало ГБ: раз в 36 часов, если осталось <10 ГБ и до обновления >8 дней;
     - нет активной подписки/закончилась: раз в 86 часов.
+
+    Напоминания об окончании подписки шлёт run_scheduled_notifications_loop.
     """
     logger.info("✅ Scheduled notification service started")
-    last_expiring_run_date = None
     last_periodic_check_at = None
 
     try:
         while True:
-            now_msk = datetime.now(MSK)
-
-            if now_msk.hour == 19 and now_msk.minute == 0 and last_expiring_run_date != now_msk.date():
-                last_expiring_run_date = now_msk.date()
-                logger.info("⏰ Scheduled check: 19:00 MSK - expiring subscriptions")
-                await _safe_run(_send_notifications_for_expiring, bot)
-                await asyncio.sleep(60)
-
             now_utc = datetime.utcnow()
             if not last_periodic_check_at or now_utc - last_periodic_check_at >= timedelta(hours=1):
                 last_periodic_check_at = now_utc
@@ -135,56 +130,102 @@ async def _safe_run(func, bot):
         logger.error("Notification task %s failed: %s", func.__name__, e, exc_info=True)
 
 
-async def _send_notifications_for_expiring(bot):
-    now = datetime.now(timezone.utc)
-    subscriptions = await db.db_execute(
-        """
-        SELECT id, tg_id, slot_number, type_index, plan_kind, subscription_until
-        FROM subscriptions
-        WHERE remnawave_uuid IS NOT NULL
-          AND tg_id > 0
-          AND generation = 'v2'
-          AND is_visible = TRUE
-          AND is_renewable = TRUE
-          AND subscription_until IS NOT NULL
-          AND subscription_until > $1
-          AND subscription_until <= $2
-        ORDER BY tg_id ASC, subscription_until ASC
-        """,
-        (now.replace(tzinfo=None), (now + timedelta(days=7)).replace(tzinfo=None)),
-        fetch_all=True,
-    )
+async def _iter_rows(batches):
+    async for batch in batches:
+        for row in batch:
+            yield row
 
-    sent = 0
-    for i, subscription in enumerate(subscriptions or []):
-        tg_id = subscription["tg_id"]
-        subscription_id = subscription["id"]
-        expire_at = ensure_utc_aware(subscription["subscription_until"])
-        time_left = expire_at - now
-        stage = _pick_expiring_stage(time_left)
-        if not stage:
-            continue
-        if not await db.can_send_notification(tg_id, stage["type"], EXPIRING_ONCE_COOLDOWN_HOURS, subscription_id):
-            continue
-
-        text = (
-            f"⏰ <b>{stage['title']}</b>\n\n"
-            f"Подписка: <b>{_subscription_name(subscription)}</b>\n"
-            f"Осталось: <b>{_format_time_left(time_left)}</b>\n\n"
-            f"{stage['body']}"
-        )
-        keyboard = [[InlineKeyboardButton(text="🔄 Продлить эту подписку", callback_data=f"renew_subscription_{subscription_id}", style="success")]]
-        if await _has_multiple_active_visible_subscriptions(tg_id):
-            keyboard.append([InlineKeyboardButton(text="🔐 Мои подписки", callback_data="my_subscriptions", style="primary")])
-        keyboard.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu", style="danger")])
-        kb = InlineKeyboardMarkup(inline_keyboard=keyboard)
-        if await _send_message(bot, tg_id, text, kb):
-            await db.mark_notification_state_sent(tg_id, stage["type"], subscription_id)
-            sent += 1
-        if i < len(subscriptions) - 1:
-            await asyncio.sleep(TELEGRAM_RATE_LIMIT)
 
-    logger.info("✅ Expiring notification batch complete: %s sent", sent)
+def _next_send_mark(now: datetime) -> datetime:
+    """Ближайшие EXPIRY_NOTIFICATION_HOUR по Москве после now (naive UTC)."""
+    now_msk = now.replace(tzinfo=timezone.utc).astimezone(MSK)
+    mark = now_msk.replace(hour=db.EXPIRY_NOTIFICATION_HOUR, minute=0, second=0, microsecond=0)
+    if mark <= now_msk:
+        mark += timedelta(days=1)
+    return mark.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def run_scheduled_notifications_loop(bot):
+    """Разбирать очередь напоминаний об окончании подписки по времени отправки.
+
+    Строки ставит db.schedule_expiry_notifications при создании, продлении и
+    правке срока подписки; время отправки всегда совпадает с отметкой
+    EXPIRY_NOTIFICATION_HOUR по Москве. Между пачками цикл спит до ближайшего
+    напоминания, но не дольше следующей отметки: к ней могли добавиться новые.
+    """
+    logger.info("✅ Expiry notification queue started")
+    while True:
+        try:
+            while True:
+                items = await db.claim_due_notifications(SCHEDULED_NOTIFICATIONS_BATCH, SCHEDULED_NOTIFICATIONS_LEASE_SECONDS)
+                for item in items or []:
+                    await _process_scheduled_notification(bot, item)
+                if len(items or []) < SCHEDULED_NOTIFICATIONS_BATCH:
+                    break
+            now = datetime.utcnow()
+            wake_at = _next_send_mark(now)
+            next_due = await db.get_next_notification_due_at()
+            if next_due is not None:
+                wake_at = min(wake_at, next_due)
+            delay = max((wake_at - now).total_seconds(), 1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Expiry notification queue error: %s", e, exc_info=True)
+            delay = 60
+        await asyncio.sleep(delay)
+
+
+async def _process_scheduled_notification(bot, item) -> None:
+    notification_id = item["id"]
+    planned_until = item["subscription_until"]
+    retry_at = None
+    try:
+        retry_at = await _send_expiring_notification(bot, item)
+    except Exception as e:
+        logger.warning("Expiry notification %s failed: %s", notification_id, e)
+        retry_at = _next_send_mark(datetime.utcnow())
+    if retry_at is not None and retry_at >= planned_until:
+        retry_at = None
+    await db.finish_scheduled_notification(notification_id, planned_until, retry_at)
+
+
+async def _send_expiring_notification(bot, item) -> datetime | None:
+    """Отправить напоминание; вернуть время повтора, если отправка не удалась."""
+    tg_id = item["tg_id"]
+    subscription_id = item["subscription_id"]
+    if (
+        item["current_subscription_until"] != item["subscription_until"]
+        or item["generation"] != "v2"
+        or not item["is_visible"]
+        or not item["is_renewable"]
+        or not item["remnawave_uuid"]
+    ):
+        return None
+
+    now = datetime.now(timezone.utc)
+    time_left = ensure_utc_aware(item["subscription_until"]) - now
+    stage = _pick_expiring_stage(time_left)
+    # Более поздний этап уже наступил — его строка тоже в очереди
+    if not stage or stage["type"] != item["notification_type"]:
+        return None
+    if not await db.can_send_notification(tg_id, stage["type"], EXPIRING_ONCE_COOLDOWN_HOURS, subscription_id):
+        return None
+
+    text = (
+        f"⏰ <b>{stage['title']}</b>\n\n"
+        f"Подписка: <b>{_subscription_name(item)}</b>\n"
+        f"Осталось: <b>{_format_time_left(time_left)}</b>\n\n"
+        f"{stage['body']}"
+    )
+    keyboard = [[InlineKeyboardButton(text="🔄 Продлить эту подписку", callback_data=f"renew_subscription_{subscription_id}", style="success")]]
+    if await _has_multiple_active_visible_subscriptions(tg_id):
+        keyboard.append([InlineKeyboardButton(text="🔐 Мои подписки", callback_data="my_subscriptions", style="primary")])
+    keyboard.append([InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu", style="danger")])
+    if not await _send_message(bot, tg_id, text, InlineKeyboardMarkup(inline_keyboard=keyboard)):
+        return _next_send_mark(datetime.utcnow())
+    await db.mark_notification_state_sent(tg_id, stage["type"], subscription_id)
+    return None
 
 
 def _pick_expiring_stage(time_left: timedelta) -> dict | None:
@@ -197,56 +238,18 @@ def _pick_expiring_stage(time_left: timedelta) -> dict | None:
 
 
 async def _send_notifications_for_expired(bot):
-    users = await db.db_execute(
-        """
-        SELECT DISTINCT tg_id
-        FROM subscriptions
-        WHERE tg_id > 0
-          AND generation = 'v2'
-          AND is_visible = TRUE
-          AND is_renewable = TRUE
-        ORDER BY tg_id ASC
-        """,
-        fetch_all=True,
+    recipients = db.iter_expired_notification_recipients(
+        EXPIRED_NOTIFICATION_TYPE,
+        EXPIRED_COOLDOWN_HOURS,
+        TELEGRAM_DELIVERY_BLOCKED_NOTIFICATION_TYPE,
     )
     now = datetime.utcnow()
     sent = 0
 
-    for i, user in enumerate(users or []):
+    async for user in _iter_rows(recipients):
         tg_id = user["tg_id"]
-        all_subscriptions = await db.get_user_subscriptions(tg_id)
-        has_active = any(
-            sub.get("subscription_until")
-            and sub["subscription_until"] > now
-            and (
-                (
-                    sub.get("generation") == "v2"
-                    and sub.get("is_visible")
-                    and sub.get("is_renewable")
-                )
-                or sub.get("legacy_readonly")
-            )
-            for sub in all_subscriptions
-        )
-        if has_active:
-            continue
-
-        subscriptions = [
-            subscription
-            for subscription in all_subscriptions
-            if subscription.get("generation") == "v2"
-            and subscription.get("is_visible")
-            and subscription.get("is_renewable")
-        ]
-        if not await db.can_send_notification(tg_id, EXPIRED_NOTIFICATION_TYPE, EXPIRED_COOLDOWN_HOURS):
-            continue
-
-        expired_dates = [
-            sub["subscription_until"] for sub in subscriptions
-            if sub.get("subscription_until") and sub["subscription_until"] <= now
-        ]
-        if expired_dates:
-            last_expired_at = max(expired_dates)
+        last_expired_at = user["last_expired_at"]
+        if last_expired_at:
             days_expired = max(0, (now - last_expired_at).days)
             text = (
                 "❌ <b>Подписка закончилась</b>\n\n"
@@ -262,18 +265,16 @@ async def _send_notifications_for_expired(bot):
         if await _send_message(bot, tg_id, text, _buy_keyboard()):
             await db.mark_notification_state_sent(tg_id, EXPIRED_NOTIFICATION_TYPE)
             sent += 1
-        if i < len(users) - 1:
-            await asyncio.sleep(TELEGRAM_RATE_LIMIT)
 
     logger.info("✅ Expired/no-sub notification batch complete: %s sent", sent)
 
 
 async def _send_notifications_for_low_traffic(bot):
     now = datetime.utcnow()
-    subscriptions = await db.db_execute(
+    batches = db.iter_row_batches(
         """
         SELECT id, tg_id, slot_number, type_index, plan_kind, remnawave_uuid,
-               subscription_until, current_period_limit_bytes, traffic_reset_at
+               subscription_until, current_period_limit_bytes, traffic_reset_at, updated_at
         FROM subscriptions
         WHERE plan_kind = 'bypass'
           AND tg_id > 0
@@ -287,28 +288,27 @@ async def _send_notifications_for_low_traffic(bot):
           AND current_period_limit_bytes > 0
           AND traffic_reset_at IS NOT NULL
           AND traffic_reset_at > $2
-        ORDER BY tg_id ASC, id ASC
         """,
         (now, now + timedelta(days=8)),
-        fetch_all=True,
+        key=("tg_id", "id"),
     )
 
-    if not subscriptions:
-        return
-
     sent = 0
-    connector = aiohttp.TCPConnector()
-    timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        for i, subscription in enumerate(subscriptions):
+    async for subscriptions in batches:
+        mirror = await fresh_mirror_rows(subscriptions)
+        for subscription in subscriptions:
             try:
                 tg_id = subscription["tg_id"]
                 subscription_id = subscription["id"]
                 if not await db.can_send_notification(tg_id, LOW_TRAFFIC_NOTIFICATION_TYPE, LOW_TRAFFIC_COOLDOWN_HOURS, subscription_id):
                     continue
 
-                user_info = await remnawave_get_user_info(session, subscription["remnawave_uuid"])
-                used_bytes = ((user_info or {}).get("userTraffic") or {}).get("usedTrafficBytes") or 0
+                mirror_row = mirror.get(str(subscription["remnawave_uuid"]))
+                if mirror_row is not None:
+                    used_bytes = mirror_row["used_traffic_bytes"] or 0
+                else:
+                    user_info = await remnawave_get_user_info(None, subscription["remnawave_uuid"])
+                    used_bytes = ((user_info or {}).get("userTraffic") or {}).get("usedTrafficBytes") or 0
                 limit_bytes = subscription.get("current_period_limit_bytes") or 0
                 remaining_bytes = max(0, limit_bytes - used_bytes)
                 if remaining_bytes >= 10 * GB_BYTES:
@@ -334,9 +334,6 @@ async def _send_notifications_for_low_traffic(bot):
             except Exception as e:
                 logger.warning("Low traffic check failed for subscription %s: %s", subscription.get("id"), e)
 
-            if i < len(subscriptions) - 1:
-                await asyncio.sleep(TELEGRAM_RATE_LIMIT)
-
     logger.info("✅ Low traffic notification batch complete: %s sent", sent)
 
 
@@ -348,7 +345,7 @@ async def _send_message(bot, tg_id: int, text: str, reply_markup: InlineKeyboard
         logger.warning("Failed to read notification delivery state for user %s: %s", tg_id, e)
 
     try:
-        await bot.send_message(tg_id, text, reply_markup=reply_markup)
+        await send_telegram_message(bot, tg_id, text, reply_markup=reply_markup, priority=PRIORITY_NOTIFICATION)
         return True
     except TelegramAPIError as e:
         error_text = str(e)
@@ -372,8 +369,8 @@ async def _send_message(bot, tg_id: int, text: str, reply_markup: InlineKeyboard
                 error_text,
             )
         elif "429" in error_text or "Too Many Requests" in error_text:
-            logger.warning("🚫 Rate limited while sending notification")
-            await asyncio.sleep(5)
+            # Паузу по retry_after уже выдержал общий отправитель
+            logger.warning("🚫 Rate limited while sending notification to user %s, giving up", tg_id)
         else:
             logger.error("Failed to send notification to user %s: %s", tg_id, e)
     except Exception as e:
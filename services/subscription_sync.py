@@ -2,7 +2,8 @@ import logging
 from datetime import datetime, timezone
 
 import database as db
-from services.remnawave import remnawave_get_user_info
+from services.remnawave import remnawave_get_subscription_url, remnawave_get_user_info
+from services.remnawave_sync import fresh_mirror_rows
 
 
 logger = logging.getLogger(__name__)
@@ -20,6 +21,8 @@ def remnawave_expiry(user_info: dict | None) -> datetime | None:
     value = (user_info or {}).get("expireAt")
     if not value:
         return None
+    if isinstance(value, datetime):
+        return _as_utc_naive(value)
     try:
         parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
         return _as_utc_naive(parsed)
@@ -47,9 +50,28 @@ async def reconcile_subscription_expiry(subscription, user_info: dict | None) ->
     return remote_expiry
 
 
-async def refresh_subscription_expiry(subscription, session=None) -> datetime | None:
+async def refresh_subscription_expiry(subscription, session=None, *, prefer_mirror: bool = True) -> datetime | None:
+    """Актуальный срок подписки: из свежего зеркала Remnawave или живым запросом."""
     if not subscription.get("remnawave_uuid"):
         return _as_utc_naive(subscription.get("subscription_until"))
 
+    if prefer_mirror:
+        mirror_row = (await fresh_mirror_rows([subscription])).get(str(subscription["remnawave_uuid"]))
+        if mirror_row is not None:
+            return await reconcile_subscription_expiry(subscription, {"expireAt": mirror_row["expire_at"]})
+
     user_info = await remnawave_get_user_info(session, subscription["remnawave_uuid"])
     return await reconcile_subscription_expiry(subscription, user_info)
+
+
+async def stored_subscription_url(subscription, session=None) -> str | None:
+    """Ссылка подписки из БД; в Remnawave идём только для записей без сохранённой ссылки."""
+    if subscription.get("subscription_url"):
+        return subscription["subscription_url"]
+    if not subscription.get("remnawave_uuid"):
+        return None
+
+    subscription_url = await remnawave_get_subscription_url(session, subscription["remnawave_uuid"])
+    if subscription_url:
+        await db.set_subscription_url(subscription["id"], subscription_url)
+    return subscription_url
@@ -0,0 +1,213 @@
+"""Исходящие сообщения Telegram через общий темп и приоритетные очереди."""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramRetryAfter
+
+import database as db
+from config import (
+    TELEGRAM_CHAT_INTERVAL,
+    TELEGRAM_GLOBAL_BURST,
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_SEND_MAX_RETRIES,
+)
+
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_PAYMENT = 0  # подтверждения оплат и активаций
+PRIORITY_INTERACTIVE = 1  # ответы на действия пользователя и админа
+PRIORITY_NOTIFICATION = 2  # плановые уведомления о подписках
+PRIORITY_BULK = 3  # рассылки
+
+PRIORITY_NAMES = {
+    PRIORITY_PAYMENT: "payment",
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_NOTIFICATION: "notification",
+    PRIORITY_BULK: "bulk",
+}
+
+# Сколько ожидающих в полосе просматривать в поисках чата, которому уже можно
+# писать: первый в очереди может ждать свой чат, остальные — нет
+_LANE_SCAN_LIMIT = 64
+_CHAT_STATE_LIMIT = 10_000
+
+
+class _SendScheduler:
+    """Выдаёт разрешения на отправку по приоритету, глобальному и чатовому темпу."""
+
+    def __init__(self, rate: float, burst: int, chat_interval: float):
+        self.rate = rate
+        self.burst = burst
+        self.chat_interval = chat_interval
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lanes: dict[int, deque] = {priority: deque() for priority in PRIORITY_NAMES}
+        self.chat_ready_at: dict[int, float] = {}
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.wakeup: asyncio.Event | None = None
+        self.pump: asyncio.Task | None = None
+        self.sent = 0
+        self.sent_by_lane = {priority: 0 for priority in PRIORITY_NAMES}
+        self.retry_after_hits = 0
+        self.failed = 0
+        self.recent: deque[float] = deque()
+
+    async def acquire(self, chat_id: int, priority: int) -> None:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Новый event loop (перезапуск, тесты): старые ожидающие и задача
+            # планировщика принадлежат закрытому циклу
+            self.loop = loop
+            self.wakeup = asyncio.Event()
+            self.pump = None
+            for lane in self.lanes.values():
+                lane.clear()
+        waiter = loop.create_future()
+        self.lanes[priority].append((chat_id, waiter))
+        self._ensure_pump()
+        self.wakeup.set()
+        await waiter
+
+    def pause(self, seconds: float) -> None:
+        self.retry_after_hits += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        logger.warning("Telegram flood control: sending paused for %.1fs", seconds)
+
+    def record_sent(self, priority: int) -> None:
+        now = time.monotonic()
+        self.sent += 1
+        self.sent_by_lane[priority] += 1
+        self.recent.append(now)
+        while self.recent and self.recent[0] < now - 60:
+            self.recent.popleft()
+
+    def _ensure_pump(self) -> None:
+        if self.pump is None or self.pump.done():
+            self.pump = asyncio.create_task(self._run())
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _next_ready(self, now: float) -> tuple[deque, int, float | None]:
+        """Первый ожидающий, чей чат свободен, по приоритету; иначе — когда освободится ближайший."""
+        earliest = None
+        for priority in sorted(self.lanes):
+            lane = self.lanes[priority]
+            while lane and lane[0][1].done():
+                lane.popleft()
+            for index, (chat_id, waiter) in enumerate(lane):
+                if index >= _LANE_SCAN_LIMIT:
+                    break
+                if waiter.done():
+                    continue
+                ready_at = self.chat_ready_at.get(chat_id, 0.0)
+                if ready_at <= now:
+                    return lane, index, None
+                earliest = ready_at if earliest is None else min(earliest, ready_at)
+        return None, -1, earliest
+
+    async def _run(self) -> None:
+        while any(self.lanes.values()):
+            now = time.monotonic()
+            if self.paused_until > now:
+                await self._sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens < 1:
+                await self._sleep((1 - self.tokens) / self.rate)
+                continue
+            lane, index, earliest = self._next_ready(now)
+            if lane is None:
+                if earliest is None:
+                    continue
+                await self._sleep(earliest - now)
+                continue
+            chat_id, waiter = lane[index]
+            del lane[index]
+            self.tokens -= 1
+            self.chat_ready_at[chat_id] = now + self.chat_interval
+            if len(self.chat_ready_at) > _CHAT_STATE_LIMIT:
+                self.chat_ready_at = {key: value for key, value in self.chat_ready_at.items() if value > now}
+            waiter.set_result(None)
+            # Отдаём управление, чтобы получивший разрешение начал отправку
+            await asyncio.sleep(0)
+
+    async def _sleep(self, seconds: float) -> None:
+        """Ждать seconds или нового ожидающего (он может быть приоритетнее)."""
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout=max(seconds, 0.001))
+        except asyncio.TimeoutError:
+            pass
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        last_10s = sum(1 for sent_at in self.recent if sent_at >= now - 10)
+        return {
+            "rate_limit_per_second": self.rate,
+            "chat_interval_seconds": self.chat_interval,
+            "queued": {PRIORITY_NAMES[priority]: len(lane) for priority, lane in self.lanes.items()},
+            "sent_total": self.sent,
+            "sent_by_lane": {PRIORITY_NAMES[priority]: count for priority, count in self.sent_by_lane.items()},
+            "sent_last_minute": len(self.recent),
+            "send_rate_per_second": round(last_10s / 10, 2),
+            "retry_after_hits": self.retry_after_hits,
+            "failed_after_retries": self.failed,
+            "paused_for_seconds": round(max(self.paused_until - now, 0.0), 2),
+        }
+
+
+_scheduler = _SendScheduler(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST, TELEGRAM_CHAT_INTERVAL)
+
+
+async def send_telegram(call: Callable[[], Awaitable], chat_id: int, priority: int = PRIORITY_INTERACTIVE):
+    """Выполнить вызов Bot API к chat_id в общем темпе.
+
+    call — функция без аргументов, создающая новый запрос (повтор после
+    retry_after вызывает её снова). Прочие ошибки Telegram уходят вызывающему.
+    """
+    await db.release_bound_connection()
+    for attempt in range(TELEGRAM_SEND_MAX_RETRIES + 1):
+        await _scheduler.acquire(chat_id, priority)
+        try:
+            result = await call()
+        except TelegramRetryAfter as exc:
+            _scheduler.pause(float(exc.retry_after))
+            if attempt == TELEGRAM_SEND_MAX_RETRIES:
+                _scheduler.failed += 1
+                raise
+            continue
+        _scheduler.record_sent(priority)
+        return result
+
+
+async def send_telegram_message(bot, chat_id: int, text: str, *, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+    return await send_telegram(lambda: bot.send_message(chat_id, text, **kwargs), chat_id, priority)
+
+
+async def copy_telegram_message(
+    bot,
+    chat_id: int,
+    from_chat_id: int,
+    message_id: int,
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    **kwargs,
+):
+    return await send_telegram(
+        lambda: bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, **kwargs),
+        chat_id,
+        priority,
+    )
+
+
+def telegram_sender_stats() -> dict:
+    """Очереди по полосам, темп отправки и срабатывания flood control."""
+    return _scheduler.snapshot()
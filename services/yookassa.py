@@ -79,6 +79,7 @@ async def create_yookassa_payment(
         connector = aiohttp.TCPConnector(ssl=True)
         timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
 
+        await db.release_bound_connection()
         async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
             async with session.post(url, headers=headers, json=payload) as resp:
                 if resp.status in (200, 201):
@@ -117,6 +118,7 @@ async def get_payment_status(payment_id: str) -> dict | None:
         connector = aiohttp.TCPConnector(ssl=True)
         timeout = aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT)
 
+        await db.release_bound_connection()
         async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
             async with session.get(url, headers=headers) as resp:
                 if resp.status == 200:
@@ -1,4 +1,4 @@
-const state = { section: "dashboard", usersOffset: 0, usersSearch: "", usersTotal: 0, pageSize: 50 };
+const state = { section: "dashboard", usersCursors: [null], usersNextCursor: null, usersSearch: "", usersTotal: 0, pageSize: 50 };
 const titles = { dashboard: "Обзор", users: "Пользователи", promos: "Промокоды", links: "Ссылки", discounts: "Скидки" };
 const $ = (id) => document.getElementById(id);
 const esc = (value) => String(value ?? "").replace(/[&<>'"]/g, (ch) => ({ "&": "&amp;", "<": "&lt;", ">": "&gt;", "'": "&#39;", '"': "&quot;" }[ch]));
@@ -67,18 +67,20 @@ async function loadDashboard() {
   } catch (error) { toast(error.message, true); }
 }
 
-$("userSearchForm").addEventListener("submit", (event) => { event.preventDefault(); state.usersSearch = $("userSearch").value.trim(); state.usersOffset = 0; loadUsers(); });
+$("userSearchForm").addEventListener("submit", (event) => { event.preventDefault(); state.usersSearch = $("userSearch").value.trim(); state.usersCursors = [null]; loadUsers(); });
 async function loadUsers() {
   try {
-    const d = await api(`/users?q=${encodeURIComponent(state.usersSearch)}&limit=${state.pageSize}&offset=${state.usersOffset}`); state.usersTotal = d.total;
+    const cursor = state.usersCursors[state.usersCursors.length - 1];
+    const d = await api(`/users?q=${encodeURIComponent(state.usersSearch)}&limit=${state.pageSize}${cursor ? `&cursor=${encodeURIComponent(cursor)}` : ""}`); state.usersTotal = d.total; state.usersNextCursor = d.next_cursor;
     $("usersTable").innerHTML = d.items.length ? `<table><thead><tr><th>Пользователь</th><th>Создан</th><th>Подписки</th><th>Ближайший срок</th><th>Выручка</th><th></th></tr></thead><tbody>${d.items.map((u) => `<tr><td><b>${esc(u.web_login || u.username || "Без username")}</b> <span class="badge ${u.account_type === "web" ? "" : "off"}">${u.account_type === "web" ? "Сайт" : "Telegram"}</span><br><span class="mono muted">${u.account_type === "web" ? "Внутренний ID" : "Telegram ID"}: ${u.tg_id}</span></td><td>${date(u.created_at)}</td><td><span class="badge ${Number(u.active_subscriptions) ? "" : "off"}">${u.active_subscriptions} активных / ${u.subscriptions_count}</span></td><td>${date(u.latest_expiry)}</td><td>${money(u.revenue)}</td><td><button class="button small blue" data-user="${u.tg_id}">Открыть</button></td></tr>`).join("")}</tbody></table>` : `<div class="empty">Пользователи не найдены</div>`;
-    const prev = state.usersOffset > 0, next = state.usersOffset + state.pageSize < state.usersTotal;
-    const rangeStart = state.usersTotal ? state.usersOffset + 1 : 0;
-    $("usersPagination").innerHTML = `<span class="muted">${rangeStart}–${Math.min(state.usersOffset + state.pageSize, state.usersTotal)} из ${state.usersTotal}</span><button class="button small" data-page="prev" ${prev ? "" : "disabled"}>Назад</button><button class="button small" data-page="next" ${next ? "" : "disabled"}>Дальше</button>`;
+    const offset = (state.usersCursors.length - 1) * state.pageSize;
+    const prev = state.usersCursors.length > 1, next = Boolean(d.next_cursor);
+    const rangeStart = d.items.length ? offset + 1 : 0;
+    $("usersPagination").innerHTML = `<span class="muted">${rangeStart}–${offset + d.items.length}${d.total === null ? "" : ` из ${d.total}`}</span><button class="button small" data-page="prev" ${prev ? "" : "disabled"}>Назад</button><button class="button small" data-page="next" ${next ? "" : "disabled"}>Дальше</button>`;
   } catch (error) { toast(error.message, true); }
 }
 $("usersTable").addEventListener("click", (e) => { const button = e.target.closest("[data-user]"); if (button) openUser(button.dataset.user); });
-$("usersPagination").addEventListener("click", (e) => { const p = e.target.dataset.page; if (p === "prev") state.usersOffset = Math.max(0, state.usersOffset - state.pageSize); if (p === "next") state.usersOffset += state.pageSize; if (p) loadUsers(); });
+$("usersPagination").addEventListener("click", (e) => { const p = e.target.dataset.page; if (p === "prev" && state.usersCursors.length > 1) state.usersCursors.pop(); if (p === "next" && state.usersNextCursor) state.usersCursors.push(state.usersNextCursor); if (p) loadUsers(); });
 
 async function openUser(tgId) {
   try {
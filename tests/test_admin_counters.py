@@ -0,0 +1,36 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import database
+
+
+class ReconcileAdminCountersTests(unittest.IsolatedAsyncioTestCase):
+    async def test_only_drifted_metrics_are_reported(self):
+        conn = AsyncMock()
+        conn.transaction = MagicMock()
+        conn.fetchrow.side_effect = [
+            {"total_users": 10, "active_subscriptions": 4, "total_revenue": 500},
+            {"total_users": 12, "active_subscriptions": 4, "total_revenue": 500},
+        ]
+        conn.fetch.return_value = [{"kind": "total", "name": "total_users", "day": None, "delta": 2, "revenue_delta": 0}]
+
+        drift = await database._reconcile_admin_counters(conn)
+
+        self.assertEqual(drift, {"total_users": {"stored": 10, "actual": 12}})
+        statements = [call.args[0] for call in conn.execute.await_args_list]
+        self.assertFalse(any("LOCK TABLE" in query for query in statements))
+        self.assertEqual(conn.execute.await_args_list[0].args[1:], (["total_users"], [2]))
+
+
+class BumpAdminCountersTests(unittest.IsolatedAsyncioTestCase):
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_deltas_are_passed_in_counter_order(self, execute):
+        await database._bump_admin_counters(paid_payments=-1, revenue=-199)
+
+        query, params = execute.await_args.args
+        self.assertIn("admin_counters", query)
+        self.assertEqual(params, (0, -1, -199))
+
+
+if __name__ == "__main__":
+    unittest.main()
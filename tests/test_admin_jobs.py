@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from services import admin_jobs
+
+
+def _job(status="running"):
+    return {"id": 7, "kind": "reissue_links", "status": status}
+
+
+@patch("services.admin_jobs.db", new_callable=AsyncMock)
+class RunAdminJobTests(unittest.IsolatedAsyncioTestCase):
+    async def test_items_are_processed_with_bounded_concurrency(self, db):
+        pending = [list(range(1, 13)), []]
+        db.get_admin_job.return_value = _job()
+        db.mark_admin_job_running.return_value = True
+        db.get_pending_admin_job_items.side_effect = lambda job_id, limit: pending.pop(0)
+        db.get_subscription_by_id.side_effect = lambda subscription_id: {"id": subscription_id}
+        in_flight = 0
+        peak = 0
+
+        async def handler(subscription):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+            return subscription["id"] != 5, "boom"
+
+        with (
+            patch.dict(admin_jobs.JOB_HANDLERS, {"reissue_links": handler}),
+            patch.object(admin_jobs, "ADMIN_JOB_CONCURRENCY", 3),
+            patch.object(admin_jobs, "ADMIN_JOB_RATE_PER_SECOND", 0),
+        ):
+            await admin_jobs.run_admin_job(7)
+
+        self.assertLessEqual(peak, 3)
+        self.assertEqual(db.finish_admin_job_item.await_count, 12)
+        db.finish_admin_job_item.assert_any_await(7, 5, False, "boom")
+        db.finish_admin_job.assert_awaited_once_with(7, "done")
+
+    async def test_cancelled_job_stops_before_next_batch(self, db):
+        db.get_admin_job.side_effect = [_job(), _job(), _job("cancelled")]
+        db.mark_admin_job_running.return_value = True
+        db.get_pending_admin_job_items.return_value = [1, 2]
+        db.get_subscription_by_id.side_effect = lambda subscription_id: {"id": subscription_id}
+        handler = AsyncMock(return_value=(True, None))
+
+        with (
+            patch.dict(admin_jobs.JOB_HANDLERS, {"reissue_links": handler}),
+            patch.object(admin_jobs, "ADMIN_JOB_RATE_PER_SECOND", 0),
+        ):
+            await admin_jobs.run_admin_job(7)
+
+        self.assertEqual(handler.await_count, 2)
+        db.get_pending_admin_job_items.assert_awaited_once()
+        db.finish_admin_job.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
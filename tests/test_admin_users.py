@@ -0,0 +1,41 @@
+import unittest
+from datetime import datetime
+from unittest.mock import AsyncMock, patch
+
+import database
+
+
+def _row(tg_id, minute):
+    return {"tg_id": tg_id, "created_at": datetime(2026, 1, 1, 12, minute)}
+
+
+class AdminListUsersTests(unittest.IsolatedAsyncioTestCase):
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_extra_row_becomes_next_cursor(self, execute):
+        execute.side_effect = [[_row(3, 3), _row(2, 2), _row(1, 1)], {"count": 3}]
+
+        page = await database.admin_list_users("", 2)
+
+        self.assertEqual([item["tg_id"] for item in page["items"]], [3, 2])
+        self.assertEqual(page["total"], 3)
+        self.assertEqual(database.decode_admin_users_cursor(page["next_cursor"]), (datetime(2026, 1, 1, 12, 2), 2))
+        self.assertEqual(execute.await_args_list[0].args[1], (3,))
+
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_search_with_cursor_uses_keyset_and_skips_total(self, execute):
+        execute.return_value = [_row(1, 1)]
+        cursor = database.encode_admin_users_cursor(_row(2, 2))
+
+        page = await database.admin_list_users(" User_A ", 2, cursor)
+
+        query, params = execute.await_args.args[:2]
+        self.assertNotIn("OFFSET", query)
+        self.assertIn("(s.created_at, s.tg_id) < ($2, $3)", query)
+        self.assertEqual(params, ("%user_a%", datetime(2026, 1, 1, 12, 2), 2, 3))
+        self.assertIsNone(page["total"])
+        self.assertIsNone(page["next_cursor"])
+        execute.assert_awaited_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
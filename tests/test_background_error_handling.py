@@ -57,6 +57,11 @@ class _FakeContextSession:
         return False
 
 
+async def _batches(*batches):
+    for batch in batches:
+        yield batch
+
+
 class RemnawaveMissingUserTests(unittest.IsolatedAsyncioTestCase):
     async def test_a025_is_success_only_for_idempotent_cleanup(self):
         factory = _FakeRemnawaveSessionFactory(
@@ -64,7 +69,7 @@ class RemnawaveMissingUserTests(unittest.IsolatedAsyncioTestCase):
             {"message": "User not found", "errorCode": "A025"},
         )
 
-        with patch("services.remnawave.aiohttp.ClientSession", side_effect=factory):
+        with patch("services.remnawave.get_remnawave_session", side_effect=factory):
             result = await remnawave.remnawave_update_user_profile(
                 object(),
                 "missing-uuid",
@@ -83,7 +88,7 @@ class RemnawaveMissingUserTests(unittest.IsolatedAsyncioTestCase):
         )
 
         with (
-            patch("services.remnawave.aiohttp.ClientSession", side_effect=factory),
+            patch("services.remnawave.get_remnawave_session", side_effect=factory),
             patch("utils.asyncio.sleep", new_callable=AsyncMock),
         ):
             result = await remnawave.remnawave_update_user_profile(
@@ -102,7 +107,7 @@ class RemnawaveMissingUserTests(unittest.IsolatedAsyncioTestCase):
         )
 
         with (
-            patch("services.remnawave.aiohttp.ClientSession", side_effect=factory),
+            patch("services.remnawave.get_remnawave_session", side_effect=factory),
             patch("utils.asyncio.sleep", new_callable=AsyncMock),
         ):
             result = await remnawave.remnawave_update_user_profile(
@@ -120,7 +125,7 @@ class LegacyCleanupTests(unittest.IsolatedAsyncioTestCase):
     @patch("services.traffic_resets.aiohttp.ClientSession", return_value=_FakeContextSession())
     @patch("services.traffic_resets.db.mark_legacy_subscription_limit_removed", new_callable=AsyncMock)
     @patch("services.traffic_resets.remnawave_update_user_profile", new_callable=AsyncMock)
-    @patch("services.traffic_resets.db.get_legacy_subscriptions_pending_limit_removal", new_callable=AsyncMock)
+    @patch("services.traffic_resets.db.iter_legacy_subscriptions_pending_limit_removal")
     async def test_missing_legacy_user_is_marked_processed(
         self,
         get_pending,
@@ -129,9 +134,9 @@ class LegacyCleanupTests(unittest.IsolatedAsyncioTestCase):
         _client_session,
         _connector,
     ):
-        get_pending.return_value = [
+        get_pending.return_value = _batches([
             {"id": 62, "remnawave_uuid": "missing-uuid"},
-        ]
+        ])
         update_profile.return_value = True
 
         await traffic_resets.process_pending_legacy_limit_removals()
@@ -149,7 +154,7 @@ class LegacyCleanupTests(unittest.IsolatedAsyncioTestCase):
     @patch("services.traffic_resets.aiohttp.ClientSession", return_value=_FakeContextSession())
     @patch("services.traffic_resets.db.mark_legacy_subscription_limit_removed", new_callable=AsyncMock)
     @patch("services.traffic_resets.remnawave_update_user_profile", new_callable=AsyncMock)
-    @patch("services.traffic_resets.db.get_legacy_subscriptions_pending_limit_removal", new_callable=AsyncMock)
+    @patch("services.traffic_resets.db.iter_legacy_subscriptions_pending_limit_removal")
     async def test_transient_failure_stays_pending(
         self,
         get_pending,
@@ -158,9 +163,9 @@ class LegacyCleanupTests(unittest.IsolatedAsyncioTestCase):
         _client_session,
         _connector,
     ):
-        get_pending.return_value = [
+        get_pending.return_value = _batches([
             {"id": 63, "remnawave_uuid": "temporarily-unavailable-uuid"},
-        ]
+        ])
         update_profile.return_value = False
 
         await traffic_resets.process_pending_legacy_limit_removals()
@@ -0,0 +1,38 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from services import batch_executor
+
+
+@patch("services.batch_executor.db", new_callable=AsyncMock)
+class SubscriptionBatchTests(unittest.IsolatedAsyncioTestCase):
+    async def test_addon_counts_are_prefetched_once_per_batch(self, db):
+        db.get_active_device_addon_counts.side_effect = lambda ids: {item: item % 2 for item in ids}
+        seen = {}
+        in_flight = 0
+        peak = 0
+
+        async def handle(subscription, active_device_addons):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+            seen[subscription["id"]] = active_device_addons
+            if subscription["id"] == 3:
+                raise RuntimeError("upstream down")
+            return subscription["id"] != 4
+
+        subscriptions = [{"id": item} for item in range(1, 8)]
+        stats = await batch_executor.run_subscription_batches("test", subscriptions, handle, workers=2, batch_size=3)
+
+        self.assertEqual(db.get_active_device_addon_counts.await_count, 3)
+        self.assertEqual(seen, {item: item % 2 for item in range(1, 8)})
+        self.assertLessEqual(peak, 2)
+        self.assertEqual((stats["batches"], stats["succeeded"], stats["failed"]), (3, 5, 2))
+        self.assertEqual(batch_executor.background_batch_stats()["test"]["total"], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
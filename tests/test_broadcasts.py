@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import CopyMessage
+
+from services import broadcasts
+
+
+def _job(status="running", cursor=0):
+    return {
+        "id": 7,
+        "mode": "all",
+        "status": status,
+        "source_chat_id": 1,
+        "source_message_id": 2,
+        "buttons": [],
+        "cursor_tg_id": cursor,
+        "total": 3,
+        "sent": 0,
+        "blocked": 0,
+        "unreachable": 0,
+        "errors": 0,
+        "last_error": None,
+        "notify_chat_id": None,
+        "notify_message_id": None,
+    }
+
+
+class BroadcastJobTests(unittest.IsolatedAsyncioTestCase):
+    def patch_db(self, batches, statuses=None):
+        db = AsyncMock()
+        statuses = list(statuses or [])
+        db.get_broadcast_job.side_effect = lambda job_id: _job(statuses.pop(0) if statuses else "running", cursor=5)
+        db.mark_broadcast_job_running.return_value = True
+        db.get_broadcast_batch.side_effect = batches
+        db.checkpoint_broadcast_job.return_value = _job()
+        db.finish_broadcast_job.return_value = _job("done")
+        patcher = patch.object(broadcasts, "db", db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return db
+
+    async def test_resumes_from_cursor_and_records_each_outcome(self):
+        db = self.patch_db([[10, 11, 12], []])
+        blocked = TelegramForbiddenError(method=CopyMessage(chat_id=11, from_chat_id=1, message_id=2), message="Forbidden: bot was blocked by the user")
+
+        async def copy(bot, chat_id, *args, **kwargs):
+            if chat_id == 11:
+                raise blocked
+
+        with patch.object(broadcasts, "copy_telegram_message", side_effect=copy):
+            await broadcasts.run_broadcast_job(7, bot=None)
+
+        self.assertEqual(db.get_broadcast_batch.await_args_list[0].args, (7, 5, broadcasts.BROADCAST_BATCH_SIZE))
+        outcomes = {call.args[1]: call.args[2] for call in db.record_broadcast_outcome.await_args_list}
+        self.assertEqual(outcomes, {10: "sent", 11: "blocked", 12: "sent"})
+        db.checkpoint_broadcast_job.assert_awaited_once_with(7, 12)
+        db.finish_broadcast_job.assert_awaited_once_with(7, "done")
+
+    async def test_stopped_job_is_left_for_resume(self):
+        db = self.patch_db([[10]], statuses=["running", "stopped"])
+
+        with patch.object(broadcasts, "copy_telegram_message", new_callable=AsyncMock) as copy:
+            await broadcasts.run_broadcast_job(7, bot=None)
+
+        copy.assert_not_awaited()
+        db.finish_broadcast_job.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
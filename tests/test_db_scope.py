@@ -0,0 +1,177 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import database as db
+
+
+class _FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.busy = False
+
+    async def fetchrow(self, query, *params):
+        if self.busy:
+            raise RuntimeError("another operation is in progress")
+        self.busy = True
+        await asyncio.sleep(0)
+        self.busy = False
+        self.statements.append(query)
+        return {"query": query, "n": len(self.statements)}
+
+    async def execute(self, query, *params):
+        self.statements.append(query)
+
+    def transaction(self):
+        return _FakeTransaction()
+
+
+class _FakeTransaction:
+    async def start(self):
+        pass
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+class _FakePool:
+    def __init__(self):
+        self.acquired = 0
+        self.released = 0
+
+    async def acquire(self, timeout=None):
+        self.acquired += 1
+        return _FakeConnection()
+
+    async def release(self, conn):
+        self.released += 1
+
+
+class ConnectionScopeTests(unittest.IsolatedAsyncioTestCase):
+    async def test_statements_in_scope_share_one_connection(self):
+        pool = _FakePool()
+        with patch.dict(db._pools, {"interactive": pool}), patch.object(db, "DB_BIND_CONNECTION", True):
+            async with db.connection_scope() as bound:
+                for item in range(4):
+                    await db.db_execute(f"SELECT {item}", fetch_one=True)
+                conn = bound.conn
+
+            self.assertEqual((pool.acquired, pool.released), (1, 1))
+            self.assertEqual(len(conn.statements), 4)
+            self.assertIsNone(db._bound_connection.get())
+
+    async def test_spawned_task_does_not_use_scope_connection(self):
+        pool = _FakePool()
+        started = asyncio.Event()
+        resume = asyncio.Event()
+
+        async def background():
+            started.set()
+            await resume.wait()
+            return await db.db_execute("SELECT 2", fetch_one=True)
+
+        with patch.dict(db._pools, {"interactive": pool}), patch.object(db, "DB_BIND_CONNECTION", True):
+            async with db.connection_scope() as bound:
+                await db.db_execute("SELECT 1", fetch_one=True)
+                task = asyncio.create_task(background())
+                await started.wait()
+            resume.set()
+            row = await task
+
+        self.assertEqual(row["n"], 1)
+        self.assertEqual((pool.acquired, pool.released), (2, 2))
+
+    async def test_connection_is_returned_during_outbound_calls(self):
+        pool = _FakePool()
+        with patch.dict(db._pools, {"interactive": pool}), patch.object(db, "DB_BIND_CONNECTION", True):
+            async with db.connection_scope() as bound:
+                await db.db_execute("SELECT 1", fetch_one=True)
+                await db.release_bound_connection()
+                self.assertEqual(pool.released, 1)
+                await db.db_execute("SELECT 2", fetch_one=True)
+                async with db.transaction():
+                    await db.release_bound_connection()
+                    self.assertIsNotNone(bound.conn)
+
+        self.assertEqual((pool.acquired, pool.released), (2, 2))
+
+    async def test_nested_scope_reuses_outer_connection(self):
+        pool = _FakePool()
+        with patch.dict(db._pools, {"interactive": pool}), patch.object(db, "DB_BIND_CONNECTION", True):
+            async with db.connection_scope() as outer:
+                async with db.connection_scope() as inner:
+                    self.assertIs(inner, outer)
+                    await db.db_execute("SELECT 1", fetch_one=True)
+                self.assertFalse(outer.closed)
+
+        self.assertEqual(pool.acquired, 1)
+
+
+class ReadMemoTests(unittest.IsolatedAsyncioTestCase):
+    async def test_repeated_reads_hit_memo_until_write(self):
+        pool = _FakePool()
+        with patch.dict(db._pools, {"interactive": pool}), patch.object(db, "DB_BIND_CONNECTION", True):
+            async with db.connection_scope() as bound:
+                first = await db.get_subscription_by_id(5)
+                again = await db.get_subscription_by_id(5)
+                user = await db.get_user(1)
+                await db.set_subscription_url(5, "https://sub.example/sub/x")
+                fresh = await db.get_subscription_by_id(5)
+                self.assertEqual(await db.get_user(1), user)
+                await db.db_execute("UPDATE users SET username = 'x' WHERE tg_id = 1")
+                await db.get_user(1)
+                hits, statements = bound.memo_hits, len(bound.conn.statements)
+
+        self.assertIs(first, again)
+        self.assertNotEqual(first, fresh)
+        self.assertEqual(hits, 2)
+        self.assertEqual(statements, 6)
+
+    async def test_subscription_write_refreshes_user_row(self):
+        pool = _FakePool()
+        with (
+            patch.dict(db._pools, {"interactive": pool}),
+            patch.object(db, "DB_BIND_CONNECTION", True),
+            patch.object(db, "get_subscription_by_id", AsyncMock(return_value={"tg_id": 1})),
+            patch.object(db, "get_subscription_by_slot", AsyncMock(return_value=None)),
+        ):
+            async with db.connection_scope():
+                before = await db.get_user(1)
+                await db.sync_subscription_expiry(5, None)
+                after = await db.get_user(1)
+
+        self.assertNotEqual(before, after)
+
+
+class WorkloadPoolTests(unittest.IsolatedAsyncioTestCase):
+    async def test_analytics_reads_leave_the_bound_interactive_connection(self):
+        pools = {"interactive": _FakePool(), "analytics": _FakePool(), "replica": _FakePool()}
+        with patch.dict(db._pools, pools), patch.object(db, "DB_BIND_CONNECTION", True):
+            async with db.connection_scope():
+                await db.db_execute("SELECT 1", fetch_one=True)
+                with db.workload("analytics"):
+                    await db.db_execute("SELECT 2", fetch_one=True)
+                    await db.db_execute("UPDATE admin_counters SET value = 0")
+                await db.db_execute("SELECT 3", fetch_one=True)
+
+        self.assertEqual(pools["interactive"].acquired, 1)
+        self.assertEqual(pools["replica"].acquired, 1)
+        self.assertEqual(pools["analytics"].acquired, 1)
+        self.assertEqual(pools["replica"].released, 1)
+
+    async def test_background_scope_binds_background_pool(self):
+        pools = {"interactive": _FakePool(), "background": _FakePool()}
+        with patch.dict(db._pools, pools), patch.object(db, "DB_BIND_CONNECTION", True):
+            with db.workload("background"):
+                async with db.connection_scope() as bound:
+                    await db.db_execute("SELECT 1", fetch_one=True)
+
+        self.assertEqual(bound.pool_name, "background")
+        self.assertEqual((pools["background"].acquired, pools["interactive"].acquired), (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
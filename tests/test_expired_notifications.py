@@ -0,0 +1,37 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from services import subscription_notifications
+
+
+async def _batches(*batches):
+    for batch in batches:
+        yield batch
+
+
+@patch("services.subscription_notifications.db")
+class ExpiredNotificationTests(unittest.IsolatedAsyncioTestCase):
+    async def test_recipients_come_from_one_set_based_query(self, db):
+        db.iter_expired_notification_recipients = MagicMock(return_value=_batches([
+            {"tg_id": 1, "last_expired_at": datetime.utcnow() - timedelta(days=3, hours=1)},
+            {"tg_id": 2, "last_expired_at": None},
+        ]))
+        db.mark_notification_state_sent = AsyncMock()
+
+        with patch.object(subscription_notifications, "_send_message", new_callable=AsyncMock, return_value=True) as send:
+            await subscription_notifications._send_notifications_for_expired(AsyncMock())
+
+        db.iter_expired_notification_recipients.assert_called_once_with(
+            subscription_notifications.EXPIRED_NOTIFICATION_TYPE,
+            subscription_notifications.EXPIRED_COOLDOWN_HOURS,
+            subscription_notifications.TELEGRAM_DELIVERY_BLOCKED_NOTIFICATION_TYPE,
+        )
+        self.assertIn("3 дн. назад", send.await_args_list[0].args[2])
+        self.assertIn("Активной подписки нет", send.await_args_list[1].args[2])
+        self.assertEqual(db.mark_notification_state_sent.await_count, 2)
+        db.get_user_subscriptions.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from unittest.mock import patch
+
+from scripts.fake_remnawave import STATE_KEY, FaultInjection, start_fake_remnawave
+from services import remnawave
+
+
+class FakeRemnawaveTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        remnawave._breakers.clear()
+        remnawave._user_info_cache.clear()
+        self.faults = FaultInjection()
+        self.runner, base_url = await start_fake_remnawave(faults=self.faults, api_token="fake-token")
+        self.state = self.runner.app[STATE_KEY]
+        self.patches = [
+            patch.object(remnawave, "REMNAWAVE_BASE_URL", f"{base_url}/api"),
+            patch.object(remnawave, "REMNAWAVE_API_TOKEN", "fake-token"),
+            patch("services.remnawave.normalize_subscription_url", side_effect=lambda url: url),
+        ]
+        for item in self.patches:
+            item.start()
+
+    async def asyncTearDown(self):
+        for item in reversed(self.patches):
+            item.stop()
+        await remnawave.close_remnawave_session()
+        await self.runner.cleanup()
+        remnawave._breakers.clear()
+
+    async def test_client_helpers_round_trip(self):
+        user_uuid, username = await remnawave.remnawave_get_or_create_user(
+            None, 101, 30, remna_username="tg_101_regular_1", hwid_device_limit=3,
+        )
+        self.assertEqual(self.state.users[user_uuid]["username"], username)
+
+        first_url = await remnawave.remnawave_get_subscription_url(None, user_uuid)
+        self.assertTrue(await remnawave.remnawave_revoke_subscription(None, user_uuid))
+        self.assertNotEqual(await remnawave.remnawave_get_subscription_url(None, user_uuid), first_url)
+
+        self.state.users[user_uuid]["usedTrafficBytes"] = 512
+        self.assertTrue(await remnawave.remnawave_reset_user_traffic(None, user_uuid))
+        usage = await remnawave.remnawave_get_user_usage(None, user_uuid)
+        self.assertEqual(usage["usedTrafficBytes"], 0)
+        self.assertEqual(await remnawave.remnawave_get_hwid_devices(None, user_uuid), [])
+
+    async def test_injected_errors_reach_the_client(self):
+        self.faults.error_rate = 1.0
+        with patch("utils.asyncio.sleep"):
+            self.assertIsNone(await remnawave.remnawave_get_user_info(None, "missing", use_cache=False))
+        self.assertGreater(self.state.requests["GET /api/users/{user_uuid}"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
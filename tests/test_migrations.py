@@ -0,0 +1,42 @@
+import unittest
+from unittest.mock import patch
+
+import database as db
+
+
+class MigrationLedgerTests(unittest.TestCase):
+    def test_applied_steps_are_not_pending(self):
+        applied = {step.version: {"checksum": step.checksum()} for step in db.MIGRATIONS}
+
+        self.assertEqual(db._pending_migrations(applied), [])
+        self.assertEqual(
+            [step.version for step in db._pending_migrations(applied, force=True)],
+            [step.version for step in db.MIGRATIONS if step.repeatable],
+        )
+
+    def test_changed_repeatable_step_is_rerun(self):
+        applied = {step.version: {"checksum": step.checksum()} for step in db.MIGRATIONS}
+        applied[1]["checksum"] = "outdated"
+
+        self.assertEqual([step.version for step in db._pending_migrations(applied)], [1])
+
+    def test_changed_versioned_step_is_rejected(self):
+        async def apply(conn):
+            return None
+
+        step = db.MigrationStep(999, "test_step", apply)
+        applied = {item.version: {"checksum": item.checksum()} for item in db.MIGRATIONS}
+        applied[999] = {"checksum": "outdated"}
+        migrations = db.MIGRATIONS + [step]
+
+        with patch.object(db, "MIGRATIONS", migrations):
+            with self.assertRaises(RuntimeError):
+                db._pending_migrations(applied)
+
+    def test_versions_are_unique(self):
+        versions = [step.version for step in db.MIGRATIONS]
+        self.assertEqual(len(versions), len(set(versions)))
+
+
+if __name__ == "__main__":
+    unittest.main()
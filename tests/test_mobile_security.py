@@ -239,6 +239,49 @@ class MobileSessionScopeTests(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(actual, expected)
 
 
+class _ProfileRequest:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+    async def json(self):
+        return {"hwid": "device-hwid-0001"}
+
+
+class ProfileCacheTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        mobile_api._profile_cache.clear()
+        mobile_api._profile_cache_bytes = 0
+
+    async def test_unchanged_profile_is_revalidated_with_etag(self):
+        subscription = {
+            "id": 77,
+            "remnawave_uuid": uuid.uuid4(),
+            "subscription_until": datetime.utcnow() + timedelta(days=3),
+            "subscription_url": "https://sub.wayspn.online/sub/abc",
+        }
+        fetch = AsyncMock(return_value={
+            "status": 200,
+            "body": b"vless://one\nvmess://blocked\n",
+            "content_type": "text/plain; charset=utf-8",
+            "headers": {},
+        })
+        with (
+            patch("mobile_api._owned_subscription", new=AsyncMock(return_value=subscription)),
+            patch("mobile_api.remnawave_fetch_subscription_profile", new=fetch),
+        ):
+            first = await mobile_api.mobile_subscription_profile(77, _ProfileRequest(), session={})
+            second = await mobile_api.mobile_subscription_profile(
+                77,
+                _ProfileRequest({"If-None-Match": first.headers["etag"]}),
+                session={},
+            )
+
+        self.assertEqual(first.body, b"vless://one\n")
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.body, b"")
+        fetch.assert_awaited_once()
+
+
 class CryptoWebhookSignatureTests(unittest.TestCase):
     def test_valid_and_forged_signatures(self):
         raw = b'{"update_type":"invoice_paid","payload":{"invoice_id":1}}'
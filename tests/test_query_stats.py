@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import patch
+
+import database as db
+
+
+class _FakeConnection:
+    async def fetch(self, query, *params):
+        return [{"n": 1}, {"n": 2}]
+
+    async def execute(self, query, *params):
+        return "UPDATE 3"
+
+
+class _FakePool:
+    def __init__(self):
+        self.released = 0
+
+    async def acquire(self, timeout=None):
+        return _FakeConnection()
+
+    async def release(self, conn):
+        self.released += 1
+
+
+async def list_things():
+    return await db.db_execute("SELECT n FROM things", fetch_all=True)
+
+
+async def touch_things(token):
+    await db.db_execute("UPDATE things SET token = $1", (token,))
+
+
+async def read_with_pool():
+    pool = await db.get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetch("SELECT 1")
+
+
+class QueryStatsTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        db.reset_query_stats()
+        self.addCleanup(db.reset_query_stats)
+
+    async def test_records_calls_rows_and_pool_wait_by_caller(self):
+        pool = _FakePool()
+        with patch.dict(db._pools, {"interactive": pool}):
+            await list_things()
+            await list_things()
+            await touch_things("secret")
+            await read_with_pool()
+
+        report = {item["name"].removeprefix(f"{__name__}."): item for item in db.query_stats()["queries"]}
+        self.assertEqual(report["list_things"]["calls"], 2)
+        self.assertEqual(report["list_things"]["rows"], 4)
+        self.assertEqual(report["touch_things"]["rows"], 3)
+        self.assertEqual(report["read_with_pool"]["calls"], 1)
+        self.assertEqual(pool.released, 4)
+        self.assertEqual(sum(report["list_things"]["histogram"].values()), 2)
+
+    async def test_slow_queries_are_logged_without_parameter_values(self):
+        with patch.dict(db._pools, {"interactive": _FakePool()}), patch.object(db, "DB_SLOW_QUERY_MS", 0.000001):
+            with self.assertLogs("database.slow", level="WARNING") as logs:
+                await touch_things("secret-token")
+
+        slow = db.query_stats()["slow"]
+        self.assertEqual(slow[0]["params"], ["<str:12>"])
+        self.assertNotIn("secret-token", "\n".join(logs.output))
+
+
+if __name__ == "__main__":
+    unittest.main()
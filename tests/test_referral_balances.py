@@ -0,0 +1,47 @@
+import unittest
+from decimal import Decimal
+from unittest.mock import AsyncMock, patch
+
+import database
+
+
+class ReferralStatsTests(unittest.IsolatedAsyncioTestCase):
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_stats_come_from_one_query(self, execute):
+        execute.return_value = {
+            "referred_users": 3,
+            "earned": Decimal("350"),
+            "withdrawn": Decimal("100"),
+            "earnings_by_tariff": '[{"tariff_code": "1m", "purchase_count": 4, "total_share": 350}]',
+        }
+
+        stats = await database.get_referral_stats(1)
+
+        execute.assert_awaited_once()
+        self.assertEqual(stats["active_referrals"], 3)
+        self.assertEqual(stats["current_balance"], 250.0)
+        self.assertEqual(stats["earnings_by_tariff"][0]["purchase_count"], 4)
+
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_missing_partnership_has_no_stats(self, execute):
+        execute.return_value = None
+
+        self.assertIsNone(await database.get_partner_stats(1))
+        execute.assert_awaited_once()
+
+
+class ReferralLedgerWritesTests(unittest.IsolatedAsyncioTestCase):
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_earning_and_withdrawal_update_the_balance_in_the_same_statement(self, execute):
+        await database.add_referral_earning(1, 2, "1m", 200, is_first_purchase=True)
+        await database.create_referral_withdrawal_request(1, 70, "sbp", phone_number="+70000000000")
+
+        earning_query, earning_params = execute.await_args_list[0].args
+        withdrawal_query, _ = execute.await_args_list[1].args
+        self.assertIn("INSERT INTO referral_balances", earning_query)
+        self.assertEqual(earning_params[4], 70)
+        self.assertIn("INSERT INTO referral_balances", withdrawal_query)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from services import remnawave
+
+
+class SharedClientTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await remnawave.close_remnawave_session()
+
+    async def test_helpers_reuse_one_pooled_session(self):
+        first = remnawave.get_remnawave_session()
+        second = remnawave.get_remnawave_session()
+
+        self.assertIs(first, second)
+        self.assertIs(first.connector._ssl, remnawave._verified_ssl_context())
+        self.assertTrue(first.connector.use_dns_cache)
+
+    async def test_closed_session_is_recreated(self):
+        first = remnawave.get_remnawave_session()
+        await remnawave.close_remnawave_session()
+
+        self.assertTrue(first.closed)
+        self.assertIsNot(remnawave.get_remnawave_session(), first)
+
+    async def test_session_from_previous_loop_is_closed(self):
+        stale = remnawave.get_remnawave_session()
+        with patch.object(remnawave, "_client_loop", object()):
+            fresh = remnawave.get_remnawave_session()
+        await asyncio.gather(*remnawave._closing_sessions)
+
+        self.assertIsNot(fresh, stale)
+        self.assertTrue(stale.closed)
+
+
+class UserInfoCacheTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        remnawave._user_info_cache.clear()
+        remnawave._user_info_refreshes.clear()
+        for key in remnawave._user_info_cache_stats:
+            remnawave._user_info_cache_stats[key] = 0
+
+    async def test_second_read_is_served_from_cache(self):
+        fetch = AsyncMock(return_value={"uuid": "u1", "expireAt": "2026-01-01T00:00:00Z"})
+        with patch("services.remnawave._fetch_user_info", new=fetch):
+            first = await remnawave.remnawave_get_user_info(None, "u1")
+            second = await remnawave.remnawave_get_user_info(None, "u1")
+
+        self.assertEqual(first, second)
+        fetch.assert_awaited_once()
+        stats = remnawave.remnawave_user_info_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    async def test_mutation_invalidates_entry(self):
+        fetch = AsyncMock(return_value={"uuid": "u2"})
+        with (
+            patch("services.remnawave._fetch_user_info", new=fetch),
+            patch("services.remnawave.safe_api_call", new=AsyncMock(return_value=True)),
+        ):
+            await remnawave.remnawave_get_user_info(None, "u2")
+            await remnawave.remnawave_reset_user_traffic(None, "u2")
+            await remnawave.remnawave_get_user_info(None, "u2")
+
+        self.assertEqual(fetch.await_count, 2)
+
+    async def test_stale_entry_is_served_while_refreshing(self):
+        remnawave._user_info_cache_put("u3", time.monotonic() - remnawave.REMNAWAVE_USER_INFO_CACHE_TTL - 1, {"v": 1})
+        fetch = AsyncMock(return_value={"v": 2})
+        with patch("services.remnawave._fetch_user_info", new=fetch):
+            stale = await remnawave.remnawave_get_user_info(None, "u3")
+            await asyncio.gather(*remnawave._user_info_refreshes.values())
+            fresh = await remnawave.remnawave_get_user_info(None, "u3")
+
+        self.assertEqual(stale, {"v": 1})
+        self.assertEqual(fresh, {"v": 2})
+        fetch.assert_awaited_once()
+
+
+class SingleFlightTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        remnawave._inflight_requests.clear()
+        remnawave._coalescing_stats.clear()
+
+    async def test_concurrent_reads_share_one_request(self):
+        release = asyncio.Event()
+
+        async def slow_fetch(user_uuid):
+            await release.wait()
+            return [{"hwid": "device-1"}]
+
+        fetch = AsyncMock(side_effect=slow_fetch)
+        with patch("services.remnawave._fetch_hwid_devices", new=fetch):
+            callers = [
+                asyncio.create_task(remnawave.remnawave_get_hwid_devices(None, "u4"))
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*callers)
+
+        fetch.assert_awaited_once()
+        self.assertEqual(results, [[{"hwid": "device-1"}]] * 3)
+        self.assertIsNot(results[0], results[1])
+        self.assertEqual(remnawave.remnawave_coalescing_stats()["deduplicated"], 2)
+        self.assertEqual(remnawave.remnawave_coalescing_stats()["in_flight"], 0)
+
+
+class _StatusResponse:
+    def __init__(self, status):
+        self.status = status
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        return False
+
+    async def text(self):
+        return "upstream error"
+
+
+class _StatusSession:
+    def __init__(self, status):
+        self.status = status
+        self.calls = 0
+
+    def patch(self, *args, **kwargs):
+        self.calls += 1
+        return _StatusResponse(self.status)
+
+
+class CircuitBreakerTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        remnawave._breakers.clear()
+        remnawave._limiter.limit = float(remnawave.REMNAWAVE_CONCURRENCY_MAX)
+
+    def tearDown(self):
+        self.setUp()
+
+    async def test_open_circuit_fails_fast_without_retries(self):
+        session = _StatusSession(503)
+        with (
+            patch("services.remnawave.get_remnawave_session", return_value=session),
+            patch("utils.asyncio.sleep", new_callable=AsyncMock),
+            patch.object(remnawave, "REMNAWAVE_BREAKER_FAILURES", 3),
+        ):
+            self.assertFalse(await remnawave.remnawave_update_user_profile(None, "u5", hwid_device_limit=3))
+            self.assertFalse(await remnawave.remnawave_update_user_profile(None, "u5", hwid_device_limit=3))
+
+        self.assertEqual(session.calls, 3)
+        breaker = remnawave.remnawave_resilience_stats()["breakers"]["PATCH /users"]
+        self.assertEqual(breaker["state"], "open")
+        self.assertEqual(breaker["rejected"], 1)
+        self.assertLess(remnawave._limiter.limit, remnawave.REMNAWAVE_CONCURRENCY_MAX)
+
+    async def test_successful_probe_closes_circuit(self):
+        breaker = remnawave._CircuitBreaker("GET /users/{id}")
+        with patch.object(remnawave, "REMNAWAVE_BREAKER_FAILURES", 1):
+            breaker.record(False)
+        self.assertEqual(breaker.state, "open")
+
+        breaker.opened_at -= remnawave.REMNAWAVE_BREAKER_OPEN_SECONDS
+        breaker.before_request()
+        self.assertEqual(breaker.state, "half_open")
+        with self.assertRaises(remnawave.RemnawaveUnavailableError):
+            breaker.before_request()
+        breaker.record(True)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_endpoint_names_hide_identifiers(self):
+        base = remnawave.REMNAWAVE_BASE_URL
+        self.assertEqual(
+            remnawave._endpoint_name("get", f"{base}/users/0f8b6a3e-3c1e-4d55-9a55-2b8c1b7a9c11"),
+            "GET /users/{id}",
+        )
+        self.assertEqual(remnawave._endpoint_name("get", f"{base}/users/by-username/tg_1"), "GET /users/by-username/{id}")
@@ -0,0 +1,160 @@
+import re
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, patch
+
+import database
+from services import remnawave_sync, subscription_sync
+
+
+class MirrorRowTests(unittest.TestCase):
+    def test_user_is_converted_to_mirror_row(self):
+        row = remnawave_sync.mirror_row_from_user({
+            "uuid": "11111111-1111-1111-1111-111111111111",
+            "username": "tg_1_bypass_1",
+            "status": "ACTIVE",
+            "expireAt": "2026-11-01T12:00:00.000Z",
+            "userTraffic": {"usedTrafficBytes": 1024},
+            "trafficLimitBytes": 2048,
+            "shortUuid": "abcdefgh",
+        })
+
+        self.assertEqual(row["expire_at"], datetime(2026, 11, 1, 12, 0))
+        self.assertEqual(row["used_traffic_bytes"], 1024)
+        self.assertEqual(row["traffic_limit_bytes"], 2048)
+        self.assertTrue(row["subscription_url"].endswith("/sub/abcdefgh"))
+
+
+@patch("services.remnawave_sync.db", new_callable=AsyncMock)
+class SyncPassTests(unittest.IsolatedAsyncioTestCase):
+    async def test_pages_until_total_and_counts_changes(self, db):
+        db.start_background_sync.return_value = datetime(2026, 10, 1)
+        db.upsert_remnawave_mirror_rows.side_effect = lambda rows: [rows[0]["remnawave_uuid"]]
+        db.get_subscription_expiry_drift_from_mirror.return_value = []
+        db.refresh_subscription_urls_from_mirror.return_value = 0
+        pages = [
+            {"users": [{"uuid": f"u{i}"} for i in range(2)], "total": 3},
+            {"users": [{"uuid": "u2"}], "total": 3},
+        ]
+        with (
+            patch.object(remnawave_sync, "REMNAWAVE_SYNC_PAGE_SIZE", 2),
+            patch("services.remnawave_sync.remnawave_list_users", new=AsyncMock(side_effect=pages)) as list_users,
+        ):
+            stats = await remnawave_sync.sync_remnawave_users_once(full=True)
+
+        self.assertEqual(list_users.await_count, 2)
+        self.assertEqual((stats["seen"], stats["changed"]), (3, 2))
+        db.delete_remnawave_mirror_rows_except.assert_awaited_once_with(["u0", "u1", "u2"])
+        self.assertIsNone(db.finish_background_sync.await_args.kwargs.get("error"))
+
+    async def test_incremental_pass_stops_at_mirror_watermark(self, db):
+        db.start_background_sync.return_value = datetime(2026, 10, 1)
+        db.get_remnawave_mirror_watermark.return_value = datetime(2026, 9, 30, 12, 0)
+        db.upsert_remnawave_mirror_rows.return_value = []
+        db.get_subscription_expiry_drift_from_mirror.return_value = []
+        db.refresh_subscription_urls_from_mirror.return_value = 0
+        pages = [
+            {"users": [{"uuid": "u0", "updatedAt": "2026-09-30T12:30:00Z"}, {"uuid": "u1", "updatedAt": "2026-09-30T11:00:00Z"}], "total": 1000},
+            {"users": [{"uuid": "u2", "updatedAt": "2026-09-30T10:00:00Z"}], "total": 1000},
+        ]
+        with (
+            patch.object(remnawave_sync, "REMNAWAVE_SYNC_PAGE_SIZE", 2),
+            patch("services.remnawave_sync.remnawave_list_users", new=AsyncMock(side_effect=pages)) as list_users,
+        ):
+            stats = await remnawave_sync.sync_remnawave_users_once()
+
+        self.assertEqual(list_users.await_count, 1)
+        self.assertTrue(list_users.await_args.kwargs["newest_first"])
+        self.assertEqual(stats["seen"], 2)
+        db.delete_remnawave_mirror_rows_except.assert_not_awaited()
+
+    async def test_locally_changed_subscription_is_not_served_from_mirror(self, db):
+        snapshot_at = datetime.utcnow() - timedelta(minutes=1)
+        db.get_background_sync_state.return_value = {"snapshot_at": snapshot_at}
+        db.get_remnawave_mirror_rows.return_value = {"a": {"expire_at": None}, "b": {"expire_at": None}}
+
+        rows = await remnawave_sync.fresh_mirror_rows([
+            {"remnawave_uuid": "a", "updated_at": snapshot_at - timedelta(minutes=5)},
+            {"remnawave_uuid": "b", "updated_at": snapshot_at + timedelta(seconds=10)},
+        ])
+
+        self.assertEqual(set(rows), {"a"})
+
+
+@patch("services.subscription_sync.db", new_callable=AsyncMock)
+class StoredSubscriptionUrlTests(unittest.IsolatedAsyncioTestCase):
+    async def test_stored_url_is_served_without_remnawave(self, db):
+        fetch = AsyncMock()
+        with patch("services.subscription_sync.remnawave_get_subscription_url", new=fetch):
+            url = await subscription_sync.stored_subscription_url({
+                "id": 1,
+                "remnawave_uuid": "u1",
+                "subscription_url": "https://sub.example/sub/abc",
+            })
+
+        self.assertEqual(url, "https://sub.example/sub/abc")
+        fetch.assert_not_awaited()
+
+    async def test_missing_url_is_fetched_once_and_persisted(self, db):
+        fetch = AsyncMock(return_value="https://sub.example/sub/new")
+        with patch("services.subscription_sync.remnawave_get_subscription_url", new=fetch):
+            url = await subscription_sync.stored_subscription_url({"id": 2, "remnawave_uuid": "u2"})
+
+        self.assertEqual(url, "https://sub.example/sub/new")
+        db.set_subscription_url.assert_awaited_once_with(2, "https://sub.example/sub/new")
+
+
+class _MoscowSessionConnection:
+    """Соединение, чья сессия живёт по Europe/Moscow, а не по UTC."""
+
+    def __init__(self):
+        self.statements = []
+
+    async def fetchval(self, query, *args):
+        self.statements.append(query)
+        return False  # now() AT TIME ZONE 'UTC' = now()::timestamp
+
+    async def execute(self, query, *args):
+        self.statements.append(query)
+
+
+class UtcClockTests(unittest.IsolatedAsyncioTestCase):
+    async def test_synced_columns_are_written_on_utc_clock(self):
+        local_now = re.compile(r"(last_traffic_sync_at|changed_at) = now\(\)(?! AT TIME ZONE 'UTC')")
+        with patch.object(database, "db_execute", new=AsyncMock(return_value=[])) as execute:
+            await database.mark_traffic_limit_synced(1)
+            await database.add_traffic_to_subscription(1, 1024)
+            await database.upsert_remnawave_mirror_rows([{
+                "remnawave_uuid": "u1",
+                "username": "tg_1_bypass_1",
+                "status": "ACTIVE",
+                "expire_at": None,
+                "used_traffic_bytes": 0,
+                "traffic_limit_bytes": None,
+                "subscription_url": None,
+                "remote_updated_at": None,
+            }])
+
+        for call in execute.await_args_list:
+            query = call.args[0]
+            self.assertIsNone(local_now.search(query), query)
+            self.assertIn("now() AT TIME ZONE 'UTC'", query)
+
+    async def test_migration_converts_local_timestamps_before_trigger(self):
+        conn = _MoscowSessionConnection()
+
+        await database._migrate_subscription_updated_at_utc(conn)
+
+        statements = [" ".join(query.split()) for query in conn.statements]
+        trigger = next(i for i, query in enumerate(statements) if query.startswith("CREATE TRIGGER"))
+        converted = [
+            i for i, query in enumerate(statements)
+            if query.startswith("UPDATE") and "::timestamptz AT TIME ZONE 'UTC'" in query
+        ]
+        self.assertEqual(len(converted), 2)
+        self.assertTrue(all(i < trigger for i in converted))
+        self.assertTrue(any("last_traffic_sync_at = last_traffic_sync_at::" in statements[i] for i in converted))
+
+
+if __name__ == "__main__":
+    unittest.main()
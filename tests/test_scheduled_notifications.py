@@ -0,0 +1,81 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, patch
+
+import database
+from services import subscription_notifications
+
+
+def _item(notification_type, time_left, **overrides):
+    until = datetime.utcnow() + time_left
+    item = {
+        "id": 5,
+        "subscription_id": 42,
+        "tg_id": 1001,
+        "notification_type": notification_type,
+        "subscription_until": until,
+        "current_subscription_until": until,
+        "slot_number": 1,
+        "type_index": 1,
+        "plan_kind": "bypass",
+        "generation": "v2",
+        "is_visible": True,
+        "is_renewable": True,
+        "remnawave_uuid": "uuid",
+    }
+    item.update(overrides)
+    return item
+
+
+class SendMarkTests(unittest.TestCase):
+    def test_next_mark_is_19_msk_in_utc(self):
+        self.assertEqual(subscription_notifications._next_send_mark(datetime(2026, 3, 1, 10, 0)), datetime(2026, 3, 1, 16, 0))
+        self.assertEqual(subscription_notifications._next_send_mark(datetime(2026, 3, 1, 16, 0)), datetime(2026, 3, 2, 16, 0))
+
+
+@patch("services.subscription_notifications.db")
+class ScheduledNotificationTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = patch.object(subscription_notifications, "_send_message", new_callable=AsyncMock, return_value=True)
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def prepare(self, db):
+        db.EXPIRY_NOTIFICATION_HOUR = database.EXPIRY_NOTIFICATION_HOUR
+        db.can_send_notification = AsyncMock(return_value=True)
+        db.get_visible_subscriptions = AsyncMock(return_value=[])
+        db.mark_notification_state_sent = AsyncMock()
+        db.finish_scheduled_notification = AsyncMock()
+
+    async def test_due_stage_is_sent_and_removed(self, db):
+        self.prepare(db)
+        item = _item("expires_3d", timedelta(days=2))
+
+        await subscription_notifications._process_scheduled_notification(AsyncMock(), item)
+
+        self.send.assert_awaited_once()
+        db.mark_notification_state_sent.assert_awaited_once_with(1001, "expires_3d", 42)
+        db.finish_scheduled_notification.assert_awaited_once_with(5, item["subscription_until"], None)
+
+    async def test_superseded_stage_is_dropped_without_sending(self, db):
+        self.prepare(db)
+        item = _item("expires_7d", timedelta(hours=20))
+
+        await subscription_notifications._process_scheduled_notification(AsyncMock(), item)
+
+        self.send.assert_not_awaited()
+        db.finish_scheduled_notification.assert_awaited_once_with(5, item["subscription_until"], None)
+
+    async def test_failed_send_is_retried_at_next_mark(self, db):
+        self.prepare(db)
+        self.send.return_value = False
+        item = _item("expires_7d", timedelta(days=6))
+
+        await subscription_notifications._process_scheduled_notification(AsyncMock(), item)
+
+        retry_at = db.finish_scheduled_notification.await_args.args[2]
+        self.assertEqual(retry_at, subscription_notifications._next_send_mark(datetime.utcnow()))
+
+
+if __name__ == "__main__":
+    unittest.main()
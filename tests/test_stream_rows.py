@@ -0,0 +1,59 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import database as db
+from services import batch_executor
+
+
+class _KeysetConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    async def fetch(self, query, *params):
+        self.queries.append((query, params))
+        after = params[-2] if "WHERE (id) >" in query else 0
+        return [row for row in self.rows if row["id"] > after][:params[-1]]
+
+
+class _Pool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def acquire(self, timeout=None):
+        return self.conn
+
+    async def release(self, conn):
+        pass
+
+
+class StreamRowsTests(unittest.IsolatedAsyncioTestCase):
+    async def test_reads_by_key_in_bounded_batches(self):
+        conn = _KeysetConnection([{"id": item} for item in range(1, 8)])
+
+        with patch.dict(db._pools, {"interactive": _Pool(conn)}):
+            batches = [
+                [row["id"] for row in batch]
+                async for batch in db.iter_row_batches("SELECT id FROM things WHERE kind = $1", ("a",), batch_size=3)
+            ]
+
+        self.assertEqual(batches, [[1, 2, 3], [4, 5, 6], [7]])
+        self.assertEqual(conn.queries[0][1], ("a", 3))
+        self.assertEqual(conn.queries[1][1], ("a", 3, 3))
+        self.assertIn("WHERE (id) > ($2) ORDER BY id LIMIT $3", conn.queries[1][0])
+
+    @patch("services.batch_executor.db", new_callable=AsyncMock)
+    async def test_executor_consumes_streamed_batches(self, executor_db):
+        executor_db.get_active_device_addon_counts.return_value = {}
+
+        async def batches():
+            yield [{"id": 1}, {"id": 2}]
+            yield [{"id": 3}]
+
+        stats = await batch_executor.run_subscription_batches("stream", batches(), AsyncMock(return_value=True))
+
+        self.assertEqual((stats["batches"], stats["total"], stats["succeeded"]), (2, 3, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from services import telegram_sender
+
+
+class TelegramSenderTests(unittest.IsolatedAsyncioTestCase):
+    def scheduler(self, rate=1000.0, burst=1, chat_interval=0.0):
+        scheduler = telegram_sender._SendScheduler(rate, burst, chat_interval)
+        patcher = patch.object(telegram_sender, "_scheduler", scheduler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return scheduler
+
+    async def test_payment_lane_overtakes_queued_bulk_messages(self):
+        self.scheduler(rate=50.0)
+        order = []
+
+        async def send(chat_id, priority):
+            await telegram_sender.send_telegram(AsyncMock(side_effect=lambda: order.append(chat_id)), chat_id, priority)
+
+        bulk = [asyncio.create_task(send(chat_id, telegram_sender.PRIORITY_BULK)) for chat_id in range(1, 6)]
+        await asyncio.sleep(0)
+        payment = asyncio.create_task(send(100, telegram_sender.PRIORITY_PAYMENT))
+        await asyncio.gather(*bulk, payment)
+
+        self.assertLess(order.index(100), 3)
+
+    async def test_same_chat_is_paced(self):
+        self.scheduler(burst=10, chat_interval=0.05)
+        call = AsyncMock()
+
+        started = time.monotonic()
+        await asyncio.gather(*(telegram_sender.send_telegram(call, 7) for _ in range(3)))
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+        self.assertEqual(call.await_count, 3)
+
+    async def test_retry_after_pauses_sending_and_retries(self):
+        scheduler = self.scheduler(burst=10)
+        flood = TelegramRetryAfter(method=SendMessage(chat_id=1, text="x"), message="Too Many Requests", retry_after=0)
+        call = AsyncMock(side_effect=[flood, "ok"])
+
+        self.assertEqual(await telegram_sender.send_telegram(call, 1), "ok")
+        stats = scheduler.snapshot()
+        self.assertEqual(stats["retry_after_hits"], 1)
+        self.assertEqual(stats["sent_total"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
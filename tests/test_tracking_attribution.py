@@ -29,22 +29,27 @@ class PaymentTrackingAttributionTests(unittest.IsolatedAsyncioTestCase):
 
 class TrackingStatsTests(unittest.IsolatedAsyncioTestCase):
     @patch("database.db_execute", new_callable=AsyncMock)
-    @patch("database.get_tracking_link", new_callable=AsyncMock)
-    async def test_subscription_kpis_are_separate_from_all_payments(self, get_link, execute):
-        get_link.return_value = {"code": "tt_d04", "is_active": True}
-        execute.side_effect = [
-            {"total_clicks": 12, "unique_clicks": 10, "new_clicks": 8},
-            {"count": 8},
-            {
-                "paid_payments": 5,
-                "paid_subscriptions": 3,
-                "new_subscriptions": 2,
-                "unique_payers": 2,
-                "revenue": 1124,
-                "subscription_revenue": 1000,
-            },
-            [{"tariff_code": "regular_1m", "payment_kind": "subscription"}],
-        ]
+    async def test_subscription_kpis_are_separate_from_all_payments(self, execute):
+        execute.return_value = {
+            "id": 4,
+            "code": "tt_d04",
+            "title": None,
+            "is_active": True,
+            "created_by": 1,
+            "created_at": None,
+            "updated_at": None,
+            "total_clicks": 12,
+            "unique_clicks": 10,
+            "new_clicks": 8,
+            "attributed_users": 8,
+            "paid_payments": 5,
+            "paid_subscriptions": 3,
+            "new_subscriptions": 2,
+            "unique_payers": 2,
+            "revenue": 1124,
+            "subscription_revenue": 1000,
+            "payments_by_tariff": '[{"tariff_code": "regular_1m", "payment_kind": "subscription"}]',
+        }
 
         stats = await database.get_tracking_link_stats("TT_D04")
 
@@ -53,7 +58,82 @@ class TrackingStatsTests(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(stats["new_subscriptions"], 2)
         self.assertEqual(stats["unique_payers"], 2)
         self.assertEqual(stats["subscription_revenue"], 1000.0)
-        get_link.assert_awaited_once_with("tt_d04")
+        self.assertEqual(stats["payments_by_tariff"][0]["tariff_code"], "regular_1m")
+        self.assertTrue(stats["link"]["is_active"])
+        execute.assert_awaited_once()
+        query, params = execute.await_args.args[:2]
+        self.assertIn("tracking_link_daily", query)
+        self.assertEqual(params, ("tt_d04",))
+
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_unknown_link_returns_none(self, execute):
+        execute.return_value = None
+
+        self.assertIsNone(await database.get_tracking_link_stats("nope"))
+
+
+class TrackingRollupTests(unittest.IsolatedAsyncioTestCase):
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_refund_of_last_payment_removes_unique_payer(self, execute):
+        payment = {
+            "tracking_code": "tt_d04",
+            "tg_id": 1001,
+            "tariff_code": "regular_1m",
+            "payment_kind": "subscription",
+            "payment_target": "new",
+            "amount": 100,
+            "tracking_day": None,
+        }
+        first_day = object()
+        execute.side_effect = [None, {"first_day": first_day, "active_payments": 0}, None]
+
+        await database._apply_tracking_payment(payment, -1)
+
+        counters = dict(zip(database._TRACKING_ROLLUP_COUNTERS, execute.await_args_list[0].args[1][4:]))
+        self.assertEqual(counters["purchases"], -1)
+        self.assertEqual(counters["new_purchases"], -1)
+        self.assertEqual(counters["paid_payments"], 0)
+        self.assertEqual(counters["revenue"], -100)
+        code, day = execute.await_args_list[2].args[1][:2]
+        self.assertEqual((code, day), ("tt_d04", first_day))
+        self.assertEqual(execute.await_args_list[2].args[1][4 + database._TRACKING_ROLLUP_COUNTERS.index("unique_payers")], -1)
+
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_repeat_payment_does_not_add_unique_payer(self, execute):
+        payment = {
+            "tracking_code": "tt_d04",
+            "tg_id": 1001,
+            "tariff_code": "regular_1m",
+            "payment_kind": "subscription",
+            "payment_target": "renew",
+            "amount": 100,
+            "refund_requested_at": None,
+            "tracking_day": None,
+        }
+        execute.side_effect = [None, {"first_day": None, "active_payments": 2}]
+
+        await database._apply_tracking_payment(payment, 1, status_change=True)
+
+        self.assertEqual(execute.await_count, 2)
+
+    @patch("database.db_execute", new_callable=AsyncMock)
+    async def test_unpaid_refunded_payment_only_drops_paid_count(self, execute):
+        payment = {
+            "tracking_code": "tt_d04",
+            "tg_id": 1001,
+            "tariff_code": "regular_1m",
+            "payment_kind": "subscription",
+            "payment_target": "new",
+            "amount": 100,
+            "refund_requested_at": object(),
+            "tracking_day": None,
+        }
+
+        await database._apply_tracking_payment(payment, -1, status_change=True)
+
+        execute.assert_awaited_once()
+        counters = dict(zip(database._TRACKING_ROLLUP_COUNTERS, execute.await_args.args[1][4:]))
+        self.assertEqual((counters["paid_payments"], counters["purchases"], counters["revenue"]), (-1, 0, 0))
 
 
 if __name__ == "__main__":
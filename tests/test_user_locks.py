@@ -0,0 +1,75 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import database as db
+
+
+class LocalUserLockTests(unittest.IsolatedAsyncioTestCase):
+    async def test_busy_lock_is_refused_and_released_lock_is_forgotten(self):
+        locks = db._LocalUserLocks()
+
+        self.assertTrue(await locks.try_acquire(1))
+        self.assertFalse(await locks.try_acquire(1))
+        await locks.release(1)
+
+        self.assertEqual(locks.held, set())
+        self.assertTrue(await locks.try_acquire(1))
+        self.assertEqual(locks.stats()["busy"], 1)
+
+
+class PostgresUserLockTests(unittest.IsolatedAsyncioTestCase):
+    async def test_lock_held_by_another_process_is_refused(self):
+        conn = AsyncMock()
+        conn.is_closed = lambda: False
+        conn.fetchval.side_effect = [False, True, True]
+        locks = db._PostgresUserLocks()
+
+        with patch("database.asyncpg.connect", new=AsyncMock(return_value=conn)):
+            self.assertFalse(await locks.try_acquire(8_000_000_001))
+            self.assertEqual(locks.held, set())
+            self.assertTrue(await locks.try_acquire(8_000_000_001))
+            await locks.release(8_000_000_001)
+
+        key = db._user_lock_key(8_000_000_001)
+        self.assertTrue(-2**31 <= key < 2**31)
+        conn.fetchval.assert_awaited_with("SELECT pg_advisory_unlock($1, $2)", db.USER_LOCK_NAMESPACE, key)
+        self.assertEqual(locks.held, set())
+
+    async def test_users_on_other_connections_do_not_wait(self):
+        conns = [AsyncMock(), AsyncMock()]
+        for conn in conns:
+            conn.is_closed = lambda: False
+            conn.fetchval.return_value = True
+        locks = db._PostgresUserLocks(connections=2)
+        first, second = 2, 3
+        self.assertNotEqual(locks._stripe(first), locks._stripe(second))
+
+        with patch("database.asyncpg.connect", new=AsyncMock(side_effect=conns)):
+            async with locks.conn_locks[locks._stripe(first)]:
+                self.assertTrue(await asyncio.wait_for(locks.try_acquire(second), 1))
+            self.assertTrue(await locks.try_acquire(first))
+
+        self.assertEqual(conns[0].fetchval.await_count, 1)
+        self.assertEqual(conns[1].fetchval.await_count, 1)
+
+    async def test_dropped_connection_relocks_held_users(self):
+        dropped, fresh = AsyncMock(), AsyncMock()
+        dropped.is_closed = lambda: False
+        dropped.fetchval.return_value = True
+        fresh.is_closed = lambda: False
+        fresh.fetchval.return_value = True
+        locks = db._PostgresUserLocks(connections=1)
+
+        with patch("database.asyncpg.connect", new=AsyncMock(side_effect=[dropped, fresh])):
+            self.assertTrue(await locks.try_acquire(1))
+            dropped.is_closed = lambda: True
+            self.assertTrue(await locks.try_acquire(2))
+
+        relocked = [call.args[2] for call in fresh.fetchval.await_args_list]
+        self.assertEqual(relocked, [db._user_lock_key(1), db._user_lock_key(2)])
+        self.assertEqual(locks.stats()["reconnects"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,6 +9,10 @@ logger = logging.getLogger(__name__)
 T = TypeVar('T')
 
 
+class NonRetryableError(Exception):
+    """Ошибка, после которой повтор бессмысленен (например, открыт circuit breaker)."""
+
+
 async def retry_with_backoff(
     func: Callable[..., Any],
     *args,
@@ -49,7 +53,10 @@ async def retry_with_backoff(
                 logger.info(f"[{func_name}] ✅ Успешно с {attempt}-й попытки")
             
             return result
-            
+
+        except NonRetryableError:
+            raise
+
         except asyncio.TimeoutError as e:
             last_exception = e
             logger.warning(f"[{func_name}] ⏱️ Timeout на попытке {attempt}/{max_attempts}")
@@ -4,7 +4,7 @@ import html
 import json
 from pathlib import Path
 from urllib.parse import quote
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import Depends, FastAPI, Request, HTTPException
 from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from datetime import datetime, timezone
@@ -29,10 +29,11 @@ from services.payment_processing import process_paid_payment
 from services.device_addons import available_device_addon_packages, current_device_limit, device_count_text, effective_device_limit
 from services.payment_summary import build_payment_success_summary
 from services.remnawave import (
+    close_remnawave_session,
+    get_remnawave_session,
     remnawave_delete_all_hwid_devices,
     remnawave_delete_hwid_device,
     remnawave_get_hwid_devices,
-    remnawave_get_subscription_url,
     remnawave_get_user_info,
 )
 from services.subscription_deletion import (
@@ -42,7 +43,8 @@ from services.subscription_deletion import (
     delete_subscription_everywhere,
 )
 from services.yookassa import create_yookassa_payment, get_payment_status
-from services.subscription_sync import reconcile_subscription_expiry
+from services.subscription_sync import reconcile_subscription_expiry, stored_subscription_url
+from services.db_scope import database_scope
 from services.discounts import calculate_discounted_price
 from services.telegram_auth import TelegramAuthError, validate_telegram_init_data
 from admin_web import router as admin_router
@@ -52,7 +54,7 @@ from mobile_api import public_router as mobile_public_router, router as mobile_r
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="SPN VPN Bot Webhooks")
+app = FastAPI(title="SPN VPN Bot Webhooks", dependencies=[Depends(database_scope)])
 STATIC_DIR = Path(__file__).parent / "static" / "miniapp"
 ADMIN_STATIC_DIR = Path(__file__).parent / "static" / "admin"
 SITE_STATIC_DIR = Path(__file__).parent / "static" / "site"
@@ -181,7 +183,7 @@ async def _serialize_subscription(subscription) -> dict:
     effective_until = subscription.get("subscription_until")
     if subscription.get("remnawave_uuid"):
         try:
-            sub_url = await remnawave_get_subscription_url(None, subscription["remnawave_uuid"])
+            sub_url = await stored_subscription_url(subscription)
         except Exception as e:
             logger.warning("MiniApp failed to fetch subscription URL for %s: %s", subscription.get("id"), e)
         try:
@@ -853,6 +855,7 @@ async def startup_event():
     logger.info("  - GET /health")
     logger.info(f"🤖 Bot instance available: {'✅ Yes' if _bot else '❌ No (will be set after connection)'}")
     logger.info("=" * 60)
+    get_remnawave_session()
 
 
 @app.on_event("shutdown")
@@ -861,6 +864,7 @@ async def shutdown_event():
     logger.info("=" * 60)
     logger.info("🛑 Webhook Server Shutting Down")
     logger.info("=" * 60)
+    await close_remnawave_session()
 
 
 async def run_webhook_server():